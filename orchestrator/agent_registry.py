@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+設定ファイル（agents.json）駆動のエージェントレジストリと、
+埋め込みベースのローカルルーティング索引。
+
+- エージェントの追加/変更は agents.json の編集だけで完結（コード・HTML の変更不要）
+- ファイルの更新時刻を監視し、変更があれば自動で再読み込み（ホットリロード）
+- 各エージェントの routing / keywords / description から文字 n-gram の
+  ハッシュ埋め込みを作り、エージェントごとの重心ベクトル行列を事前計算。
+  ルーティングは「質問ベクトル × 重心行列」の 1 回の行列積（NumPy）で済み、
+  エージェント数が 3 → 数百に増えても LLM 分類器のプロンプトは上位 k 件分のまま
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agents.json")
+
+EMBED_DIM = 4096
+
+_ASCII_WORD_RE = re.compile(r"[a-z][a-z0-9+#]*")
+_CJK_RUN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uff66-\uff9f]+")
+
+
+def text_features(text: str) -> List[str]:
+    """ASCII words plus character bigrams of Japanese runs (no tokenizer needed)."""
+    text = text.lower()
+    feats = _ASCII_WORD_RE.findall(text)
+    for run in _CJK_RUN_RE.findall(text):
+        if len(run) == 1:
+            feats.append(run)
+        else:
+            feats.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return feats
+
+
+def hash_features(feats: List[str], dim: int = EMBED_DIM) -> np.ndarray:
+    """Term counts hashed into a fixed-size vector (crc32 is stable across processes)."""
+    if not feats:
+        return np.zeros(dim, dtype=np.float32)
+    idx = np.fromiter((zlib.crc32(f.encode("utf-8")) % dim for f in feats), dtype=np.int64, count=len(feats))
+    return np.bincount(idx, minlength=dim).astype(np.float32)
+
+
+class AgentSpec:
+    def __init__(self, data: Dict[str, Any]):
+        self.key: str = data["key"]
+        self.title: str = data.get("title") or self.key.title()
+        self.name: str = data.get("name") or self.title
+        self.description: str = data.get("description", "")
+        self.color: str = data.get("color", "var(--primary)")
+        self.routing: List[str] = list(data.get("routing") or [])
+        self.keywords: List[str] = [k.lower() for k in data.get("keywords") or []]
+        system = data.get("system") or ""
+        self.system: str = "\n".join(system) if isinstance(system, list) else system
+        self.extra: Dict[str, Any] = {k: v for k, v in data.items() if k not in (
+            "key", "title", "name", "description", "color", "routing", "keywords", "system")}
+
+    def routing_summary(self) -> str:
+        return "、".join(self.routing) or self.description
+
+    def to_public_dict(self) -> Dict[str, Any]:
+        return {
+            "key": self.key,
+            "title": self.title,
+            "name": self.name,
+            "description": self.description,
+            "color": self.color,
+        }
+
+
+class AgentIndex:
+    """Centroid index over agent descriptions for embedding-based routing."""
+
+    def __init__(self, agents: List[AgentSpec], dim: int = EMBED_DIM):
+        self.dim = dim
+        self.keys = [a.key for a in agents]
+        docs = []  # (agent row, counts)
+        for row, agent in enumerate(agents):
+            texts = agent.routing + agent.keywords + [agent.description, agent.title]
+            for text in texts:
+                if text:
+                    docs.append((row, hash_features(text_features(text), dim)))
+
+        # IDF over agents (not lines): terms every agent shares carry no routing signal
+        n = max(1, len(agents))
+        per_agent = np.zeros((n, dim), dtype=np.float32)
+        for row, counts in docs:
+            per_agent[row] += counts
+        df = (per_agent > 0).sum(axis=0)
+        self.idf = (np.log((1.0 + n) / (1.0 + df)) + 1.0).astype(np.float32)
+
+        centroids = np.zeros((n, dim), dtype=np.float32)
+        for row, counts in docs:
+            centroids[row] += self._normalize(np.log1p(counts) * self.idf)
+        self.centroids = np.vstack([self._normalize(c) for c in centroids]) if agents else centroids
+
+    @staticmethod
+    def _normalize(vec: np.ndarray) -> np.ndarray:
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm > 0 else vec
+
+    def embed(self, text: str) -> np.ndarray:
+        return self._normalize(np.log1p(hash_features(text_features(text), self.dim)) * self.idf)
+
+    def scores(self, text: str) -> np.ndarray:
+        """Cosine similarity of text against every agent centroid (one mat-vec)."""
+        if not self.keys:
+            return np.zeros(0, dtype=np.float32)
+        return self.centroids @ self.embed(text)
+
+    def rank(self, text: str, k: Optional[int] = None) -> List[Tuple[str, float]]:
+        scores = self.scores(text)
+        k = len(self.keys) if k is None else min(k, len(self.keys))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.keys[i], float(scores[i])) for i in top]
+
+
+class AgentRegistry:
+    def __init__(self, path: Optional[str] = None, reload_interval: Optional[float] = None):
+        self.path = path or os.environ.get("AGENT_REGISTRY_PATH", DEFAULT_REGISTRY_PATH)
+        if reload_interval is None:
+            reload_interval = float(os.environ.get("AGENT_REGISTRY_RELOAD_INTERVAL", "2"))
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self.version = ""
+        self._agents: List[AgentSpec] = []
+        self._by_key: Dict[str, AgentSpec] = {}
+        self.general_system = ""
+        self.index = AgentIndex([])
+        self._load()
+
+    def _load(self) -> None:
+        with open(self.path, "rb") as f:
+            raw = f.read()
+        data = json.loads(raw.decode("utf-8"))
+        agents = [AgentSpec(a) for a in data.get("agents", [])]
+        keys = [a.key for a in agents]
+        if len(set(keys)) != len(keys) or "none" in keys:
+            raise ValueError("agent keys must be unique and must not be 'none'")
+        general = (data.get("general") or {}).get("system") or ""
+
+        self._agents = agents
+        self._by_key = {a.key: a for a in agents}
+        self.general_system = "\n".join(general) if isinstance(general, list) else general
+        self.index = AgentIndex(agents)
+        self.version = hashlib.sha256(raw).hexdigest()[:12]
+        self._mtime = os.path.getmtime(self.path)
+
+    def maybe_reload(self) -> bool:
+        """Reload when agents.json changed (checked at most every reload_interval seconds)."""
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return False
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                return False
+            if mtime == self._mtime:
+                return False
+            try:
+                self._load()
+            except Exception as e:
+                # 壊れた設定では置き換えない（直前の正常な設定で動き続ける）
+                self._mtime = mtime
+                print(f"Agent registry reload failed, keeping previous version: {e}")
+                return False
+        print(f"Agent registry reloaded: {self.keys} (version {self.version})")
+        return True
+
+    @property
+    def agents(self) -> List[AgentSpec]:
+        self.maybe_reload()
+        return self._agents
+
+    @property
+    def keys(self) -> List[str]:
+        return [a.key for a in self._agents]
+
+    def get(self, key: str) -> Optional[AgentSpec]:
+        self.maybe_reload()
+        return self._by_key.get(key)
+
+    def system_for(self, key: str) -> str:
+        agent = self.get(key)
+        return agent.system if agent is not None else self.general_system
+
+
+_registry: Optional[AgentRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> AgentRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = AgentRegistry()
+        return _registry
@@ -2,61 +2,241 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import time
+import hashlib
+import uuid
+import queue
+import sqlite3
 import asyncio
-from flask import Flask, render_template, request, jsonify
+import concurrent.futures
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 from dotenv import load_dotenv
 
-# Try to import autogen_router, fall back to mock implementation if not available
-try:
-    from autogen_router import Orchestrator
-    # Test if we can actually create an orchestrator (API keys available)
-    test_orch = Orchestrator()
-    AUTOGEN_AVAILABLE = True
-except Exception as e:
-    print(f"Warning: autogen_router not fully available ({e}). Using mock implementation for development.")
-    AUTOGEN_AVAILABLE = False
-    
-    class MockOrchestrator:
-        async def ask_async(self, prompt):
-            # Simple mock logic to test different agent selections
-            prompt_lower = prompt.lower()
-            if any(keyword in prompt_lower for keyword in ["code", "program", "flask", "websocket", "実装", "設計", "デプロイ", "コード", "プログラム", "開発"]):
-                return {
-                    "selected": "coder",
-                    "response": f"Mock coder response for development: '{prompt}'. This would normally be handled by the Coder agent."
-                }
-            elif any(keyword in prompt_lower for keyword in ["data", "analysis", "research", "統計", "分析", "データ"]):
-                return {
-                    "selected": "analyst", 
-                    "response": f"Mock analyst response for development: '{prompt}'. This would normally be handled by the Analyst agent."
-                }
-            elif any(keyword in prompt_lower for keyword in ["travel", "trip", "vacation", "旅行", "観光", "プラン"]):
-                return {
-                    "selected": "travel",
-                    "response": f"Mock travel response for development: '{prompt}'. This would normally be handled by the Travel agent."
-                }
-            else:
-                return {
-                    "selected": "none",
-                    "response": f"Mock general response for development: '{prompt}'. AutoGen dependencies need to be installed for full functionality."
-                }
+from startup import LazyObject, autogen_installed, credentials_configured
 
 load_dotenv()
 
+# AutoGen が入っていて上流（API キー等）が設定されていれば本物の Orchestrator を使う。
+# 判定は import もクライアント生成もせずに行い、重いモジュールは最初のリクエストまで読み込まない
+AUTOGEN_AVAILABLE = autogen_installed() and credentials_configured()
+if not AUTOGEN_AVAILABLE:
+    print("Warning: AutoGen or GEMINI_API_KEY not available. Using mock implementation for development.")
+
+class MockOrchestrator:
+    KEYWORDS = {
+        "coder": ["code", "program", "flask", "websocket", "実装", "設計", "デプロイ", "コード", "プログラム", "開発"],
+        "analyst": ["data", "analysis", "research", "統計", "分析", "データ"],
+        "travel": ["travel", "trip", "vacation", "旅行", "観光", "プラン"],
+    }
+
+    async def ask_async(self, prompt, run_id=None):
+        # Simple mock logic to test different agent selections
+        prompt_lower = prompt.lower()
+        if any(keyword in prompt_lower for keyword in self.KEYWORDS["coder"]):
+            return {
+                "selected": "coder",
+                "response": f"Mock coder response for development: '{prompt}'. This would normally be handled by the Coder agent."
+            }
+        elif any(keyword in prompt_lower for keyword in self.KEYWORDS["analyst"]):
+            return {
+                "selected": "analyst", 
+                "response": f"Mock analyst response for development: '{prompt}'. This would normally be handled by the Analyst agent."
+            }
+        elif any(keyword in prompt_lower for keyword in self.KEYWORDS["travel"]):
+            return {
+                "selected": "travel",
+                "response": f"Mock travel response for development: '{prompt}'. This would normally be handled by the Travel agent."
+            }
+        else:
+            return {
+                "selected": "none",
+                "response": f"Mock general response for development: '{prompt}'. AutoGen dependencies need to be installed for full functionality."
+            }
+
+    async def ask_multi_async(self, prompt, synthesize=False, on_event=None):
+        # Every agent whose keywords match answers (mock of multi-label fan-out)
+        emit = on_event or (lambda event: None)
+        prompt_lower = prompt.lower()
+        agents = [a for a, kws in self.KEYWORDS.items() if any(kw in prompt_lower for kw in kws)]
+        emit({"type": "selected", "agents": agents})
+        responses = {}
+        for agent in agents or ["none"]:
+            responses[agent] = f"Mock {agent} response for development: '{prompt}'."
+            emit({"type": "partial", "agent": agent, "delta": responses[agent]})
+            emit({"type": "answer", "agent": agent, "response": responses[agent]})
+        merged = "\n\n".join(responses.values())
+        if synthesize and len(responses) > 1:
+            emit({"type": "synthesis", "response": merged})
+        return {
+            "selected": agents[0] if agents else "none",
+            "selected_agents": agents,
+            "responses": responses,
+            "response": merged,
+        }
+
+from background import get_background_loop
+from cancellation import approx_tokens, get_cancellations
+from checkpoint import validate_run_id
+from circuit_breaker import get_breaker
+from rate_limit import client_identity, get_rate_limiter
+from usage import attributed, get_usage_ledger
+from profiling import admin_authorized, get_profiler
+from readiness import get_readiness, warmup_enabled
+from assets import init_assets
+from router_input import get_routing_input_stats
+from shadow import get_shadow
+from idempotency import IdempotencyConflict, IdempotencyMismatch, fingerprint, get_idempotency, scope_key
+from scheduling import BACKGROUND, SCHED_DEFAULT_CLASS, classified, get_scheduler, normalize_class
+
 app = Flask(__name__)
 
-app.config["TEMPLATES_AUTO_RELOAD"] = True
-app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 0
+# 開発時はテンプレート自動リロード・キャッシュなし、本番はハッシュ付き・圧縮済みの静的ファイル（assets.py）
+assets = init_assets(app)
+
+def build_orchestrator():
+    """Create the orchestrator on first use (the client is then reused by every request)."""
+    global AUTOGEN_AVAILABLE
+    if AUTOGEN_AVAILABLE:
+        try:
+            from autogen_router import Orchestrator
+            return Orchestrator()
+        except Exception as e:
+            print(f"Warning: autogen_router not fully available ({e}). Using mock implementation for development.")
+            AUTOGEN_AVAILABLE = False
+    return MockOrchestrator()
 
-# プロセス起動時に Orchestrator を初期化（クライアントは使い回す）
-if AUTOGEN_AVAILABLE:
-    orchestrator = Orchestrator()
-else:
-    orchestrator = MockOrchestrator()
+orchestrator = LazyObject(build_orchestrator)
+
+# サンプリング対象のリクエストだけ、処理中のスタックを採取（PROFILE_SAMPLE_RATE / /admin/profile）
+@app.before_request
+def start_profile():
+    if request.endpoint not in (None, "static") and not request.path.startswith("/admin/"):
+        get_profiler().begin(request.endpoint)
+
+@app.teardown_request
+def stop_profile(exc):
+    get_profiler().end()
 
 @app.get("/")
 def index():
-    return render_template("index.html")
+    from agent_registry import get_registry
+    return render_template("index.html", agents=get_registry().agents)
+
+@app.get("/api/agents")
+def api_agents():
+    """エージェント一覧（agents.json のホットリロード結果をそのまま返す）"""
+    from agent_registry import get_registry
+    registry = get_registry()
+    return jsonify({
+        "version": registry.version,
+        "agents": [a.to_public_dict() for a in registry.agents],
+    })
+
+def answer_version():
+    """
+    Validator for answers cached in the browser (static/app.js): it changes when the agent
+    definitions (agents.json), the model or ANSWER_CACHE_EPOCH change.
+    """
+    from agent_registry import get_registry
+    parts = (
+        get_registry().version,
+        os.environ.get("GEMINI_MODEL", "gemini-2.5-flash"),
+        os.environ.get("ANSWER_CACHE_EPOCH", ""),
+    )
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()[:12]
+
+@app.get("/api/answers/version")
+def api_answer_version():
+    """ブラウザの回答キャッシュの検証子（ETag 付き、変わっていなければ 304）"""
+    version = answer_version()
+    resp = jsonify({"version": version})
+    resp.set_etag(version)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+CANCELLED_ERRORS = (concurrent.futures.CancelledError, asyncio.CancelledError)
+
+def get_request_id(data):
+    """Client-supplied request id (body or X-Request-ID) used for cancellation."""
+    request_id = (data.get("request_id") or request.headers.get("X-Request-ID") or "").strip()
+    return request_id[:128] or uuid.uuid4().hex
+
+def check_rate_limit(prompt, fanout=1):
+    """
+    Charge the caller's request/token buckets before any upstream work.
+    returns: (client_id, estimated_tokens, 429 response or None)
+    """
+    client_id = client_identity(request)
+    estimate = approx_tokens(prompt) + get_cancellations().stats()["avg_answer_tokens"] * fanout
+    try:
+        decision = get_rate_limiter().acquire(client_id, estimate)
+    except sqlite3.Error as e:
+        # 制限ストアの障害でサービス自体を止めない（fail open）
+        print(f"Rate limiter unavailable, allowing request: {e}")
+        return client_id, estimate, None
+    if decision.allowed:
+        return client_id, estimate, None
+    resp = jsonify({
+        "error": "rate limit exceeded",
+        "reason": decision.reason,
+        "retry_after": round(decision.retry_after, 1),
+    })
+    resp.status_code = 429
+    resp.headers.update(decision.headers())
+    return client_id, estimate, resp
+
+def settle_rate_limit(client_id, estimate, prompt, responses, usage=None):
+    """Replace the up-front estimate with the tokens actually used."""
+    if usage and usage.get("total_tokens"):
+        actual = usage["total_tokens"]
+    else:
+        actual = approx_tokens(prompt) + sum(approx_tokens(r) for r in responses)
+    try:
+        get_rate_limiter().settle(client_id, actual - estimate)
+    except sqlite3.Error as e:
+        print(f"Rate limiter settle failed: {e}")
+
+def request_class_for(req, default=SCHED_DEFAULT_CLASS):
+    """Scheduling class from the X-Request-Class header (scheduling.py); ValueError when unknown."""
+    return normalize_class(req.headers.get("X-Request-Class")) or default
+
+class Rejected(Exception):
+    """Ends an idempotent execution early with a ready response (e.g. 429); nothing is stored."""
+
+    def __init__(self, response):
+        super().__init__(response.status_code)
+        self.response = response
+
+def idempotent(data, execute):
+    """
+    Run execute() -> (status, body) at most once per Idempotency-Key header (idempotency.py).
+    Retries attach to the running execution or get the stored result back.
+    """
+    key = (request.headers.get("Idempotency-Key") or "").strip()
+    replayed = False
+    try:
+        if not key:
+            status, body = execute()
+        elif len(key) > 255:
+            status, body = 400, {"error": "Idempotency-Key must be at most 255 characters"}
+        else:
+            scoped = scope_key(client_identity(request), request.endpoint, key)
+            status, body, replayed = get_idempotency().run(scoped, fingerprint(data), execute)
+    except Rejected as e:
+        return e.response
+    except IdempotencyMismatch as e:
+        status, body = 422, {"error": str(e)}
+    except IdempotencyConflict as e:
+        resp = jsonify({"error": str(e), "retry_after": e.retry_after})
+        resp.status_code = 409
+        resp.headers["Retry-After"] = str(int(e.retry_after))
+        return resp
+    resp = jsonify(body)
+    resp.status_code = status
+    if replayed:
+        resp.headers["Idempotent-Replayed"] = "true"
+    return resp
 
 @app.post("/api/ask")
 def api_ask():
@@ -64,29 +244,497 @@ def api_ask():
     prompt = (data.get("prompt") or "").strip()
     if not prompt:
         return jsonify({"error": "prompt is required"}), 400
+    request_id = get_request_id(data)
+    try:
+        # run_id: 失敗後のリトライで分類結果を再利用するためのチェックポイントID（任意）
+        run_id = validate_run_id(data.get("run_id"))
+        request_class = request_class_for(request)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def execute():
+        # 再送が結果を受け取るだけなら制限を消費しない
+        client_id, estimate, limited = check_rate_limit(prompt)
+        if limited is not None:
+            raise Rejected(limited)
+        # 常駐ループ上のタスクとして実行し、キャンセル要求で上流呼び出しごと中断できるようにする
+        future = get_cancellations().track(
+            request_id,
+            get_profiler().profiled(classified(
+                attributed(orchestrator.ask_async(prompt, run_id=run_id), client_id), request_class, client_id)),
+            get_background_loop(),
+            owner=client_id,
+        )
+        try:
+            result = future.result()
+            settle_rate_limit(client_id, estimate, prompt, [result.get("response", "")], result.get("usage"))
+            # result: {"selected": "<agent key>"/"none", "response": "...", "usage": {...}}
+            return 200, result
+        except CANCELLED_ERRORS:
+            return 499, {"error": "cancelled", "request_id": request_id}
+        except Exception as e:
+            return 500, {"error": str(e)}
+
+    resp = idempotent(data, execute)
+    if resp.status_code == 200 and not resp.get_json().get("degraded"):
+        # ブラウザはこの版の回答としてキャッシュする（版が変われば捨てる）。縮退応答はキャッシュさせない
+        resp.headers["X-Answer-Version"] = answer_version()
+    return resp
+
+@app.post("/api/requests/<request_id>/cancel")
+def api_cancel_request(request_id):
+    """
+    ブラウザの中断（AbortController / sendBeacon）から呼ばれるキャンセル要求。
+    取り消せるのは同じクライアント（client_identity）が送ったリクエストだけ。
+    """
+    reason = request.args.get("reason", "client")
+    cancelled = get_cancellations().cancel(request_id, reason=reason, owner=client_identity(request))
+    return jsonify({"request_id": request_id, "cancelled": cancelled})
 
+def sse_response(events):
+    """Wrap an iterator of event dicts as a Server-Sent Events response."""
+    def stream():
+        for event in events:
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            data = json.dumps(event, ensure_ascii=False)
+            yield f"event: {event['type']}\ndata: {data}\n\n"
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def subscription_events(broadcaster, sub, keepalive=15):
+    """Drain a broadcaster subscription; yields None on idle for keepalives."""
     try:
-        # 同期ルートから安全に実行
-        result = asyncio.run(orchestrator.ask_async(prompt))
-        # result: {"selected": "coder"/"analyst"/"travel"/"none", "response": "..."}
-        return jsonify(result)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        while True:
+            try:
+                event = sub.get(timeout=keepalive)
+            except queue.Empty:
+                yield None
+                continue
+            if event is None:
+                break
+            yield event
+    finally:
+        broadcaster.unsubscribe(sub)
+
+@app.post("/api/ask/multi")
+def api_ask_multi():
+    """
+    複数エージェントへの fan-out。選択された各エージェントが並行に回答し、
+    部分回答を SSE（partial / answer / synthesis / done）で逐次返す。
+    """
+    from broadcaster import Broadcaster
+
+    data = request.get_json(force=True, silent=True) or {}
+    prompt = (data.get("prompt") or "").strip()
+    if not prompt:
+        return jsonify({"error": "prompt is required"}), 400
+    synthesize = bool(data.get("synthesize"))
+    try:
+        request_class = request_class_for(request)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # 回答するエージェント数は分類後まで分からないため 2 件分で見積もり、完了後に精算
+    client_id, estimate, limited = check_rate_limit(prompt, fanout=2)
+    if limited is not None:
+        return limited
+
+    broadcaster = Broadcaster(queue_size=1000)
+    sub = broadcaster.subscribe()
+
+    async def run():
+        try:
+            result = await classified(attributed(orchestrator.ask_multi_async(
+                prompt, synthesize=synthesize, on_event=broadcaster.publish
+            ), client_id), request_class, client_id)
+            done = {"type": "done", **result}
+            if not result.get("degraded"):
+                # 結果が出るまで成否が分からないのでヘッダーではなく done イベントで渡す
+                # （エラー・中断・縮退した回答には付けない = ブラウザはキャッシュしない）
+                done["answer_version"] = answer_version()
+            broadcaster.publish(done)
+            settle_rate_limit(client_id, estimate, prompt, result["responses"].values(), result.get("usage"))
+        except Exception as e:
+            broadcaster.publish({"type": "error", "error": str(e)})
+        finally:
+            broadcaster.close()
+
+    request_id = get_request_id(data)
+    future = get_cancellations().track(request_id, get_profiler().profiled(run()), get_background_loop(),
+                                       kind="ask_multi", owner=client_id)
+
+    def events():
+        completed = False
+        try:
+            yield from subscription_events(broadcaster, sub)
+            completed = True
+        finally:
+            # クライアント切断でストリームが閉じられたら、全エージェントの上流呼び出しを中断
+            if not completed and not future.done():
+                get_cancellations().cancel(request_id, reason="disconnect", owner=client_id, kind="ask_multi")
+
+    return sse_response(events())
+
+# ---------------- 非同期ジョブ（投入 → ポーリング / 完了イベント / Webhook） ----------------
+_jobs = None
+
+async def run_ask_job(payload):
+    """Job runner: the same routing + answer flow as /api/ask (background class unless the caller chose one)."""
+    prompt = payload["prompt"]
+    client_id = payload.get("client_id") or "-"
+    result = await classified(
+        attributed(orchestrator.ask_async(prompt, run_id=payload.get("run_id")), client_id),
+        payload.get("request_class") or BACKGROUND,
+        payload.get("client_id"),
+    )
+    if payload.get("client_id"):
+        await asyncio.to_thread(
+            settle_rate_limit, client_id, payload["estimate"], prompt,
+            [result.get("response", "")], result.get("usage"),
+        )
+    return result
+
+def get_jobs():
+    """JobQueue は初回利用時に生成し、常駐ループ上でワーカーを起動"""
+    global _jobs
+    if _jobs is None:
+        from jobs import JobQueue, JobStore
+        _jobs = JobQueue(JobStore(), run_ask_job)
+    return _jobs
+
+@app.post("/api/jobs")
+def api_submit_job():
+    """ジョブを積んで即座に 202 を返す（回答生成中も Web スレッドを占有しない）"""
+    data = request.get_json(force=True, silent=True) or {}
+    prompt = (data.get("prompt") or "").strip()
+    if not prompt:
+        return jsonify({"error": "prompt is required"}), 400
+    try:
+        priority = int(data.get("priority") or 0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "priority must be an integer"}), 400
+    try:
+        run_id = validate_run_id(data.get("run_id"))
+        request_class = request_class_for(request, default=BACKGROUND)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def execute():
+        client_id, estimate, limited = check_rate_limit(prompt)
+        if limited is not None:
+            raise Rejected(limited)
+        payload = {
+            "prompt": prompt,
+            "run_id": run_id,
+            "client_id": client_id,
+            "estimate": estimate,
+            "request_class": request_class,
+        }
+        try:
+            job = get_jobs().submit(payload, priority=priority, webhook=data.get("webhook"))
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        job["links"] = {"self": f"/api/jobs/{job['id']}", "events": f"/api/jobs/{job['id']}/events"}
+        return 202, job
+
+    # 再送で同じジョブを二重に積まない（同じ Idempotency-Key なら最初のジョブを返す）
+    resp = idempotent(data, execute)
+    if resp.status_code == 202:
+        resp.headers["Location"] = resp.get_json()["links"]["self"]
+    return resp
+
+@app.get("/api/jobs/<job_id>")
+def api_get_job(job_id):
+    job = get_jobs().store.get(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(job)
+
+@app.get("/api/jobs/<job_id>/events")
+def api_job_events(job_id):
+    """Server-Sent Events: 状態が変わるたびに queued / running / done|error|cancelled を送る"""
+    jobs = get_jobs()
+    if jobs.store.get(job_id) is None:
+        return jsonify({"error": "job not found"}), 404
+
+    def events(keepalive=15):
+        last_status = None
+        idle = 0.0
+        while True:
+            job = jobs.wait(job_id, timeout=jobs.poll_interval) if last_status else jobs.store.get(job_id)
+            if job is None:
+                yield {"type": "error", "error": "job expired"}
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                idle = 0.0
+                yield {"type": last_status, **job}
+                if last_status in ("done", "error", "cancelled"):
+                    return
+                continue
+            idle += jobs.poll_interval
+            if idle >= keepalive:
+                idle = 0.0
+                yield None
+
+    return sse_response(events())
+
+@app.post("/api/jobs/<job_id>/cancel")
+def api_cancel_job(job_id):
+    return jsonify({"id": job_id, "cancelled": get_jobs().cancel(job_id)})
+
+# ---------------- 議論（グループチャット）のライブ配信 ----------------
+_discussions = None
+
+def get_discussions():
+    """
+    DiscussionManager は初回利用時に生成（autogen_agentchat の読み込みを遅延）。
+    議論も Orchestrator と同じ上流クライアント（プール・ブレーカー・スケジューラー）を共有する
+    """
+    global _discussions
+    if _discussions is None:
+        from discussion import DiscussionManager
+        _discussions = DiscussionManager(model_client=getattr(orchestrator, "client", None))
+    return _discussions
+
+@app.post("/api/discussions")
+def api_start_discussion():
+    if not AUTOGEN_AVAILABLE:
+        return jsonify({"error": "discussions require AutoGen and GEMINI_API_KEY"}), 503
+    data = request.get_json(force=True, silent=True) or {}
+    task = (data.get("task") or "").strip() or None
+    try:
+        run_id = validate_run_id(data.get("run_id"))
+        run = get_discussions().start(task=task, run_id=run_id, request_class=request_class_for(request),
+                                      speaker_selection=data.get("speaker_selection"),
+                                      client_id=client_identity(request))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(run.to_dict()), 202
+
+@app.get("/api/discussions/<run_id>")
+def api_discussion_status(run_id):
+    # 他のクライアントの議論は存在しないものとして扱う
+    run = get_discussions().get(run_id, client_identity(request))
+    if run is None:
+        return jsonify({"error": "discussion not found"}), 404
+    return jsonify(run.to_dict())
+
+@app.get("/api/discussions/<run_id>/events")
+def api_discussion_events(run_id):
+    """Server-Sent Events: 確定した発言を 1 件ずつ配信（購読者ごとに上限付きキュー）"""
+    run = get_discussions().get(run_id, client_identity(request))
+    if run is None:
+        return jsonify({"error": "discussion not found"}), 404
+    sub = run.broadcaster.subscribe()
+    return sse_response(subscription_events(run.broadcaster, sub))
+
+@app.post("/api/discussions/<run_id>/cancel")
+def api_cancel_discussion(run_id):
+    """議論を中断（チェックポイントは残るので同じクライアントが同じ run_id で再開可能）"""
+    cancelled = get_discussions().cancel(run_id, client_identity(request))
+    return jsonify({"id": run_id, "cancelled": cancelled})
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition (limiter counters are shared across workers, token usage and scheduling are per process)."""
+    text = get_rate_limiter().metrics_text() + get_usage_ledger().metrics_text() + get_scheduler().metrics_text()
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+@app.get("/api/usage")
+def api_usage():
+    """保存済みのトークン使用量（?group_by=agent|client|purpose&since=<秒前>、ADMIN_TOKEN で保護）"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    group_by = request.args.get("group_by", "agent")
+    try:
+        since = time.time() - float(request.args.get("since", "86400"))
+        rows = get_usage_ledger().summary(since=since, group_by=group_by)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"group_by": group_by, "since": since, "usage": rows})
+
+# ---------------- 管理用: プロファイル（ADMIN_TOKEN で保護） ----------------
+def admin_denied():
+    """Error response unless the request carries ADMIN_TOKEN (404 when admin routes are disabled)."""
+    authorized = admin_authorized(request.headers)
+    if authorized is None:
+        return jsonify({"error": "not found"}), 404
+    if not authorized:
+        return jsonify({"error": "admin token required"}), 401
+    return None
+
+@app.get("/admin/profile")
+def admin_profile():
+    denied = admin_denied()
+    return denied or jsonify(get_profiler().summary())
+
+@app.post("/admin/profile")
+def admin_profile_enable():
+    """一時的にサンプリング割合を上げる: {"rate": 0.2, "seconds": 300}"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        rate = float(data.get("rate", 1.0))
+        seconds = float(data.get("seconds", 60))
+    except (TypeError, ValueError):
+        return jsonify({"error": "rate and seconds must be numbers"}), 400
+    get_profiler().enable(rate, seconds)
+    return jsonify(get_profiler().summary())
+
+@app.delete("/admin/profile")
+def admin_profile_reset():
+    denied = admin_denied()
+    if denied:
+        return denied
+    get_profiler().reset()
+    return jsonify(get_profiler().summary())
+
+@app.get("/admin/profile/<endpoint>")
+def admin_profile_download(endpoint):
+    """エンドポイントごとのプロファイル（?format=collapsed|speedscope）をダウンロード"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    profiler = get_profiler()
+    if endpoint not in profiler.endpoints():
+        return jsonify({"error": f"no samples for {endpoint}"}), 404
+    fmt = request.args.get("format", "collapsed")
+    if fmt == "speedscope":
+        body = json.dumps(profiler.speedscope(endpoint), ensure_ascii=False)
+        mimetype, filename = "application/json", f"{endpoint}.speedscope.json"
+    elif fmt == "collapsed":
+        body, mimetype, filename = profiler.collapsed(endpoint), "text/plain", f"{endpoint}.collapsed.txt"
+    else:
+        return jsonify({"error": "format must be collapsed or speedscope"}), 400
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# ---------------- 管理用: 代替ルーターのシャドー評価（shadow.py） ----------------
+@app.get("/admin/shadow")
+def admin_shadow():
+    """候補ルーターごとの本番ラベルとの一致率・所要時間"""
+    denied = admin_denied()
+    return denied or jsonify(get_shadow().report())
+
+@app.post("/admin/shadow")
+def admin_shadow_enable():
+    """一時的に評価する割合を上げる: {"rate": 0.1, "seconds": 600}"""
+    denied = admin_denied()
+    if denied:
+        return denied
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        rate = float(data.get("rate", 0.1))
+        seconds = float(data.get("seconds", 600))
+    except (TypeError, ValueError):
+        return jsonify({"error": "rate and seconds must be numbers"}), 400
+    get_shadow().enable(rate, seconds)
+    return jsonify(get_shadow().report())
+
+@app.delete("/admin/shadow")
+def admin_shadow_reset():
+    denied = admin_denied()
+    if denied:
+        return denied
+    get_shadow().reset()
+    return jsonify(get_shadow().report())
+
+# ---------------- ウォームアップ / readiness（/healthz はライブネス、/readyz はレディネス） ----------------
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "10"))
+
+def warm_registry():
+    """エージェント定義とルーティング用の索引（キーワード / 特徴量）を読み込む"""
+    from agent_registry import get_registry
+    registry = get_registry()
+    return {"agents": len(registry.agents), "version": registry.version}
+
+def warm_orchestrator():
+    """重いモジュールの import とモデルクライアントの生成"""
+    return type(orchestrator.get()).__name__
+
+def warm_upstream():
+    """上流への接続（DNS / TLS / HTTP/2）を常駐ループ上のクライアントで先に張っておく"""
+    warm = getattr(orchestrator.get(), "warmup", None)
+    if warm is None:
+        return "skipped"
+    return get_background_loop().run(warm(WARMUP_TIMEOUT), timeout=WARMUP_TIMEOUT + 5)
+
+def warm_stores():
+    """SQLite ストアのスキーマ確認と、前回の停止で残ったジョブの再開"""
+    get_rate_limiter()
+    get_jobs().start()
+    return {"queued_jobs": get_jobs().store.counts().get("queued", 0)}
+
+if warmup_enabled():
+    get_readiness().add_step("registry", warm_registry)
+    get_readiness().add_step("orchestrator", warm_orchestrator)
+    # 上流に届かなくてもサービスは縮退して動く（サーキットブレーカー）ため ready は止めない
+    get_readiness().add_step("upstream", warm_upstream, required=False)
+    get_readiness().add_step("stores", warm_stores)
+
+def start_warmup():
+    """Start warming this worker (gunicorn post_worker_init / dev server)."""
+    get_readiness().start()
 
 @app.get("/healthz")
 def healthz():
     return "ok - auto-reload verified!", 200
 
+@app.get("/readyz")
+def readyz():
+    readiness = get_readiness()
+    # フックのないサーバーでも最初の問い合わせでウォームアップを始める
+    readiness.start()
+    status = readiness.status()
+    if status["ready"]:
+        return jsonify(status), 200
+    return jsonify(status), 503, {"Retry-After": "1"}
+
 @app.get("/status")
 def status():
+    # 先に Orchestrator を生成しておく（生成に失敗するとモックに切り替わり AUTOGEN_AVAILABLE が変わる）
+    client = getattr(orchestrator, "client", None)
+    tool_stats = generation_stats = prompt_cache_stats = None
+    if AUTOGEN_AVAILABLE:
+        # autogen_router と一緒に読み込み済み
+        from tools import get_tools
+        from generation import get_generation_limits
+        from prompt_cache import get_prompt_cache
+        tool_stats = get_tools().stats()
+        generation_stats = get_generation_limits().stats()
+        prompt_cache_stats = get_prompt_cache().stats()
     return jsonify({
         "autogen_available": AUTOGEN_AVAILABLE,
         "debug_mode": app.debug,
         "auto_reload": app.config.get("TEMPLATES_AUTO_RELOAD", False),
+        "cancellation": get_cancellations().stats(),
+        "circuit_breaker": get_breaker().stats(),
+        "rate_limit": get_rate_limiter().stats(),
+        "idempotency": get_idempotency().stats(),
+        "scheduling": get_scheduler().stats(),
+        "jobs": _jobs.stats() if _jobs is not None else None,
+        "readiness": get_readiness().status(),
+        "upstream": client.stats() if hasattr(client, "stats") else None,
+        "tools": tool_stats,
+        "generation": generation_stats,
+        "prompt_cache": prompt_cache_stats,
+        "routing_input": get_routing_input_stats().stats(),
         "message": "Auto-reload is working! Code changes are automatically reflected! 自動リロード機能が動作中です！"
     })
 
 if __name__ == "__main__":
     # 開発ローカル用:flask run と同様（Docker本番は gunicorn）
     debug_mode = os.getenv("FLASK_ENV") == "development" or os.getenv("FLASK_DEBUG") == "1"
+    # リローダーの親プロセスはリクエストを処理しないのでウォームアップしない
+    if not debug_mode or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warmup()
     app.run(host="0.0.0.0", port=8000, debug=debug_mode, use_reloader=debug_mode)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+静的ファイル（static/app.js, static/styles.css）の本番向け配信。
+
+開発モード（FLASK_DEBUG=1 など）は従来どおり: テンプレート自動リロード、キャッシュなし。
+
+本番モード:
+- 内容のハッシュを含むファイル名（static/dist/app.<hash>.js）と gzip / brotli 版を事前に生成し、
+  static/dist/manifest.json に記録（`python assets.py build`、Docker イメージのビルド時に実行）。
+  起動時に元ファイルと照合し、古ければその場で作り直す
+- テンプレートの url_for('static', filename='app.js') はハッシュ付きのパスに置き換わる
+- ハッシュ付きファイルはメモリに載せておき、Accept-Encoding に応じて圧縮済みの版を
+  Cache-Control: immutable（1 年）と ETag 付きで返す（リクエストごとの圧縮・ディスク I/O なし）
+- テンプレートは起動時に一度だけコンパイルし、以後は更新を確認しない
+
+設定: ASSET_MODE=auto（既定: デバッグ時のみ開発モード）/ dev / prod
+"""
+
+import os
+import sys
+import gzip
+import json
+import hashlib
+import mimetypes
+from typing import Any, Dict, Optional, Tuple
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # brotli は任意（なければ gzip のみ）
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_DIR = "dist"
+MANIFEST_NAME = "manifest.json"
+ASSETS = ("app.js", "styles.css")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hashed_name(name: str, digest: str) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest[:10]}{ext}"
+
+
+def _write(path: str, data: bytes) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build(static_dir: str = STATIC_DIR, names=ASSETS) -> Dict[str, Any]:
+    """Write fingerprinted + precompressed copies of the assets and their manifest."""
+    dist = os.path.join(static_dir, DIST_DIR)
+    os.makedirs(dist, exist_ok=True)
+    manifest: Dict[str, Any] = {}
+    for name in names:
+        with open(os.path.join(static_dir, name), "rb") as f:
+            data = f.read()
+        digest = _digest(data)
+        hashed = _hashed_name(name, digest)
+        target = os.path.join(dist, hashed)
+        # 古いハッシュのファイルは残す（デプロイ中に古い HTML を持つクライアント向け）
+        _write(target, data)
+        encodings = ["gzip"]
+        _write(f"{target}.gz", gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write(f"{target}.br", brotli.compress(data, quality=11))
+            encodings.insert(0, "br")
+        manifest[name] = {"path": f"{DIST_DIR}/{hashed}", "sha256": digest, "encodings": encodings}
+    _write(os.path.join(dist, MANIFEST_NAME),
+           json.dumps(manifest, indent=2, ensure_ascii=False).encode("utf-8"))
+    return manifest
+
+
+def load_manifest(static_dir: str = STATIC_DIR, names=ASSETS) -> Dict[str, Any]:
+    """The manifest, rebuilt if missing or if any source asset changed since it was built."""
+    path = os.path.join(static_dir, DIST_DIR, MANIFEST_NAME)
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        for name in names:
+            with open(os.path.join(static_dir, name), "rb") as f:
+                if manifest.get(name, {}).get("sha256") != _digest(f.read()):
+                    raise ValueError(f"{name} changed")
+            if brotli is not None and "br" not in manifest[name]["encodings"]:
+                raise ValueError("brotli variants missing")
+        return manifest
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Building static assets ({e})")
+        return build(static_dir, names)
+
+
+class AssetStore:
+    """Fingerprinted assets held in memory with their precompressed variants."""
+
+    def __init__(self, static_dir: str = STATIC_DIR, names=ASSETS):
+        self.manifest = load_manifest(static_dir, names)
+        self.urls = {name: entry["path"] for name, entry in self.manifest.items()}
+        # dist パス -> (mimetype, etag の元, {encoding: bytes})
+        self.files: Dict[str, Tuple[str, str, Dict[str, bytes]]] = {}
+        for name, entry in self.manifest.items():
+            full = os.path.join(static_dir, entry["path"])
+            variants = {}
+            for encoding, suffix in (("identity", ""), ("br", ".br"), ("gzip", ".gz")):
+                if encoding == "identity" or encoding in entry["encodings"]:
+                    with open(full + suffix, "rb") as f:
+                        variants[encoding] = f.read()
+            mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            if mimetype.startswith("text/") or mimetype.endswith("javascript"):
+                mimetype += "; charset=utf-8"
+            self.files[entry["path"]] = (mimetype, entry["sha256"][:16], variants)
+
+    def response(self, path: str, req) -> Optional[Response]:
+        """Response for a fingerprinted path, or None if it is not one of ours."""
+        found = self.files.get(path)
+        if found is None:
+            return None
+        mimetype, tag, variants = found
+        encoding = next(
+            (e for e in ("br", "gzip") if e in variants and req.accept_encodings.quality(e) > 0), "identity"
+        )
+        etag = f"{tag}-{encoding}"
+        headers = {"Cache-Control": IMMUTABLE, "Vary": "Accept-Encoding"}
+        if etag in req.if_none_match:
+            resp = Response(status=304, headers=headers)
+        else:
+            resp = Response(variants[encoding], headers=headers, content_type=mimetype)
+            if encoding != "identity":
+                resp.headers["Content-Encoding"] = encoding
+        resp.set_etag(etag)
+        return resp
+
+
+def production_mode(app) -> bool:
+    mode = os.environ.get("ASSET_MODE", "auto").strip().lower()
+    if mode in ("dev", "prod"):
+        return mode == "prod"
+    # python app.py は FLASK_ENV=development だけでもデバッグ起動する
+    return not (app.debug or os.environ.get("FLASK_ENV") == "development")
+
+
+def init_assets(app) -> Optional[AssetStore]:
+    """Configure static asset serving and template reloading for the app's mode."""
+    # ハッシュなしのファイルは内容が変わりうるので常に再検証させる
+    app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 0
+    if not production_mode(app):
+        app.config["TEMPLATES_AUTO_RELOAD"] = True
+        return None
+
+    app.config["TEMPLATES_AUTO_RELOAD"] = False
+    store = AssetStore(app.static_folder)
+
+    @app.url_defaults
+    def fingerprinted_static(endpoint, values):
+        if endpoint == "static" and values.get("filename") in store.urls:
+            values["filename"] = store.urls[values["filename"]]
+
+    send_static = app.view_functions["static"]
+
+    def serve_static(filename):
+        resp = store.response(filename, request)
+        return resp if resp is not None else send_static(filename=filename)
+
+    app.view_functions["static"] = serve_static
+    # 起動時に一度だけコンパイル（auto_reload 無効なので以後はキャッシュを使う）
+    app.jinja_env.auto_reload = False
+    app.jinja_env.get_template("index.html")
+    return store
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["build"]:
+        print("usage: python assets.py build")
+        sys.exit(2)
+    for name, entry in build().items():
+        print(f"{name} -> {entry['path']} ({', '.join(entry['encodings'])})")
@@ -3,9 +3,13 @@
 
 """
 AutoGen (autogen-ext) を用いて:
-1) プロンプトを 3 クラス（coder / analyst / travel）+ none に分類
+1) プロンプトを agents.json に登録されたエージェント + none に分類
+   （ローカル埋め込み索引で即決できなければ、上位候補だけを LLM 分類器へ）
+   （長い質問は冒頭・末尾などの抜粋だけで分類: router_input.py）
 2) 該当エージェントの「役割(System指示)」で 1ターン回答を生成
 3) none のときは一般回答（ハイライトなし）
+4) agents.json の "tools" があるエージェントはツールを呼びながら回答（tools.py）
+5) 生成トークン上限は用途・エージェントごとに適応的に決め、上限で切れた回答は自動で続きを生成（generation.py）
 
 - 依存: autogen-ext==0.4.7
 - LLM 接続は Gemini(OpenAI互換API) を既定。環境変数で設定。
@@ -15,138 +19,139 @@ import os
 import json
 import asyncio
 import re
-from typing import Dict, Literal
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 from autogen_ext.models.openai import OpenAIChatCompletionClient
-from autogen_core.models import SystemMessage, UserMessage
+from autogen_core.models import (
+    AssistantMessage, CreateResult, FunctionExecutionResultMessage, LLMMessage, SystemMessage, UserMessage,
+)
+# Agent definitions (system prompts, routing descriptions, keywords) live in
+# agents.json and are served by the hot-reloading registry.
+from agent_registry import AgentSpec, get_registry
+from cassette import CassetteClient
+from cancellation import approx_tokens, get_cancellations, mark_stage, note_output
+from checkpoint import CheckpointStore
+from circuit_breaker import BreakerClient, CircuitOpenError
+from generation import CONTINUABLE, CONTINUE_PROMPT, MAX_CONTINUATIONS, get_generation_limits
+from prompt_cache import capture_cached_tokens, get_prompt_cache, with_context_cache
+from tools import Tool, get_tools, start_budget, tool_calls
+from router_input import routing_input
+from scheduling import ScheduledClient
+from shadow import get_shadow
+from upstream_pool import UpstreamPool
+from usage import current_scope, record_usage, start_request, usage_scope
 
 load_dotenv()
 
-AgentKey = Literal["coder", "analyst", "travel", "none"]
+# Registry agent key, or "none" for general questions
+AgentKey = str
 
-CLASSIFIER_SYSTEM = """あなたは専門的なルーティング分類器です。ユーザーの質問を以下の専門エージェントのいずれかに分類してください:
+# ルーティング設定: 埋め込みスコアが十分に高く差も明確なら LLM 分類器を呼ばない。
+# それ以外は上位 k 件の候補だけを分類器に渡す（エージェント数が増えてもプロンプトは一定）
+ROUTER_TOP_K = int(os.environ.get("ROUTER_TOP_K", "3"))
+ROUTER_MULTI_TOP_K = int(os.environ.get("ROUTER_MULTI_TOP_K", "5"))
+ROUTER_EMBED_MIN_SCORE = float(os.environ.get("ROUTER_EMBED_MIN_SCORE", "0.12"))
+ROUTER_EMBED_MIN_MARGIN = float(os.environ.get("ROUTER_EMBED_MIN_MARGIN", "0.06"))
 
-**coder** - 以下の場合に選択:
-- プログラミング言語、コード作成、デバッグ、実装
-- ソフトウェア設計、アーキテクチャ、システム構築
-- フレームワーク、ライブラリ、API開発
-- データベース設計、Web開発、アプリ開発
-- デプロイメント、CI/CD、DevOps
+CLASSIFIER_SYSTEM = """あなたは専門的なルーティング分類器です。ユーザーの質問を、【候補エージェント】として提示される専門エージェントのいずれかに分類してください。
 
-**analyst** - 以下の場合に選択:
-- データ分析、統計処理、機械学習
-- 研究方法論、実験設計、仮説検証
-- ビジネス分析、市場調査、競合分析
-- データ可視化、レポート作成
-- 学術的調査、論文関連、エビデンス分析
-
-**travel** - 以下の場合に選択:
-- 旅行計画、観光ルート、宿泊施設
-- 交通手段、移動方法、アクセス情報
-- 地域ガイド、現地情報、文化・歴史
-- 旅行の準備、持ち物、予算計画
-- グルメ、ショッピング、アクティビティ
-
-**none** - 上記のどれにも明確に当てはまらない一般的な質問
+- 各候補の説明に明確に当てはまるものを1つだけ選んでください
+- どの候補にも明確に当てはまらない一般的な質問は "none" としてください
 
 必ずJSON形式で回答してください:
-{"label": "coder"}
-{"label": "analyst"}  
-{"label": "travel"}
+{"label": "<候補エージェントのキー>"}
 {"label": "none"}
 
-この4つの形式のいずれか1つのみを出力してください。"""
+このいずれか1つの形式のみを出力してください。"""
 
-AGENT_SYSTEMS: Dict[str, str] = {
-    "coder": (
-        "あなたは経験豊富なソフトウェアエンジニア・アーキテクトです。\n"
-        "【あなたの専門分野】\n"
-        "- プログラミング言語（Python、JavaScript、Java、Go等）\n"
-        "- Web開発（フロントエンド・バックエンド）\n"
-        "- システム設計・マイクロサービス・API設計\n"
-        "- データベース設計・クエリ最適化\n"
-        "- DevOps・CI/CD・クラウド技術\n\n"
-        "【回答方針】\n"
-        "1. 具体的なコード例を含めて説明する\n"
-        "2. ベストプラクティスとセキュリティを考慮する\n"
-        "3. 実装手順を段階的に示す\n"
-        "4. 必要に応じて代替案も提示する\n\n"
-        "技術的な質問に対して、実用的で信頼性の高いソリューションを提供してください。"
-    ),
-    "analyst": (
-        "あなたは専門的なデータアナリスト・研究者です。\n"
-        "【あなたの専門分野】\n"
-        "- データ分析・統計解析・機械学習\n"
-        "- 実験設計・仮説検証・A/Bテスト\n"
-        "- ビジネス分析・市場調査・競合分析\n"
-        "- データ可視化・ダッシュボード作成\n"
-        "- 学術研究・論文分析・エビデンス評価\n\n"
-        "【回答方針】\n"
-        "1. データに基づく客観的な分析を行う\n"
-        "2. 統計的手法や分析アプローチを明示する\n"
-        "3. 仮定・制約・限界を明確に説明する\n"
-        "4. 可視化や具体的な分析例を提示する\n\n"
-        "分析的思考を重視し、エビデンスに基づいた洞察を提供してください。"
-    ),
-    "travel": (
-        "あなたは経験豊富な旅行プランナー・観光ガイドです。\n"
-        "【あなたの専門分野】\n"
-        "- 旅行プラン作成・ルート最適化\n"
-        "- 宿泊施設・交通手段の選択\n"
-        "- 地域情報・文化・歴史・グルメ\n"
-        "- 予算管理・旅行準備・必要な手続き\n"
-        "- 季節性・混雑状況・穴場スポット\n\n"
-        "【回答方針】\n"
-        "1. 具体的な行程表・スケジュールを提示する\n"
-        "2. 予算・所要時間・アクセス方法を明記する\n"
-        "3. 実用的なアドバイス・注意点を含める\n"
-        "4. 代替案・プランBも用意する\n\n"
-        "旅行者のニーズに合わせて、実現可能で魅力的な旅行体験を提案してください。"
-    ),
-    "general": (
-        "あなたは知識豊富で親しみやすい汎用アシスタントです。\n"
-        "【対応範囲】\n"
-        "- 一般的な質問・日常的な相談\n"
-        "- 概念の説明・用語の定義\n"
-        "- 生活に役立つ情報・アドバイス\n"
-        "- クリエイティブな相談・アイデア提案\n\n"
-        "【回答方針】\n"
-        "1. 分かりやすく親しみやすい口調で回答する\n"
-        "2. 具体例や身近な例を使って説明する\n"
-        "3. 必要に応じて複数の視点を提示する\n"
-        "4. 追加の質問や確認を促す\n\n"
-        "ユーザーの質問に真摯に向き合い、役立つ情報を提供してください。"
-    ),
+# 複数分野にまたがる質問用（multi-label ルーティング）
+MULTI_CLASSIFIER_SYSTEM = """あなたは専門的なルーティング分類器です。ユーザーの質問に答えるために必要な専門エージェントを、【候補エージェント】から**すべて**選んでください。
+
+複数の分野にまたがる質問では、該当するものをすべて含めてください。
+どれにも明確に当てはまらない場合は空の配列にしてください。
+
+必ずJSON形式で回答してください（例）:
+{"labels": ["coder", "analyst"]}
+{"labels": []}"""
+
+SYNTHESIS_SYSTEM = (
+    "あなたは複数の専門家の回答を1つにまとめる編集者です。\n"
+    "各専門家の回答の要点を落とさずに統合し、重複を除き、矛盾があれば指摘してください。\n"
+    "ユーザーの質問に対する一貫した最終回答として、見出し付きで簡潔に構成してください。"
+)
+
+def build_routing_input(prompt: str, candidates: List[AgentSpec]) -> str:
+    """Classifier user message: candidate agents (top-k only) followed by the question."""
+    lines = ["【候補エージェント】"]
+    for agent in candidates:
+        lines.append(f"- {agent.key}: {agent.routing_summary()}")
+    lines += ["", "【ユーザーの質問】", prompt]
+    return "\n".join(lines)
+
+def embedding_route(ranked: List[Tuple[str, float]]) -> Optional[AgentKey]:
+    """Confident embedding match (top score high enough and clearly ahead), else None."""
+    if not ranked:
+        return None
+    top_key, top_score = ranked[0]
+    second = ranked[1][1] if len(ranked) > 1 else 0.0
+    if top_score >= ROUTER_EMBED_MIN_SCORE and top_score - second >= ROUTER_EMBED_MIN_MARGIN:
+        return top_key
+    return None
+
+# v0.4.7+ で family 指定が必須
+MODEL_INFO = {
+    "vision": False,
+    "function_calling": True,
+    "json_output": False,
+    "structured_output": False,
+    "family": "gemini",
 }
 
-def build_model_client() -> OpenAIChatCompletionClient:
-    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+def build_model_client(api_key: Optional[str] = None, base_url: Optional[str] = None,
+                       model: Optional[str] = None) -> OpenAIChatCompletionClient:
+    api_key = api_key or os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
     if not api_key:
         raise RuntimeError("GEMINI_API_KEY (or GOOGLE_API_KEY) is required")
 
-    base_url = os.environ.get(
+    base_url = base_url or os.environ.get(
         "GEMINI_OPENAI_BASE_URL",
         "https://generativelanguage.googleapis.com/v1beta/openai/",
     )
-    model = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+    model = model or os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
 
-    # v0.4.7+ で family 指定が必須
     client = OpenAIChatCompletionClient(
         model=model,
         api_key=api_key,
         base_url=base_url,
-        model_info={
-            "vision": False,
-            "function_calling": True,
-            "json_output": False,
-            "structured_output": False,
-            "family": "gemini",
-        },
+        model_info=MODEL_INFO,
         max_tokens=2048,
     )
     return client
 
+def build_upstream_client() -> Any:
+    """
+    Every configured key / endpoint behind one latency-aware pool (see upstream_pool.py),
+    optionally wrapped in a record/replay cassette (LLM_CASSETTE_MODE, see cassette.py).
+    Context caches belong to one API key, so each member caches its own (see prompt_cache.py).
+    Calls wait for a slot of their request class first (see scheduling.py); the circuit
+    breaker (timeout, error / slow-call rates) then times only the upstream call itself.
+    Used by the Orchestrator and by group-chat discussions (the agents read model_info).
+    """
+    def member(**kwargs):
+        return with_context_cache(build_model_client(**kwargs))
+    return ScheduledClient(BreakerClient(CassetteClient.from_env(
+        lambda: UpstreamPool.from_env(member), model_info=MODEL_INFO,
+    )))
+
+async def open_upstream_connection(client: OpenAIChatCompletionClient) -> None:
+    """
+    One cheap authenticated request (GET /models) so the client's connection pool holds
+    a live connection. autogen does not expose the underlying AsyncOpenAI client publicly.
+    """
+    await client._client.models.list()
+
 def clean_response_content(content: str) -> str:
     """Clean response content from API metadata"""
     if not content:
@@ -166,21 +171,135 @@ def clean_response_content(content: str) -> str:
     
     return content
 
+# Keyword-based fallback classification (LLM 分類器が使えない/解釈不能なとき)
+def keyword_scores(prompt: str) -> Dict[str, int]:
+    """Number of registry keywords found in the prompt, per agent (registry order)."""
+    prompt_lower = prompt.lower()
+    return {
+        agent.key: sum(1 for kw in agent.keywords if kw in prompt_lower)
+        for agent in get_registry().agents
+    }
+
+def keyword_classify(prompt: str) -> AgentKey:
+    scores = keyword_scores(prompt)
+    print(f"Keyword scores - {scores}")
+    
+    # Highest score wins; ties go to the agent listed first in agents.json
+    best = max(scores, key=lambda k: scores[k], default=None)
+    if best is None or scores[best] == 0:
+        return "none"
+    return best
+
+def degraded_response(agent: AgentKey, retry_in: float) -> str:
+    """Fast local reply while the upstream circuit is open (no LLM call)."""
+    spec = get_registry().get(agent)
+    assignee = f"{spec.name}（{spec.description}）" if spec is not None else "汎用アシスタント"
+    return (
+        "現在 AI サービスが混雑または停止しているため、簡易モードで応答しています。\n"
+        f"ご質問は {assignee} の担当として受け付けました。"
+        f"約{max(1, round(retry_in))}秒後に再度お試しください。"
+    )
+
 class Orchestrator:
     def __init__(self):
-        self.client = build_model_client()
+        # 複数キー/エンドポイントのプール（1 つだけなら従来どおりの単一クライアント相当）
+        self.client = build_upstream_client()
+        # 分類→回答の途中結果（run_id 指定時のみ使用）
+        self.checkpoints = CheckpointStore()
 
-    async def _chat(self, system: str, user: str) -> str:
+    async def warmup(self, timeout: float = 10.0) -> Dict[str, Any]:
+        """Open upstream connections before the first request (see readiness.py)."""
+        warm = getattr(self.client, "warmup", None)
+        return await warm(open_upstream_connection, timeout) if warm is not None else {}
+
+    @staticmethod
+    def _create_kwargs(tools: List[Tool], round_index: int, create_args: Dict[str, Any]) -> Dict[str, Any]:
+        """create() options for one model turn: generation limits, tools on offer or a forced text answer."""
+        kwargs: Dict[str, Any] = {}
+        if create_args:
+            kwargs["extra_create_args"] = dict(create_args)
+        if not tools:
+            return kwargs
+        schemas = [tool.schema() for tool in tools]
+        if get_tools().offer(tools, round_index):
+            return {**kwargs, "tools": schemas}
+        # ツール結果を含む会話なので定義は渡したまま、これ以上は呼ばせない
+        return {**kwargs, "tools": schemas, "tool_choice": "none"}
+
+    @staticmethod
+    def _continue(messages: List[LLMMessage], purpose: str, content: str,
+                  finish_reason: Optional[str], continuations: int) -> bool:
+        """Ask for the rest of a text cut off at max_tokens (appends the turn to messages)."""
+        if finish_reason != "length" or purpose not in CONTINUABLE or continuations >= MAX_CONTINUATIONS:
+            return False
+        messages.append(AssistantMessage(content=content, source="assistant"))
+        messages.append(UserMessage(content=CONTINUE_PROMPT, source="user"))
+        print(f"Response cut off at max_tokens, continuing ({continuations + 1}/{MAX_CONTINUATIONS})")
+        return True
+
+    @staticmethod
+    async def _run_tools(messages: List[LLMMessage], resp: Any, offered: bool) -> bool:
+        """
+        Execute the turn's tool calls concurrently and append them to messages (False if none).
+        Calls made although no tools were offered (tool_choice "none") are dropped, ending the loop.
+        """
+        calls = tool_calls(resp)
+        if not calls:
+            return False
+        if not offered:
+            print(f"Ignoring tool calls after tools were withdrawn: {[c.name for c in calls]}")
+            return False
+        results = await get_tools().run_calls(calls)
+        print(f"Tool calls: {[c.name for c in calls]}")
+        messages.append(AssistantMessage(content=calls, source="assistant"))
+        messages.append(FunctionExecutionResultMessage(content=results))
+        return True
+
+    async def _chat(self, system: str, user: str, tools: Optional[List[Tool]] = None) -> str:
         """
         Create a single turn conversation with autogen-ext OpenAI compatible client.
+        With tools, loops model turn -> concurrent tool calls until a text answer;
+        text cut off at max_tokens is continued automatically.
         Clean API metadata from the response.
         """
-        resp = await self.client.create(
-            messages=[
-                SystemMessage(content=system),
-                UserMessage(content=user, source="user"),
-            ],
-        )
+        # 用途・エージェントは呼び出し元の usage_scope から
+        purpose, agent = current_scope()
+        # システムプロンプトはバイト単位で固定の接頭部に（可変部分はすべてユーザーメッセージ以降）
+        messages: List[LLMMessage] = [
+            SystemMessage(content=get_prompt_cache().stable(system, f"{purpose}/{agent}")),
+            UserMessage(content=user, source="user"),
+        ]
+        limits = get_generation_limits()
+        create_args = limits.create_args(purpose, agent, user)
+        parts: List[str] = []
+        round_index = continuations = completion = 0
+        while True:
+            # クライアントはブレーカー経由（タイムアウト付き）。open 中は上流を呼ばずに CircuitOpenError
+            capture = capture_cached_tokens()
+            kwargs = self._create_kwargs(tools or [], round_index, create_args)
+            resp = await self.client.create(messages=messages, **kwargs)
+            # 使用トークン数（うちキャッシュ済み）を記録
+            usage = getattr(resp, "usage", None)
+            record_usage(usage, capture.cached_tokens)
+            if tools and await self._run_tools(messages, resp, kwargs.get("tool_choice") != "none"):
+                round_index += 1
+                continue
+            # autogen CreateResult: content is the generated text
+            content = getattr(resp, "content", None)
+            if not isinstance(content, str):
+                break
+            parts.append(content)
+            completion += getattr(usage, "completion_tokens", 0) or approx_tokens(content)
+            limits.observe_finish(purpose, getattr(resp, "finish_reason", None))
+            if not self._continue(messages, purpose, content, getattr(resp, "finish_reason", None), continuations):
+                break
+            continuations += 1
+        if purpose == "answer":
+            limits.observe(agent, user, completion, continuations)
+        if parts:
+            return clean_response_content("".join(parts).strip())
+        if tool_calls(resp):
+            return ""
         # OpenAI compatible response format: choices[0].message.content
         try:
             content = resp.choices[0].message.get("content") or ""
@@ -193,128 +312,327 @@ class Orchestrator:
     async def classify_async(self, prompt: str) -> AgentKey:
         """
         Classify prompt into agent type.
+        1) local embedding index (no upstream call when confident)
+        2) LLM classifier over the top-k candidates only
         Implements robust JSON parsing and fallback logic.
         """
+        # 長い貼り付けは冒頭・末尾・地の文の抜粋だけで振り分ける（router_input.py）
+        prompt = routing_input(prompt).text
+        start = time.perf_counter()
+        label, source = await self._route(prompt)
+        # サンプル対象なら代替ルーターを応答経路の外で評価（shadow.py、待たない）
+        get_shadow().observe(prompt, label, time.perf_counter() - start, source)
+        return label
+
+    async def _route(self, prompt: str) -> Tuple[AgentKey, str]:
+        """Primary routing decision and how it was made ("embedding" / "llm" / "keyword")."""
         try:
-            raw = await self._chat(CLASSIFIER_SYSTEM, prompt)
+            registry = get_registry()
+            ranked = registry.index.rank(prompt, ROUTER_TOP_K)
+            routed = embedding_route(ranked)
+            if routed is not None:
+                print(f"Classification successful (embedding): {routed} {ranked}")
+                return routed, "embedding"
+            
+            candidates = [a for a in (registry.get(key) for key, _ in ranked) if a is not None]
+            raw = await self._chat(CLASSIFIER_SYSTEM, build_routing_input(prompt, candidates))
             print(f"Classifier raw response: {raw}")  # Debug log
             
             # Multiple JSON parsing attempts
             label = "none"
+            valid = [a.key for a in candidates]
             
             # 1. Standard JSON parsing
             try:
                 data = json.loads(raw)
                 lbl = (data.get("label") or "").strip().lower()
-                if lbl in ("coder", "analyst", "travel", "none"):
+                if lbl in valid or lbl == "none":
                     label = lbl
                     print(f"Classification successful (JSON): {label}")
-                    return label  # type: ignore[return-value]
+                    return label, "llm"
             except json.JSONDecodeError:
                 pass
             
             # 2. Pattern matching if JSON fails
             raw_lower = raw.lower()
-            if '"coder"' in raw_lower or 'coder' in raw_lower:
-                label = "coder"
-            elif '"analyst"' in raw_lower or 'analyst' in raw_lower:
-                label = "analyst"
-            elif '"travel"' in raw_lower or 'travel' in raw_lower:
-                label = "travel"
+            matched = [key for key in valid if key in raw_lower]
+            if matched:
+                label, source = matched[0], "llm"
             else:
                 # 3. Keyword-based fallback classification
-                prompt_lower = prompt.lower()
-                
-                # Programming related keywords
-                coding_keywords = [
-                    "コード", "プログラム", "実装", "開発", "設計", "python", "javascript", 
-                    "java", "api", "データベース", "web", "アプリ", "システム", "サーバー",
-                    "フレームワーク", "ライブラリ", "バグ", "デバッグ", "deploy", "git"
-                ]
-                
-                # Analysis related keywords
-                analysis_keywords = [
-                    "分析", "統計", "データ", "機械学習", "研究", "実験", "調査", "可視化",
-                    "グラフ", "レポート", "検証", "仮説", "エビデンス", "競合", "市場"
-                ]
-                
-                # Travel related keywords
-                travel_keywords = [
-                    "旅行", "観光", "宿泊", "ホテル", "交通", "電車", "飛行機", "ルート",
-                    "プラン", "予算", "グルメ", "レストラン", "スポット", "地域", "文化"
-                ]
-                
-                # Keyword matching
-                coding_score = sum(1 for kw in coding_keywords if kw in prompt_lower)
-                analysis_score = sum(1 for kw in analysis_keywords if kw in prompt_lower)
-                travel_score = sum(1 for kw in travel_keywords if kw in prompt_lower)
-                
-                print(f"Keyword scores - coding: {coding_score}, analysis: {analysis_score}, travel: {travel_score}")
-                
-                if coding_score > 0 and coding_score >= analysis_score and coding_score >= travel_score:
-                    label = "coder"
-                elif analysis_score > 0 and analysis_score >= travel_score:
-                    label = "analyst"
-                elif travel_score > 0:
-                    label = "travel"
-                else:
-                    label = "none"
+                label, source = keyword_classify(prompt), "keyword"
             
             print(f"Final classification: {label}")
-            return label  # type: ignore[return-value]
+            return label, source
             
+        except CircuitOpenError as e:
+            # 上流障害中はプロセス内のキーワード分類で振り分ける
+            print(f"Classification degraded ({e}), using keyword classifier")
+            return keyword_classify(prompt), "keyword"
         except Exception as e:
-            print(f"Classification error: {e}")
-            return "none"
+            print(f"Classification error: {e}, using keyword classifier")
+            return keyword_classify(prompt), "keyword"
+
+    async def _chat_stream(self, system: str, user: str, tools: Optional[List[Tool]] = None):
+        """
+        Streaming variant of _chat: yields text deltas as they arrive.
+        """
+        purpose, agent = current_scope()
+        messages: List[LLMMessage] = [
+            SystemMessage(content=get_prompt_cache().stable(system, f"{purpose}/{agent}")),
+            UserMessage(content=user, source="user"),
+        ]
+        limits = get_generation_limits()
+        create_args = limits.create_args(purpose, agent, user)
+        round_index = continuations = completion = 0
+        while True:
+            final = None
+            text: List[str] = []
+            capture = capture_cached_tokens()
+            kwargs = self._create_kwargs(tools or [], round_index, create_args)
+            # チャンク間隔のタイムアウトはクライアント側のブレーカー（circuit_breaker.BreakerClient）
+            async for chunk in self.client.create_stream(messages=messages, include_usage=True, **kwargs):
+                if isinstance(chunk, str):
+                    text.append(chunk)
+                    yield chunk
+                elif isinstance(chunk, CreateResult):
+                    # ストリームの最後に使用量付きの CreateResult が届く
+                    record_usage(chunk.usage, capture.cached_tokens)
+                    final = chunk
+            # ツール実行は上流呼び出しの外（ブレーカーの遅延判定に含めない）
+            if tools and await self._run_tools(messages, final, kwargs.get("tool_choice") != "none"):
+                round_index += 1
+                continue
+            content = "".join(text)
+            completion += getattr(getattr(final, "usage", None), "completion_tokens", 0) or approx_tokens(content)
+            limits.observe_finish(purpose, getattr(final, "finish_reason", None))
+            if not self._continue(messages, purpose, content, getattr(final, "finish_reason", None), continuations):
+                break
+            continuations += 1
+        if purpose == "answer":
+            limits.observe(agent, user, completion, continuations)
+
+    @staticmethod
+    def _agent_system(agent: AgentKey) -> str:
+        return get_registry().system_for(agent)
+
+    @staticmethod
+    def _agent_tools(agent: AgentKey) -> List[Tool]:
+        spec = get_registry().get(agent)
+        return get_tools().resolve(spec.extra.get("tools") if spec is not None else None)
+
+    @staticmethod
+    def _sign_response(agent: AgentKey, response: str) -> str:
+        # Include agent identification in response (for debugging)
+        if agent != "none":
+            spec = get_registry().get(agent)
+            agent_name = spec.name if spec is not None else "専門エージェント"
+            # Add agent info to end of response (can be processed by UI later)
+            response += f"\n\n---\n【回答者: {agent_name}】"
+        return response
+
+    async def _generate_answer(self, agent: AgentKey, prompt: str) -> str:
+        """
+        Generate answer using the specified agent (raises on upstream errors).
+        """
+        response = await self._chat(self._agent_system(agent), prompt, self._agent_tools(agent))
+        return self._sign_response(agent, response)
 
     async def answer_with_agent_async(self, agent: AgentKey, prompt: str) -> str:
         """
         Generate answer using the specified agent.
         """
-        if agent in ("coder", "analyst", "travel"):
-            system = AGENT_SYSTEMS[agent]
-        else:
-            system = AGENT_SYSTEMS["general"]
-        
         try:
-            response = await self._chat(system, prompt)
-            
-            # Include agent identification in response (for debugging)
-            if agent != "none":
-                agent_names = {
-                    "coder": "ソフトウェアエンジニア",
-                    "analyst": "データアナリスト",
-                    "travel": "旅行プランナー"
-                }
-                agent_name = agent_names.get(agent, "専門エージェント")
-                # Add agent info to end of response (can be processed by UI later)
-                response += f"\n\n---\n【回答者: {agent_name}】"
-            
-            return response
-            
+            return await self._generate_answer(agent, prompt)
         except Exception as e:
             print(f"Answer generation error for agent {agent}: {e}")
             return f"Sorry, an error occurred while generating response from {agent} agent."
 
-    async def ask_async(self, prompt: str) -> Dict[str, str]:
+    async def ask_async(self, prompt: str, run_id: Optional[str] = None) -> Dict[str, str]:
         """
         Routing -> Answer generation
-        returns: {"selected": "...", "response": "..."}
+        run_id を指定すると分類結果をチェックポイントし、回答生成が失敗しても
+        同じ run_id での再実行時は分類をスキップして回答生成から再開する。
+        returns: {"selected": "...", "response": "...", "usage": {...}}
         """
-        print(f"Processing prompt: {prompt}")
+        print(f"Processing prompt: {prompt[:200]}")
+        usage = start_request()
+        start_budget()
         
-        # Classification
-        agent: AgentKey = await self.classify_async(prompt)
-        print(f"Classified as: {agent}")
+        # Classification (resume from checkpoint if available)
+        mark_stage("classify")
+        saved = self.checkpoints.load(run_id, kind="ask") if run_id else None
+        if saved and saved["meta"].get("prompt") == prompt:
+            agent: AgentKey = saved["state"]["selected"]
+            print(f"Resumed classification from checkpoint {run_id}: {agent}")
+        else:
+            with usage_scope("classify"):
+                agent = await self.classify_async(prompt)
+            print(f"Classified as: {agent}")
+            if run_id:
+                self.checkpoints.save(run_id, "ask", {"selected": agent}, prompt=prompt)
         
         # Answer generation
-        answer = await self.answer_with_agent_async(agent, prompt)
+        mark_stage("answer")
+        degraded = False
+        try:
+            with usage_scope("answer", agent):
+                answer = await self._generate_answer(agent, prompt)
+        except CircuitOpenError as e:
+            answer = degraded_response(agent, e.retry_in)
+            degraded = True
+        except Exception as e:
+            # チェックポイントは残し、再実行時に分類をやり直さない
+            print(f"Answer generation error for agent {agent}: {e}")
+            answer = f"Sorry, an error occurred while generating response from {agent} agent."
+            # 定型のエラー文も縮退応答として扱い、冪等キャッシュやブラウザのキャッシュに残さない
+            degraded = True
+        else:
+            get_cancellations().record_answer_tokens(
+                usage.completion_tokens_for("answer") or approx_tokens(answer)
+            )
+            if run_id:
+                self.checkpoints.delete(run_id)
         print(f"Response generated by {agent} agent")
         
-        return {
+        result = {
             "selected": agent, 
-            "response": answer
+            "response": answer,
+            "usage": usage.to_dict(),
         }
+        if degraded:
+            result["degraded"] = True
+        return result
+
+    async def classify_multi_async(self, prompt: str) -> List[AgentKey]:
+        """
+        Multi-label classification: every agent needed to answer the prompt.
+        Returns [] for general questions.
+        """
+        prompt = routing_input(prompt).text
+        try:
+            registry = get_registry()
+            candidates = [
+                a for a in (registry.get(key) for key, _ in registry.index.rank(prompt, ROUTER_MULTI_TOP_K))
+                if a is not None
+            ]
+            valid = [a.key for a in candidates]
+            raw = await self._chat(MULTI_CLASSIFIER_SYSTEM, build_routing_input(prompt, candidates))
+            print(f"Multi-classifier raw response: {raw}")  # Debug log
+            
+            # 1. JSON parsing (also when wrapped in extra text / code fences)
+            match = re.search(r"\{.*\}", raw, re.DOTALL)
+            if match:
+                try:
+                    data = json.loads(match.group(0))
+                    labels = [str(l).strip().lower() for l in data.get("labels") or []]
+                    labels = [l for l in dict.fromkeys(labels) if l in valid]
+                    print(f"Multi-classification successful (JSON): {labels}")
+                    return labels
+                except (json.JSONDecodeError, AttributeError):
+                    pass
+            
+            # 2. Pattern matching if JSON fails
+            raw_lower = raw.lower()
+            labels = [l for l in valid if l in raw_lower]
+            if labels:
+                return labels
+        except Exception as e:
+            print(f"Multi-classification error: {e}")
+        
+        # 3. Keyword-based fallback: every agent with at least one keyword hit
+        scores = keyword_scores(prompt)
+        labels = sorted((a for a in scores if scores[a] > 0), key=lambda a: -scores[a])
+        print(f"Multi-classification (keywords): {labels}")
+        return labels
+
+    async def _stream_answer(self, agent: AgentKey, prompt: str,
+                             emit: Callable[[Dict[str, Any]], None]) -> str:
+        """
+        Generate one agent's answer, emitting partial text as it streams in.
+        """
+        parts: List[str] = []
+        with usage_scope("answer", agent):
+            async for delta in self._chat_stream(self._agent_system(agent), prompt, self._agent_tools(agent)):
+                parts.append(delta)
+                note_output(delta)
+                emit({"type": "partial", "agent": agent, "delta": delta})
+        response = self._sign_response(agent, clean_response_content("".join(parts).strip()))
+        emit({"type": "answer", "agent": agent, "response": response})
+        return response
+
+    async def ask_multi_async(
+        self,
+        prompt: str,
+        synthesize: bool = False,
+        on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Multi-label routing -> concurrent answer generation (-> optional synthesis)
+        Selected agents run concurrently, so wall time is roughly the slowest agent.
+        returns: {"selected": first agent or "none", "selected_agents": [...],
+                  "responses": {agent: text}, "response": merged text}
+        """
+        emit = on_event or (lambda event: None)
+        print(f"Processing multi-agent prompt: {prompt[:200]}")
+        usage = start_request()
+        start_budget()
+        
+        mark_stage("classify")
+        with usage_scope("classify"):
+            agents = await self.classify_multi_async(prompt)
+        emit({"type": "selected", "agents": agents})
+        run_agents: List[AgentKey] = agents or ["none"]
+        mark_stage("answer", answers=len(run_agents))
+        
+        results = await asyncio.gather(
+            *(self._stream_answer(agent, prompt, emit) for agent in run_agents),
+            return_exceptions=True,
+        )
+        responses: Dict[str, str] = {}
+        # 定型文で代替した回答がある（再送キャッシュ・ブラウザキャッシュには残さない）
+        degraded = False
+        for agent, result in zip(run_agents, results):
+            if isinstance(result, CircuitOpenError):
+                responses[agent] = degraded_response(agent, result.retry_in)
+                emit({"type": "answer", "agent": agent, "response": responses[agent], "degraded": True})
+                degraded = True
+            elif isinstance(result, BaseException):
+                print(f"Answer generation error for agent {agent}: {result}")
+                responses[agent] = f"Sorry, an error occurred while generating response from {agent} agent."
+                emit({"type": "answer", "agent": agent, "response": responses[agent], "error": True})
+                degraded = True
+            else:
+                responses[agent] = result
+        
+        if synthesize and len(responses) > 1:
+            mark_stage("synthesis", answers=len(responses) + 1)
+            registry = get_registry()
+            sections = "\n\n".join(
+                f"## {getattr(registry.get(a), 'name', a)}の回答\n{text}" for a, text in responses.items()
+            )
+            try:
+                with usage_scope("synthesis"):
+                    merged = await self._chat(
+                        SYNTHESIS_SYSTEM, f"質問:\n{prompt}\n\n{sections}"
+                    )
+            except Exception as e:
+                print(f"Synthesis error: {e}")
+                merged = sections
+            emit({"type": "synthesis", "response": merged})
+        else:
+            merged = "\n\n".join(responses.values())
+        
+        result = {
+            "selected": agents[0] if agents else "none",
+            "selected_agents": agents,
+            "responses": responses,
+            "response": merged,
+            "usage": usage.to_dict(),
+        }
+        if degraded:
+            result["degraded"] = True
+        return result
 
     async def close(self):
         try:
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+プロセス内で 1 本だけ常駐させる asyncio イベントループ。
+
+Flask のリクエストスレッドは同期なので、リクエストより長生きするコルーチン
+（議論の実行など）はここへ投入し、concurrent.futures.Future で結果を受け取る。
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine, Optional
+
+
+class BackgroundLoop:
+    def __init__(self, name: str = "orchestrator-loop"):
+        self._name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        self._ensure_started()
+        return self._loop  # type: ignore[return-value]
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run() -> None:
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            self._loop = loop
+            self._thread = threading.Thread(target=run, name=self._name, daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def submit(self, coro: Coroutine[Any, Any, Any]) -> Future:
+        """Schedule coro on the background loop (thread-safe)."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine[Any, Any, Any], timeout: Optional[float] = None) -> Any:
+        """Run coro on the background loop and block the calling thread for its result."""
+        return self.submit(coro).result(timeout)
+
+
+_background_loop: Optional[BackgroundLoop] = None
+_background_lock = threading.Lock()
+
+
+def get_background_loop() -> BackgroundLoop:
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None:
+            _background_loop = BackgroundLoop()
+        return _background_loop
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+1 つの発行元（議論の実行）から複数の購読者（ブラウザの SSE 接続）へ
+イベントを配る fan-out ブロードキャスタ。
+
+- 購読者ごとに上限付きキュー。満杯なら最も古いイベントを捨てて新しいものを入れる
+  （遅いブラウザがいても publish 側＝議論の進行は決して待たされない）
+- 途中から購読したクライアントには直近の履歴を先に流す
+- close() で全購読者へ終端を通知
+"""
+
+import queue
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_HISTORY_SIZE = 200
+
+# 終端マーカー（購読者の get() が None を返したらストリーム終了）
+_CLOSED = None
+
+
+class Subscription:
+    def __init__(self, maxsize: int):
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def _offer(self, event: Optional[Dict[str, Any]]) -> None:
+        while True:
+            try:
+                self._queue.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Next event, None when the stream is closed; raises queue.Empty on timeout."""
+        return self._queue.get(timeout=timeout)
+
+
+class Broadcaster:
+    def __init__(self, queue_size: int = DEFAULT_QUEUE_SIZE, history_size: int = DEFAULT_HISTORY_SIZE):
+        self._queue_size = queue_size
+        self._history: deque = deque(maxlen=history_size)
+        self._subscribers: List[Subscription] = []
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def subscribe(self) -> Subscription:
+        sub = Subscription(self._queue_size)
+        with self._lock:
+            for event in self._history:
+                sub._offer(event)
+            if self.closed:
+                sub._offer(_CLOSED)
+            else:
+                self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        with self._lock:
+            if self.closed:
+                return
+            self._history.append(event)
+            for sub in self._subscribers:
+                sub._offer(event)
+
+    def close(self) -> None:
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            for sub in self._subscribers:
+                sub._offer(_CLOSED)
+            self._subscribers.clear()
+
+    @property
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ブラウザの中断（AbortController / ページ離脱 / 再送信）から上流 LLM 呼び出しまでの
+キャンセル伝播。
+
+- 実行中のリクエストは (owner, kind, request_id) → concurrent.futures.Future（常駐ループ上のタスク）
+  として登録しておき、キャンセル要求で future.cancel() する。request_id はクライアントが決めるため、
+  owner（client_identity）と種類（ask / ask_multi / discussion）ごとの名前空間に分け、
+  他のクライアントの同じ ID を取り消したり置き換えたりしない
+- タスクのキャンセルは await 中の self.client.create（HTTP リクエスト）と、
+  asyncio.gather で並行実行中の兄弟呼び出しにもそのまま伝播する
+- gunicorn の別ワーカーに届いたキャンセル要求も、SQLite 上の共有テーブル経由で実行中のワーカーへ渡す
+  （各ワーカーは実行中のリクエストを登録し、自分宛ての要求をポーリングして取り消し、結果を書き戻す）
+- キャンセル件数（理由別・段階別）と、生成されずに済んだトークン数の推定値を集計
+  （ストリーミングで既に生成済みの分は差し引く）
+
+設定:
+  CANCEL_DB             ワーカー間で共有するキャンセル要求の SQLite（既定: data/cancellations.sqlite3）
+  CANCEL_POLL_INTERVAL  実行中のリクエストがあるワーカーが自分宛ての要求を確認する間隔（秒、既定 0.2）
+  CANCEL_WAIT           別ワーカーでの取り消し結果を待つ最大秒数（既定 2）
+"""
+
+import os
+import time
+import sqlite3
+import threading
+import contextvars
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+# 回答 1 件あたりの推定完了トークン数（実績が無いうちの初期値）
+DEFAULT_ANSWER_TOKENS = 600
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cancellations.sqlite3")
+
+# 処理されずに残ったキャンセル要求（宛先のワーカーが落ちた等）を消すまでの秒数
+REQUEST_TTL = 60.0
+
+
+def approx_tokens(text: str) -> int:
+    """Rough token estimate: ~4 ASCII chars or ~1.5 Japanese chars per token."""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return max(1, int(ascii_chars / 4 + (len(text) - ascii_chars) / 1.5))
+
+
+class InFlight:
+    def __init__(self, request_id: str, future: Optional[Future], kind: str, owner: Optional[str] = None):
+        self.request_id = request_id
+        self.future = future
+        self.kind = kind
+        self.owner = owner
+        self.stage = "queued"
+        self.started_at = time.time()
+        # 節約量の推定用: 予定している回答の件数と、既にストリーミングで生成された分
+        self.expected_answers = 1
+        self.produced_tokens = 0
+
+
+_current: contextvars.ContextVar[Optional[InFlight]] = contextvars.ContextVar(
+    "current_request", default=None
+)
+
+
+def mark_stage(stage: str, answers: Optional[int] = None) -> None:
+    """Record which step the current request is in (classify / answer / ...) and, if known,
+    how many answers it will generate in total."""
+    entry = _current.get()
+    if entry is not None:
+        entry.stage = stage
+        if answers is not None:
+            entry.expected_answers = answers
+
+
+def note_output(text: str) -> None:
+    """Count streamed output of the current request (not saved if it is cancelled later)."""
+    entry = _current.get()
+    if entry is not None:
+        entry.produced_tokens += approx_tokens(text)
+
+
+class SharedCancellations:
+    """
+    Cancel requests shared by every worker process through SQLite: workers publish what they
+    run, a cancel for another worker's request is queued for it and answered by its poller.
+    """
+
+    def __init__(self, path: Optional[str] = None, worker: Optional[str] = None,
+                 poll_interval: Optional[float] = None, wait: Optional[float] = None):
+        env = os.environ.get
+        self.path = path or env("CANCEL_DB", DEFAULT_DB_PATH)
+        self.worker = worker
+        self.poll_interval = poll_interval if poll_interval is not None else float(env("CANCEL_POLL_INTERVAL", "0.2"))
+        self.wait = wait if wait is not None else float(env("CANCEL_WAIT", "2"))
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS inflight ("
+                "owner TEXT NOT NULL, kind TEXT NOT NULL, request_id TEXT NOT NULL, "
+                "worker TEXT NOT NULL, started REAL NOT NULL, PRIMARY KEY (owner, kind, request_id))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cancels ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, worker TEXT NOT NULL, owner TEXT NOT NULL, "
+                "kind TEXT NOT NULL, request_id TEXT NOT NULL, reason TEXT NOT NULL, "
+                "created REAL NOT NULL, cancelled INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cancels_worker ON cancels (worker, cancelled)")
+        finally:
+            conn.close()
+
+    @property
+    def worker_id(self) -> str:
+        # gunicorn は preload 後に fork するため、PID は使う時点で取る
+        return self.worker or str(os.getpid())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def publish(self, owner: Optional[str], kind: str, request_id: str) -> None:
+        """Register a running request; the same request still running on another worker is superseded."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT worker FROM inflight WHERE owner = ? AND kind = ? AND request_id = ?",
+                (owner or "", kind, request_id),
+            ).fetchone()
+            if row is not None and row["worker"] != self.worker_id:
+                conn.execute(
+                    "INSERT INTO cancels (worker, owner, kind, request_id, reason, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (row["worker"], owner or "", kind, request_id, "superseded", time.time()),
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO inflight (owner, kind, request_id, worker, started) VALUES (?, ?, ?, ?, ?)",
+                (owner or "", kind, request_id, self.worker_id, time.time()),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def unpublish(self, owner: Optional[str], kind: str, request_id: str) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                "DELETE FROM inflight WHERE owner = ? AND kind = ? AND request_id = ? AND worker = ?",
+                (owner or "", kind, request_id, self.worker_id),
+            )
+        finally:
+            conn.close()
+
+    def request(self, owner: Optional[str], request_id: str, kind: Optional[str], reason: str) -> List[int]:
+        """Queue a cancel for every other worker running the request; returns the queued ids."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT worker, kind FROM inflight WHERE owner = ? AND request_id = ? AND worker != ?"
+                + (" AND kind = ?" if kind is not None else ""),
+                (owner or "", request_id, self.worker_id) + ((kind,) if kind is not None else ()),
+            ).fetchall()
+            ids = [
+                conn.execute(
+                    "INSERT INTO cancels (worker, owner, kind, request_id, reason, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (row["worker"], owner or "", row["kind"], request_id, reason, now),
+                ).lastrowid
+                for row in rows
+            ]
+            conn.execute("DELETE FROM cancels WHERE created < ?", (now - REQUEST_TTL,))
+            conn.execute("COMMIT")
+            return ids
+        finally:
+            conn.close()
+
+    def outcome(self, ids: List[int]) -> bool:
+        """Wait (up to self.wait seconds) for the owning workers; True if any of them cancelled."""
+        deadline = time.time() + self.wait
+        marks = ",".join("?" * len(ids))
+        while True:
+            conn = self._connect()
+            try:
+                results = [row["cancelled"] for row in conn.execute(
+                    f"SELECT cancelled FROM cancels WHERE id IN ({marks})", ids)]
+            finally:
+                conn.close()
+            if any(results):
+                return True
+            if all(r is not None for r in results) or time.time() >= deadline:
+                return False
+            time.sleep(self.poll_interval / 2)
+
+    def pending(self) -> List[sqlite3.Row]:
+        """Cancel requests addressed to this worker that it has not answered yet."""
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT id, owner, kind, request_id, reason FROM cancels WHERE worker = ? AND cancelled IS NULL",
+                (self.worker_id,),
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def resolve(self, request_id: int, cancelled: bool) -> None:
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE cancels SET cancelled = ? WHERE id = ?", (int(cancelled), request_id))
+        finally:
+            conn.close()
+
+
+class CancellationRegistry:
+    def __init__(self, shared: Optional[SharedCancellations] = None):
+        self._lock = threading.Lock()
+        self.shared = shared
+        self._poller: Optional[threading.Thread] = None
+        self._inflight: Dict[Tuple[Optional[str], str, str], InFlight] = {}
+        self.cancelled_total = 0
+        self.cancelled_by_reason: Dict[str, int] = {}
+        self.cancelled_by_stage: Dict[str, int] = {}
+        self.estimated_tokens_saved = 0
+        # 完了した回答の平均トークン数（節約量の推定に使う移動平均）
+        self._answer_tokens_avg = float(DEFAULT_ANSWER_TOKENS)
+        self._answers_seen = 0
+
+    def track(self, request_id: str, coro, loop, kind: str = "ask", owner: Optional[str] = None) -> Future:
+        """
+        Submit coro to the background loop as a cancellable request. A request with the
+        same owner, kind and request_id still running is superseded (cancelled).
+        """
+        key = (owner, kind, request_id)
+        entry = InFlight(request_id, None, kind, owner)
+
+        async def run():
+            _current.set(entry)
+            return await coro
+
+        # 登録までロックを保持し、実行開始直後に届いたキャンセル要求も取りこぼさない
+        with self._lock:
+            future = loop.submit(run())
+            entry.future = future
+            previous = self._inflight.get(key)
+            self._inflight[key] = entry
+        if previous is not None and previous.future is not future:
+            self._cancel_entry(previous, "superseded")
+        if self.shared is not None:
+            self._share(self.shared.publish, key)
+            self._start_poller()
+        future.add_done_callback(lambda f: self._finished(key, entry))
+        return future
+
+    def _finished(self, key: Tuple[Optional[str], str, str], entry: InFlight) -> None:
+        with self._lock:
+            if self._inflight.get(key) is not entry:
+                return
+            del self._inflight[key]
+        if self.shared is not None:
+            self._share(self.shared.unpublish, key)
+
+    @staticmethod
+    def _share(action, key: Tuple[Optional[str], str, str]) -> None:
+        # 共有テーブルに書けなくても、同じワーカー内のキャンセルは効くので処理は続ける
+        try:
+            action(*key)
+        except sqlite3.Error as e:
+            print(f"Cancellation store error: {e}")
+
+    def cancel(self, request_id: str, reason: str = "client", owner: Optional[str] = None,
+               kind: Optional[str] = None) -> bool:
+        """
+        Cancel the owner's in-flight request (any kind unless given). Returns False if it
+        already finished, is unknown, or belongs to another owner.
+        """
+        with self._lock:
+            entries: List[InFlight] = [
+                e for (o, k, rid), e in self._inflight.items()
+                if rid == request_id and o == owner and (kind is None or k == kind)
+            ]
+        cancelled = False
+        for entry in entries:
+            cancelled = self._cancel_entry(entry, reason) or cancelled
+        if cancelled or self.shared is None:
+            return cancelled
+        # このワーカーでは実行していない: 実行中のワーカーに取り消しを依頼して結果を待つ
+        try:
+            ids = self.shared.request(owner, request_id, kind, reason)
+            return bool(ids) and self.shared.outcome(ids)
+        except sqlite3.Error as e:
+            print(f"Cancellation store error: {e}")
+            return False
+
+    def _start_poller(self) -> None:
+        with self._lock:
+            if self._poller is not None:
+                return
+            self._poller = threading.Thread(target=self._poll, name="cancellation-poller", daemon=True)
+        self._poller.start()
+
+    def _poll(self) -> None:
+        """Apply cancel requests other workers queued for this one (only while something runs here)."""
+        while True:
+            time.sleep(self.shared.poll_interval)
+            with self._lock:
+                idle = not self._inflight
+            if idle:
+                continue
+            try:
+                for row in self.shared.pending():
+                    with self._lock:
+                        entry = self._inflight.get((row["owner"] or None, row["kind"], row["request_id"]))
+                    cancelled = entry is not None and self._cancel_entry(entry, row["reason"])
+                    self.shared.resolve(row["id"], cancelled)
+            except sqlite3.Error as e:
+                print(f"Cancellation store error: {e}")
+
+    def _cancel_entry(self, entry: InFlight, reason: str) -> bool:
+        if not entry.future.cancel():
+            return False
+        with self._lock:
+            self.cancelled_total += 1
+            self.cancelled_by_reason[reason] = self.cancelled_by_reason.get(reason, 0) + 1
+            self.cancelled_by_stage[entry.stage] = self.cancelled_by_stage.get(entry.stage, 0) + 1
+            # 予定していた回答のうち、まだ生成されていない分だけが節約される
+            expected = self._answer_tokens_avg * entry.expected_answers
+            self.estimated_tokens_saved += max(0, int(expected) - entry.produced_tokens)
+        print(f"Cancelled {entry.kind} request {entry.request_id} during {entry.stage} ({reason})")
+        return True
+
+    def record_answer_tokens(self, tokens: int) -> None:
+        """Feed completed-answer sizes into the tokens-saved estimate."""
+        if tokens <= 0:
+            return
+        with self._lock:
+            self._answers_seen += 1
+            alpha = max(0.05, 1.0 / self._answers_seen)
+            self._answer_tokens_avg += alpha * (tokens - self._answer_tokens_avg)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in_flight": len(self._inflight),
+                "cancelled_total": self.cancelled_total,
+                "cancelled_by_reason": dict(self.cancelled_by_reason),
+                "cancelled_by_stage": dict(self.cancelled_by_stage),
+                "estimated_tokens_saved": self.estimated_tokens_saved,
+                "avg_answer_tokens": round(self._answer_tokens_avg, 1),
+            }
+
+
+_registry: Optional[CancellationRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_cancellations() -> CancellationRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = CancellationRegistry(SharedCancellations())
+        return _registry
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上流 LLM 通信の記録/再生（カセット）レイヤー。
+
+- record: 実クライアント（上流プール）の前に挟み、リクエストと応答
+  （ストリームのチャンクとその到着タイミング、使用トークン数を含む）を
+  gzip 圧縮した JSON Lines カセットに 1 件ずつ追記する（ファイル全体は書き直さない）。
+  追記はファイルロック下で行うので、gunicorn の複数ワーカーが同じカセットに記録しても壊れない
+- replay: カセットから応答を返す。ネットワークも API キーも不要で、
+  本物の Orchestrator のコードパス（分類 → 回答 → ストリーミング）をそのまま通せる
+- ツール呼び出しのターン（FunctionCall の列）もそのまま記録・再生する
+- 再生速度は LLM_CASSETTE_SPEED で指定（0 = 待ちなしで最速、1 = 記録どおりのレイテンシ、
+  2 = 2 倍速）。性能の回帰比較では 1 を使う
+
+同じリクエスト（メッセージ列 + オプション）が複数回記録されていれば、記録順に返す
+（使い切ったら先頭に戻る）。未記録のリクエストは CassetteMissError。
+出力上限（max_tokens）はキーに含めないので、上限を調整しても同じカセットで再生できる。
+
+設定:
+- LLM_CASSETTE_MODE: off（既定）/ record / replay
+- LLM_CASSETTE_PATH: カセットファイル（既定 data/cassettes/default.json.gz）
+- LLM_CASSETTE_SPEED: 再生速度（既定 0）
+"""
+
+import os
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from typing import Any, AsyncIterator, Dict, List
+
+try:
+    import fcntl
+except ImportError:  # Windows: プロセス間ロックなし（スレッド間はロックする）
+    fcntl = None
+
+from autogen_core import FunctionCall
+from autogen_core.models import CreateResult, RequestUsage
+
+# 1: 単一の JSON（interactions の配列）、2: ヘッダー行 + 1 行 1 件の JSON Lines（gzip メンバーの連結）
+CASSETTE_VERSION = 2
+DEFAULT_CASSETTE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "cassettes", "default.json.gz"
+)
+
+# キーに含めないオプション（応答内容に影響しないもの）
+_IGNORED_OPTIONS = ("include_usage", "cancellation_token")
+# extra_create_args のうちキーに含めないもの（上限の調整で既存カセットが使えなくならないように）
+_IGNORED_CREATE_ARGS = ("max_tokens",)
+
+
+class CassetteMissError(KeyError):
+    """The replayed request was never recorded."""
+
+    def __init__(self, kind: str, preview: str):
+        super().__init__(f"no recorded {kind} interaction for request: {preview!r}")
+        self.kind = kind
+
+
+def request_key(kind: str, messages, kwargs: Dict[str, Any]) -> str:
+    """Stable key for a request: message types + contents + options that change the answer."""
+    payload = {
+        "kind": kind,
+        "messages": [[getattr(m, "type", type(m).__name__), getattr(m, "content", str(m))] for m in messages],
+        "options": _key_options(kwargs),
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def _key_options(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    options = {k: v for k, v in sorted(kwargs.items()) if k not in _IGNORED_OPTIONS}
+    extra = options.get("extra_create_args")
+    if isinstance(extra, dict):
+        extra = {k: v for k, v in extra.items() if k not in _IGNORED_CREATE_ARGS}
+        if extra:
+            options["extra_create_args"] = extra
+        else:
+            del options["extra_create_args"]
+    return options
+
+
+def _preview(messages) -> str:
+    last = getattr(messages[-1], "content", "") if messages else ""
+    return str(last)[:80]
+
+
+def _result_to_dict(result: CreateResult) -> Dict[str, Any]:
+    usage = result.usage
+    content = result.content
+    if not isinstance(content, str):
+        # ツール呼び出しのターン
+        content = [{"id": c.id, "name": c.name, "arguments": c.arguments} for c in content]
+    return {
+        "content": content,
+        "finish_reason": result.finish_reason,
+        "usage": [usage.prompt_tokens, usage.completion_tokens] if usage is not None else [0, 0],
+    }
+
+
+def _result_from_dict(data: Dict[str, Any]) -> CreateResult:
+    prompt, completion = data.get("usage") or [0, 0]
+    content = data["content"]
+    if not isinstance(content, str):
+        content = [FunctionCall(id=c["id"], name=c["name"], arguments=c["arguments"]) for c in content]
+    return CreateResult(
+        content=content,
+        finish_reason=data.get("finish_reason") or "stop",
+        usage=RequestUsage(prompt_tokens=prompt, completion_tokens=completion),
+        cached=False,
+    )
+
+
+class CassetteClient:
+    """
+    Record/replay wrapper with the model-client surface the Orchestrator uses
+    (create / create_stream / close / stats).
+    """
+
+    def __init__(self, path: str, mode: str = "replay", inner: Any = None, speed: float = 0.0,
+                 model_info: Any = None):
+        if mode not in ("record", "replay"):
+            raise ValueError("cassette mode must be record or replay")
+        if mode == "record" and inner is None:
+            raise ValueError("record mode needs the real client to record from")
+        self.path = path
+        self.mode = mode
+        self.inner = inner
+        self.speed = speed
+        self._model_info = model_info
+        self._lock = threading.Lock()
+        self.interactions: List[Dict[str, Any]] = []
+        self._cursor: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        if os.path.exists(path):
+            self.interactions = self._load()
+        elif mode == "replay":
+            raise FileNotFoundError(f"cassette not found: {path}")
+
+    @classmethod
+    def from_env(cls, inner_factory, model_info: Any = None) -> Any:
+        """
+        Wrap inner_factory() according to LLM_CASSETTE_MODE (off returns the real client).
+        model_info stands in for the real client's in replay (autogen agents check it).
+        """
+        mode = os.environ.get("LLM_CASSETTE_MODE", "off").strip().lower()
+        if mode in ("", "off"):
+            return inner_factory()
+        path = os.environ.get("LLM_CASSETTE_PATH", DEFAULT_CASSETTE_PATH)
+        speed = float(os.environ.get("LLM_CASSETTE_SPEED", "0"))
+        # replay では実クライアントを作らない（API キー不要）
+        inner = inner_factory() if mode == "record" else None
+        print(f"LLM cassette: {mode} {path} (speed={speed})")
+        return cls(path, mode, inner=inner, speed=speed, model_info=model_info)
+
+    # ---- storage ----
+    def _load(self) -> List[Dict[str, Any]]:
+        interactions: List[Dict[str, Any]] = []
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                if "key" in data:
+                    interactions.append(data)
+                elif data.get("version") not in (1, CASSETTE_VERSION):
+                    raise ValueError(f"unsupported cassette version: {data.get('version')}")
+                else:
+                    # version 1 は interactions をまとめて持つ（その後ろに追記された分も読む）
+                    interactions.extend(data.get("interactions", []))
+        return interactions
+
+    def _append(self, interaction: Dict[str, Any]) -> None:
+        """Append one interaction as its own gzip member (header first when the file is new)."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        line = json.dumps(interaction, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with open(self.path, "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if f.seek(0, os.SEEK_END) == 0:
+                    f.write(gzip.compress(json.dumps({"version": CASSETTE_VERSION}).encode("utf-8") + b"\n"))
+                f.write(gzip.compress(line.encode("utf-8")))
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _record(self, interaction: Dict[str, Any]) -> None:
+        with self._lock:
+            self.interactions.append(interaction)
+            self.recorded += 1
+            self._append(interaction)
+
+    def _lookup(self, kind: str, messages, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        key = request_key(kind, messages, kwargs)
+        with self._lock:
+            matches = [i for i in self.interactions if i["key"] == key]
+            if not matches:
+                self.misses += 1
+                raise CassetteMissError(kind, _preview(messages))
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            self.hits += 1
+            return matches[index % len(matches)]
+
+    async def _wait(self, seconds: float) -> None:
+        if self.speed > 0 and seconds > 0:
+            await asyncio.sleep(seconds / self.speed)
+
+    # ---- model client surface ----
+    @property
+    def model_info(self) -> Any:
+        if self.inner is not None:
+            return self.inner.model_info
+        if self._model_info is None:
+            raise AttributeError("model_info")
+        return self._model_info
+
+    async def create(self, messages, **kwargs) -> CreateResult:
+        if self.mode == "replay":
+            interaction = self._lookup("create", messages, kwargs)
+            await self._wait(interaction["elapsed"])
+            return _result_from_dict(interaction["result"])
+
+        start = time.monotonic()
+        result = await self.inner.create(messages, **kwargs)
+        self._record({
+            "key": request_key("create", messages, kwargs),
+            "kind": "create",
+            "prompt": _preview(messages),
+            "elapsed": round(time.monotonic() - start, 4),
+            "result": _result_to_dict(result),
+        })
+        return result
+
+    async def create_stream(self, messages, **kwargs) -> AsyncIterator[Any]:
+        if self.mode == "replay":
+            interaction = self._lookup("stream", messages, kwargs)
+            previous = 0.0
+            for offset, text in interaction["chunks"]:
+                await self._wait(offset - previous)
+                previous = offset
+                yield text
+            await self._wait(interaction["elapsed"] - previous)
+            yield _result_from_dict(interaction["result"])
+            return
+
+        start = time.monotonic()
+        chunks: List[List[Any]] = []
+        async for chunk in self.inner.create_stream(messages, **kwargs):
+            if isinstance(chunk, str):
+                chunks.append([round(time.monotonic() - start, 4), chunk])
+            elif isinstance(chunk, CreateResult):
+                # 最後まで受信できたストリームだけを記録する（途中で切れたものは残さない）
+                self._record({
+                    "key": request_key("stream", messages, kwargs),
+                    "kind": "stream",
+                    "prompt": _preview(messages),
+                    "elapsed": round(time.monotonic() - start, 4),
+                    "chunks": chunks,
+                    "result": _result_to_dict(chunk),
+                })
+            yield chunk
+
+    async def warmup(self, connect, timeout: float = 10.0) -> Dict[str, Any]:
+        # 再生時は接続先がない
+        if self.inner is None or not hasattr(self.inner, "warmup"):
+            return {}
+        return await self.inner.warmup(connect, timeout)
+
+    async def close(self) -> None:
+        if self.inner is not None:
+            await self.inner.close()
+
+    def stats(self) -> Dict[str, Any]:
+        inner = self.inner.stats() if hasattr(self.inner, "stats") else {}
+        with self._lock:
+            cassette = {
+                "mode": self.mode,
+                "path": self.path,
+                "speed": self.speed,
+                "interactions": len(self.interactions),
+                "hits": self.hits,
+                "misses": self.misses,
+                "recorded": self.recorded,
+            }
+        return {**inner, "cassette": cassette}
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+長い処理（グループチャット議論 / 分類→回答の多段フロー）の途中状態を
+ディスクに保存し、失敗後に最後に完了したステップから再開するためのストア。
+
+- 1 実行 = 1 ファイル（<CHECKPOINT_DIR>/<run_id>.json）。Web から起動した議論は
+  クライアントごとの名前空間（checkpoint_key）に保存し、他のクライアントが同じ run_id で再開できないようにする
+- 書き込みは一時ファイル + os.replace によるアトミック置換
+  （途中でプロセスが落ちても壊れた JSON が残らない）
+- JSON は区切り文字を詰めたコンパクト形式、日本語はエスケープしない
+- 種類（discussion / ask）を問わず、最後の保存から CHECKPOINT_TTL 秒を過ぎたものは再開に使わず削除する
+  （保存の GC_EVERY 回ごとにまとめて掃除。成功した実行は完了時に削除済み）
+
+設定:
+- CHECKPOINT_DIR: 保存先ディレクトリ（既定 data/checkpoints）
+- CHECKPOINT_TTL: チェックポイントを残す秒数（既定 86400 = 1 日）
+"""
+
+import os
+import re
+import json
+import hashlib
+import time
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+
+CHECKPOINT_VERSION = 1
+
+DEFAULT_CHECKPOINT_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "checkpoints"
+)
+
+CHECKPOINT_TTL = float(os.environ.get("CHECKPOINT_TTL", "86400"))
+# 期限切れファイルの掃除間隔（保存回数）
+GC_EVERY = 100
+
+# run_id はファイル名になるため、パス区切り等を含まない安全な文字だけ許可
+_RUN_ID_RE = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+# 保存名（run_id、またはクライアントのハッシュ + "." + run_id）
+_KEY_RE = re.compile(r"^[A-Za-z0-9_.-]{1,160}$")
+
+
+def validate_run_id(run_id: Optional[str]) -> Optional[str]:
+    """Stripped run_id (None when empty); ValueError when it cannot be a checkpoint name."""
+    run_id = str(run_id or "").strip() or None
+    if run_id is not None and not _RUN_ID_RE.match(run_id):
+        raise ValueError("run_id must be 1-128 characters of A-Z, a-z, 0-9, '_', '.' or '-'")
+    return run_id
+
+
+def checkpoint_key(run_id: str, owner: Optional[str] = None) -> str:
+    """Name run_id's checkpoint is stored under: scoped to owner (client identity) when given."""
+    if owner is None:
+        return run_id
+    return hashlib.sha256(owner.encode("utf-8")).hexdigest()[:16] + "." + run_id
+
+
+class CheckpointStore:
+    def __init__(self, root: Optional[str] = None, ttl: Optional[float] = None):
+        self.root = root or os.environ.get("CHECKPOINT_DIR", DEFAULT_CHECKPOINT_DIR)
+        self.ttl = CHECKPOINT_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._saves = 0
+
+    def _path(self, run_id: str) -> str:
+        if not _KEY_RE.match(run_id or ""):
+            raise ValueError(f"invalid run_id: {run_id!r}")
+        return os.path.join(self.root, f"{run_id}.json")
+
+    def save(self, run_id: str, kind: str, state: Dict[str, Any], **meta: Any) -> None:
+        """Atomically write the checkpoint for run_id (overwrites the previous one)."""
+        path = self._path(run_id)
+        os.makedirs(self.root, exist_ok=True)
+        payload = {
+            "version": CHECKPOINT_VERSION,
+            "run_id": run_id,
+            "kind": kind,
+            "updated_at": time.time(),
+            "meta": meta,
+            "state": state,
+        }
+        data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=f".{run_id}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._saves += 1
+            due = self._saves % GC_EVERY == 0
+        if due:
+            self.purge_expired()
+
+    def load(self, run_id: str, kind: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Return the stored payload, or None if missing / unreadable / other kind."""
+        try:
+            with open(self._path(run_id), "r", encoding="utf-8") as f:
+                payload = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if payload.get("version") != CHECKPOINT_VERSION:
+            return None
+        if kind is not None and payload.get("kind") != kind:
+            return None
+        if time.time() - payload.get("updated_at", 0) > self.ttl:
+            # 古すぎる途中結果からは再開しない
+            self.delete(run_id)
+            return None
+        return payload
+
+    def delete(self, run_id: str) -> None:
+        try:
+            os.unlink(self._path(run_id))
+        except FileNotFoundError:
+            pass
+
+    def purge_expired(self) -> int:
+        """Delete checkpoints (and leftover temp files) not saved for ttl seconds."""
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for name in names:
+            if not (name.endswith(".json") or name.endswith(".tmp")):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                # save() は毎回ファイルを置き換えるので、更新時刻 = 最後の保存
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            print(f"Checkpoint store: removed {removed} expired checkpoint(s)")
+        return removed
+
+    def list_runs(self, kind: Optional[str] = None) -> List[str]:
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        runs = []
+        for name in sorted(names):
+            if not name.endswith(".json") or name.startswith("."):
+                continue
+            run_id = name[: -len(".json")]
+            if kind is None or self.load(run_id, kind) is not None:
+                runs.append(run_id)
+        return runs
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上流 LLM 呼び出し用のサーキットブレーカー。
+
+- 直近 CIRCUIT_WINDOW_SECONDS 秒の呼び出し結果（成功/失敗/応答開始までの時間）を保持し、
+  エラー率または遅延呼び出し率がしきい値を超えたら open にする
+- 遅延の判定は回答の長さに左右されない値で行う: ストリームは最初のチャンクまでの時間、
+  一括の create は所要時間から出力トークン数 × CIRCUIT_SLOW_SECONDS_PER_TOKEN を差し引いた時間。
+  これが CIRCUIT_SLOW_CALL_SECONDS 以上なら遅延呼び出し（長い回答を正常に生成しただけでは数えない）
+- open の間は上流を呼ばずに即座に CircuitOpenError を送出
+  （呼び出し側はキーワード分類・簡易回答に切り替える）
+- CIRCUIT_OPEN_SECONDS 経過後は half-open として少数のプローブ呼び出しだけを通し、
+  成功すれば closed に戻る／失敗すれば再び open
+- 各呼び出しには UPSTREAM_TIMEOUT 秒のタイムアウトを設け、
+  gunicorn の --timeout までワーカーが塞がらないようにする
+  （ストリームは最初のチャンクとチャンク間隔ごと、create は max_tokens 分の生成時間を上乗せ）
+- BreakerClient はモデルクライアントの create / create_stream をブレーカー経由にするラッパー。
+  スケジューラー（scheduling.ScheduledClient）の内側に置き、枠の空き待ちを上流の遅延として数えない
+"""
+
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Deque, Dict, Optional, Tuple
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def output_tokens(result: Any) -> int:
+    """Completion tokens reported on a create() result (0 when unknown)."""
+    return getattr(getattr(result, "usage", None), "completion_tokens", 0) or 0
+
+
+class CallTiming:
+    """Start time of one guarded call; the wrapper sets latency when it measures it itself."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latency: Optional[float] = None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling upstream while the circuit is open."""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"circuit '{name}' is open (retry in {retry_in:.0f}s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str = "llm",
+        window_seconds: Optional[float] = None,
+        min_calls: Optional[int] = None,
+        error_rate: Optional[float] = None,
+        slow_call_seconds: Optional[float] = None,
+        slow_call_rate: Optional[float] = None,
+        slow_seconds_per_token: Optional[float] = None,
+        open_seconds: Optional[float] = None,
+        half_open_probes: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ):
+        env = os.environ.get
+        self.name = name
+        self.window_seconds = window_seconds if window_seconds is not None else float(env("CIRCUIT_WINDOW_SECONDS", "60"))
+        self.min_calls = min_calls if min_calls is not None else int(env("CIRCUIT_MIN_CALLS", "5"))
+        self.error_rate = error_rate if error_rate is not None else float(env("CIRCUIT_ERROR_RATE", "0.5"))
+        # 応答開始まで（出力トークン分の生成時間を除く）の秒数がこれ以上なら遅延呼び出し
+        self.slow_call_seconds = slow_call_seconds if slow_call_seconds is not None else float(env("CIRCUIT_SLOW_CALL_SECONDS", "10"))
+        self.slow_call_rate = slow_call_rate if slow_call_rate is not None else float(env("CIRCUIT_SLOW_CALL_RATE", "0.8"))
+        # 出力 1 トークンあたりに見込む生成時間（既定 0.05 秒 = 20 トークン/秒を下回らなければ正常）
+        self.slow_seconds_per_token = (slow_seconds_per_token if slow_seconds_per_token is not None
+                                       else float(env("CIRCUIT_SLOW_SECONDS_PER_TOKEN", "0.05")))
+        self.open_seconds = open_seconds if open_seconds is not None else float(env("CIRCUIT_OPEN_SECONDS", "30"))
+        self.half_open_probes = half_open_probes if half_open_probes is not None else int(env("CIRCUIT_HALF_OPEN_PROBES", "1"))
+        self.timeout = timeout if timeout is not None else float(env("UPSTREAM_TIMEOUT", "45"))
+
+        self._lock = threading.Lock()
+        self._calls: Deque[Tuple[float, bool, float]] = deque()  # (finished_at, ok, first-token latency)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self.opened_total = 0
+        self.rejected_total = 0
+
+    # ---- state ----
+    def _trim_locked(self, now: float) -> None:
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    def _open_locked(self, now: float) -> None:
+        if self._state != OPEN:
+            self.opened_total += 1
+            print(f"Circuit '{self.name}' opened")
+        self._state = OPEN
+        self._opened_at = now
+        self._probes_in_flight = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def _acquire(self) -> bool:
+        """Admit a call; returns True when it is a half-open probe."""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+                self._state = HALF_OPEN
+            if self._state == CLOSED:
+                return False
+            if self._state == HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return True
+            self.rejected_total += 1
+            retry_in = max(0.0, self.open_seconds - (now - self._opened_at))
+        raise CircuitOpenError(self.name, retry_in)
+
+    def _record(self, probe: bool, ok: bool, latency: float) -> None:
+        now = time.monotonic()
+        # 遅すぎる呼び出しは成功扱いでも上流の劣化として数える
+        slow = latency >= self.slow_call_seconds
+        with self._lock:
+            if probe:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if self._state != HALF_OPEN:
+                    return
+                if ok and not slow:
+                    self._state = CLOSED
+                    self._calls.clear()
+                    print(f"Circuit '{self.name}' closed")
+                else:
+                    self._open_locked(now)
+                return
+            self._calls.append((now, ok, latency))
+            self._trim_locked(now)
+            if self._state != CLOSED or len(self._calls) < self.min_calls:
+                return
+            total = len(self._calls)
+            errors = sum(1 for _, call_ok, _ in self._calls if not call_ok)
+            slows = sum(1 for _, _, lat in self._calls if lat >= self.slow_call_seconds)
+            if errors / total >= self.error_rate or slows / total >= self.slow_call_rate:
+                self._open_locked(now)
+
+    def _release(self, probe: bool) -> None:
+        if probe:
+            with self._lock:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def timeout_for(self, max_tokens: Optional[int] = None) -> float:
+        """Timeout of a non-streaming call: UPSTREAM_TIMEOUT plus generation time for max_tokens."""
+        return self.timeout + (max_tokens or 0) * self.slow_seconds_per_token
+
+    def first_token_latency(self, elapsed: float, tokens: int) -> float:
+        """Time a non-streaming call took beyond generating its output tokens."""
+        return max(0.0, elapsed - tokens * self.slow_seconds_per_token)
+
+    # ---- call wrappers ----
+    @asynccontextmanager
+    async def guard(self) -> AsyncIterator[CallTiming]:
+        """
+        Admit one upstream call and record its outcome (no timeout). The latency recorded is
+        timing.latency if the caller set it, else the time the block took.
+        """
+        probe = self._acquire()
+        timing = CallTiming()
+        try:
+            yield timing
+        except Exception:
+            self._record(probe, False, timing.elapsed() if timing.latency is None else timing.latency)
+            raise
+        except BaseException:
+            # キャンセル・ストリームの途中終了は上流の健全性とは無関係
+            self._release(probe)
+            raise
+        self._record(probe, True, timing.elapsed() if timing.latency is None else timing.latency)
+
+    async def call(self, coro: Awaitable[Any], max_tokens: Optional[int] = None) -> Any:
+        """
+        Await coro through the breaker with the upstream timeout applied (extended for max_tokens).
+        Slowness is judged on the time left after the output tokens' generation time.
+        """
+        try:
+            async with self.guard() as timing:
+                result = await asyncio.wait_for(coro, self.timeout_for(max_tokens))
+                timing.latency = self.first_token_latency(timing.elapsed(), output_tokens(result))
+                return result
+        except CircuitOpenError:
+            if asyncio.iscoroutine(coro):
+                coro.close()
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        state = self.state
+        with self._lock:
+            self._trim_locked(now)
+            calls = list(self._calls)
+            opened_at = self._opened_at
+        total = len(calls)
+        latencies = sorted(lat for _, _, lat in calls)
+
+        def pct(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3)
+
+        return {
+            "name": self.name,
+            "state": state,
+            "window_calls": total,
+            "error_rate": round(sum(1 for _, ok, _ in calls if not ok) / total, 3) if total else 0.0,
+            "slow_call_rate": round(sum(1 for lat in latencies if lat >= self.slow_call_seconds) / total, 3) if total else 0.0,
+            "latency_p50": pct(0.5),
+            "latency_p95": pct(0.95),
+            "retry_in": round(max(0.0, self.open_seconds - (now - opened_at)), 1) if state == OPEN else 0.0,
+            "opened_total": self.opened_total,
+            "rejected_total": self.rejected_total,
+            "timeout": self.timeout,
+            "slow_call_seconds": self.slow_call_seconds,
+        }
+
+
+class BreakerClient:
+    """
+    Model client wrapper that sends every create / create_stream through the breaker
+    (timeout, outcome record). Everything else is passed through.
+    """
+
+    def __init__(self, inner: Any, breaker: Optional[CircuitBreaker] = None):
+        self.inner = inner
+        self._breaker = breaker
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return self._breaker or get_breaker()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+    async def create(self, messages, **kwargs) -> Any:
+        max_tokens = (kwargs.get("extra_create_args") or {}).get("max_tokens")
+        return await self.breaker.call(self.inner.create(messages, **kwargs), max_tokens=max_tokens)
+
+    async def create_stream(self, messages, **kwargs) -> AsyncIterator[Any]:
+        breaker = self.breaker
+        async with breaker.guard() as timing:
+            stream = self.inner.create_stream(messages, **kwargs)
+            while True:
+                # 最初のチャンクとチャンク間隔にタイムアウトを設け、途中で止まった上流を待ち続けない
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), breaker.timeout)
+                except StopAsyncIteration:
+                    break
+                if timing.latency is None:
+                    # 遅延の判定は最初のチャンクまで（生成の長さと読み手の処理時間は含めない）
+                    timing.latency = timing.elapsed()
+                yield chunk
+
+    async def close(self) -> None:
+        await self.inner.close()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str = "llm") -> CircuitBreaker:
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
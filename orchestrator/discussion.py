@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+専門家2名（経済学/気候科学）によるグループチャット議論（../autogen_simple.py の
+run_discussion をオーケストレータ側へ移したもの）。
+
+autogen_simple.py は最低限の動作確認用として手を入れず、こちらに
+チェックポイント / 再開機能を持たせる:
+- 発言が確定するたびに（DISCUSSION_CHECKPOINT_EVERY 件ごとに）
+  team.save_state() を CheckpointStore へアトミックに保存
+- タイムアウトや 429 で途中失敗しても、同じ run_id で再実行すれば
+  最後に完了した発言の続きから再開する（それまでのターンの再課金なし）
+- 正常終了したらチェックポイントは削除
+
+発言者は既定で順番どおり（RoundRobinGroupChat）。DISCUSSION_SPEAKER_SELECTION=local では
+専門分野の語と直近の発言の重なりで次の発言者をプロセス内で選び、誰にも新しい論点が
+なければ議論を終える（speaker_selection.py、選択のための上流呼び出しなし）。
+
+Web からは DiscussionManager 経由で起動し、確定した発言（発話者・本文・
+トークン使用量）を Broadcaster で SSE 購読者へ逐次配信する（app.py 参照）。
+
+使い方:
+    python discussion.py                 # 新規実行（run_id を表示）
+    python discussion.py --resume <id>   # 失敗した議論を再開
+    python discussion.py --speaker-selection local
+"""
+
+import os
+import time
+import uuid
+import argparse
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from autogen_agentchat.agents import AssistantAgent
+from autogen_agentchat.base import TaskResult
+from autogen_agentchat.teams import RoundRobinGroupChat, SelectorGroupChat
+from autogen_agentchat.conditions import (
+    TextMentionTermination,
+    MaxMessageTermination,
+    SourceMatchTermination,
+)
+from autogen_agentchat.messages import BaseChatMessage
+
+from background import get_background_loop
+from broadcaster import Broadcaster
+from cancellation import get_cancellations
+from checkpoint import CheckpointStore, checkpoint_key
+from scheduling import INTERACTIVE, ScheduledClient, class_scope, get_scheduler
+from speaker_selection import LOCAL, LocalSpeakerSelector, NoNewPointsTermination, normalize_speaker_selection
+
+EXPERT_NAMES = ("economist", "climatologist")
+
+# 議題（ユーザー文側には『【結論】』のリテラルを含めない）
+DEFAULT_TASK = (
+    "議題: 大都市圏で2030年までに道路渋滞を30%削減する施策を検討しなさい。"
+    "各自の専門性（経済学/気候科学）の観点から、2〜4ターンで要点を出し合い、"
+    "最終的に合意の“結論”を1行で提示してください。"
+    "結論は政策の組み合わせ（例: 料金施策×需要抑制×代替手段強化）を含み、"
+    "実現可能性と副作用に触れて簡潔に書きなさい。"
+)
+
+# 表示ラベル（日本語）
+LABEL_MAP = {
+    "economist": "経済学者",
+    "climatologist": "気候科学者",
+    "user": "user",
+    "system": "system",
+}
+
+
+# 専門家ごとの指示（ローカルの発言者選択はここから各自の専門用語を取り出す）
+EXPERT_SYSTEM_MESSAGES = {
+    "economist": (
+        "あなたはマクロ経済・公共政策の教授です。政策評価（費用便益分析）、"
+        "税制設計、労働市場の一般均衡効果に精通しています。"
+        "主張には定量的根拠や参考値（概算）を示し、前提を明記してください。"
+        "冗長さは避け、要点を短くまとめて発言します。"
+        "最終ターンに限り、合意が形成できたと判断したら、最後の1行を"
+        "『【結論】…』で始めて簡潔に書きなさい。"
+    ),
+    "climatologist": (
+        "あなたは気候科学・環境工学の専門家です。温室効果ガス排出、"
+        "交通起源排出量の推計、ライフサイクル影響評価に精通しています。"
+        "不確実性と前提条件を明確化し、科学的妥当性を重視して発言します。"
+        "冗長さは避け、要点を短くまとめて発言します。"
+        "最終ターンに限り、合意が形成できたと判断したら、最後の1行を"
+        "『【結論】…』で始めて簡潔に書きなさい。"
+    ),
+}
+
+
+def build_agents(model_client) -> List[AssistantAgent]:
+    """2名の専門家エージェント（異分野）を作成"""
+    return [
+        AssistantAgent(name=name, model_client=model_client, system_message=EXPERT_SYSTEM_MESSAGES[name])
+        for name in EXPERT_NAMES
+    ]
+
+
+def build_team(model_client, speaker_selection: Optional[str] = None):
+    # 「【結論】」という文字列が *かつ* 発話者が専門家（=ユーザー以外）の時だけ停止。
+    text_done = TextMentionTermination("【結論】")
+    by_agent = SourceMatchTermination(EXPERT_NAMES[0]) | SourceMatchTermination(EXPERT_NAMES[1])
+    termination = (text_done & by_agent) | MaxMessageTermination(16)
+
+    if normalize_speaker_selection(speaker_selection) == LOCAL:
+        # selector_func が常に発言者を返すので、model_client は選択には使われない
+        selector = LocalSpeakerSelector(EXPERT_SYSTEM_MESSAGES)
+        return SelectorGroupChat(
+            participants=build_agents(model_client),
+            model_client=model_client,
+            termination_condition=termination | NoNewPointsTermination(selector),
+            max_turns=24,
+            selector_func=selector,
+            allow_repeated_speaker=True,
+        )
+    return RoundRobinGroupChat(
+        participants=build_agents(model_client),
+        termination_condition=termination,
+        max_turns=24,  # セーフティ上限
+    )
+
+
+def message_text(message: BaseChatMessage) -> str:
+    """content の取り出しは to_text() を優先"""
+    try:
+        text = message.to_text()
+        if isinstance(text, str):
+            return text
+    except Exception:
+        pass
+    content = getattr(message, "content", "")
+    return content if isinstance(content, str) else ""
+
+
+def print_message(source: str, content: str) -> None:
+    print(f"[{LABEL_MAP.get(source, source)}] {content}")
+
+
+async def run_discussion(
+    task: str = DEFAULT_TASK,
+    run_id: Optional[str] = None,
+    store: Optional[CheckpointStore] = None,
+    model_client=None,
+    on_message: Optional[Callable[[BaseChatMessage, str], Any]] = None,
+    checkpoint_every: Optional[int] = None,
+    speaker_selection: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    議論を実行（または run_id のチェックポイントから再開）する。
+    再開時は保存時と同じ発言者選択（チームの種類）を使う。
+    returns: {"run_id", "resumed", "speaker_selection", "messages": [{"source", "content"}], "stop_reason"}
+    """
+    store = store or CheckpointStore()
+    run_id = run_id or uuid.uuid4().hex
+    if checkpoint_every is None:
+        checkpoint_every = int(os.environ.get("DISCUSSION_CHECKPOINT_EVERY", "1"))
+    checkpoint_every = max(1, checkpoint_every)
+
+    owns_client = model_client is None
+    if owns_client:
+        # 上流プール（キー/エンドポイントのフェイルオーバー・429 クールダウン）とブレーカー・スケジューラー経由
+        from autogen_router import build_upstream_client
+        model_client = build_upstream_client()
+
+    saved = store.load(run_id, kind="discussion")
+    if saved:
+        speaker_selection = saved["meta"].get("speaker_selection") or speaker_selection
+    speaker_selection = normalize_speaker_selection(speaker_selection)
+    team = build_team(model_client, speaker_selection)
+    message_count = 0
+    if saved:
+        await team.load_state(saved["state"]["team"])
+        message_count = saved["state"].get("message_count", 0)
+        task = saved["meta"].get("task", task)
+        print(f"Resuming discussion {run_id} after {message_count} messages")
+        stream = team.run_stream()
+    else:
+        stream = team.run_stream(task=task)
+
+    messages: List[Dict[str, str]] = []
+    stop_reason: Optional[str] = None
+    since_checkpoint = 0
+
+    try:
+        async for message in stream:
+            if isinstance(message, TaskResult):
+                stop_reason = message.stop_reason
+                continue
+            if not isinstance(message, BaseChatMessage):
+                # イベントやエラーオブジェクトなどはスキップ
+                continue
+
+            message_count += 1
+            since_checkpoint += 1
+            if since_checkpoint >= checkpoint_every:
+                state = await team.save_state()
+                store.save(
+                    run_id,
+                    "discussion",
+                    {"team": state, "message_count": message_count},
+                    task=task,
+                    speaker_selection=speaker_selection,
+                )
+                since_checkpoint = 0
+
+            content = message_text(message)
+            # 空メッセージは表示しない
+            if not content.strip():
+                continue
+            source = getattr(message, "source", "unknown")
+            messages.append({"source": source, "content": content})
+            if on_message is not None:
+                on_message(message, content)
+            else:
+                print_message(source, content)
+    except BaseException:
+        print(f"Discussion {run_id} interrupted; resume with: python discussion.py --resume {run_id}")
+        raise
+    finally:
+        if owns_client:
+            try:
+                await model_client.close()
+            except Exception:
+                pass
+
+    store.delete(run_id)
+    return {
+        "run_id": run_id,
+        "resumed": bool(saved),
+        "speaker_selection": speaker_selection,
+        "messages": messages,
+        "stop_reason": stop_reason,
+    }
+
+
+def message_event(message: BaseChatMessage, content: str) -> Dict[str, Any]:
+    """Browser-facing event for one finalized chat message."""
+    source = getattr(message, "source", "unknown")
+    usage = getattr(message, "models_usage", None)
+    return {
+        "type": "message",
+        "source": source,
+        "label": LABEL_MAP.get(source, source),
+        "content": content,
+        "usage": {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+        } if usage is not None else None,
+    }
+
+
+class DiscussionRun:
+    def __init__(self, run_id: str, task: str, request_class: str = INTERACTIVE,
+                 speaker_selection: Optional[str] = None, client_id: Optional[str] = None):
+        self.run_id = run_id
+        self.task = task
+        self.request_class = request_class
+        self.client_id = client_id
+        self.speaker_selection = speaker_selection
+        self.broadcaster = Broadcaster()
+        self.status = "running"  # running / done / error / cancelled
+        self.stop_reason: Optional[str] = None
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self.future = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.run_id,
+            "status": self.status,
+            "speaker_selection": self.speaker_selection,
+            "stop_reason": self.stop_reason,
+            "error": self.error,
+            "subscribers": self.broadcaster.subscriber_count,
+        }
+
+
+class DiscussionManager:
+    """
+    Web 側から議論を起動し、確定した発言を Broadcaster 経由で購読者へ配る。
+    議論は常駐イベントループ（background.py）上で実行され、HTTP リクエストとは独立に進む。
+    """
+
+    def __init__(self, model_client_factory: Optional[Callable[[], Any]] = None,
+                 store: Optional[CheckpointStore] = None, max_finished: int = 50,
+                 model_client: Optional[Any] = None):
+        """
+        model_client: shared upstream client (e.g. the Orchestrator's), kept open between runs.
+        Without it each run gets model_client_factory() (default build_upstream_client), closed afterwards.
+        """
+        self._model_client = model_client
+        self._model_client_factory = model_client_factory
+        self._store = store or CheckpointStore()
+        self._max_finished = max_finished
+        # run_id はクライアントが決めるため (client_id, run_id) ごとに管理する
+        self._runs: "OrderedDict[Tuple[Optional[str], str], DiscussionRun]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, run_id: str, client_id: Optional[str] = None) -> Optional[DiscussionRun]:
+        """The client's run with this id (None for unknown ids and other clients' runs)."""
+        with self._lock:
+            return self._runs.get((client_id, run_id))
+
+    def start(self, task: Optional[str] = None, run_id: Optional[str] = None,
+              request_class: str = INTERACTIVE, speaker_selection: Optional[str] = None,
+              client_id: Optional[str] = None) -> DiscussionRun:
+        """
+        Start (or resume, when the client's run_id has a checkpoint) a discussion in the background.
+        Its upstream calls are scheduled in request_class, capped per client_id (see scheduling.py).
+        """
+        speaker_selection = normalize_speaker_selection(speaker_selection)
+        run_id = run_id or uuid.uuid4().hex
+        key = (client_id, run_id)
+        with self._lock:
+            existing = self._runs.get(key)
+            if existing is not None and existing.status == "running":
+                return existing
+            run = DiscussionRun(run_id, task or DEFAULT_TASK, request_class, speaker_selection, client_id)
+            self._runs[key] = run
+            self._runs.move_to_end(key)
+            self._prune_locked()
+        run.future = get_cancellations().track(
+            run.run_id, self._run(run), get_background_loop(), kind="discussion", owner=client_id
+        )
+        return run
+
+    def cancel(self, run_id: str, client_id: Optional[str] = None) -> bool:
+        """Stop the client's running discussion; its checkpoint is kept so it can be resumed."""
+        run = self.get(run_id, client_id)
+        if run is None or run.status != "running":
+            return False
+        return get_cancellations().cancel(run_id, kind="discussion", owner=client_id)
+
+    def _prune_locked(self) -> None:
+        finished = [key for key, r in self._runs.items() if r.status != "running"]
+        for key in finished[: max(0, len(finished) - self._max_finished)]:
+            del self._runs[key]
+
+    async def _run(self, run: DiscussionRun) -> None:
+        publish = run.broadcaster.publish
+        owned = None
+        try:
+            model_client = self._model_client
+            if model_client is None:
+                if self._model_client_factory is not None:
+                    owned = self._model_client_factory()
+                else:
+                    from autogen_router import build_upstream_client
+                    owned = build_upstream_client()
+                model_client = owned
+            if not isinstance(model_client, ScheduledClient):
+                model_client = ScheduledClient(model_client)
+            publish({"type": "start", "id": run.run_id, "task": run.task})
+            with get_scheduler().admit(run.request_class, run.client_id) as request_class, \
+                    class_scope(request_class):
+                result = await run_discussion(
+                    task=run.task,
+                    run_id=checkpoint_key(run.run_id, run.client_id),
+                    store=self._store,
+                    model_client=model_client,
+                    on_message=lambda message, content: publish(message_event(message, content)),
+                    speaker_selection=run.speaker_selection,
+                )
+            run.stop_reason = result["stop_reason"]
+            run.status = "done"
+            publish({"type": "done", "stop_reason": run.stop_reason, "resumed": result["resumed"]})
+        except asyncio.CancelledError:
+            run.status = "cancelled"
+            publish({"type": "error", "error": "cancelled", "resumable": True})
+            raise
+        except Exception as e:
+            run.status = "error"
+            run.error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            publish({"type": "error", "error": run.error, "resumable": True})
+        finally:
+            run.broadcaster.close()
+            if owned is not None:
+                try:
+                    await owned.close()
+                except Exception:
+                    pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Expert group-chat discussion with checkpoint/resume")
+    parser.add_argument("--resume", metavar="RUN_ID", help="resume an interrupted discussion")
+    parser.add_argument("--task", default=DEFAULT_TASK, help="discussion topic")
+    parser.add_argument("--speaker-selection", choices=("round_robin", "local"), default=None,
+                        help="next-speaker choice (default: DISCUSSION_SPEAKER_SELECTION)")
+    args = parser.parse_args()
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except Exception:
+        pass
+
+    print("\n================ 会話ログ（逐次） ================\n")
+    result = asyncio.run(run_discussion(task=args.task, run_id=args.resume,
+                                        speaker_selection=args.speaker_selection))
+    print("\n================ 停止情報 ================\n")
+    print(f"stop_reason: {result['stop_reason']}")
+    print("\n================ 実行完了 ================\n")
+
+
+if __name__ == "__main__":
+    main()
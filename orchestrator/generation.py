@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上流呼び出しごとの生成トークン上限（max_tokens）と、長さ上限で切れた回答の自動継続。
+
+- 分類器は {"label": ...} を返すだけなので小さな上限（CLASSIFY_MAX_TOKENS）。
+  gemini-2.5-flash は思考モデルで、思考トークンも上限に数えられるため分類では思考を切る
+  （reasoning_effort、CLASSIFY_REASONING_EFFORT）。それでも上限で切れた分類は件数を数える
+- 回答の上限はエージェントごとに agents.json の "max_tokens" で設定（なければ ANSWER_MAX_TOKENS）
+- 過去の回答の長さ（完了トークン数）を (エージェント, 質問の種類) ごとに記録し、
+  十分な件数が集まったら p95 × 余裕率 を上限にする（設定値を超えない・下限あり）
+- 上限で切れた回答（finish_reason = "length"）は続きを自動で依頼して連結する
+  （MAX_CONTINUATIONS 回まで）。長いコード回答も最後まで返る
+
+設定:
+- CLASSIFY_MAX_TOKENS（既定 128）/ ANSWER_MAX_TOKENS（既定 1536）/ SYNTHESIS_MAX_TOKENS（既定 2048）
+- CLASSIFY_REASONING_EFFORT: 分類呼び出しの reasoning_effort（既定 none = 思考なし、空なら送らない）
+- ADAPTIVE_MIN_SAMPLES: 適応を始めるまでの件数（既定 20）
+- ADAPTIVE_PERCENTILE（既定 0.95）/ ADAPTIVE_HEADROOM（既定 1.25）/ ADAPTIVE_FLOOR（既定 256）
+- MAX_CONTINUATIONS: 続きを依頼する最大回数（既定 3）
+"""
+
+import os
+import math
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from agent_registry import get_registry
+from cancellation import approx_tokens
+
+CLASSIFY_MAX_TOKENS = int(os.environ.get("CLASSIFY_MAX_TOKENS", "128"))
+ANSWER_MAX_TOKENS = int(os.environ.get("ANSWER_MAX_TOKENS", "1536"))
+SYNTHESIS_MAX_TOKENS = int(os.environ.get("SYNTHESIS_MAX_TOKENS", "2048"))
+MAX_CONTINUATIONS = int(os.environ.get("MAX_CONTINUATIONS", "3"))
+CLASSIFY_REASONING_EFFORT = os.environ.get("CLASSIFY_REASONING_EFFORT", "none").strip()
+
+CONTINUE_PROMPT = (
+    "出力が長さの上限で途切れました。直前の出力の続きだけを、"
+    "繰り返しや前置きなしで途切れた位置からそのまま書き続けてください。"
+)
+
+# 続きを依頼する用途（分類結果は途中で切れても使わない）
+CONTINUABLE = ("answer", "synthesis")
+
+
+def prompt_type(prompt: str) -> str:
+    """Coarse prompt class for the length statistics (answers to long / code prompts run longer)."""
+    if "```" in prompt:
+        return "code"
+    tokens = approx_tokens(prompt)
+    if tokens < 40:
+        return "short"
+    return "medium" if tokens < 200 else "long"
+
+
+def _percentile(values, q: float) -> int:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)]
+
+
+class GenerationLimits:
+    def __init__(self, history: Optional[int] = None):
+        env = os.environ.get
+        self.history = history if history is not None else int(env("ADAPTIVE_HISTORY", "200"))
+        self.min_samples = int(env("ADAPTIVE_MIN_SAMPLES", "20"))
+        self.percentile = float(env("ADAPTIVE_PERCENTILE", "0.95"))
+        self.headroom = float(env("ADAPTIVE_HEADROOM", "1.25"))
+        self.floor = int(env("ADAPTIVE_FLOOR", "256"))
+        self._lock = threading.Lock()
+        # (agent, prompt type) -> 直近の回答の完了トークン数
+        self._lengths: Dict[Tuple[str, str], Deque[int]] = {}
+        self.continuations = 0
+        self.truncated_answers = 0
+        self.truncated_classifications = 0
+
+    @staticmethod
+    def configured(agent: str) -> int:
+        spec = get_registry().get(agent)
+        value = spec.extra.get("max_tokens") if spec is not None else None
+        return int(value) if value else ANSWER_MAX_TOKENS
+
+    def _adaptive_locked(self, agent: str, kind: str, ceiling: int) -> int:
+        lengths = self._lengths.get((agent, kind))
+        if not lengths or len(lengths) < self.min_samples:
+            return ceiling
+        target = int(_percentile(lengths, self.percentile) * self.headroom)
+        return max(min(self.floor, ceiling), min(ceiling, target))
+
+    def limit(self, purpose: str, agent: str, prompt: str) -> Optional[int]:
+        """max_tokens for one upstream call (None keeps the client default)."""
+        if purpose == "classify":
+            return CLASSIFY_MAX_TOKENS
+        if purpose == "synthesis":
+            return SYNTHESIS_MAX_TOKENS
+        if purpose != "answer":
+            return None
+        ceiling = self.configured(agent)
+        with self._lock:
+            return self._adaptive_locked(agent, prompt_type(prompt), ceiling)
+
+    def create_args(self, purpose: str, agent: str, prompt: str) -> Dict[str, Any]:
+        """extra_create_args for one upstream call: max_tokens, and no thinking for the classifier."""
+        args: Dict[str, Any] = {}
+        max_tokens = self.limit(purpose, agent, prompt)
+        if max_tokens:
+            args["max_tokens"] = max_tokens
+        if purpose == "classify" and CLASSIFY_REASONING_EFFORT:
+            args["reasoning_effort"] = CLASSIFY_REASONING_EFFORT
+        return args
+
+    def observe_finish(self, purpose: str, finish_reason: Optional[str]) -> None:
+        """Count classifier replies cut off at max_tokens (their JSON is usually unusable)."""
+        if purpose != "classify" or finish_reason != "length":
+            return
+        with self._lock:
+            self.truncated_classifications += 1
+        print(f"Classification cut off at max_tokens={CLASSIFY_MAX_TOKENS}")
+
+    def observe(self, agent: str, prompt: str, completion_tokens: int, continuations: int = 0) -> None:
+        """Record the full length of a finished answer (continuations included)."""
+        if completion_tokens <= 0:
+            return
+        key = (agent, prompt_type(prompt))
+        with self._lock:
+            lengths = self._lengths.get(key)
+            if lengths is None:
+                lengths = self._lengths[key] = deque(maxlen=self.history)
+            lengths.append(completion_tokens)
+            if continuations:
+                self.truncated_answers += 1
+                self.continuations += continuations
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            per_key = {}
+            for (agent, kind), lengths in sorted(self._lengths.items()):
+                ceiling = self.configured(agent)
+                per_key[f"{agent}/{kind}"] = {
+                    "samples": len(lengths),
+                    "p50": _percentile(lengths, 0.5),
+                    "p95": _percentile(lengths, 0.95),
+                    "max_tokens": self._adaptive_locked(agent, kind, ceiling),
+                    "configured": ceiling,
+                }
+            return {
+                "classify_max_tokens": CLASSIFY_MAX_TOKENS,
+                "classify_reasoning_effort": CLASSIFY_REASONING_EFFORT or None,
+                "truncated_classifications": self.truncated_classifications,
+                "truncated_answers": self.truncated_answers,
+                "continuations": self.continuations,
+                "answers": per_key,
+            }
+
+
+_limits: Optional[GenerationLimits] = None
+_limits_lock = threading.Lock()
+
+
+def get_generation_limits() -> GenerationLimits:
+    global _limits
+    with _limits_lock:
+        if _limits is None:
+            _limits = GenerationLimits()
+        return _limits
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""
+本番用の gunicorn 設定（docker-compose.prod.yml: gunicorn -c gunicorn.conf.py app:app）
+
+preload_app でマスターが app と重いモジュール（autogen / openai）を一度だけ読み込み、
+fork したワーカーは copy-on-write でそれを共有する。ワーカーの起動・再起動（max_requests）では
+import をやり直さない。Orchestrator（HTTP クライアント）やバックグラウンドスレッドは
+fork 後に各ワーカーで初めて使われたときに作られる。
+
+各ワーカーは起動直後（post_worker_init）にウォームアップを始め、終わるまで /readyz は 503 を返す。
+
+--reload と preload_app は併用できない（コードを再読み込みしない）ため、
+GUNICORN_RELOAD=1 のときは preload しない。
+"""
+
+import gc
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+reload = os.environ.get("GUNICORN_RELOAD", "0") == "1"
+preload_app = not reload
+# メモリの断片化対策にワーカーを定期的に入れ替える（preload 済みなので再起動は軽い）
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from startup import preload_modules
+    preload_modules()
+    # 読み込み済みオブジェクトを GC の対象外にし、ワーカーでの参照カウント更新による
+    # copy-on-write ページの複製を減らす
+    gc.freeze()
+    server.log.info("Preloaded heavy modules in master (frozen %d objects)", gc.get_freeze_count())
+
+
+def post_worker_init(worker):
+    # 上流への接続・索引・ストアをワーカーごとに準備（readiness.py）
+    import app
+    app.start_warmup()
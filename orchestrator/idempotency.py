@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Idempotency-Key による再送の重複排除（gunicorn の全ワーカーで共有）。
+
+プロキシのタイムアウトなどでクライアントが同じリクエストを送り直しても、回答を作り直さない。
+
+- キーはクライアント × エンドポイント × Idempotency-Key ヘッダーごと。本文（request_id を除く）の
+  ハッシュも記録し、同じキーで別の内容が届いたら 422 を返す
+- 実行中の再送: 同じワーカーなら実行中の処理の完了を待って同じ結果を返す（上流を二重に呼ばない）。
+  別のワーカーで実行中なら共有ストアを完了までポーリングし、IDEMPOTENCY_WAIT 秒を過ぎたら
+  409（Retry-After 付き）
+- 完了後の再送: 成功（2xx）した結果を IDEMPOTENCY_TTL 秒保持し、そのまま返す
+  （Idempotent-Replayed: true）。失敗・キャンセルと、上流障害中の縮退応答（"degraded": true の 200）は
+  保存せず、再送で実行し直す（回復後の再送が定型文を受け取り続けないように）
+- 直近の結果はプロセス内に、全ワーカー共有の状態は SQLite（WAL）に置く。実行中の記録には
+  期限（IDEMPOTENCY_LEASE）があり、ワーカーが落ちても再送で実行し直せる
+- ストアの障害時は重複排除なしでそのまま実行する（fail open）
+
+設定:
+- IDEMPOTENCY_TTL: 結果を保持する秒数（既定 600）
+- IDEMPOTENCY_WAIT: 別ワーカーで実行中の結果を待つ最大秒数（既定 120）
+- IDEMPOTENCY_LEASE: 実行中の記録の有効期間（秒、既定 300）
+- IDEMPOTENCY_DB: SQLite のパス（既定 data/idempotency.sqlite3）
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "idempotency.sqlite3")
+
+# 別ワーカーの完了を待つときのポーリング間隔 / プロセス内に保持する結果の件数 / 期限切れ行の掃除間隔
+POLL_INTERVAL = 0.2
+LOCAL_RESULTS = 1000
+GC_EVERY = 200
+# 本文のハッシュに含めないフィールド（再送ごとに変わってよい）
+VOLATILE_FIELDS = ("request_id",)
+
+# (status code, JSON body, replayed)
+Outcome = Tuple[int, Dict[str, Any], bool]
+
+
+class IdempotencyConflict(Exception):
+    """Same key still running on another worker past the wait limit (409)."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("a request with this Idempotency-Key is still in progress")
+        self.retry_after = retry_after
+
+
+class IdempotencyMismatch(Exception):
+    """Same key reused with a different request body (422)."""
+
+    def __init__(self):
+        super().__init__("Idempotency-Key was already used with a different request body")
+
+
+def storable(status: int, body: Dict[str, Any]) -> bool:
+    """Only complete successes are kept: not failures, cancellations or degraded fallbacks."""
+    return 200 <= status < 300 and not (isinstance(body, dict) and body.get("degraded"))
+
+
+def scope_key(client_id: str, endpoint: str, key: str) -> str:
+    return hashlib.sha256(f"{client_id}\x00{endpoint}\x00{key}".encode("utf-8")).hexdigest()
+
+
+def fingerprint(data: Dict[str, Any]) -> str:
+    body = {k: v for k, v in data.items() if k not in VOLATILE_FIELDS}
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, path: Optional[str] = None, ttl: Optional[float] = None,
+                 wait: Optional[float] = None, lease: Optional[float] = None):
+        env = os.environ.get
+        self.path = path or env("IDEMPOTENCY_DB", DEFAULT_DB_PATH)
+        self.ttl = ttl if ttl is not None else float(env("IDEMPOTENCY_TTL", "600"))
+        self.wait = wait if wait is not None else float(env("IDEMPOTENCY_WAIT", "120"))
+        self.lease = lease if lease is not None else float(env("IDEMPOTENCY_LEASE", "300"))
+        self._lock = threading.Lock()
+        # このワーカーで実行中: key -> (fingerprint, Future[(status, body) / None = 実行せずに手放した])
+        self._running: Dict[str, Tuple[str, Future]] = {}
+        # このワーカーで完了した結果: key -> (fingerprint, status, body, expires)
+        self._done: Dict[str, Tuple[str, int, Dict[str, Any], float]] = {}
+        self.counters = {"executed": 0, "attached": 0, "replayed": 0, "waited": 0, "conflicts": 0, "mismatches": 0}
+        self._ops = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency ("
+                "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, state TEXT NOT NULL, "
+                "status INTEGER, body TEXT, expires REAL NOT NULL)"
+            )
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # 接続はスレッドごとに都度開く（autocommit、トランザクションは明示的に BEGIN）
+        return sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    # ---- shared store ----
+    def _claim(self, key: str, body_hash: str) -> Optional[Tuple[str, Optional[int], Optional[str]]]:
+        """
+        Atomically take the key for execution (returns None), or the existing row's
+        (state, status, body) if another execution holds or finished it.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT fingerprint, state, status, body, expires FROM idempotency WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[4] > now:
+                conn.execute("COMMIT")
+                if row[0] != body_hash:
+                    raise IdempotencyMismatch()
+                return row[1], row[2], row[3]
+            conn.execute(
+                "INSERT INTO idempotency (key, fingerprint, state, status, body, expires) "
+                "VALUES (?, ?, 'running', NULL, NULL, ?) ON CONFLICT(key) DO UPDATE SET "
+                "fingerprint = excluded.fingerprint, state = 'running', status = NULL, body = NULL, "
+                "expires = excluded.expires",
+                (key, body_hash, now + self.lease),
+            )
+            conn.execute("COMMIT")
+            return None
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _finish(self, key: str, status: int, body: Dict[str, Any]) -> None:
+        conn = self._connect()
+        try:
+            if storable(status, body):
+                conn.execute(
+                    "UPDATE idempotency SET state = 'done', status = ?, body = ?, expires = ? WHERE key = ?",
+                    (status, json.dumps(body, ensure_ascii=False), time.time() + self.ttl, key),
+                )
+            else:
+                # 失敗・キャンセル・縮退応答は残さない（再送で実行し直す）
+                conn.execute("DELETE FROM idempotency WHERE key = ? AND state = 'running'", (key,))
+        finally:
+            conn.close()
+
+    def _maybe_gc(self) -> None:
+        with self._lock:
+            self._ops += 1
+            if self._ops % GC_EVERY:
+                return
+            now = time.time()
+            for key in [k for k, v in self._done.items() if v[3] <= now]:
+                del self._done[key]
+        try:
+            conn = self._connect()
+            try:
+                conn.execute("DELETE FROM idempotency WHERE expires <= ?", (time.time(),))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"Idempotency store cleanup failed: {e}")
+
+    # ---- entry point ----
+    def run(self, key: str, body_hash: str, execute: Callable[[], Tuple[int, Dict[str, Any]]]) -> Outcome:
+        """
+        Execute once per key: returns (status, body, replayed). Raises IdempotencyMismatch
+        or IdempotencyConflict; sqlite errors fall back to plain execution.
+        """
+        self._maybe_gc()
+        deadline = time.monotonic() + self.wait
+        while True:
+            with self._lock:
+                done = self._done.get(key)
+                running = self._running.get(key)
+            if done is not None and done[3] > time.time():
+                if done[0] != body_hash:
+                    self._count("mismatches")
+                    raise IdempotencyMismatch()
+                self._count("replayed")
+                return done[1], done[2], True
+            if running is not None:
+                if running[0] != body_hash:
+                    self._count("mismatches")
+                    raise IdempotencyMismatch()
+                # 同じワーカーで実行中: 完了を待って同じ結果を返す
+                outcome = running[1].result()
+                if outcome is None:
+                    continue
+                self._count("attached")
+                return outcome[0], outcome[1], True
+
+            future: Future = Future()
+            with self._lock:
+                # ロックの外で確認してから登録するまでに同じキーが登録されていたらやり直す
+                if key in self._running:
+                    continue
+                self._running[key] = (body_hash, future)
+            try:
+                existing = self._claim(key, body_hash)
+            except IdempotencyMismatch:
+                self._release(key, future, None)
+                self._count("mismatches")
+                raise
+            except sqlite3.Error as e:
+                print(f"Idempotency store unavailable, executing without it: {e}")
+                existing = None
+            except BaseException as e:
+                self._release(key, future, e)
+                raise
+
+            if existing is None:
+                return self._execute(key, body_hash, future, execute)
+
+            # 別のワーカーが実行中 / 完了済み
+            self._release(key, future, None)
+            state, status, body = existing
+            if state == "done":
+                self._count("replayed")
+                return status, json.loads(body), True
+            if time.monotonic() >= deadline:
+                self._count("conflicts")
+                raise IdempotencyConflict(retry_after=max(1.0, self.lease / 10))
+            self._count("waited")
+            time.sleep(POLL_INTERVAL)
+
+    def _release(self, key: str, future: Future, error: Optional[BaseException]) -> None:
+        with self._lock:
+            if self._running.get(key, (None, None))[1] is future:
+                del self._running[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            # 待っていた再送は最初からやり直す（共有ストアの状態を見に行く）
+            future.set_result(None)
+
+    def _execute(self, key: str, body_hash: str, future: Future,
+                 execute: Callable[[], Tuple[int, Dict[str, Any]]]) -> Outcome:
+        self._count("executed")
+        try:
+            status, body = execute()
+        except BaseException as e:
+            self._release(key, future, e)
+            try:
+                self._finish(key, 500, {})
+            except sqlite3.Error:
+                pass
+            raise
+        try:
+            self._finish(key, status, body)
+        except sqlite3.Error as e:
+            print(f"Idempotency result not stored: {e}")
+        with self._lock:
+            if storable(status, body):
+                self._done[key] = (body_hash, status, body, time.time() + self.ttl)
+                while len(self._done) > LOCAL_RESULTS:
+                    self._done.pop(next(iter(self._done)))
+            self._running.pop(key, None)
+        future.set_result((status, body))
+        return status, body, False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"ttl": self.ttl, "running": len(self._running), "cached": len(self._done), **self.counters}
+
+
+_store: Optional[IdempotencyStore] = None
+_store_lock = threading.Lock()
+
+
+def get_idempotency() -> IdempotencyStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = IdempotencyStore()
+        return _store
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+非同期ジョブキュー（投入 → ポーリング / 完了イベント / Webhook）。
+
+- POST 時はジョブを SQLite に積んで ID を即座に返すだけなので、
+  Web ワーカーのスレッドは回答生成の間ずっと塞がらない
+- 常駐イベントループ（background.py）上の asyncio ワーカー群が
+  優先度の高い順（同じなら古い順）にジョブを取り出して実行
+- キューは SQLite 上にあるため、gunicorn の各ワーカープロセスが同じキューを共有し、
+  プロセスが落ちてもリース切れのジョブは他のワーカーが拾い直す
+  （実行中はリースを定期的に延長するので、長いジョブが二重に実行されることはない）
+- 結果は JOB_RESULT_TTL 秒保持（期限切れは自動削除）
+- 完了時は同一プロセスの待機者へ即時通知（他プロセスはポーリング間隔で検知）し、
+  webhook が指定されていれば結果を POST する
+- webhook は DNS 解決後のアドレスがプライベート / ループバック / リンクローカル等なら拒否
+  （JOB_WEBHOOK_ALLOWED_HOSTS に明示したホストだけは内部アドレスでも許可）。リダイレクトは追わない
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import ipaddress
+import concurrent.futures
+import sqlite3
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jobs.sqlite3")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+CANCELLED = "cancelled"
+TERMINAL = (DONE, ERROR, CANCELLED)
+
+MIN_PRIORITY, MAX_PRIORITY = -10, 10
+
+
+def _public_address(host: str, port: int) -> bool:
+    """True when every address the host resolves to is globally routable."""
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        return False
+    for info in infos:
+        addr = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+        if isinstance(addr, ipaddress.IPv6Address) and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+        if (addr.is_private or addr.is_loopback or addr.is_link_local or addr.is_multicast
+                or addr.is_reserved or addr.is_unspecified or not addr.is_global):
+            return False
+    return bool(infos)
+
+
+def validate_webhook(url: Optional[str]) -> Optional[str]:
+    """
+    Accept only http(s) URLs that resolve to public addresses.
+    With JOB_WEBHOOK_ALLOWED_HOSTS set, only those hosts are accepted (and trusted even if internal).
+    """
+    if not url:
+        return None
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("webhook must be an http(s) URL")
+    allowed = [h.strip() for h in os.environ.get("JOB_WEBHOOK_ALLOWED_HOSTS", "").split(",") if h.strip()]
+    if allowed:
+        if parsed.hostname not in allowed:
+            raise ValueError(f"webhook host {parsed.hostname} is not allowed")
+        return url
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    except ValueError:
+        raise ValueError("webhook must be an http(s) URL")
+    if not _public_address(parsed.hostname, port):
+        raise ValueError(f"webhook host {parsed.hostname} does not resolve to a public address")
+    return url
+
+
+class JobStore:
+    def __init__(self, path: Optional[str] = None, ttl: Optional[float] = None, lease_seconds: Optional[float] = None):
+        self.path = path or os.environ.get("JOB_DB", DEFAULT_DB_PATH)
+        self.ttl = ttl if ttl is not None else float(os.environ.get("JOB_RESULT_TTL", "3600"))
+        # 実行中のまま更新が止まったジョブ（プロセス停止など）を再実行するまでの時間
+        self.lease_seconds = lease_seconds if lease_seconds is not None else float(os.environ.get("JOB_LEASE_SECONDS", "300"))
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, status TEXT NOT NULL, priority INTEGER NOT NULL, "
+                "payload TEXT NOT NULL, result TEXT, error TEXT, webhook TEXT, "
+                "attempts INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, "
+                "started REAL, finished REAL, expires REAL, heartbeat REAL)"
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "heartbeat" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created)")
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        job = {
+            "id": row["id"],
+            "status": row["status"],
+            "priority": row["priority"],
+            "attempts": row["attempts"],
+            "created_at": row["created"],
+            "started_at": row["started"],
+            "finished_at": row["finished"],
+            "expires_at": row["expires"],
+        }
+        if row["result"] is not None:
+            job["result"] = json.loads(row["result"])
+        if row["error"] is not None:
+            job["error"] = row["error"]
+        return job
+
+    def enqueue(self, payload: Dict[str, Any], priority: int = 0, webhook: Optional[str] = None) -> Dict[str, Any]:
+        job_id = uuid.uuid4().hex
+        priority = max(MIN_PRIORITY, min(MAX_PRIORITY, int(priority)))
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, status, priority, payload, webhook, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, priority, json.dumps(payload, ensure_ascii=False), webhook, time.time()),
+            )
+            return self._to_dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+        finally:
+            conn.close()
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Atomically take the next job (highest priority, oldest first, or an expired lease)."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? OR (status = ? AND COALESCE(heartbeat, started) < ?) "
+                "ORDER BY priority DESC, created LIMIT 1",
+                (QUEUED, RUNNING, now - self.lease_seconds),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, started = ?, heartbeat = ?, attempts = attempts + 1 WHERE id = ?",
+                (RUNNING, now, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return {"id": row["id"], "payload": json.loads(row["payload"]), "webhook": row["webhook"]}
+
+    def renew(self, job_id: str) -> bool:
+        """Extend the lease of a running job so other workers do not re-claim it."""
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE id = ? AND status = ?", (time.time(), job_id, RUNNING)
+            )
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def requeue(self, job_id: str) -> None:
+        """Hand a running job back to the queue (its worker is shutting down)."""
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE jobs SET status = ?, heartbeat = NULL WHERE id = ? AND status = ?",
+                         (QUEUED, job_id, RUNNING))
+        finally:
+            conn.close()
+
+    def finish(self, job_id: str, status: str, result: Any = None, error: Optional[str] = None) -> None:
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished = ?, expires = ? "
+                "WHERE id = ? AND status NOT IN (?, ?, ?)",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 error, now, now + self.ttl, job_id, *TERMINAL),
+            )
+        finally:
+            conn.close()
+
+    def cancel_queued(self, job_id: str) -> bool:
+        now = time.time()
+        conn = self._connect()
+        try:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, finished = ?, expires = ? WHERE id = ? AND status = ?",
+                (CANCELLED, now, now + self.ttl, job_id, QUEUED),
+            )
+            return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE id = ? AND (expires IS NULL OR expires > ?)", (job_id, time.time())
+            ).fetchone()
+        finally:
+            conn.close()
+        return self._to_dict(row) if row is not None else None
+
+    def purge_expired(self) -> int:
+        conn = self._connect()
+        try:
+            return conn.execute("DELETE FROM jobs WHERE expires IS NOT NULL AND expires <= ?", (time.time(),)).rowcount
+        finally:
+            conn.close()
+
+    def counts(self) -> Dict[str, int]:
+        conn = self._connect()
+        try:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        finally:
+            conn.close()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # リダイレクト先は検証していないので追わない（3xx はそのまま失敗扱い）
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_webhook_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def post_webhook(url: str, body: Dict[str, Any], attempts: int = 3, timeout: float = 10.0) -> bool:
+    """POST the finished job as JSON, retrying with backoff (runs in a worker thread)."""
+    data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    for attempt in range(attempts):
+        try:
+            # 投入後に DNS が内部アドレスへ向け直されていないか、送信直前に再検証する
+            validate_webhook(url)
+            req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"}, method="POST")
+            with _webhook_opener.open(req, timeout=timeout) as resp:
+                if resp.status < 300:
+                    return True
+        except ValueError as e:
+            print(f"Webhook {url} rejected: {e}")
+            return False
+        except (urllib.error.URLError, OSError) as e:
+            print(f"Webhook {url} failed (attempt {attempt + 1}): {e}")
+        time.sleep(min(8.0, 0.5 * (2 ** attempt)))
+    return False
+
+
+class JobQueue:
+    """
+    Background asyncio workers draining the JobStore.
+    runner(payload) -> JSON-serialisable result (e.g. orchestrator.ask_async).
+    """
+
+    def __init__(self, store: JobStore, runner: Callable[[Dict[str, Any]], Awaitable[Any]],
+                 workers: Optional[int] = None, poll_interval: Optional[float] = None, loop=None):
+        self.store = store
+        self.runner = runner
+        self.workers = workers if workers is not None else int(os.environ.get("JOB_WORKERS", "4"))
+        # 他プロセスが積んだジョブを拾うためのポーリング間隔
+        self.poll_interval = poll_interval if poll_interval is not None else float(os.environ.get("JOB_POLL_INTERVAL", "1.0"))
+        if loop is None:
+            from background import get_background_loop
+            loop = get_background_loop()
+        self._loop = loop
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List["asyncio.Task[Any]"] = []
+        self._running: Dict[str, "asyncio.Task[Any]"] = {}
+        self._cancel_requested: set = set()
+        self._changed = threading.Condition()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._started:
+                return
+            self._started = True
+        self._loop.submit(self._start_workers()).result()
+
+    async def _start_workers(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._janitor()))
+
+    def stop(self) -> None:
+        """Stop the workers (running jobs go back to the queue; queued ones stay for the next start)."""
+        with self._start_lock:
+            if not self._started:
+                return
+            self._started = False
+        try:
+            self._loop.run(self._stop_workers(), timeout=10.0)
+        except concurrent.futures.TimeoutError:
+            print("Job workers did not stop within 10s (running jobs are re-claimed after their lease)")
+
+    async def _stop_workers(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def submit(self, payload: Dict[str, Any], priority: int = 0, webhook: Optional[str] = None) -> Dict[str, Any]:
+        self.start()
+        job = self.store.enqueue(payload, priority=priority, webhook=validate_webhook(webhook))
+        self._loop.loop.call_soon_threadsafe(self._wakeup.set)
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued job, or a running one owned by this process."""
+        if self.store.cancel_queued(job_id):
+            self._notify()
+            return True
+        task = self._running.get(job_id)
+        if task is None:
+            return False
+        self._cancel_requested.add(job_id)
+        self._loop.loop.call_soon_threadsafe(task.cancel)
+        return True
+
+    def _notify(self) -> None:
+        with self._changed:
+            self._changed.notify_all()
+
+    def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Block until the job changes state here (or timeout), then return its current record."""
+        with self._changed:
+            self._changed.wait(timeout)
+        return self.store.get(job_id)
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            try:
+                job = await asyncio.to_thread(self.store.claim)
+            except Exception as e:
+                print(f"Job worker {index}: claim failed: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._execute(job)
+
+    async def _heartbeat(self, job_id: str) -> None:
+        interval = max(0.05, self.store.lease_seconds / 3)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.store.renew, job_id)
+            except Exception as e:
+                print(f"Job {job_id}: lease renewal failed: {e}")
+
+    async def _execute(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        task = asyncio.ensure_future(self.runner(job["payload"]))
+        heartbeat = asyncio.ensure_future(self._heartbeat(job_id))
+        self._running[job_id] = task
+        self._notify()
+        body: Dict[str, Any] = {"id": job_id}
+        try:
+            result = await task
+            await asyncio.to_thread(self.store.finish, job_id, DONE, result)
+            body.update(status=DONE, result=result)
+            self.completed += 1
+        except asyncio.CancelledError:
+            if job_id not in self._cancel_requested:
+                # ワーカー自体の停止（stop()）: 状態をキューに戻してから取り消しを伝播する
+                task.cancel()
+                try:
+                    await asyncio.to_thread(self.store.requeue, job_id)
+                except Exception as e:
+                    print(f"Job {job_id}: requeue failed: {e}")
+                raise
+            await asyncio.to_thread(self.store.finish, job_id, CANCELLED)
+            body.update(status=CANCELLED)
+        except Exception as e:
+            error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            await asyncio.to_thread(self.store.finish, job_id, ERROR, None, error)
+            body.update(status=ERROR, error=error)
+            self.failed += 1
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job_id, None)
+            self._cancel_requested.discard(job_id)
+            self._notify()
+        if job.get("webhook"):
+            await asyncio.to_thread(post_webhook, job["webhook"], body)
+
+    async def _janitor(self) -> None:
+        while True:
+            await asyncio.sleep(max(60.0, min(self.store.ttl, 600.0)))
+            try:
+                await asyncio.to_thread(self.store.purge_expired)
+            except Exception as e:
+                print(f"Job purge failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers if self._started else 0,
+            "running_here": len(self._running),
+            "completed": self.completed,
+            "failed": self.failed,
+            "by_status": self.store.counts(),
+        }
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+本番向けのオンデマンド・サンプリングプロファイラ。
+
+- リクエストの一部（PROFILE_SAMPLE_RATE、または /admin/profile で一時的に指定した割合）だけを対象にする
+- 対象リクエストがある間だけ専用スレッドが PROFILE_INTERVAL 秒ごとに
+  sys._current_frames() でスタックを採取（計測対象のコードには手を入れない統計的プロファイラ）
+- Web スレッドのスタック（JSON 処理など）に加え、常駐ループ上で実行中の asyncio タスクのスタックも
+  つなげて記録する。タスクが上流応答などを待っている間は「[await ...]」として計上するので、
+  CPU 時間だけでなく待ち時間もエンドポイントごとに見える
+- エンドポイントごとに collapsed stacks（flamegraph.pl / speedscope 互換）または
+  speedscope JSON で /admin/profile/<endpoint> からダウンロード
+- gunicorn の複数ワーカーで使えるよう、一時的な割合とリセットは PROFILE_DIR の control.json で共有し
+  （各ワーカーが 1 秒ごとに確認）、各ワーカーの採取結果は worker-<pid>.json に書き出す。
+  /admin/profile のサマリーとダウンロードは全ワーカー分を合算する
+
+/admin/* は ADMIN_TOKEN（Authorization: Bearer / X-Admin-Token）で保護し、未設定なら無効。
+
+設定:
+- PROFILE_SAMPLE_RATE: 対象にするリクエストの割合（既定 0 = 無効）
+- PROFILE_INTERVAL: スタックを採取する間隔（秒、既定 0.01）
+- PROFILE_DIR: ワーカー間で共有する設定と採取結果の置き場所（既定 data/profiles）
+"""
+
+import os
+import sys
+import glob
+import hmac
+import json
+import time
+import random
+import asyncio
+import tempfile
+import threading
+import contextvars
+from collections import Counter
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
+
+DEFAULT_PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "profiles")
+
+# 他のワーカーが変えた割合・リセットを確認する間隔と、採取結果を書き出すまでの待ち（秒）
+CONTROL_REFRESH = 1.0
+FLUSH_DELAY = 1.0
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def thread_stack(frame) -> List[str]:
+    """Frames of a thread from outermost to innermost."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _coro_frame(obj):
+    return getattr(obj, "cr_frame", None) or getattr(obj, "ag_frame", None) or getattr(obj, "gi_frame", None)
+
+
+def _coro_await(obj):
+    for attr in ("cr_await", "ag_await", "gi_yieldfrom"):
+        value = getattr(obj, attr, None)
+        if value is not None:
+            return value
+    return None
+
+
+def _is_running(task: "asyncio.Task", loop_frame) -> bool:
+    return loop_frame is not None and asyncio.current_task(task.get_loop()) is task
+
+
+def task_stack(task: "asyncio.Task", loop_frame, leaf: bool = True) -> List[str]:
+    """
+    Stack of an asyncio task. While it runs, the loop thread's real frames from the
+    task's coroutine down; while it waits, its await chain (plus "[await]" if leaf).
+    """
+    if _is_running(task, loop_frame):
+        running = thread_stack(loop_frame)
+        root = _coro_frame(task.get_coro())
+        label = _frame_label(root) if root is not None else None
+        return running[running.index(label):] if label in running else running
+    labels = []
+    obj = task.get_coro()
+    while obj is not None:
+        frame = _coro_frame(obj)
+        if frame is not None:
+            labels.append(_frame_label(frame))
+        obj = _coro_await(obj)
+    return labels + ["[await]"] if leaf else labels
+
+
+class ProfileSession:
+    """One profiled request: the web thread plus the asyncio tasks working for it."""
+
+    def __init__(self, endpoint: str, thread_id: int):
+        self.endpoint = endpoint
+        self.thread_id = thread_id
+        # 作成順の (task, ループのスレッド)。先頭がリクエスト本体、以降は wait_for / gather などの子タスク
+        self.tasks: List[Tuple[asyncio.Task, int]] = []
+
+    def add_task(self, task: "asyncio.Task") -> None:
+        entry = (task, threading.get_ident())
+        self.tasks.append(entry)
+        task.add_done_callback(lambda _: self.tasks.remove(entry) if entry in self.tasks else None)
+
+    def asyncio_stack(self, frames: Dict[int, Any]) -> List[str]:
+        """
+        Request task's await chain continued by the child task doing the work:
+        the one running on the loop right now, else the most recently created.
+        """
+        tasks = list(self.tasks)
+        if not tasks:
+            return []
+        root, root_thread = tasks[0]
+        root_frame = frames.get(root_thread)
+        if len(tasks) == 1 or _is_running(root, root_frame):
+            return task_stack(root, root_frame)
+        leaf, leaf_thread = next(
+            ((t, th) for t, th in tasks[1:] if _is_running(t, frames.get(th))), tasks[-1]
+        )
+        return task_stack(root, root_frame, leaf=False) + task_stack(leaf, frames.get(leaf_thread))
+
+
+_session_var: contextvars.ContextVar[Optional[ProfileSession]] = contextvars.ContextVar("profile_session", default=None)
+
+
+def _tagging_task_factory(previous):
+    """Task factory that adds tasks created inside a profiled request to its session."""
+    def factory(loop, coro, **kwargs):
+        task = previous(loop, coro, **kwargs) if previous is not None else asyncio.Task(coro, loop=loop, **kwargs)
+        session = _session_var.get()
+        if session is not None:
+            session.add_task(task)
+        return task
+
+    factory.profiling = True
+    return factory
+
+
+def _write_json(path: str, data: Dict[str, Any]) -> None:
+    """Atomically replace path (readers in other workers never see a partial file)."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".profile.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class SamplingProfiler:
+    def __init__(self, sample_rate: Optional[float] = None, interval: Optional[float] = None,
+                 directory: Optional[str] = None, worker: Optional[str] = None):
+        env = os.environ.get
+        self.sample_rate = sample_rate if sample_rate is not None else float(env("PROFILE_SAMPLE_RATE", "0"))
+        self.interval = interval if interval is not None else float(env("PROFILE_INTERVAL", "0.01"))
+        self.directory = directory or env("PROFILE_DIR", DEFAULT_PROFILE_DIR)
+        self.worker = worker
+        self._lock = threading.Lock()
+        self._override: Optional[float] = None  # /admin/profile で一時的に指定した割合（全ワーカー共通）
+        self._override_until = 0.0  # 壁時計の時刻
+        self._control_checked = float("-inf")
+        self._control_mtime: Optional[float] = None
+        self._reset_seen = 0.0  # 反映済みのリセットの時刻
+        self._flush_timer: Optional[threading.Timer] = None
+        self._active: Dict[int, ProfileSession] = {}  # web thread id -> session
+        self._local = threading.local()
+        # endpoint -> Counter(collapsed stack -> samples)
+        self.stacks: Dict[str, Counter] = {}
+        self.requests: Counter = Counter()
+        self.samples = 0
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- shared state (PROFILE_DIR) ----
+    @property
+    def worker_id(self) -> str:
+        # gunicorn は preload 後に fork するため、PID は使う時点で取る
+        return self.worker or str(os.getpid())
+
+    @property
+    def _control_path(self) -> str:
+        return os.path.join(self.directory, "control.json")
+
+    def _worker_path(self, worker: str) -> str:
+        return os.path.join(self.directory, f"worker-{worker}.json")
+
+    def _refresh_control(self, force: bool = False) -> None:
+        """Pick up the override / reset another worker wrote (at most every CONTROL_REFRESH seconds)."""
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._control_checked < CONTROL_REFRESH:
+                return
+            self._control_checked = now
+        try:
+            mtime = os.path.getmtime(self._control_path)
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        control = _read_json(self._control_path)
+        if control is None:
+            return
+        with self._lock:
+            self._control_mtime = mtime
+            self._override = control.get("rate")
+            self._override_until = control.get("until", 0.0)
+            reset_at = control.get("reset_at", 0.0)
+            if reset_at > self._reset_seen:
+                self._reset_seen = reset_at
+                self._clear_locked()
+
+    def _update_control(self, **changes: Any) -> None:
+        control = _read_json(self._control_path) or {}
+        control.update(changes)
+        _write_json(self._control_path, control)
+
+    # ---- sampling decision ----
+    def current_rate(self) -> float:
+        self._refresh_control()
+        with self._lock:
+            if self._override is not None and time.time() < self._override_until:
+                return self._override
+            return self.sample_rate
+
+    def enable(self, rate: float, seconds: float) -> None:
+        """Profile `rate` of requests for the next `seconds` seconds (in every worker)."""
+        rate = max(0.0, min(1.0, rate))
+        until = time.time() + seconds
+        self._update_control(rate=rate, until=until)
+        with self._lock:
+            self._override, self._override_until = rate, until
+
+    def begin(self, endpoint: Optional[str]) -> bool:
+        """Start profiling the current web thread's request if it is sampled."""
+        rate = self.current_rate()
+        if not endpoint or rate <= 0 or random.random() >= rate:
+            return False
+        session = ProfileSession(endpoint, threading.get_ident())
+        self._local.session = session
+        with self._lock:
+            self._active[session.thread_id] = session
+            self.requests[endpoint] += 1
+            self._wake.set()
+        self._ensure_thread()
+        return True
+
+    def end(self) -> None:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            return
+        self._local.session = None
+        with self._lock:
+            self._active.pop(session.thread_id, None)
+            if not self._active:
+                self._wake.clear()
+            # 続けて届くリクエストの分もまとめて書き出す
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(FLUSH_DELAY, self._flush_quietly)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self) -> None:
+        """Write this worker's samples where the other workers' /admin/profile can merge them."""
+        self._refresh_control(force=True)
+        with self._lock:
+            self._flush_timer = None
+            data = {
+                "interval": self.interval,
+                "samples": self.samples,
+                "requests": dict(self.requests),
+                "stacks": {endpoint: dict(counts) for endpoint, counts in self.stacks.items()},
+            }
+        _write_json(self._worker_path(self.worker_id), data)
+
+    def _flush_quietly(self) -> None:
+        try:
+            self.flush()
+        except OSError as e:
+            print(f"Profiler flush error: {e}")
+
+    def profiled(self, coro: Awaitable[Any]) -> Awaitable[Any]:
+        """Attach the coroutine's task to the calling request's profile (no-op if not sampled)."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            return coro
+
+        async def run():
+            # 以降このタスクが作る子タスク（wait_for など）もセッションに入る
+            loop = asyncio.get_running_loop()
+            factory = loop.get_task_factory()
+            if not getattr(factory, "profiling", False):
+                loop.set_task_factory(_tagging_task_factory(factory))
+            _session_var.set(session)
+            session.add_task(asyncio.current_task())
+            return await coro
+
+        return run()
+
+    # ---- sampler thread ----
+    def _ensure_thread(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._sample_loop, name="sampling-profiler", daemon=True)
+                self._thread.start()
+
+    def _sample_loop(self) -> None:
+        me = threading.get_ident()
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                sessions = list(self._active.values())
+            for session in sessions:
+                frame = frames.get(session.thread_id)
+                if frame is None or session.thread_id == me:
+                    continue
+                stack = thread_stack(frame)
+                tasks = session.asyncio_stack(frames)
+                self._add(session.endpoint, stack + ["[asyncio]"] + tasks if tasks else stack)
+            del frames
+
+    def _add(self, endpoint: str, stack: List[str]) -> None:
+        key = ";".join(label.replace(";", ":") for label in stack)
+        with self._lock:
+            self.stacks.setdefault(endpoint, Counter())[key] += 1
+            self.samples += 1
+
+    # ---- export ----
+    def merged(self) -> Tuple[Counter, Dict[str, Counter], int, int]:
+        """(requests, stacks per endpoint, samples, workers) of this worker plus the others' flushed files."""
+        self._refresh_control()
+        with self._lock:
+            requests = Counter(self.requests)
+            stacks = {endpoint: Counter(counts) for endpoint, counts in self.stacks.items()}
+            samples = self.samples
+            reset_seen = self._reset_seen
+        workers = 1
+        own = self._worker_path(self.worker_id)
+        for path in glob.glob(os.path.join(self.directory, "worker-*.json")):
+            if path == own:
+                continue
+            try:
+                if os.path.getmtime(path) < reset_seen:
+                    continue  # リセット前の結果
+            except OSError:
+                continue
+            data = _read_json(path)
+            if data is None:
+                continue
+            workers += 1
+            requests.update(data.get("requests", {}))
+            for endpoint, counts in data.get("stacks", {}).items():
+                stacks.setdefault(endpoint, Counter()).update(counts)
+            samples += data.get("samples", 0)
+        return requests, stacks, samples, workers
+
+    def endpoints(self) -> List[str]:
+        """Endpoints with samples in any worker."""
+        return sorted(self.merged()[1])
+
+    def collapsed(self, endpoint: str) -> str:
+        """Brendan Gregg's collapsed format: 'frame;frame;frame count' per line (all workers)."""
+        counts = dict(self.merged()[1].get(endpoint, {}))
+        return "".join(f"{stack} {n}\n" for stack, n in sorted(counts.items(), key=lambda kv: -kv[1]))
+
+    def speedscope(self, endpoint: str) -> Dict[str, Any]:
+        """speedscope file format (sampled profile, weights in seconds; all workers)."""
+        counts = dict(self.merged()[1].get(endpoint, {}))
+        frames: List[Dict[str, str]] = []
+        index: Dict[str, int] = {}
+        samples, weights = [], []
+        for stack, n in counts.items():
+            ids = []
+            for label in stack.split(";"):
+                if label not in index:
+                    index[label] = len(frames)
+                    frames.append({"name": label})
+                ids.append(index[label])
+            samples.append(ids)
+            weights.append(round(n * self.interval, 6))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": endpoint,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": round(sum(weights), 6),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "name": f"orchestrator {endpoint}",
+            "exporter": "orchestrator.profiling",
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        """Totals over every worker; "active" is this worker's profiled requests in progress."""
+        rate = self.current_rate()
+        requests, stacks, samples, workers = self.merged()
+        with self._lock:
+            active = len(self._active)
+        return {
+            "sample_rate": rate,
+            "interval": self.interval,
+            "active": active,
+            "workers": workers,
+            "samples": samples,
+            "endpoints": {
+                endpoint: {
+                    "requests": requests[endpoint],
+                    "samples": sum(stacks.get(endpoint, Counter()).values()),
+                }
+                for endpoint in requests
+            },
+        }
+
+    def _clear_locked(self) -> None:
+        self.stacks.clear()
+        self.requests.clear()
+        self.samples = 0
+
+    def reset(self) -> None:
+        """Discard the samples of every worker (the others clear theirs on their next control check)."""
+        reset_at = time.time()
+        self._update_control(reset_at=reset_at)
+        with self._lock:
+            self._reset_seen = reset_at
+            self._clear_locked()
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        for path in glob.glob(os.path.join(self.directory, "worker-*.json")):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+_profiler: Optional[SamplingProfiler] = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler() -> SamplingProfiler:
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = SamplingProfiler()
+        return _profiler
+
+
+def admin_authorized(headers) -> Optional[bool]:
+    """None if admin routes are disabled (no ADMIN_TOKEN), else whether the token matches."""
+    token = os.environ.get("ADMIN_TOKEN", "")
+    if not token:
+        return None
+    auth = headers.get("Authorization", "")
+    supplied = auth[7:] if auth.startswith("Bearer ") else headers.get("X-Admin-Token", "")
+    return hmac.compare_digest(supplied.encode(), token.encode())
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+システムプロンプト（固定の接頭部）のキャッシュ。
+
+エージェントのシステムプロンプトや分類器の指示文は毎回同じ長い日本語を送っているので、
+上流のプロンプトキャッシュに乗るようにする。
+
+- 接頭部の安定化: システムプロンプトは改行コード・行末の空白を正規化して毎回バイト単位で同一にし、
+  可変部分（候補エージェント・質問・ツール結果）は必ずその後ろに置く。
+  接頭部ごとに内容ハッシュ（version）を付け、同じ用途で内容が変わった回数を数える
+  （暗黙キャッシュが効かなくなる原因の検出用）
+- 明示的なコンテキストキャッシュ: 上流が対応していれば（Gemini の cachedContents）、
+  PROMPT_CACHE_MIN_TOKENS 以上の接頭部をキャッシュとして登録し、以降の呼び出しでは
+  システムプロンプトの代わりにキャッシュ名を送る。登録はバックグラウンドで行い、
+  期限が近づいたら作り直す。キャッシュは API キーごとなので上流プールのメンバーごとに持つ
+  （ツール付きの呼び出しは Gemini の制約で対象外）
+- キャッシュ済みトークン数: 上流の usage（prompt_tokens_details.cached_tokens）から取り出して
+  usage.py に記録（/api/ask の usage、/api/usage、/metrics）。ストリーミングでは autogen が
+  この値を捨てるため、明示キャッシュを使った呼び出しは接頭部のトークン数で数える
+
+設定:
+- PROMPT_CACHE_PROVIDER: auto（Gemini の API なら gemini）/ gemini / local（テスト用のスタブ）/ off（既定 auto）
+- PROMPT_CACHE_MIN_TOKENS: 明示キャッシュする接頭部の最小トークン数（既定 1024、Gemini の下限）
+- PROMPT_CACHE_TTL: キャッシュの有効期間（秒、既定 3600）
+- PROMPT_CACHE_MAX_ENTRIES: メンバーごとに保持するキャッシュ数の上限（既定 32）
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+import contextvars
+import urllib.request
+from typing import Any, Dict, List, Optional, Tuple
+
+from cancellation import approx_tokens
+
+PROMPT_CACHE_PROVIDER = os.environ.get("PROMPT_CACHE_PROVIDER", "auto").lower()
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get("PROMPT_CACHE_MIN_TOKENS", "1024"))
+PROMPT_CACHE_TTL = int(os.environ.get("PROMPT_CACHE_TTL", "3600"))
+PROMPT_CACHE_MAX_ENTRIES = int(os.environ.get("PROMPT_CACHE_MAX_ENTRIES", "32"))
+
+# 残り期間がこの割合を切ったら作り直す / 作成に失敗したら待つ秒数
+REFRESH_SHARE = 0.2
+RETRY_AFTER_FAILURE = 300.0
+# 正規化結果を覚えておく接頭部の数（動的なシステムプロンプトで際限なく増えないように）
+MAX_PREFIXES = 256
+
+EVENT_LOGGER_NAME = "autogen_core.events"  # autogen_core.EVENT_LOGGER_NAME
+
+
+def normalize_prefix(text: str) -> str:
+    """Byte-stable form of a fixed prompt (line endings and trailing whitespace)."""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+class PromptPrefix:
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text
+        self.version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+        self.tokens = approx_tokens(text)
+
+
+class CacheHandle:
+    def __init__(self, name: str, version: str, tokens: int, expires_at: float):
+        self.name = name
+        self.version = version
+        self.tokens = tokens
+        self.expires_at = expires_at
+
+
+# ---------------- キャッシュ済みトークン数の取り出し ----------------
+class CacheCapture:
+    """Cached-token figures of one upstream call (filled in from child tasks too)."""
+
+    def __init__(self):
+        self.reported: Optional[int] = None
+        self.explicit_tokens = 0
+
+    @property
+    def cached_tokens(self) -> int:
+        return self.reported if self.reported is not None else self.explicit_tokens
+
+
+_capture: contextvars.ContextVar[Optional[CacheCapture]] = contextvars.ContextVar("prompt_cache_capture", default=None)
+
+
+def capture_cached_tokens() -> CacheCapture:
+    """Collect cached-token counts of the next upstream call made from this context."""
+    # 子タスク（タイムアウト用の wait_for など）にはコンテキストがコピーされるので、可変オブジェクトを渡す
+    capture = CacheCapture()
+    _capture.set(capture)
+    return capture
+
+
+def reported_cached_tokens(response: Any) -> Optional[int]:
+    """cached_tokens from a raw chat completion (dict) if the upstream reported it."""
+    usage = response.get("usage") if isinstance(response, dict) else None
+    if not isinstance(usage, dict):
+        return None
+    details = usage.get("prompt_tokens_details")
+    if isinstance(details, dict) and details.get("cached_tokens") is not None:
+        return int(details["cached_tokens"])
+    if usage.get("cached_content_token_count") is not None:
+        return int(usage["cached_content_token_count"])
+    return None
+
+
+class _UsageEventHandler(logging.Handler):
+    """autogen logs every raw completion (LLMCallEvent); the cached-token count is only there."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        capture = _capture.get()
+        kwargs = getattr(record.msg, "kwargs", None)
+        if capture is None or not isinstance(kwargs, dict):
+            return
+        cached = reported_cached_tokens(kwargs.get("response"))
+        if cached is not None:
+            capture.reported = cached
+
+
+_handler_lock = threading.Lock()
+_handler_installed = False
+
+
+def install_usage_capture() -> None:
+    global _handler_installed
+    with _handler_lock:
+        if _handler_installed:
+            return
+        logger = logging.getLogger(EVENT_LOGGER_NAME)
+        logger.addHandler(_UsageEventHandler(logging.INFO))
+        if logger.getEffectiveLevel() > logging.INFO:
+            logger.setLevel(logging.INFO)
+        _handler_installed = True
+
+
+# ---------------- 明示的なコンテキストキャッシュ ----------------
+class GeminiContextCacheProvider:
+    """Gemini cachedContents API (the OpenAI-compatible endpoint only references caches)."""
+
+    name = "gemini"
+
+    def __init__(self, api_key: str, base_url: str, model: str):
+        self.api_key = api_key
+        # ".../v1beta/openai/" -> ".../v1beta"
+        self.base_url = base_url.rstrip("/").removesuffix("/openai")
+        self.model = model if model.startswith("models/") else f"models/{model}"
+
+    def _post(self, url: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        request = urllib.request.Request(
+            url, data=json.dumps(body, ensure_ascii=False).encode("utf-8"), method="POST",
+            headers={"Content-Type": "application/json", "x-goog-api-key": self.api_key},
+        )
+        with urllib.request.urlopen(request, timeout=10.0) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    async def create(self, prefix: PromptPrefix, ttl: int) -> CacheHandle:
+        body = {
+            "model": self.model,
+            "systemInstruction": {"parts": [{"text": prefix.text}]},
+            "ttl": f"{ttl}s",
+            "displayName": f"{prefix.name}-{prefix.version}",
+        }
+        data = await asyncio.to_thread(self._post, f"{self.base_url}/cachedContents", body)
+        tokens = int((data.get("usageMetadata") or {}).get("totalTokenCount") or prefix.tokens)
+        return CacheHandle(data["name"], prefix.version, tokens, time.monotonic() + ttl)
+
+    @staticmethod
+    def reference(handle: CacheHandle) -> Dict[str, Any]:
+        # OpenAI 互換 API ではリクエスト本文の "extra_body" でキャッシュ名を渡す
+        return {"extra_body": {"google": {"cached_content": handle.name}}}
+
+
+class LocalContextCacheProvider:
+    """In-process stand-in with the same contract (tests / offline runs)."""
+
+    name = "local"
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.created: List[Tuple[str, str]] = []
+
+    async def create(self, prefix: PromptPrefix, ttl: int) -> CacheHandle:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        name = f"cachedContents/local-{len(self.created) + 1}"
+        self.created.append((name, prefix.version))
+        return CacheHandle(name, prefix.version, prefix.tokens, time.monotonic() + ttl)
+
+    @staticmethod
+    def reference(handle: CacheHandle) -> Dict[str, Any]:
+        return {"extra_body": {"google": {"cached_content": handle.name}}}
+
+
+def _is_system(message: Any) -> bool:
+    return type(message).__name__ == "SystemMessage"
+
+
+class ContextCachedClient:
+    """
+    Model client wrapper: sends the cache name instead of a long system prompt once the
+    provider holds it. Everything else (close, model_info, _client …) is the inner client's.
+    """
+
+    def __init__(self, inner: Any, provider: Any, min_tokens: Optional[int] = None, ttl: Optional[int] = None):
+        self.inner = inner
+        self.provider = provider
+        self.min_tokens = PROMPT_CACHE_MIN_TOKENS if min_tokens is None else min_tokens
+        self.ttl = PROMPT_CACHE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._handles: Dict[str, CacheHandle] = {}
+        self._creating: Dict[str, asyncio.Task] = {}
+        self._failed_until: Dict[str, float] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+    def _handle_for(self, prefix: PromptPrefix) -> Optional[CacheHandle]:
+        """Usable handle for prefix; starts creating / refreshing one in the background."""
+        now = time.monotonic()
+        with self._lock:
+            handle = self._handles.get(prefix.version)
+            usable = handle if handle is not None and handle.expires_at - now > 5 else None
+            stale = usable is None or handle.expires_at - now < self.ttl * REFRESH_SHARE
+            start = (stale and prefix.version not in self._creating
+                     and self._failed_until.get(prefix.version, 0.0) <= now
+                     and (prefix.version in self._handles or len(self._handles) < PROMPT_CACHE_MAX_ENTRIES))
+            if start:
+                task = asyncio.get_running_loop().create_task(self._create(prefix))
+                self._creating[prefix.version] = task
+        return usable
+
+    async def _create(self, prefix: PromptPrefix) -> None:
+        stats = get_prompt_cache()
+        try:
+            handle = await self.provider.create(prefix, self.ttl)
+        except Exception as e:
+            print(f"Context cache creation failed for {prefix.name} ({prefix.version}): {e}")
+            stats.count("create_failures")
+            with self._lock:
+                self._failed_until[prefix.version] = time.monotonic() + RETRY_AFTER_FAILURE
+                self._creating.pop(prefix.version, None)
+            return
+        with self._lock:
+            self._handles[prefix.version] = handle
+            self._creating.pop(prefix.version, None)
+        stats.count("creates")
+        print(f"Context cache ready: {prefix.name} ({prefix.version}, ~{handle.tokens} tokens) -> {handle.name}")
+
+    def _invalidate(self, handle: CacheHandle) -> None:
+        with self._lock:
+            if self._handles.get(handle.version) is handle:
+                del self._handles[handle.version]
+        get_prompt_cache().count("invalidations")
+
+    def _apply(self, messages: List[Any], kwargs: Dict[str, Any]) -> Tuple[List[Any], Dict[str, Any], Optional[CacheHandle]]:
+        if not messages or not _is_system(messages[0]) or kwargs.get("tools"):
+            return messages, kwargs, None
+        prefix = get_prompt_cache().prefix(messages[0].content)
+        if prefix.tokens < self.min_tokens:
+            return messages, kwargs, None
+        handle = self._handle_for(prefix)
+        if handle is None:
+            return messages, kwargs, None
+        extra = dict(kwargs.get("extra_create_args") or {})
+        extra["extra_body"] = {**(extra.get("extra_body") or {}), **self.provider.reference(handle)}
+        capture = _capture.get()
+        if capture is not None:
+            capture.explicit_tokens = handle.tokens
+        get_prompt_cache().count("explicit_hits")
+        # キャッシュにシステムプロンプトが入っているので送らない
+        return messages[1:], {**kwargs, "extra_create_args": extra}, handle
+
+    async def create(self, messages, **kwargs):
+        cached_messages, cached_kwargs, handle = self._apply(list(messages), kwargs)
+        if handle is None:
+            return await self.inner.create(messages, **kwargs)
+        try:
+            return await self.inner.create(cached_messages, **cached_kwargs)
+        except Exception as e:
+            # 期限切れ・削除済みのキャッシュは通常の送信でやり直す（429 などはそのまま上へ）
+            if getattr(e, "status_code", None) not in (400, 403, 404):
+                raise
+            print(f"Context cache {handle.name} rejected ({e}), resending the system prompt")
+            self._invalidate(handle)
+            capture = _capture.get()
+            if capture is not None:
+                capture.explicit_tokens = 0
+            return await self.inner.create(messages, **kwargs)
+
+    async def create_stream(self, messages, **kwargs):
+        cached_messages, cached_kwargs, handle = self._apply(list(messages), kwargs)
+        yielded = False
+        try:
+            async for chunk in self.inner.create_stream(cached_messages, **cached_kwargs):
+                yielded = True
+                yield chunk
+            return
+        except Exception as e:
+            if handle is None or getattr(e, "status_code", None) not in (400, 403, 404):
+                raise
+            self._invalidate(handle)
+            # 途中まで流した応答はやり直せない。最初のチャンク前なら create() と同じく通常の送信で再試行する
+            if yielded:
+                raise
+            print(f"Context cache {handle.name} rejected ({e}), resending the system prompt")
+        capture = _capture.get()
+        if capture is not None:
+            capture.explicit_tokens = 0
+        async for chunk in self.inner.create_stream(messages, **kwargs):
+            yield chunk
+
+
+def _provider_for(api_key: Optional[str], base_url: str, model: str) -> Optional[Any]:
+    kind = PROMPT_CACHE_PROVIDER
+    if kind == "auto":
+        kind = "gemini" if "generativelanguage.googleapis.com" in base_url else "off"
+    if kind == "gemini" and api_key:
+        return GeminiContextCacheProvider(api_key, base_url, model)
+    if kind == "local":
+        return LocalContextCacheProvider()
+    return None
+
+
+def with_context_cache(client: Any) -> Any:
+    """Wrap one upstream member's model client if its provider supports context caching."""
+    config = getattr(client, "_raw_config", None) or {}
+    provider = _provider_for(config.get("api_key"), config.get("base_url") or "", config.get("model") or "")
+    return ContextCachedClient(client, provider) if provider is not None else client
+
+
+# ---------------- 接頭部の登録と集計 ----------------
+class PromptCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_text: Dict[str, PromptPrefix] = {}
+        # 用途（purpose/agent）-> [現在の version, 呼び出し数, 内容が変わった回数, トークン数]
+        self._names: Dict[str, List[Any]] = {}
+        self.counters: Dict[str, int] = {"creates": 0, "create_failures": 0, "explicit_hits": 0, "invalidations": 0}
+
+    def prefix(self, text: str, name: str = "other") -> PromptPrefix:
+        with self._lock:
+            prefix = self._by_text.get(text)
+        if prefix is None:
+            prefix = PromptPrefix(name, normalize_prefix(text))
+            with self._lock:
+                if len(self._by_text) >= MAX_PREFIXES:
+                    self._by_text.clear()
+                self._by_text[text] = prefix
+                # 正規化後のテキストでも引けるように（_chat で正規化済みのものが届く）
+                self._by_text.setdefault(prefix.text, prefix)
+        return prefix
+
+    def stable(self, text: str, name: str) -> str:
+        """Normalized system prompt for (purpose/agent) name; tracks its version."""
+        prefix = self.prefix(text, name)
+        with self._lock:
+            entry = self._names.get(name)
+            if entry is None:
+                self._names[name] = [prefix.version, 1, 0, prefix.tokens]
+            else:
+                if entry[0] != prefix.version:
+                    entry[0], entry[3] = prefix.version, prefix.tokens
+                    entry[2] += 1
+                entry[1] += 1
+        return prefix.text
+
+    def count(self, counter: str) -> None:
+        with self._lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        from usage import get_usage_ledger
+        prompt, cached = get_usage_ledger().cached_summary()
+        with self._lock:
+            return {
+                "provider": PROMPT_CACHE_PROVIDER,
+                "min_tokens": PROMPT_CACHE_MIN_TOKENS,
+                "prefixes": {
+                    name: {"version": version, "tokens": tokens, "calls": calls, "changes": changes,
+                           "explicit": tokens >= PROMPT_CACHE_MIN_TOKENS}
+                    for name, (version, calls, changes, tokens) in sorted(self._names.items())
+                },
+                **self.counters,
+                "prompt_tokens": prompt,
+                "cached_tokens": cached,
+                "cached_share": round(cached / prompt, 3) if prompt else None,
+            }
+
+
+_cache: Optional[PromptCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_prompt_cache() -> PromptCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PromptCache()
+            install_usage_capture()
+        return _cache
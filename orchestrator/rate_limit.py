@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+クライアント単位のトークンバケット型レート制限（gunicorn の全ワーカーで共有）。
+
+- クライアントごとに 2 つのバケットを持つ
+  - requests: リクエスト数（1 リクエスト = 1）
+  - tokens:   推定トークン消費量（質問 + 平均回答長で先に引き、完了後に実績で精算）
+- 状態は SQLite（WAL）に置き、BEGIN IMMEDIATE で補充と消費をアトミックに行うため、
+  外部サービスなしでワーカー/スレッド間で共有できる
+- クライアントは X-API-Key（RATE_LIMIT_API_KEYS に登録されたキーだけ）、それ以外は接続元アドレスで識別する。
+  未登録のキーを信用すると、キーを付け替えるだけで別クライアントとして制限を回避できてしまうため
+- 拒否時は Retry-After（どちらのバケットが先に足りるか）を返し、
+  許可/拒否件数は /metrics（Prometheus 形式）で確認できる
+"""
+
+import os
+import hmac
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ratelimit.sqlite3")
+
+# 使われなくなったバケットを掃除する間隔（acquire 回数）と保持期間
+GC_EVERY = 500
+GC_IDLE_SECONDS = 3600
+
+
+class Decision:
+    def __init__(self, allowed: bool, retry_after: float = 0.0, reason: Optional[str] = None,
+                 remaining_requests: int = 0, remaining_tokens: int = 0):
+        self.allowed = allowed
+        self.retry_after = retry_after
+        self.reason = reason  # "requests" / "tokens"（拒否時のみ）
+        self.remaining_requests = remaining_requests
+        self.remaining_tokens = remaining_tokens
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            "X-RateLimit-Remaining-Requests": str(self.remaining_requests),
+            "X-RateLimit-Remaining-Tokens": str(self.remaining_tokens),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+def _known_api_key(api_key: str) -> bool:
+    keys = [k.strip() for k in os.environ.get("RATE_LIMIT_API_KEYS", "").split(",") if k.strip()]
+    return any(hmac.compare_digest(api_key.encode("utf-8"), k.encode("utf-8")) for k in keys)
+
+
+def client_identity(req) -> str:
+    """
+    API key (hashed) if it is one of RATE_LIMIT_API_KEYS, else client address
+    (X-Forwarded-For only behind a trusted proxy). Unknown keys are ignored.
+    """
+    api_key = req.headers.get("X-API-Key")
+    if api_key and _known_api_key(api_key):
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    addr = req.remote_addr or "unknown"
+    if os.environ.get("RATE_LIMIT_TRUST_PROXY") == "1":
+        forwarded = req.headers.get("X-Forwarded-For", "")
+        addr = forwarded.split(",")[0].strip() or addr
+    return "ip:" + addr
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        requests_per_minute: Optional[float] = None,
+        request_burst: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        token_burst: Optional[float] = None,
+        enabled: Optional[bool] = None,
+    ):
+        env = os.environ.get
+        self.path = path or env("RATE_LIMIT_DB", DEFAULT_DB_PATH)
+        self.request_rate = (requests_per_minute if requests_per_minute is not None
+                             else float(env("RATE_LIMIT_REQUESTS_PER_MINUTE", "30"))) / 60.0
+        self.request_burst = request_burst if request_burst is not None else float(env("RATE_LIMIT_REQUEST_BURST", "10"))
+        self.token_rate = (tokens_per_minute if tokens_per_minute is not None
+                           else float(env("RATE_LIMIT_TOKENS_PER_MINUTE", "60000"))) / 60.0
+        self.token_burst = token_burst if token_burst is not None else float(env("RATE_LIMIT_TOKEN_BURST", "20000"))
+        self.enabled = enabled if enabled is not None else env("RATE_LIMIT_ENABLED", "1") != "0"
+        self._ops = 0
+        self._ops_lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = self._connect()
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS buckets ("
+                    "key TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+                )
+            finally:
+                conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # 接続はスレッドごとに都度開く（autocommit、トランザクションは明示的に BEGIN）
+        return sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+
+    @staticmethod
+    def _level(conn: sqlite3.Connection, key: str, rate: float, burst: float, now: float) -> float:
+        row = conn.execute("SELECT level, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return burst
+        level, updated = row
+        return min(burst, level + max(0.0, now - updated) * rate)
+
+    @staticmethod
+    def _store(conn: sqlite3.Connection, key: str, level: float, now: float) -> None:
+        conn.execute(
+            "INSERT INTO buckets (key, level, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET level = excluded.level, updated = excluded.updated",
+            (key, level, now),
+        )
+
+    @staticmethod
+    def _count(conn: sqlite3.Connection, name: str) -> None:
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def acquire(self, client_id: str, tokens: float = 0) -> Decision:
+        """Take one request and `tokens` estimated tokens from the client's buckets (all or nothing)."""
+        if not self.enabled:
+            return Decision(True)
+        now = time.time()
+        # バースト上限を超える単発リクエストも、バケットが満杯なら通す
+        cost = min(float(tokens), self.token_burst)
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            req = self._level(conn, f"req:{client_id}", self.request_rate, self.request_burst, now)
+            tok = self._level(conn, f"tok:{client_id}", self.token_rate, self.token_burst, now)
+            waits: List[Tuple[float, str]] = []
+            if req < 1.0:
+                waits.append(((1.0 - req) / self.request_rate, "requests"))
+            if tok < cost:
+                waits.append(((cost - tok) / self.token_rate, "tokens"))
+            if waits:
+                retry_after, reason = max(waits)
+                self._count(conn, f"limited_{reason}")
+                decision = Decision(False, retry_after, reason, int(req), int(max(0.0, tok)))
+            else:
+                req -= 1.0
+                tok -= cost
+                self._count(conn, "allowed")
+                decision = Decision(True, 0.0, None, int(req), int(max(0.0, tok)))
+            self._store(conn, f"req:{client_id}", req, now)
+            self._store(conn, f"tok:{client_id}", tok, now)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        self._maybe_gc()
+        return decision
+
+    def settle(self, client_id: str, delta_tokens: float) -> None:
+        """Correct the token bucket once actual usage is known (+ charge / - refund)."""
+        if not self.enabled or not delta_tokens:
+            return
+        now = time.time()
+        key = f"tok:{client_id}"
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            level = self._level(conn, key, self.token_rate, self.token_burst, now)
+            # 超過分は負債として残し、次のリクエストから回復を待たせる
+            self._store(conn, key, min(self.token_burst, level - delta_tokens), now)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _maybe_gc(self) -> None:
+        with self._ops_lock:
+            self._ops += 1
+            if self._ops % GC_EVERY:
+                return
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM buckets WHERE updated < ?", (time.time() - GC_IDLE_SECONDS,))
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {"enabled": False}
+        conn = self._connect()
+        try:
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            clients = conn.execute(
+                "SELECT COUNT(*) FROM buckets WHERE key LIKE 'req:%' AND updated >= ?",
+                (time.time() - GC_IDLE_SECONDS,),
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        return {
+            "enabled": True,
+            "allowed": counters.get("allowed", 0),
+            "limited": {
+                "requests": counters.get("limited_requests", 0),
+                "tokens": counters.get("limited_tokens", 0),
+            },
+            "active_clients": clients,
+            "requests_per_minute": self.request_rate * 60,
+            "tokens_per_minute": self.token_rate * 60,
+        }
+
+    def metrics_text(self) -> str:
+        """Prometheus exposition of the limiter counters (shared across workers)."""
+        stats = self.stats()
+        if not stats["enabled"]:
+            return ""
+        lines = [
+            "# HELP ratelimit_allowed_total Requests admitted by the rate limiter.",
+            "# TYPE ratelimit_allowed_total counter",
+            f"ratelimit_allowed_total {stats['allowed']}",
+            "# HELP ratelimit_limited_total Requests rejected with 429, by exhausted bucket.",
+            "# TYPE ratelimit_limited_total counter",
+        ]
+        for reason, value in stats["limited"].items():
+            lines.append(f'ratelimit_limited_total{{reason="{reason}"}} {value}')
+        lines += [
+            "# HELP ratelimit_active_clients Clients seen within the last hour.",
+            "# TYPE ratelimit_active_clients gauge",
+            f"ratelimit_active_clients {stats['active_clients']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ワーカー起動時のウォームアップと readiness。
+
+- 起動直後のワーカーは、最初のリクエストで重いモジュールの読み込み・HTTP クライアント生成・
+  上流への DNS / TLS 接続・エージェント索引の構築をすべて払うことになる
+- ワーカー起動時（gunicorn の post_worker_init、開発サーバー起動時、または最初の /readyz）に
+  登録済みのステップをバックグラウンドスレッドで順に実行し、/readyz は必須ステップが
+  すべて終わるまで 503 を返す（ロードバランサーは準備済みのワーカーにだけ振り分ける）
+- 失敗しても起動を止めないステップ（上流への接続など）は required=False で登録し、結果だけ報告する
+- 必須ステップの失敗（起動直後に DB がまだ使えない等）はバックオフしながら再試行し、それでも失敗した
+  ステップはスレッド終了後の /readyz から再実行する（一時的な失敗でワーカーが永久に外れないように）
+- /healthz は従来どおりのライブネス（プロセスが応答するか）
+
+設定:
+- WARMUP_RETRIES: 必須ステップが失敗したときの再試行回数（既定 3）
+- WARMUP_RETRY_BACKOFF: 最初の再試行までの待ち秒数。再試行ごとに倍にする（既定 1、上限 30）。
+  /readyz からの再実行もこの間隔より詰めては行わない
+"""
+
+import os
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+WARMUP_RETRIES = int(os.environ.get("WARMUP_RETRIES", "3"))
+WARMUP_RETRY_BACKOFF = float(os.environ.get("WARMUP_RETRY_BACKOFF", "1"))
+MAX_RETRY_BACKOFF = 30.0
+
+
+class Readiness:
+    def __init__(self, retries: Optional[int] = None, backoff: Optional[float] = None):
+        self.retries = WARMUP_RETRIES if retries is None else retries
+        self.backoff = WARMUP_RETRY_BACKOFF if backoff is None else backoff
+        self._steps: List[Tuple[str, Callable[[], Any], bool]] = []
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._done = threading.Event()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def add_step(self, name: str, fn: Callable[[], Any], required: bool = True) -> None:
+        """Register a warmup step; fn's return value is reported as the step's detail."""
+        with self._lock:
+            self._steps.append((name, fn, required))
+            self._state[name] = {"status": "pending", "required": required}
+
+    def start(self) -> bool:
+        """Run the steps in a background thread (returns False if nothing was started).
+
+        Once the thread has finished, calling start() again (as /readyz does) re-runs
+        the required steps that still failed, at most once per backoff interval.
+        """
+        with self._lock:
+            if self._thread is None:
+                steps = list(self._steps)
+                self.started_at = time.monotonic()
+            else:
+                if self._thread.is_alive() or self.finished_at is None:
+                    return False
+                if time.monotonic() - self.finished_at < self.backoff:
+                    return False
+                steps = [step for step in self._steps
+                         if step[2] and self._state[step[0]]["status"] == "failed"]
+                if not steps:
+                    return False
+                print(f"Re-running failed warmup steps: {', '.join(name for name, _, _ in steps)}")
+                self.finished_at = None
+                self._done.clear()
+            self._thread = threading.Thread(target=self._run, args=(steps,), name="warmup", daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self, steps: List[Tuple[str, Callable[[], Any], bool]]) -> None:
+        for name, fn, required in steps:
+            attempts = 0
+            delay = self.backoff
+            while True:
+                attempts += 1
+                with self._lock:
+                    self._state[name]["status"] = "running"
+                start = time.monotonic()
+                try:
+                    detail = fn()
+                    update = {"status": "ok", "detail": detail}
+                except Exception as e:
+                    print(f"Warmup step {name} failed (attempt {attempts}): {e}")
+                    update = {"status": "failed", "error": str(e)[:300]}
+                update["seconds"] = round(time.monotonic() - start, 3)
+                with self._lock:
+                    state = self._state[name]
+                    if update["status"] == "ok":
+                        state.pop("error", None)
+                    state.update(update)
+                    state["attempts"] = state.get("attempts", 0) + 1
+                # 任意ステップは結果を報告するだけ。必須ステップは一時的な失敗を見込んで再試行する
+                if update["status"] == "ok" or not required or attempts > self.retries:
+                    break
+                with self._lock:
+                    self._state[name]["status"] = "retrying"
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_BACKOFF)
+        self.finished_at = time.monotonic()
+        self._done.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    @property
+    def ready(self) -> bool:
+        if not self._done.is_set():
+            return False
+        with self._lock:
+            return all(s["status"] == "ok" for s in self._state.values() if s["required"])
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            steps = {name: dict(state) for name, state in self._state.items()}
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = round((self.finished_at or time.monotonic()) - self.started_at, 3)
+        return {"ready": self.ready, "started": self.started_at is not None, "seconds": elapsed, "steps": steps}
+
+
+_readiness: Optional[Readiness] = None
+_readiness_lock = threading.Lock()
+
+
+def get_readiness() -> Readiness:
+    global _readiness
+    with _readiness_lock:
+        if _readiness is None:
+            _readiness = Readiness()
+        return _readiness
+
+
+def warmup_enabled() -> bool:
+    return os.environ.get("WARMUP_ENABLED", "1") != "0"
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+ルーティング（分類）用の入力の縮約。
+
+ログやソースファイルを貼り付けた長い質問でも、振り分け先を決めるのはたいてい
+冒頭・末尾の指示文だけなので、分類器（埋め込み索引・LLM 分類器・キーワード分類）には
+固定のトークン予算内に収めた抜粋だけを渡す。
+
+- 冒頭（head）と末尾（tail）
+- 途中の地の文（コードブロック外で、ログ行やコード行に見えない行）
+- コードブロックの言語タグ（```python など）と省略した行数
+- 入力全体はコピーせず、行の位置を順にたどって必要な範囲だけを切り出す。
+  途中の走査にも上限（ROUTER_INPUT_MAX_SCAN 文字）を設け、貼り付けの大きさに関係なく
+  分類の所要時間をほぼ一定に保つ
+- 予算に収まる質問はそのまま（縮約しない）
+
+回答生成には元の質問全体を使う。削減したトークン数（推定）は /status の routing_input に表示。
+
+設定:
+- ROUTER_INPUT_TOKENS: 分類器に渡す最大トークン数（推定、既定 400）
+- ROUTER_INPUT_MAX_SCAN: 途中部分を走査する最大文字数（既定 200000）
+"""
+
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+ROUTER_INPUT_TOKENS = int(os.environ.get("ROUTER_INPUT_TOKENS", "400"))
+ROUTER_INPUT_MAX_SCAN = int(os.environ.get("ROUTER_INPUT_MAX_SCAN", "200000"))
+
+# 予算の配分（残りは途中の地の文）
+HEAD_SHARE = 0.4
+TAIL_SHARE = 0.25
+# 途中から拾う 1 行の最大文字数
+MAX_LINE_CHARS = 200
+
+_LOG_LINE_RE = re.compile(
+    r"^\s*(\[?\d{4}[-/]\d\d[-/]\d\d|\[?\d\d:\d\d:\d\d|(DEBUG|INFO|WARN|WARNING|ERROR|FATAL|TRACE)\b|"
+    r"at\s+[\w.$]+\(|File \"|Traceback|#\d+\s)"
+)
+_CODE_LINE_RE = re.compile(
+    r"^\s*(def |class |import |from \S+ import|return\b|if\s*\(|for\s*\(|while\s*\(|function\b|const |let |var |"
+    r"public |private |#include|package |SELECT\b|INSERT\b|[}\])];?$|</?\w+[^>]*>$)"
+)
+_FENCE_TAG_RE = re.compile(r"[ \t]*([\w+#.-]*)")
+MAX_FENCES = 256
+_SYMBOLS = set("{}[]();=<>$&|\\/*+#@`~^")
+
+
+def _char_tokens(ch: str) -> float:
+    # cancellation.approx_tokens と同じ見積もり（ASCII 4 文字 / 日本語 1.5 文字で 1 トークン）
+    return 0.25 if ord(ch) < 128 else 1 / 1.5
+
+
+def _advance(text: str, start: int, budget: float, stop: int) -> int:
+    """Index after the chars from start that fit in budget (snapped back to a line end if one is near)."""
+    used = 0.0
+    i = start
+    while i < stop:
+        used += _char_tokens(text[i])
+        if used > budget:
+            break
+        i += 1
+    if i < stop:
+        newline = text.rfind("\n", start, i)
+        if newline > start + (i - start) // 2:
+            return newline + 1
+    return i
+
+
+def _retreat(text: str, end: int, budget: float, stop: int) -> int:
+    """Start index of the chars before end that fit in budget (snapped forward to a line start)."""
+    used = 0.0
+    i = end
+    while i > stop:
+        used += _char_tokens(text[i - 1])
+        if used > budget:
+            break
+        i -= 1
+    if i > stop:
+        newline = text.find("\n", i, end)
+        if newline != -1 and newline < i + (end - i) // 2:
+            return newline + 1
+    return i
+
+
+def _text_tokens(text: str) -> float:
+    return sum(_char_tokens(ch) for ch in text)
+
+
+def looks_like_prose(line: str) -> bool:
+    """Instruction-like text: not indented code, not a log line, not symbol-heavy."""
+    stripped = line.strip()
+    if not stripped or line.startswith(("    ", "\t")):
+        return False
+    if _LOG_LINE_RE.match(stripped) or _CODE_LINE_RE.match(stripped):
+        return False
+    symbols = sum(1 for ch in stripped if ch in _SYMBOLS)
+    if symbols / len(stripped) > 0.08:
+        return False
+    if any(ord(ch) >= 0x3000 for ch in stripped):
+        return True
+    return len(stripped.split()) >= 3
+
+
+class RoutingInput:
+    def __init__(self, text: str, original_chars: int, original_tokens: int, reduced: bool,
+                 languages: Optional[List[str]] = None, skipped_lines: int = 0):
+        self.text = text
+        self.original_chars = original_chars
+        self.original_tokens = original_tokens
+        self.tokens = int(_text_tokens(text)) if reduced else original_tokens
+        self.reduced = reduced
+        self.languages = languages or []
+        self.skipped_lines = skipped_lines
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(0, self.original_tokens - self.tokens)
+
+
+def _estimate_tokens(text: str) -> int:
+    """Token estimate for a long text from a bounded sample (no full scan)."""
+    n = len(text)
+    if n <= 8192:
+        return int(_text_tokens(text))
+    step = n // 8
+    sample = "".join(text[i:i + 1024] for i in range(0, n, step))
+    return int(_text_tokens(sample) * n / len(sample))
+
+
+def _prose_lines(text: str, start: int, end: int, budget: float, fences: List[int], in_fence: bool) -> List[str]:
+    """Prose lines outside code fences in [start, end), at most budget tokens."""
+    prose: List[str] = []
+    used = 0.0
+    pos = start
+    fence_index = 0
+    while pos < end and used < budget:
+        newline = text.find("\n", pos, end)
+        line_end = end if newline == -1 else newline
+        while fence_index < len(fences) and fences[fence_index] < pos:
+            fence_index += 1
+        if fence_index < len(fences) and fences[fence_index] == pos:
+            in_fence = not in_fence
+        elif not in_fence:
+            line = text[pos:min(line_end, pos + MAX_LINE_CHARS)]
+            if looks_like_prose(line):
+                cost = _text_tokens(line.strip())
+                if used + cost <= budget:
+                    prose.append(line.strip())
+                    used += cost
+        pos = line_end + 1
+    return prose
+
+
+def _fences(text: str) -> Tuple[List[int], List[str]]:
+    """Line starts of code fences and the languages of opening fences (str.find skips, bounded count)."""
+    fences: List[int] = []
+    languages: List[str] = []
+    pos = text.find("```")
+    while pos != -1 and len(fences) < MAX_FENCES:
+        line_start = text.rfind("\n", 0, pos) + 1
+        if not text[line_start:pos].strip():
+            if len(fences) % 2 == 0:
+                match = _FENCE_TAG_RE.match(text, pos + 3, pos + 64)
+                tag = match.group(1) if match else ""
+                if tag and tag not in languages:
+                    languages.append(tag)
+            fences.append(line_start)
+        pos = text.find("```", pos + 3)
+    return fences, languages
+
+
+def _scan_middle(text: str, start: int, end: int, budget: float, fences: List[int]) -> Tuple[List[str], int]:
+    """Prose lines between start and end and the number of omitted lines."""
+    # 地の文は head 直後と tail 直前の 2 つの窓だけを走査（大きさに関係なく一定の手間）
+    if end - start <= ROUTER_INPUT_MAX_SCAN:
+        windows = [(start, end, budget)]
+    else:
+        half = ROUTER_INPUT_MAX_SCAN // 2
+        back = text.find("\n", end - half, end) + 1 or end - half
+        windows = [(start, start + half, budget / 2), (back, end, budget / 2)]
+    prose: List[str] = []
+    for window_start, window_end, window_budget in windows:
+        in_fence = sum(1 for f in fences if f < window_start) % 2 == 1
+        prose += _prose_lines(text, window_start, window_end, window_budget, fences, in_fence)
+    if len(windows) == 1:
+        lines = text.count("\n", start, end) + 1
+    else:
+        # 走査した窓の行密度から全体の行数を推定
+        scanned = sum(text.count("\n", a, b) for a, b, _ in windows)
+        lines = int(scanned * (end - start) / sum(b - a for a, b, _ in windows)) + 1
+    return prose, lines - len(prose)
+
+
+def reduce_routing_input(prompt: str, budget: Optional[int] = None) -> RoutingInput:
+    """Instruction-bearing excerpt of prompt within the routing token budget."""
+    budget = budget if budget is not None else ROUTER_INPUT_TOKENS
+    n = len(prompt)
+    # 1 トークンは 1.5 文字以上なので、これより短ければ必ず予算内
+    if n <= budget * 1.5:
+        return RoutingInput(prompt, n, int(_text_tokens(prompt)), reduced=False)
+
+    head_end = _advance(prompt, 0, budget * HEAD_SHARE, n)
+    tail_start = _retreat(prompt, n, budget * TAIL_SHARE, head_end)
+    middle_budget = budget * (1 - HEAD_SHARE - TAIL_SHARE)
+    # 途中部分も予算に収まるなら全体がそのまま収まる（1 文字 0.25 トークン以上なので長ければ数えない）
+    if tail_start - head_end <= middle_budget * 4 and _text_tokens(prompt[head_end:tail_start]) <= middle_budget:
+        return RoutingInput(prompt, n, int(_text_tokens(prompt)), reduced=False)
+
+    fences, languages = _fences(prompt)
+    prose, skipped = _scan_middle(prompt, head_end, tail_start, middle_budget - 20, fences)
+    note = f"…（中略: 約{skipped}行"
+    if languages:
+        note += f"、コード: {', '.join(languages)}"
+    note += "）…"
+    parts = [prompt[:head_end].rstrip("\n"), note, *prose, "…", prompt[tail_start:].lstrip("\n")]
+    return RoutingInput("\n".join(parts), n, _estimate_tokens(prompt), reduced=True,
+                        languages=languages, skipped_lines=skipped)
+
+
+class RoutingInputStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.inputs = 0
+        self.reduced = 0
+        self.original_tokens = 0
+        self.routed_tokens = 0
+
+    def record(self, routing: RoutingInput) -> None:
+        with self._lock:
+            self.inputs += 1
+            self.reduced += int(routing.reduced)
+            self.original_tokens += routing.original_tokens
+            self.routed_tokens += routing.tokens
+        if routing.reduced:
+            print(f"Routing input reduced: ~{routing.original_tokens} -> ~{routing.tokens} tokens "
+                  f"({routing.original_chars} chars, languages={routing.languages})")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "budget_tokens": ROUTER_INPUT_TOKENS,
+                "inputs": self.inputs,
+                "reduced": self.reduced,
+                "original_tokens": self.original_tokens,
+                "routed_tokens": self.routed_tokens,
+                "saved_tokens": self.original_tokens - self.routed_tokens,
+            }
+
+
+_stats: Optional[RoutingInputStats] = None
+_stats_lock = threading.Lock()
+
+
+def get_routing_input_stats() -> RoutingInputStats:
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            _stats = RoutingInputStats()
+        return _stats
+
+
+def routing_input(prompt: str) -> RoutingInput:
+    """reduce_routing_input + savings accounting (what the classifiers call)."""
+    routing = reduce_routing_input(prompt)
+    get_routing_input_stats().record(routing)
+    return routing
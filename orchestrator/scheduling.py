@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+上流 LLM 呼び出しのリクエストクラス別スケジューリング（対話 / 一括 / バックグラウンド）。
+
+UI からの対話的な質問と一括 API 呼び出し・ジョブが同じ上流の枠を取り合うと、
+バッチが UI の待ち時間を数十秒まで押し上げる。呼び出しをクラスごとのキューに分けて割り当てる。
+
+- クラス: interactive（UI、app.js が X-Request-Class で名乗る）/ bulk（ヘッダーなしの API 呼び出し）/
+  background（非同期ジョブ）
+- プロセス内の同時上流呼び出しを SCHED_MAX_CONCURRENCY 枠に制限し、空いた枠は重み付き公平
+  （ストライドスケジューリング: 割り当てごとにクラスのパスを 1/重み 進め、最小のクラスへ）で配る。
+  クラス内は到着順
+- 各クラスに予約枠（SCHED_RESERVED）があり、他のクラスは予約の空きを使えない。
+  バッチで枠が埋まっていても対話的な呼び出しはすぐ始められる
+- 枠はストリーミングを含む 1 回の create の間だけ持つ（ツール実行中などは返す）
+- X-Request-Class は自己申告なので、1 クライアント（client_identity）が同時に interactive で
+  実行できるリクエストは SCHED_INTERACTIVE_PER_CLIENT 件まで（プロセスごと）。超えた分は bulk として扱う
+- クラスごとに上流呼び出しの待ち時間と、リクエスト全体の所要時間・SLO（SCHED_SLO_MS）超過を集計し、
+  /status の scheduling と /metrics に出す
+
+設定（クラス別の値は "interactive=6,bulk=3,background=1" の形式）:
+- SCHED_MAX_CONCURRENCY: プロセスあたりの同時上流呼び出し数（既定 8、0 で制限なし）
+- SCHED_WEIGHTS: 枠を配る重み（既定 interactive=6,bulk=3,background=1）
+- SCHED_RESERVED: 予約枠（既定 interactive=3,bulk=1,background=0）
+- SCHED_SLO_MS: リクエスト全体の目標所要時間（既定 interactive=15000,bulk=60000,background=600000）
+- SCHED_DEFAULT_CLASS: ヘッダーのない API 呼び出しのクラス（既定 bulk）
+- SCHED_INTERACTIVE_PER_CLIENT: クライアントごとの同時 interactive リクエスト数（既定 2、0 で制限なし）
+"""
+
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Awaitable, Deque, Dict, Iterator, List, Optional
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+BACKGROUND = "background"
+REQUEST_CLASSES = (INTERACTIVE, BULK, BACKGROUND)
+
+SCHED_DEFAULT_CLASS = os.environ.get("SCHED_DEFAULT_CLASS", BULK).strip().lower()
+
+# 百分位を計算する直近の記録件数
+LATENCY_HISTORY = 1000
+
+_class: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_class", default=None)
+
+
+def _parse_classes(value: str, defaults: Dict[str, float]) -> Dict[str, float]:
+    """"interactive=6,bulk=3" -> per-class values (unlisted classes keep their default)."""
+    result = dict(defaults)
+    for item in value.split(","):
+        name, _, number = item.partition("=")
+        name = name.strip().lower()
+        if name in REQUEST_CLASSES and number.strip():
+            result[name] = float(number)
+    return result
+
+
+def _percentile_ms(values, q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+
+def normalize_class(name: Optional[str]) -> Optional[str]:
+    """Request class for a header value (None when empty, ValueError when unknown)."""
+    name = (name or "").strip().lower()
+    if not name:
+        return None
+    if name not in REQUEST_CLASSES:
+        raise ValueError(f"request class must be one of {', '.join(REQUEST_CLASSES)}")
+    return name
+
+
+def current_class() -> str:
+    return _class.get() or SCHED_DEFAULT_CLASS
+
+
+@contextmanager
+def class_scope(request_class: str) -> Iterator[None]:
+    """Schedule upstream calls made inside the block in request_class (no SLO record)."""
+    token = _class.set(request_class)
+    try:
+        yield
+    finally:
+        _class.reset(token)
+
+
+async def classified(coro: Awaitable[Any], request_class: str, client_id: Optional[str] = None) -> Any:
+    """
+    Run coro as one request of request_class (capped per client, see FairScheduler.admit):
+    its upstream calls are scheduled in that class and the end-to-end time counts toward
+    the class SLO (cancellations excluded).
+    """
+    scheduler = get_scheduler()
+    with scheduler.admit(request_class, client_id) as request_class:
+        _class.set(request_class)
+        start = time.monotonic()
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            scheduler.record_request(request_class, time.monotonic() - start, ok=False)
+            raise
+        scheduler.record_request(request_class, time.monotonic() - start)
+        return result
+
+
+class _Waiter:
+    __slots__ = ("lane", "loop", "future", "enqueued", "granted")
+
+    def __init__(self, lane: str, loop: asyncio.AbstractEventLoop):
+        self.lane = lane
+        self.loop = loop
+        self.future: asyncio.Future = loop.create_future()
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class Lane:
+    """Queue, weight, reservation and latency record of one request class."""
+
+    def __init__(self, name: str, weight: float, reserved: int, slo_seconds: float):
+        self.name = name
+        self.weight = max(weight, 0.001)
+        self.reserved = max(0, reserved)
+        self.slo_seconds = slo_seconds
+        self.waiters: Deque[_Waiter] = deque()
+        self.in_flight = 0
+        self.pass_value = 0.0
+        self.calls = 0
+        self.requests = 0
+        self.errors = 0
+        self.slo_violations = 0
+        self.latency_sum = 0.0
+        self.wait_sum = 0.0
+        self.waits: Deque[float] = deque(maxlen=LATENCY_HISTORY)
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_HISTORY)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "weight": self.weight,
+            "reserved": self.reserved,
+            "slo_ms": round(self.slo_seconds * 1000),
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "calls": self.calls,
+            "queue_wait_ms": {"p50": _percentile_ms(self.waits, 0.5), "p95": _percentile_ms(self.waits, 0.95),
+                              "max": _percentile_ms(self.waits, 1.0)},
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_ms": {"p50": _percentile_ms(self.latencies, 0.5), "p95": _percentile_ms(self.latencies, 0.95),
+                           "p99": _percentile_ms(self.latencies, 0.99)},
+            "slo_violations": self.slo_violations,
+            "slo_attainment": round(1 - self.slo_violations / self.requests, 4) if self.requests else None,
+        }
+
+
+class FairScheduler:
+    """
+    Weighted-fair admission of upstream calls with per-class reserved slots.
+    Thread-safe; waiters may live on any event loop (the resident loop, asyncio.run in tests).
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None, weights: Optional[Dict[str, float]] = None,
+                 reserved: Optional[Dict[str, int]] = None, slo_ms: Optional[Dict[str, float]] = None,
+                 interactive_per_client: Optional[int] = None):
+        env = os.environ.get
+        self.max_concurrency = (max_concurrency if max_concurrency is not None
+                                else int(env("SCHED_MAX_CONCURRENCY", "8")))
+        self.interactive_per_client = (interactive_per_client if interactive_per_client is not None
+                                       else int(env("SCHED_INTERACTIVE_PER_CLIENT", "2")))
+        weights = weights or _parse_classes(env("SCHED_WEIGHTS", ""), {INTERACTIVE: 6, BULK: 3, BACKGROUND: 1})
+        reserved = reserved or _parse_classes(env("SCHED_RESERVED", ""), {INTERACTIVE: 3, BULK: 1, BACKGROUND: 0})
+        slo_ms = slo_ms or _parse_classes(env("SCHED_SLO_MS", ""),
+                                          {INTERACTIVE: 15000, BULK: 60000, BACKGROUND: 600000})
+        self._lock = threading.Lock()
+        self.lanes: Dict[str, Lane] = {
+            name: Lane(name, float(weights.get(name, 1)), int(reserved.get(name, 0)),
+                       float(slo_ms.get(name, 60000)) / 1000)
+            for name in REQUEST_CLASSES
+        }
+        if self.max_concurrency > 0 and sum(l.reserved for l in self.lanes.values()) > self.max_concurrency:
+            raise ValueError("SCHED_RESERVED exceeds SCHED_MAX_CONCURRENCY")
+        # 最後に割り当てたクラスのパス（しばらく空だったクラスが溜めた分で割り込まないように）
+        self._virtual_time = 0.0
+        # client_id -> 実行中の interactive リクエスト数
+        self._interactive: Dict[str, int] = {}
+        self.demoted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    def _lane(self, request_class: str) -> Lane:
+        return self.lanes.get(request_class) or self.lanes[BULK]
+
+    def _can_start_locked(self, lane: Lane) -> bool:
+        in_flight = sum(l.in_flight for l in self.lanes.values())
+        # 他のクラスの予約のうち使われていない分には手を付けない
+        held_back = sum(max(0, l.reserved - l.in_flight) for l in self.lanes.values() if l is not lane)
+        return in_flight + held_back < self.max_concurrency
+
+    def _dispatch_locked(self) -> List[_Waiter]:
+        granted = []
+        while True:
+            ready = [l for l in self.lanes.values() if l.waiters and self._can_start_locked(l)]
+            if not ready:
+                return granted
+            lane = min(ready, key=lambda l: l.pass_value)
+            waiter = lane.waiters.popleft()
+            waiter.granted = True
+            lane.in_flight += 1
+            lane.pass_value += 1 / lane.weight
+            self._virtual_time = lane.pass_value
+            self._record_wait_locked(lane, time.monotonic() - waiter.enqueued)
+            granted.append(waiter)
+
+    def _record_wait_locked(self, lane: Lane, wait: float) -> None:
+        lane.calls += 1
+        lane.wait_sum += wait
+        lane.waits.append(wait)
+
+    def _wake(self, granted: List[_Waiter]) -> None:
+        for waiter in granted:
+            try:
+                waiter.loop.call_soon_threadsafe(_set_granted, waiter.future)
+            except RuntimeError:
+                # 待っていたループが既に閉じている: 枠を返す
+                self.release(waiter.lane)
+
+    async def acquire(self, request_class: str) -> None:
+        """Wait for an upstream slot in request_class (release() it afterwards)."""
+        lane = self._lane(request_class)
+        if not self.enabled:
+            with self._lock:
+                lane.in_flight += 1
+                self._record_wait_locked(lane, 0.0)
+            return
+        waiter = _Waiter(lane.name, asyncio.get_running_loop())
+        with self._lock:
+            if not lane.waiters and not lane.in_flight:
+                lane.pass_value = max(lane.pass_value, self._virtual_time)
+            lane.waiters.append(waiter)
+            granted = self._dispatch_locked()
+        self._wake([w for w in granted if w is not waiter])
+        if waiter.granted:
+            return
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if not waiter.granted:
+                    lane.waiters.remove(waiter)
+                    raise
+            # 割り当てと同時にキャンセルされた: 受け取った枠を返す
+            self.release(lane.name)
+            raise
+
+    def release(self, request_class: str) -> None:
+        lane = self._lane(request_class)
+        with self._lock:
+            lane.in_flight = max(0, lane.in_flight - 1)
+            granted = self._dispatch_locked() if self.enabled else []
+        self._wake(granted)
+
+    @contextmanager
+    def admit(self, request_class: str, client_id: Optional[str] = None) -> Iterator[str]:
+        """
+        Class one request actually runs in: a client's interactive requests beyond
+        interactive_per_client at once run as bulk (the header is self-declared).
+        """
+        counted = False
+        if request_class == INTERACTIVE and client_id and self.interactive_per_client > 0:
+            with self._lock:
+                running = self._interactive.get(client_id, 0)
+                if running < self.interactive_per_client:
+                    self._interactive[client_id] = running + 1
+                    counted = True
+                else:
+                    self.demoted += 1
+                    request_class = BULK
+            if not counted:
+                print(f"Scheduling: {client_id} already has {running} interactive request(s), running as bulk")
+        try:
+            yield request_class
+        finally:
+            if counted:
+                with self._lock:
+                    running = self._interactive.get(client_id, 1) - 1
+                    if running > 0:
+                        self._interactive[client_id] = running
+                    else:
+                        self._interactive.pop(client_id, None)
+
+    def record_request(self, request_class: str, seconds: float, ok: bool = True) -> None:
+        lane = self._lane(request_class)
+        with self._lock:
+            lane.requests += 1
+            lane.latency_sum += seconds
+            lane.latencies.append(seconds)
+            if not ok:
+                lane.errors += 1
+            if seconds > lane.slo_seconds or not ok:
+                lane.slo_violations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "in_flight": sum(l.in_flight for l in self.lanes.values()),
+                "interactive_per_client": self.interactive_per_client,
+                "demoted_interactive": self.demoted,
+                "classes": {name: lane.summary() for name, lane in self.lanes.items()},
+            }
+
+    def metrics_text(self) -> str:
+        """Prometheus exposition of this process's per-class queues, waits and SLOs."""
+        with self._lock:
+            rows = [(name, lane.summary(), lane.wait_sum, lane.latency_sum) for name, lane in self.lanes.items()]
+        lines = []
+        for name, kind, help_text, value in (
+            ("sched_upstream_calls_total", "counter", "Upstream calls admitted per request class.",
+             lambda s, w, l: s["calls"]),
+            ("sched_queue_wait_seconds_sum", "counter", "Time upstream calls waited for a slot.",
+             lambda s, w, l: round(w, 6)),
+            ("sched_in_flight", "gauge", "Upstream calls running.", lambda s, w, l: s["in_flight"]),
+            ("sched_queued", "gauge", "Upstream calls waiting for a slot.", lambda s, w, l: s["queued"]),
+            ("sched_requests_total", "counter", "Requests completed per request class.",
+             lambda s, w, l: s["requests"]),
+            ("sched_request_seconds_sum", "counter", "End-to-end request time.", lambda s, w, l: round(l, 6)),
+            ("sched_slo_violations_total", "counter", "Requests slower than the class SLO (or failed).",
+             lambda s, w, l: s["slo_violations"]),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for cls, summary, wait_sum, latency_sum in rows:
+                lines.append(f'{name}{{class="{cls}"}} {value(summary, wait_sum, latency_sum)}')
+        with self._lock:
+            demoted = self.demoted
+        lines += ["# HELP sched_demoted_interactive_total Interactive requests run as bulk (per-client cap).",
+                  "# TYPE sched_demoted_interactive_total counter",
+                  f"sched_demoted_interactive_total {demoted}"]
+        lines += ["# HELP sched_request_latency_seconds End-to-end request time (recent requests).",
+                  "# TYPE sched_request_latency_seconds gauge"]
+        for cls, summary, _, _ in rows:
+            for quantile in ("p50", "p95", "p99"):
+                ms = summary["latency_ms"][quantile]
+                if ms is not None:
+                    lines.append(f'sched_request_latency_seconds{{class="{cls}",quantile="0.{quantile[1:]}"}} '
+                                 f'{ms / 1000:.3f}')
+        return "\n".join(lines) + "\n"
+
+
+def _set_granted(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class ScheduledClient:
+    """
+    Model client wrapper that holds a scheduler slot for every create / create_stream
+    (in the current request class). Everything else is passed through.
+    """
+
+    def __init__(self, inner: Any, scheduler: Optional[FairScheduler] = None):
+        self.inner = inner
+        self._scheduler = scheduler
+
+    @property
+    def scheduler(self) -> FairScheduler:
+        return self._scheduler or get_scheduler()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+    async def create(self, messages, **kwargs):
+        scheduler, request_class = self.scheduler, current_class()
+        await scheduler.acquire(request_class)
+        try:
+            return await self.inner.create(messages, **kwargs)
+        finally:
+            scheduler.release(request_class)
+
+    async def create_stream(self, messages, **kwargs) -> AsyncIterator[Any]:
+        scheduler, request_class = self.scheduler, current_class()
+        await scheduler.acquire(request_class)
+        try:
+            async for chunk in self.inner.create_stream(messages, **kwargs):
+                yield chunk
+        finally:
+            scheduler.release(request_class)
+
+    async def close(self) -> None:
+        await self.inner.close()
+
+
+_scheduler: Optional[FairScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> FairScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler()
+        return _scheduler
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+本番トラフィックでの代替ルーターのシャドー評価。
+
+キーワード分類・埋め込みのみ・過去の振り分け結果のキャッシュなど、LLM 分類器より速い
+ルーターへ切り替えてよいかを、実際の質問で確かめるための仕組み。
+
+- 一部のリクエスト（SHADOW_SAMPLE_RATE、または /admin/shadow で一時的に指定した割合）だけを対象に、
+  本番の分類（classify_async）が決まった後で候補ルーターを専用スレッドで実行する
+- 応答経路からは投入するだけ（待たない）。同時に走る評価は SHADOW_MAX_CONCURRENCY 件までで、
+  埋まっているときは評価を捨てる（キューに溜めない）のでユーザーの待ち時間は増えない
+- 候補ごとに本番ラベルとの一致・所要時間を記録し、/admin/shadow で集計を返す
+  （一致率・回答率・p50/p95・取り違えの組み合わせ・本番がどの方式で決めたか別の一致率）
+- 集計と /admin/shadow で指定した一時的な割合は SQLite（WAL）に置き、gunicorn の全ワーカーで共有する
+  （どのワーカーが管理 API を受けても同じ設定・同じレポートになる）。ワーカーごとなのは
+  実行中の評価数（in_flight）と cache ルーターの中身だけ
+
+候補ルーターは register(name, fn) で追加できる。fn(prompt) はラベル（agents.json のキーか "none"）
+か、判断できないとき None を返す（コルーチン関数も可）。
+
+設定:
+- SHADOW_SAMPLE_RATE: 評価するリクエストの割合（既定 0 = 無効）
+- SHADOW_MAX_CONCURRENCY: 同時に実行する評価の上限（既定 2）
+- SHADOW_ROUTERS: 有効にする候補（既定 "keyword,embedding,cache"）
+- SHADOW_CACHE_SIZE: cache ルーターが覚える質問数（既定 5000）
+- SHADOW_DB: 集計と一時的な割合を共有する SQLite（既定 data/shadow.sqlite3）
+"""
+
+import os
+import time
+import random
+import asyncio
+import sqlite3
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+SHADOW_SAMPLE_RATE = float(os.environ.get("SHADOW_SAMPLE_RATE", "0"))
+SHADOW_MAX_CONCURRENCY = int(os.environ.get("SHADOW_MAX_CONCURRENCY", "2"))
+SHADOW_ROUTERS = os.environ.get("SHADOW_ROUTERS", "keyword,embedding,cache")
+SHADOW_CACHE_SIZE = int(os.environ.get("SHADOW_CACHE_SIZE", "5000"))
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "shadow.sqlite3")
+
+# 所要時間の記録件数（候補ごと）と、レポートに載せる直近の不一致の件数
+LATENCY_HISTORY = 1000
+RECENT_DISAGREEMENTS = 20
+# 他のワーカーが変えた一時的な割合を読み直す間隔（秒）
+OVERRIDE_REFRESH = 1.0
+
+Router = Callable[[str], Any]
+
+
+def _percentile_ms(values, q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+
+class LabelCache:
+    """LRU of primary labels by normalized prompt (the "cache" candidate router)."""
+
+    def __init__(self, size: int = SHADOW_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._labels: "OrderedDict[str, str]" = OrderedDict()
+
+    @staticmethod
+    def key(prompt: str) -> str:
+        normalized = " ".join(prompt.lower().split())
+        return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, prompt: str) -> Optional[str]:
+        key = self.key(prompt)
+        with self._lock:
+            label = self._labels.get(key)
+            if label is not None:
+                self._labels.move_to_end(key)
+            return label
+
+    def put(self, prompt: str, label: str) -> None:
+        key = self.key(prompt)
+        with self._lock:
+            self._labels[key] = label
+            self._labels.move_to_end(key)
+            while len(self._labels) > self.size:
+                self._labels.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._labels)
+
+
+class ShadowStore:
+    """Aggregates and the sample-rate override in SQLite, shared by every worker process."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.environ.get("SHADOW_DB", DEFAULT_DB_PATH)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS primaries (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "latency REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS primary_sources (source TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS routers (name TEXT PRIMARY KEY, runs INTEGER NOT NULL, "
+                         "answered INTEGER NOT NULL, agree INTEGER NOT NULL, errors INTEGER NOT NULL)")
+            # 本番の決め方（embedding / llm / keyword）ごとの件数と一致数
+            conn.execute("CREATE TABLE IF NOT EXISTS by_source (router TEXT NOT NULL, source TEXT NOT NULL, "
+                         "runs INTEGER NOT NULL, agree INTEGER NOT NULL, PRIMARY KEY (router, source))")
+            conn.execute("CREATE TABLE IF NOT EXISTS confusions (router TEXT NOT NULL, pair TEXT NOT NULL, "
+                         "count INTEGER NOT NULL, PRIMARY KEY (router, pair))")
+            conn.execute("CREATE TABLE IF NOT EXISTS latencies (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "router TEXT NOT NULL, value REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS latencies_router ON latencies (router, id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS recent (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "router TEXT NOT NULL, primary_label TEXT NOT NULL, label TEXT NOT NULL, prompt TEXT NOT NULL)")
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _add_meta(conn: sqlite3.Connection, key: str, amount: float) -> None:
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value", (key, amount))
+
+    def override(self) -> Tuple[Optional[float], float]:
+        """(rate, until as a wall-clock time) set through /admin/shadow, or (None, 0)."""
+        conn = self._connect()
+        try:
+            meta = {row["key"]: row["value"] for row in conn.execute(
+                "SELECT key, value FROM meta WHERE key IN ('override_rate', 'override_until')")}
+        finally:
+            conn.close()
+        return meta.get("override_rate"), meta.get("override_until", 0.0)
+
+    def set_override(self, rate: float, until: float) -> None:
+        conn = self._connect()
+        try:
+            conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                             [("override_rate", rate), ("override_until", until)])
+        finally:
+            conn.close()
+
+    def record(self, prompt: str, primary: str, source: str, latency: float,
+               outcomes: List[Tuple[str, Optional[str], float, Optional[Exception]]], dropped: int = 0) -> None:
+        """Add one sampled request (and the drops counted since the last one) in a single transaction."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._add_meta(conn, "sampled", 1)
+            if dropped:
+                self._add_meta(conn, "dropped", dropped)
+            conn.execute("INSERT INTO primaries (latency) VALUES (?)", (latency,))
+            conn.execute("DELETE FROM primaries WHERE id <= (SELECT MAX(id) FROM primaries) - ?", (LATENCY_HISTORY,))
+            conn.execute("INSERT INTO primary_sources (source, count) VALUES (?, 1) "
+                         "ON CONFLICT(source) DO UPDATE SET count = count + 1", (source,))
+            for name, label, elapsed, error in outcomes:
+                answered = int(error is None and label is not None)
+                agree = int(answered and label == primary)
+                conn.execute(
+                    "INSERT INTO routers (name, runs, answered, agree, errors) VALUES (?, 1, ?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET runs = runs + 1, answered = answered + excluded.answered, "
+                    "agree = agree + excluded.agree, errors = errors + excluded.errors",
+                    (name, answered, agree, int(error is not None)),
+                )
+                conn.execute("INSERT INTO latencies (router, value) VALUES (?, ?)", (name, elapsed))
+                conn.execute(
+                    "DELETE FROM latencies WHERE router = ? AND id <= (SELECT id FROM latencies WHERE router = ? "
+                    "ORDER BY id DESC LIMIT 1 OFFSET ?)", (name, name, LATENCY_HISTORY),
+                )
+                if not answered:
+                    continue
+                conn.execute(
+                    "INSERT INTO by_source (router, source, runs, agree) VALUES (?, ?, 1, ?) "
+                    "ON CONFLICT(router, source) DO UPDATE SET runs = runs + 1, agree = agree + excluded.agree",
+                    (name, source, agree),
+                )
+                if not agree:
+                    conn.execute(
+                        "INSERT INTO confusions (router, pair, count) VALUES (?, ?, 1) "
+                        "ON CONFLICT(router, pair) DO UPDATE SET count = count + 1", (name, f"{primary}->{label}"),
+                    )
+                    conn.execute("INSERT INTO recent (router, primary_label, label, prompt) VALUES (?, ?, ?, ?)",
+                                 (name, primary, label, prompt[:80]))
+            conn.execute("DELETE FROM recent WHERE id <= (SELECT MAX(id) FROM recent) - ?", (RECENT_DISAGREEMENTS,))
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def add_dropped(self, count: int) -> None:
+        conn = self._connect()
+        try:
+            self._add_meta(conn, "dropped", count)
+        finally:
+            conn.close()
+
+    def summary(self, names: List[str]) -> Dict[str, Any]:
+        """Totals over every worker; routers in names are listed even before their first run."""
+        conn = self._connect()
+        try:
+            meta = {row["key"]: row["value"] for row in conn.execute("SELECT key, value FROM meta")}
+            primary_latencies = [row["latency"] for row in conn.execute("SELECT latency FROM primaries")]
+            sources = {row["source"]: row["count"] for row in conn.execute(
+                "SELECT source, count FROM primary_sources ORDER BY source")}
+            counts = {row["name"]: row for row in conn.execute("SELECT * FROM routers")}
+            routers: Dict[str, Any] = {}
+            for name in list(names) + [n for n in counts if n not in names]:
+                row = counts.get(name)
+                runs, answered, agree, errors = (row["runs"], row["answered"], row["agree"], row["errors"]) if row else (0, 0, 0, 0)
+                latencies = [r["value"] for r in conn.execute("SELECT value FROM latencies WHERE router = ?", (name,))]
+                by_source = conn.execute("SELECT source, runs, agree FROM by_source WHERE router = ? ORDER BY source",
+                                         (name,)).fetchall()
+                confusions = conn.execute("SELECT pair, count FROM confusions WHERE router = ? "
+                                          "ORDER BY count DESC, pair LIMIT 10", (name,)).fetchall()
+                routers[name] = {
+                    "runs": runs,
+                    "answered": answered,
+                    "coverage": round(answered / runs, 3) if runs else None,
+                    "agree": agree,
+                    "agreement": round(agree / answered, 3) if answered else None,
+                    "errors": errors,
+                    "latency_ms": {"p50": _percentile_ms(latencies, 0.5), "p95": _percentile_ms(latencies, 0.95)},
+                    "by_primary_source": {
+                        r["source"]: {"runs": r["runs"], "agreement": round(r["agree"] / r["runs"], 3) if r["runs"] else None}
+                        for r in by_source
+                    },
+                    "confusions": {r["pair"]: r["count"] for r in confusions},
+                }
+            recent = [{"router": r["router"], "primary": r["primary_label"], "label": r["label"], "prompt": r["prompt"]}
+                      for r in conn.execute("SELECT * FROM recent ORDER BY id")]
+        finally:
+            conn.close()
+        return {
+            "sampled": int(meta.get("sampled", 0)),
+            "dropped": int(meta.get("dropped", 0)),
+            "primary": {
+                "latency_ms": {"p50": _percentile_ms(primary_latencies, 0.5),
+                               "p95": _percentile_ms(primary_latencies, 0.95)},
+                "sources": sources,
+            },
+            "routers": routers,
+            "recent_disagreements": recent,
+        }
+
+    def reset(self) -> None:
+        """Clear the aggregates (the sample-rate override is kept)."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM meta WHERE key IN ('sampled', 'dropped')")
+            for table in ("primaries", "primary_sources", "routers", "by_source", "confusions", "latencies", "recent"):
+                conn.execute(f"DELETE FROM {table}")
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+
+class ShadowEvaluator:
+    def __init__(self, sample_rate: Optional[float] = None, max_concurrency: Optional[int] = None,
+                 store: Optional[ShadowStore] = None):
+        self.sample_rate = SHADOW_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.max_concurrency = max(1, SHADOW_MAX_CONCURRENCY if max_concurrency is None else max_concurrency)
+        self.store = store or ShadowStore()
+        self._lock = threading.Lock()
+        self._routers: Dict[str, Router] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._in_flight = 0
+        # 共有ストアに書く前の取りこぼし件数（次の評価の記録と一緒に書く）
+        self._dropped = 0
+        self._override: Optional[float] = None
+        self._override_until = 0.0
+        self._override_checked = float("-inf")
+        self.cache = LabelCache()
+
+    def reset(self) -> None:
+        """Clear the aggregates of every worker."""
+        with self._lock:
+            self._dropped = 0
+        self.store.reset()
+
+    def register(self, name: str, fn: Router) -> None:
+        with self._lock:
+            self._routers[name] = fn
+
+    def current_rate(self) -> float:
+        now = time.monotonic()
+        with self._lock:
+            refresh = now - self._override_checked >= OVERRIDE_REFRESH
+            if refresh:
+                self._override_checked = now
+        if refresh:
+            # 他のワーカーが /admin/shadow で変えた割合を読み直す（読めなければ前回の値のまま）
+            try:
+                rate, until = self.store.override()
+            except sqlite3.Error as e:
+                print(f"Shadow store error: {e}")
+            else:
+                with self._lock:
+                    self._override, self._override_until = rate, until
+        with self._lock:
+            if self._override is not None and time.time() < self._override_until:
+                return self._override
+            return self.sample_rate
+
+    def enable(self, rate: float, seconds: float) -> None:
+        """Shadow-evaluate `rate` of requests for the next `seconds` seconds (in every worker)."""
+        rate = max(0.0, min(1.0, rate))
+        until = time.time() + seconds
+        self.store.set_override(rate, until)
+        with self._lock:
+            self._override, self._override_until = rate, until
+            self._override_checked = time.monotonic()
+
+    def observe(self, prompt: str, label: str, latency: float, source: str = "llm") -> bool:
+        """
+        Queue the candidates for a routed prompt if it is sampled (never blocks).
+        Returns False when not sampled or dropped because the shadow workers are busy.
+        """
+        rate = self.current_rate()
+        if rate <= 0 or random.random() >= rate:
+            return False
+        with self._lock:
+            if not self._routers:
+                return False
+            if self._in_flight >= self.max_concurrency:
+                self._dropped += 1
+                return False
+            self._in_flight += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_concurrency, thread_name_prefix="shadow")
+            executor = self._executor
+        try:
+            executor.submit(self._evaluate, prompt, label, latency, source)
+        except RuntimeError:
+            with self._lock:
+                self._in_flight -= 1
+            return False
+        return True
+
+    def _evaluate(self, prompt: str, primary: str, latency: float, source: str) -> None:
+        try:
+            with self._lock:
+                routers = list(self._routers.items())
+            outcomes = []
+            for name, fn in routers:
+                start = time.perf_counter()
+                try:
+                    label = fn(prompt)
+                    if inspect.isawaitable(label):
+                        label = asyncio.run(label)
+                    error = None
+                except Exception as e:
+                    label, error = None, e
+                outcomes.append((name, label, time.perf_counter() - start, error))
+            self._record(prompt, primary, latency, source, outcomes)
+            self.cache.put(prompt, primary)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def _record(self, prompt: str, primary: str, latency: float, source: str, outcomes) -> None:
+        with self._lock:
+            dropped, self._dropped = self._dropped, 0
+        try:
+            self.store.record(prompt, primary, source, latency, outcomes, dropped)
+        except sqlite3.Error as e:
+            print(f"Shadow store error: {e}")
+            with self._lock:
+                self._dropped += dropped
+        parts = []
+        for name, label, elapsed, error in outcomes:
+            if error is not None:
+                parts.append(f"{name}=error({error})")
+            elif label is None:
+                parts.append(f"{name}=-")
+            else:
+                parts.append(f"{name}={label}{'' if label == primary else '✗'} {elapsed * 1000:.1f}ms")
+        print(f"Shadow routing: primary={primary} ({source}) | " + ", ".join(parts))
+
+    def wait_idle(self, timeout: float = 5.0) -> bool:
+        """Wait until queued evaluations have finished (tests / shutdown)."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if self._in_flight == 0:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def report(self) -> Dict[str, Any]:
+        """Aggregates of every worker; in_flight and cache_size are this worker's (see "pid")."""
+        rate = self.current_rate()
+        with self._lock:
+            names = list(self._routers)
+            in_flight, dropped = self._in_flight, self._dropped
+        summary = self.store.summary(names)
+        return {
+            "sample_rate": rate,
+            "max_concurrency": self.max_concurrency,
+            "sampled": summary["sampled"],
+            "dropped": summary["dropped"] + dropped,
+            "in_flight": in_flight,
+            "pid": os.getpid(),
+            "primary": summary["primary"],
+            "routers": summary["routers"],
+            "recent_disagreements": summary["recent_disagreements"],
+            "cache_size": len(self.cache),
+        }
+
+
+# ---------------- 既定の候補ルーター ----------------
+def keyword_router(prompt: str) -> str:
+    """Keyword scores only (the classifier's offline fallback, without its logging)."""
+    from autogen_router import keyword_scores
+    scores = keyword_scores(prompt)
+    best = max(scores, key=lambda k: scores[k], default=None)
+    return best if best is not None and scores[best] > 0 else "none"
+
+
+def embedding_router(prompt: str) -> Optional[str]:
+    """Top embedding match, without the confidence threshold / LLM fallback."""
+    from agent_registry import get_registry
+    ranked = get_registry().index.rank(prompt, 1)
+    return ranked[0][0] if ranked else None
+
+
+def register_default_routers(evaluator: ShadowEvaluator, names: Optional[str] = None) -> None:
+    available: Dict[str, Router] = {
+        "keyword": keyword_router,
+        "embedding": embedding_router,
+        "cache": evaluator.cache.get,
+    }
+    for name in (n.strip() for n in (names if names is not None else SHADOW_ROUTERS).split(",")):
+        if name in available:
+            evaluator.register(name, available[name])
+        elif name:
+            print(f"Unknown shadow router: {name}")
+
+
+_shadow: Optional[ShadowEvaluator] = None
+_shadow_lock = threading.Lock()
+
+
+def get_shadow() -> ShadowEvaluator:
+    global _shadow
+    with _shadow_lock:
+        if _shadow is None:
+            _shadow = ShadowEvaluator()
+            register_default_routers(_shadow)
+        return _shadow
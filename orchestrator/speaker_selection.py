@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+グループチャット（discussion.py）の次の発言者をプロセス内で選ぶローカル選択器。
+
+RoundRobinGroupChat では話すことのない専門家にも順番が回り、LLM で選ぶ SelectorGroupChat は
+ターンごとに選択用の上流呼び出しが 1 回増える。ここでは各専門家の system_message から
+その専門家だけが持つ語（英単語と日本語の文字 bigram、agent_registry.text_features）を取り出し、
+発言との重なりで次の発言者を決める（ネットワーク呼び出しなし）。
+
+- まだ発言していない専門家: 議論全体（議題を含む）に自分の語が出ていれば、多い順に 1 回ずつ
+- 以降: 各専門家が最後に話してから出た発言に、その専門家の語が DISCUSSION_SELECTOR_MIN_TERMS 個以上
+  出ていれば候補（多い順、同点は長く話していない順）
+- 候補がいなければ誰にも新しい論点はないとみなし、NoNewPointsTermination で議論を終える
+  （直前の発言者に続けて話させても上流呼び出しは減らないため、そのターン自体を払わない）
+- 選択と終了判定は発言履歴だけから決まるので、チェックポイントからの再開でも同じ順になる
+
+設定:
+- DISCUSSION_SPEAKER_SELECTION: round_robin（既定）/ local（/api/discussions の speaker_selection でも指定可）
+- DISCUSSION_SELECTOR_MIN_TERMS: 発言権を得るのに必要な一致語数（既定 2）
+"""
+
+import os
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from autogen_agentchat.base import TerminatedException, TerminationCondition
+from autogen_agentchat.messages import BaseChatMessage, StopMessage
+
+from agent_registry import text_features
+
+ROUND_ROBIN = "round_robin"
+LOCAL = "local"
+SPEAKER_SELECTIONS = (ROUND_ROBIN, LOCAL)
+
+SPEAKER_SELECTION = os.environ.get("DISCUSSION_SPEAKER_SELECTION", ROUND_ROBIN).strip().lower()
+SELECTOR_MIN_TERMS = int(os.environ.get("DISCUSSION_SELECTOR_MIN_TERMS", "2"))
+
+# ひらがなだけの bigram（「には」「して」など）は分野を表さない
+_HIRAGANA_ONLY_RE = re.compile(r"^[\u3040-\u309f]+$")
+
+
+def normalize_speaker_selection(mode: Optional[str]) -> str:
+    """Speaker-selection mode (the configured default when empty, ValueError when unknown)."""
+    mode = str(mode or "").strip().lower() or SPEAKER_SELECTION
+    if mode not in SPEAKER_SELECTIONS:
+        raise ValueError(f"speaker_selection must be one of {', '.join(SPEAKER_SELECTIONS)}")
+    return mode
+
+
+class LocalSpeakerSelector:
+    """
+    selector_func for SelectorGroupChat: always names a speaker, so the team never
+    falls back to a model call for selection. Pair it with NoNewPointsTermination.
+    """
+
+    def __init__(self, experts: Dict[str, str], min_terms: Optional[int] = None):
+        self.names = list(experts)
+        feats = {name: {t for t in text_features(text) if not _HIRAGANA_ONLY_RE.match(t)}
+                 for name, text in experts.items()}
+        # 全員の system_message に出る語（共通の指示文）は誰の出番かの手がかりにならない
+        shared = set.intersection(*feats.values()) if len(feats) > 1 else set()
+        self.terms = {name: terms - shared for name, terms in feats.items()}
+        self.min_terms = SELECTOR_MIN_TERMS if min_terms is None else min_terms
+        # 最後に選んだときの発言履歴（終了判定はこれに新しい発言を足して行う）
+        self.history: List[Tuple[str, str]] = []
+
+    def score(self, name: str, text: str) -> int:
+        """Number of the expert's own terms found in text."""
+        return len(self.terms[name] & set(text_features(text)))
+
+    def __call__(self, messages: Sequence[object]) -> str:
+        self.history = chat_history(messages)
+        return self.select(self.history)
+
+    def _last(self, history: List[Tuple[str, str]]) -> Optional[str]:
+        return next((source for source, _ in reversed(history) if source in self.terms), None)
+
+    def select(self, history: List[Tuple[str, str]]) -> str:
+        """Next speaker for the (source, text) history."""
+        name = self.with_new_points(history)
+        if name is not None:
+            return name
+        last = self._last(history)
+        if last is None:
+            return self.names[0]
+        # 通常は NoNewPointsTermination が先に議論を終える（再開直後などの保険として順番どおり）
+        return self.names[(self.names.index(last) + 1) % len(self.names)]
+
+    def converged(self, history: List[Tuple[str, str]]) -> bool:
+        """True once an expert has spoken and nobody has anything new to respond to."""
+        return self._last(history) is not None and self.with_new_points(history) is None
+
+    def with_new_points(self, history: List[Tuple[str, str]]) -> Optional[str]:
+        """The expert with the most to respond to, or None when nobody has new points."""
+        turns = [i for i, (source, _) in enumerate(history) if source in self.terms]
+        last = history[turns[-1]][0] if turns else None
+
+        # 1. まだ話していない専門家は、議論に自分の分野が出ていれば一度は話す
+        whole = "\n".join(text for _, text in history)
+        spoken = {history[i][0] for i in turns}
+        fresh = [(self.score(name, whole), -order, name) for order, name in enumerate(self.names)
+                 if name not in spoken]
+        fresh = [f for f in fresh if f[0] >= self.min_terms]
+        if fresh:
+            return max(fresh)[2]
+        if last is None:
+            return None
+
+        # 2. 最後に話してから、自分の分野に触れる発言があった専門家
+        candidates = []
+        for name in self.names:
+            if name == last:
+                continue
+            own = [i for i in turns if history[i][0] == name]
+            since = own[-1] + 1 if own else 0
+            score = self.score(name, "\n".join(text for _, text in history[since:]))
+            if score >= self.min_terms:
+                candidates.append((score, -since, name))
+        if candidates:
+            return max(candidates)[2]
+        return None
+
+
+def chat_history(messages: Sequence[object]) -> List[Tuple[str, str]]:
+    return [(m.source, m.to_text()) for m in messages if isinstance(m, BaseChatMessage)]
+
+
+class NoNewPointsTermination(TerminationCondition):
+    """
+    Ends a discussion run by LocalSpeakerSelector once no expert has anything new
+    to respond to (another turn would only repeat the last speaker).
+    """
+
+    def __init__(self, selector: LocalSpeakerSelector):
+        self.selector = selector
+        self._terminated = False
+
+    @property
+    def terminated(self) -> bool:
+        return self._terminated
+
+    async def __call__(self, messages: Sequence[object]) -> Optional[StopMessage]:
+        if self._terminated:
+            raise TerminatedException("Termination condition has already been reached")
+        # 終了判定は新しい発言ごと、発言者の選択はその後なので、選択時の履歴に今回の発言を足す
+        history = self.selector.history + chat_history(messages)
+        if not self.selector.converged(history):
+            return None
+        self._terminated = True
+        print("Speaker selection: no expert has new points, ending the discussion")
+        return StopMessage(content="No expert has new points to add", source="NoNewPointsTermination")
+
+    async def reset(self) -> None:
+        self._terminated = False
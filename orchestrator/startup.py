@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+起動処理の軽量化。
+
+- autogen_ext / autogen_core / openai の import は 1 秒近くかかるため、app の import 時には読み込まない
+- API キーの有無は環境変数だけで判定し、クライアントは作らない（以前は判定のためだけに Orchestrator を生成していた）
+- Orchestrator は最初に使われたときに生成（LazyObject）
+- gunicorn を preload_app で動かす場合は、マスターで preload_modules() を呼んで重いモジュールを
+  一度だけ読み込み、fork したワーカーに copy-on-write で共有させる（gunicorn.conf.py）
+"""
+
+import os
+import importlib
+import importlib.util
+import threading
+from typing import Any, Callable, Optional
+
+# 回答に必要な重いモジュール（preload_modules で読み込む）
+HEAVY_MODULES = ("autogen_router", "discussion")
+
+
+def autogen_installed() -> bool:
+    """Whether the autogen packages are installed, without importing them."""
+    return all(importlib.util.find_spec(name) is not None for name in ("autogen_core", "autogen_ext"))
+
+
+def credentials_configured() -> bool:
+    """Whether an upstream is configured (keys, endpoints, or a replay cassette)."""
+    env = os.environ.get
+    if any(env(name, "").strip() for name in ("GEMINI_API_KEY", "GOOGLE_API_KEY", "GEMINI_API_KEYS", "UPSTREAM_ENDPOINTS")):
+        return True
+    return env("LLM_CASSETTE_MODE", "").strip().lower() == "replay"
+
+
+def preload_modules() -> None:
+    """Import the heavy modules now (gunicorn master, before forking workers)."""
+    for name in HEAVY_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"Preload of {name} failed: {e}")
+
+
+class LazyObject:
+    """Proxy that builds the wrapped object on first attribute access."""
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._instance: Optional[Any] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    @property
+    def loaded(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
@@ -3,50 +3,360 @@
 
   const promptEl = $("#prompt");
   const sendBtn  = $("#sendBtn");
+  const refreshBtn = $("#refreshBtn");
   const statusEl = $("#status");
   const respEl   = $("#response");
 
-  const agentEls = {
-    coder:  $("#agent-coder"),
-    analyst:$("#agent-analyst"),
-    travel: $("#agent-travel"),
-  };
-
-  const statusEls = {
-    coder:  $("#status-coder"),
-    analyst:$("#status-analyst"),
-    travel: $("#status-travel"),
-  };
+  // エージェント枠はサーバー側でレジストリ（agents.json）から描画される
+  const agentEls = {};
+  const statusEls = {};
+  const agentNames = {};
+  document.querySelectorAll(".agent-card[data-agent]").forEach(el => {
+    const key = el.dataset.agent;
+    agentEls[key] = el;
+    statusEls[key] = $(`#status-${key}`);
+    agentNames[key] = el.dataset.name;
+  });
+
+  const multiMode = $("#multiMode");
+  const synthMode = $("#synthMode");
 
   const selectionInfo = $("#selection-info");
   const selectionText = $("#selection-text");
 
-  const agentNames = {
-    coder: "Coder (ソフトウェアエンジニア)",
-    analyst: "Analyst (データアナリスト)",
-    travel: "Travel (旅行プランナー)"
-  };
+  // 画面からの操作は対話クラス（上流の枠をバッチより優先して割り当てられる、scheduling.py）
+  const JSON_HEADERS = { "Content-Type":"application/json", "X-Request-Class":"interactive" };
 
   function clearHighlights(){
-    Object.values(agentEls).forEach(el =>
-      el.classList.remove(
-        "selected",
-        "selected-coder",
-        "selected-analyst",
-        "selected-travel"
-      )
+    Object.entries(agentEls).forEach(([key, el]) =>
+      el.classList.remove("selected", `selected-${key}`)
     );
     Object.values(statusEls).forEach(el => el.style.display = 'none');
     
-    selectionInfo.classList.remove("active", "active-coder", "active-analyst", "active-travel");
+    selectionInfo.classList.remove("active", ...Object.keys(agentEls).map(key => `active-${key}`));
     selectionText.textContent = "エージェントが選択されると、ここに表示されます";
   }
 
-  async function ask(){
+  function highlightAgent(agent){
+    agentEls[agent].classList.add("selected", `selected-${agent}`);
+    if(statusEls[agent]){
+      statusEls[agent].style.display = 'block';
+    }
+  }
+
+  // ---------------- 回答キャッシュ（IndexedDB、サーバーの検証子で無効化） ----------------
+  // 同じ質問の再送信や「戻る」で回答を作り直さない。エントリは回答の版（エージェント定義・モデルで
+  // 決まる、/api/answers/version と X-Answer-Version）が現在の版と一致する間だけ使う
+  const ANSWER_CACHE_MAX = 50;
+  const ANSWER_CACHE_TTL_MS = 24 * 60 * 60 * 1000;
+
+  const answerCache = (() => {
+    const memory = new Map(); // IndexedDB が使えない環境（プライベートモードなど）ではタブ内だけ
+    let dbPromise = null;
+
+    const done = (req) => new Promise((resolve, reject) => {
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => reject(req.error);
+    });
+
+    function open(){
+      if(!dbPromise){
+        dbPromise = new Promise((resolve) => {
+          if(!window.indexedDB){ resolve(null); return; }
+          const req = indexedDB.open("orchestrator-answers", 1);
+          req.onupgradeneeded = () => {
+            req.result.createObjectStore("answers", { keyPath: "key" }).createIndex("savedAt", "savedAt");
+          };
+          req.onsuccess = () => resolve(req.result);
+          req.onerror = req.onblocked = () => resolve(null);
+        });
+      }
+      return dbPromise;
+    }
+
+    async function store(mode){
+      const db = await open();
+      return db ? db.transaction("answers", mode).objectStore("answers") : null;
+    }
+
+    // 古い順に走査し、keep(entry, index) が false のエントリを消す
+    async function sweep(keep){
+      const answers = await store("readwrite");
+      if(!answers){
+        [...memory.values()].sort((a, b) => b.savedAt - a.savedAt)
+          .forEach((entry, i) => { if(!keep(entry, i)) memory.delete(entry.key); });
+        return;
+      }
+      const total = await done(answers.count());
+      let index = total;
+      await new Promise((resolve) => {
+        const cursorReq = answers.index("savedAt").openCursor();
+        cursorReq.onsuccess = () => {
+          const cursor = cursorReq.result;
+          if(!cursor){ resolve(); return; }
+          index -= 1; // 新しい順の位置
+          if(!keep(cursor.value, index)) cursor.delete();
+          cursor.continue();
+        };
+        cursorReq.onerror = () => resolve();
+      });
+    }
+
+    return {
+      async get(key){
+        try{
+          const answers = await store("readonly");
+          return answers ? await done(answers.get(key)) : memory.get(key);
+        }catch(err){
+          return undefined;
+        }
+      },
+      async put(entry){
+        try{
+          const answers = await store("readwrite");
+          if(answers) await done(answers.put(entry));
+          else memory.set(entry.key, entry);
+          await sweep((_, i) => i < ANSWER_CACHE_MAX);
+        }catch(err){
+          console.warn("answer cache write failed", err);
+        }
+      },
+      async remove(key){
+        try{
+          const answers = await store("readwrite");
+          if(answers) await done(answers.delete(key));
+          else memory.delete(key);
+        }catch(err){ /* 次の読み出しで再び無効と判定される */ }
+      },
+      // 版が変わったら、それ以前の回答をまとめて捨てる
+      async retain(version){
+        try{
+          await sweep((entry) => entry.version === version);
+        }catch(err){ /* 同上 */ }
+      },
+    };
+  })();
+
+  let answerVersion = null;
+
+  function setAnswerVersion(version){
+    if(!version || version === answerVersion) return;
+    answerVersion = version;
+    answerCache.retain(version);
+  }
+
+  async function refreshAnswerVersion(){
+    try{
+      // no-cache: ブラウザが ETag で再検証する（変わっていなければ 304 の往復だけ）
+      const r = await fetch("/api/answers/version", { cache: "no-cache" });
+      if(r.ok) setAnswerVersion((await r.json()).version);
+    }catch(err){ /* オフラインなどは手元の版のまま */ }
+    return answerVersion;
+  }
+
+  // キャッシュのキーだけ空白の違いを無視する（サーバーへは改行・インデントを保ったまま送る）
+  function normalizePrompt(text){
+    return (text || "").trim().replace(/\s+/g, " ");
+  }
+
+  function cacheKey(prompt){
+    const mode = multiMode.checked ? (synthMode.checked ? "multi+synth" : "multi") : "single";
+    return `${mode}|${normalizePrompt(prompt)}`;
+  }
+
+  async function lookupAnswer(key){
+    const entry = await answerCache.get(key);
+    if(!entry) return null;
+    const version = await refreshAnswerVersion();
+    if(entry.version !== version || Date.now() - entry.savedAt > ANSWER_CACHE_TTL_MS){
+      answerCache.remove(key);
+      return null;
+    }
+    return entry;
+  }
+
+  function showCached(entry){
+    clearHighlights();
+    const agents = entry.selected.filter(a => agentEls[a]);
+    agents.forEach(highlightAgent);
+    selectionInfo.classList.add("active");
+    if(agents.length === 1) selectionInfo.classList.add(`active-${agents[0]}`);
+    selectionText.textContent = agents.length
+      ? `✓ ${agents.map(a => agentNames[a]).join(" / ")} の回答（保存済み）`
+      : "✓ 汎用エージェントの回答（保存済み）";
+    respEl.textContent = entry.response;
+    statusEl.textContent = `保存済みの回答を表示しています（${new Date(entry.savedAt).toLocaleString()}）`;
+    refreshBtn.hidden = false;
+  }
+
+  // ---------------- 中断（再送信・ページ離脱で上流の LLM 呼び出しも止める） ----------------
+  let current = null; // { id, key, controller }: 実行中のリクエスト
+
+  function newRequestId(){
+    return crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+  }
+
+  function cancelCurrent(reason){
+    if(!current) return;
+    const { id, controller, cacheLookup } = current;
+    current = null;
+    controller.abort();
+    if(cacheLookup) return; // キャッシュ確認中でまだサーバーに送っていない
+    // fetch の中断だけではサーバー側の処理は止まらないため、明示的にキャンセルを通知
+    navigator.sendBeacon(`/api/requests/${encodeURIComponent(id)}/cancel?reason=${reason}`);
+  }
+
+  window.addEventListener("pagehide", () => cancelCurrent("navigation"));
+
+  // ---------------- 複数エージェント（fan-out, SSE over fetch） ----------------
+  async function readSse(response, onEvent){
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    while(true){
+      const { value, done } = await reader.read();
+      if(done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let idx;
+      while((idx = buffer.indexOf("\n\n")) >= 0){
+        const block = buffer.slice(0, idx);
+        buffer = buffer.slice(idx + 2);
+        let type = "message", data = "";
+        block.split("\n").forEach(line => {
+          if(line.startsWith("event: ")) type = line.slice(7);
+          else if(line.startsWith("data: ")) data += line.slice(6);
+        });
+        if(data) onEvent(type, JSON.parse(data));
+      }
+    }
+  }
+
+  async function askMulti(prompt, request){
+    const answers = {};
+    const order = [];
+    let synthesis = null;
+    const render = () => {
+      const parts = order.map(a => `■ ${agentNames[a] || "汎用エージェント"}\n${answers[a]}`);
+      if(synthesis !== null){
+        parts.unshift(`■ 統合回答\n${synthesis}`);
+      }
+      respEl.textContent = parts.join("\n\n");
+    };
+
+    const r = await fetch("/api/ask/multi", {
+      method:"POST",
+      headers: JSON_HEADERS,
+      body: JSON.stringify({ prompt, synthesize: synthMode.checked, request_id: request.id }),
+      signal: request.controller.signal
+    });
+    if(!r.ok){
+      const data = await r.json();
+      throw new Error(data.error || `HTTP ${r.status}`);
+    }
+
+    let selected = [];
+    let version = null;
+    await readSse(r, (type, ev) => {
+      if(type === "selected"){
+        selected = ev.agents;
+        const agents = ev.agents.filter(a => agentEls[a]);
+        agents.forEach(highlightAgent);
+        selectionInfo.classList.add("active");
+        selectionText.textContent = agents.length
+          ? `✓ ${agents.map(a => agentNames[a]).join(" / ")} が並行して回答中`
+          : "✓ 汎用エージェントが応答しました";
+      }else if(type === "partial"){
+        if(!(ev.agent in answers)){ answers[ev.agent] = ""; order.push(ev.agent); }
+        answers[ev.agent] += ev.delta;
+        render();
+      }else if(type === "answer"){
+        if(!(ev.agent in answers)){ order.push(ev.agent); }
+        answers[ev.agent] = ev.response;
+        render();
+      }else if(type === "synthesis"){
+        synthesis = ev.response;
+        render();
+      }else if(type === "done"){
+        // 縮退・エラーの回答には版が付かない（キャッシュしない）
+        version = ev.answer_version || null;
+      }else if(type === "error"){
+        throw new Error(ev.error);
+      }
+    });
+    return { selected, response: respEl.textContent, version };
+  }
+
+  async function askSingle(prompt, request){
+    const r = await fetch("/api/ask", {
+      method:"POST",
+      // 途中のプロキシが再送しても回答は 1 回だけ生成される（同じキーの再送は結果を受け取るだけ）
+      headers:{ ...JSON_HEADERS, "Idempotency-Key": request.id },
+      body: JSON.stringify({ prompt, request_id: request.id }),
+      signal: request.controller.signal
+    });
+    const data = await r.json();
+
+    if(!r.ok){
+      throw new Error(data.error || `HTTP ${r.status}`);
+    }
+
+    // data.selected: レジストリのエージェントキー | "none"
+    console.log("API Response:", data); // デバッグログ
+    
+    if(data.selected && agentEls[data.selected]){
+      highlightAgent(data.selected);
+      
+      // Update selection info
+      selectionInfo.classList.add("active", `active-${data.selected}`);
+      selectionText.textContent = `✓ ${agentNames[data.selected]} が選択されて回答しました`;
+    } else if(data.selected === "none") {
+      // Show general response info
+      selectionInfo.classList.add("active");
+      selectionText.textContent = "✓ 汎用エージェントが応答しました";
+    } else {
+      // エラーケース
+      selectionInfo.classList.add("active");
+      selectionText.textContent = `⚠️ 不明なエージェント (${data.selected}) が応答しました`;
+    } // "none" の場合はハイライトなし
+
+    respEl.textContent = data.response || "(no content)";
+    return {
+      selected: data.selected && data.selected !== "none" ? [data.selected] : [],
+      response: respEl.textContent,
+      version: data.degraded ? null : r.headers.get("X-Answer-Version"),
+    };
+  }
+
+  // refresh: 保存済みの回答を使わずに作り直す（「再生成」ボタン / Ctrl+Shift+Enter）
+  async function ask({ refresh = false } = {}){
     const prompt = (promptEl.value || "").trim();
     if(!prompt){
       statusEl.textContent = "プロンプトを入力してください。";
       return;
+    }
+
+    // 同じ質問を処理中なら送り直さない（連打・Ctrl+Enter の重複）
+    const key = cacheKey(prompt);
+    if(current && current.key === key && !(refresh && current.cacheLookup)){
+      statusEl.textContent = "同じ質問を処理中です...";
+      return;
+    }
+
+    // 前のリクエストが残っていれば中断してから送り直す
+    cancelCurrent("superseded");
+    const request = { id: newRequestId(), key, controller: new AbortController(), cacheLookup: !refresh };
+    current = request;
+    refreshBtn.hidden = true;
+
+    if(!refresh){
+      const cached = await lookupAnswer(key);
+      if(current !== request) return; // 確認中に別の質問が送られた
+      request.cacheLookup = false;
+      if(cached){
+        current = null;
+        showCached(cached);
+        return;
+      }
     }
 
     clearHighlights();
@@ -55,54 +365,107 @@
     statusEl.textContent = "Thinking...";
 
     try{
-      const r = await fetch("/api/ask", {
+      const result = multiMode.checked ? await askMulti(prompt, request) : await askSingle(prompt, request);
+      statusEl.textContent = "Done.";
+      if(result.version){
+        setAnswerVersion(result.version);
+        answerCache.put({ key, prompt, ...result, savedAt: Date.now() });
+      }
+    }catch(err){
+      if(err.name === "AbortError") return; // 再送信・離脱による中断（表示は後続に任せる）
+      console.error(err);
+      statusEl.textContent = "Error.";
+      respEl.textContent = String(err);
+    }finally{
+      if(current === request){
+        current = null;
+        sendBtn.disabled = false;
+      }
+    }
+  }
+
+  // ---------------- 専門家ディスカッション（SSE ライブ配信） ----------------
+  const discussionTaskEl   = $("#discussion-task");
+  const discussionBtn      = $("#discussionBtn");
+  const discussionStatusEl = $("#discussion-status");
+  const discussionLogEl    = $("#discussion-log");
+  let discussionSource = null;
+
+  function appendDiscussionMessage(ev){
+    const li = document.createElement("li");
+    li.className = `speaker-${ev.source}`;
+    const who = document.createElement("span");
+    who.className = "speaker";
+    who.textContent = `[${ev.label}]`;
+    li.appendChild(who);
+    li.appendChild(document.createTextNode(ev.content));
+    if(ev.usage){
+      const usage = document.createElement("div");
+      usage.className = "usage";
+      usage.textContent = `tokens: prompt ${ev.usage.prompt_tokens} / completion ${ev.usage.completion_tokens}`;
+      li.appendChild(usage);
+    }
+    discussionLogEl.appendChild(li);
+  }
+
+  async function startDiscussion(){
+    if(discussionSource){ discussionSource.close(); }
+    discussionLogEl.textContent = "";
+    discussionBtn.disabled = true;
+    discussionStatusEl.textContent = "Starting...";
+
+    try{
+      const r = await fetch("/api/discussions", {
         method:"POST",
-        headers:{ "Content-Type":"application/json" },
-        body: JSON.stringify({ prompt })
+        headers: JSON_HEADERS,
+        body: JSON.stringify({ task: (discussionTaskEl.value || "").trim() })
       });
       const data = await r.json();
-
       if(!r.ok){
         throw new Error(data.error || `HTTP ${r.status}`);
       }
 
-      // data.selected: "coder" | "analyst" | "travel" | "none"
-      console.log("API Response:", data); // デバッグログ
-      
-      if(data.selected && agentEls[data.selected]){
-        agentEls[data.selected].classList.add("selected", `selected-${data.selected}`);
-        if(statusEls[data.selected]){
-          statusEls[data.selected].style.display = 'block';
-        }
-        
-        // Update selection info
-        selectionInfo.classList.add("active", `active-${data.selected}`);
-        selectionText.textContent = `✓ ${agentNames[data.selected]} が選択されて回答しました`;
-      } else if(data.selected === "none") {
-        // Show general response info
-        selectionInfo.classList.add("active");
-        selectionText.textContent = "✓ 汎用エージェントが応答しました";
-      } else {
-        // エラーケース
-        selectionInfo.classList.add("active");
-        selectionText.textContent = `⚠️ 不明なエージェント (${data.selected}) が応答しました`;
-      } // "none" の場合はハイライトなし
-
-      respEl.textContent = data.response || "(no content)";
-      statusEl.textContent = "Done.";
+      discussionStatusEl.textContent = "議論中...";
+      const source = new EventSource(`/api/discussions/${data.id}/events`);
+      discussionSource = source;
+      const finish = (text) => {
+        source.close();
+        discussionSource = null;
+        discussionStatusEl.textContent = text;
+        discussionBtn.disabled = false;
+      };
+      source.addEventListener("message", (e) => appendDiscussionMessage(JSON.parse(e.data)));
+      source.addEventListener("done", (e) => {
+        const ev = JSON.parse(e.data);
+        finish(`Done. (${ev.stop_reason || "finished"})`);
+      });
+      source.addEventListener("error", (e) => {
+        // サーバー送信の error イベント（data あり）と接続エラーの両方がここに来る
+        const ev = e.data ? JSON.parse(e.data) : null;
+        finish(ev ? `Error: ${ev.error}` : "Connection lost.");
+      });
     }catch(err){
       console.error(err);
-      statusEl.textContent = "Error.";
-      respEl.textContent = String(err);
-    }finally{
-      sendBtn.disabled = false;
+      discussionStatusEl.textContent = `Error: ${err.message || err}`;
+      discussionBtn.disabled = false;
     }
   }
 
-  sendBtn.addEventListener("click", ask);
+  discussionBtn.addEventListener("click", startDiscussion);
+
+  sendBtn.addEventListener("click", () => ask());
+  refreshBtn.addEventListener("click", () => ask({ refresh: true }));
   promptEl.addEventListener("keydown", (e)=>{
     if((e.ctrlKey || e.metaKey) && e.key === "Enter"){
-      ask();
+      ask({ refresh: e.shiftKey });
     }
   });
+
+  // 「戻る」などで入力欄が復元されたら、保存済みの回答があればそのまま表示（サーバーへの質問なし）
+  window.addEventListener("pageshow", async () => {
+    const prompt = (promptEl.value || "").trim();
+    if(!prompt || current || respEl.textContent) return;
+    const cached = await lookupAnswer(cacheKey(prompt));
+    if(cached && !current && !respEl.textContent) showCached(cached);
+  });
 })();
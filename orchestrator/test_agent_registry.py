@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Agent Registry Test Script
+
+Verifies the data-driven agent registry without API keys:
+- agents.json loads, and edits are picked up by hot reload
+  (a broken file keeps the previous version)
+- the embedding index routes confident prompts without an LLM call
+- with hundreds of agents the classifier only sees the top-k candidates,
+  so routing cost stays flat
+
+Usage:
+    python test_agent_registry.py
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import agent_registry
+from agent_registry import AgentRegistry, DEFAULT_REGISTRY_PATH
+
+
+def test_hot_reload():
+    print("=== Registry Hot Reload ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "agents.json")
+        shutil.copy(DEFAULT_REGISTRY_PATH, path)
+        registry = AgentRegistry(path, reload_interval=0)
+        assert registry.keys == ["coder", "analyst", "travel"]
+        assert "ソフトウェアエンジニア" in registry.system_for("coder")
+        assert "汎用アシスタント" in registry.system_for("none")
+        version = registry.version
+
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        data["agents"].append({
+            "key": "chef",
+            "title": "Chef",
+            "name": "料理研究家",
+            "description": "レシピ/献立/調理のコツ",
+            "routing": ["料理のレシピ、献立作成、調理方法、食材の保存"],
+            "keywords": ["レシピ", "料理", "献立", "食材"],
+            "system": "あなたは料理研究家です。",
+        })
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.utime(path, (time.time() + 5, time.time() + 5))
+
+        assert [a.key for a in registry.agents] == ["coder", "analyst", "travel", "chef"]
+        assert registry.version != version
+        assert registry.index.rank("今夜の献立とレシピを考えて", 1)[0][0] == "chef"
+        print("✅ new agent picked up without restart and routable")
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("{ broken")
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        assert [a.key for a in registry.agents][-1] == "chef"
+        print("✅ broken config keeps the previous version")
+    return True
+
+
+def test_embedding_routing():
+    from autogen_router import Orchestrator
+
+    print("\n=== Embedding Routing ===")
+
+    class CountingOrchestrator(Orchestrator):
+        def __init__(self):
+            self.calls = []
+
+        async def _chat(self, system, user):
+            self.calls.append(user)
+            return '{"label": "none"}'
+
+    cases = [
+        ("Pythonでウェブサーバーのコードを書いてください", "coder", 0),
+        ("データ分析をして統計的な検証をしたい", "analyst", 0),
+        ("週末に京都で歴史を感じる半日観光プランを作って", "travel", 0),
+        ("今日の天気はどうですか？", "none", 1),
+    ]
+    ok = True
+    for prompt, expected, llm_calls in cases:
+        orch = CountingOrchestrator()
+        label = asyncio.run(orch.classify_async(prompt))
+        if label == expected and len(orch.calls) == llm_calls:
+            print(f"✅ {prompt[:20]} → {label} (LLM calls: {len(orch.calls)})")
+        else:
+            print(f"❌ {prompt[:20]} → {label}, LLM calls {len(orch.calls)} (expected {expected}, {llm_calls})")
+            ok = False
+    return ok
+
+
+def test_flat_routing_cost():
+    from autogen_router import Orchestrator, ROUTER_TOP_K
+
+    print("\n=== Routing Cost with Many Agents ===")
+    with open(DEFAULT_REGISTRY_PATH, encoding="utf-8") as f:
+        data = json.load(f)
+    for i in range(300):
+        data["agents"].append({
+            "key": f"domain{i}",
+            "title": f"Domain {i}",
+            "routing": [f"専門領域{i}に関する相談、項目{i}の手続き"],
+            "keywords": [f"領域{i}"],
+            "system": f"あなたは領域{i}の専門家です。",
+        })
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "agents.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        big = AgentRegistry(path, reload_interval=3600)
+
+        start = time.perf_counter()
+        for _ in range(100):
+            big.index.rank("おすすめの本を教えて", ROUTER_TOP_K)
+        per_route_ms = (time.perf_counter() - start) * 10
+        assert per_route_ms < 20, f"routing took {per_route_ms:.2f}ms"
+
+        class CapturingOrchestrator(Orchestrator):
+            def __init__(self):
+                self.user_messages = []
+
+            async def _chat(self, system, user):
+                self.user_messages.append(user)
+                return '{"label": "none"}'
+
+        saved = agent_registry._registry
+        agent_registry._registry = big
+        try:
+            orch = CapturingOrchestrator()
+            asyncio.run(orch.classify_async("おすすめの本を教えて"))
+        finally:
+            agent_registry._registry = saved
+        candidates = [l for l in orch.user_messages[0].splitlines() if l.startswith("- ")]
+        assert len(candidates) == ROUTER_TOP_K, candidates
+    print(f"✅ 303 agents: {per_route_ms:.2f}ms per routing, classifier saw {ROUTER_TOP_K} candidates")
+    return True
+
+
+def main():
+    print("Agent Registry Test")
+    print("=" * 50)
+    results = [test_hot_reload(), test_embedding_routing(), test_flat_routing_cost()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All agent registry tests passed!")
+        return 0
+    print("⚠️ Some agent registry tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Answer Version Test Script
+
+Verifies the validator behind the browser answer cache (static/app.js) without API keys:
+- GET /api/answers/version carries an ETag and answers 304 to If-None-Match
+- answers from /api/ask carry X-Answer-Version with the same value; errors and
+  degraded (circuit-open) answers do not, so the browser does not cache them
+- /api/ask/multi reports the version in its done event, only for clean answers
+- the version changes with ANSWER_CACHE_EPOCH (and the model), invalidating cached answers
+
+Usage:
+    python test_answer_version.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import idempotency
+import rate_limit
+from idempotency import IdempotencyStore
+from rate_limit import RateLimiter
+
+
+class FakeOrchestrator:
+    def __init__(self):
+        self.degraded = False
+
+    def _result(self, **extra):
+        result = {"selected": "travel", "response": "answer", "usage": {}, **extra}
+        if self.degraded:
+            result["degraded"] = True
+        return result
+
+    async def ask_async(self, prompt, run_id=None):
+        await asyncio.sleep(0.01)
+        return self._result()
+
+    async def ask_multi_async(self, prompt, synthesize=False, on_event=None):
+        await asyncio.sleep(0.01)
+        return self._result(selected_agents=["travel"], responses={"travel": "answer"})
+
+
+def done_event(client):
+    stream = client.post("/api/ask/multi", json={"prompt": "京都の観光"})
+    assert "X-Answer-Version" not in stream.headers, "the outcome is unknown when the stream starts"
+    events = stream.get_data(as_text=True).split("\n\n")
+    done = next(e for e in events if e.startswith("event: done"))
+    return json.loads(done.split("data: ", 1)[1])
+
+
+def test_version_endpoint(tmp):
+    print("=== /api/answers/version ===")
+    import app as app_module
+
+    saved = (app_module.orchestrator, idempotency._store, rate_limit._limiter, os.environ.get("ANSWER_CACHE_EPOCH"))
+    fake = app_module.orchestrator = FakeOrchestrator()
+    idempotency._store = IdempotencyStore(os.path.join(tmp, "idem.sqlite3"))
+    rate_limit._limiter = RateLimiter(os.path.join(tmp, "rl.sqlite3"))
+    try:
+        with app_module.app.test_client() as client:
+            first = client.get("/api/answers/version")
+            version = first.get_json()["version"]
+            assert first.status_code == 200 and first.headers["ETag"] == f'"{version}"'
+            assert first.headers["Cache-Control"] == "no-cache"
+            again = client.get("/api/answers/version", headers={"If-None-Match": first.headers["ETag"]})
+            assert again.status_code == 304 and not again.get_data()
+            print(f"✅ version {version}; revalidation with If-None-Match → 304")
+
+            answer = client.post("/api/ask", json={"prompt": "京都の観光"})
+            assert answer.status_code == 200 and answer.headers["X-Answer-Version"] == version
+            assert "X-Answer-Version" not in client.post("/api/ask", json={}).headers, "errors are not cacheable"
+            assert done_event(client)["answer_version"] == version
+            print("✅ /api/ask answers carry X-Answer-Version; /api/ask/multi sends it in the done event")
+
+            fake.degraded = True
+            degraded = client.post("/api/ask", json={"prompt": "京都の観光"})
+            assert degraded.status_code == 200 and "X-Answer-Version" not in degraded.headers
+            assert "answer_version" not in done_event(client)
+            fake.degraded = False
+            print("✅ degraded answers carry no version (not cached in the browser)")
+
+            os.environ["ANSWER_CACHE_EPOCH"] = "2"
+            changed = client.get("/api/answers/version", headers={"If-None-Match": first.headers["ETag"]})
+            assert changed.status_code == 200 and changed.get_json()["version"] != version
+            os.environ["GEMINI_MODEL"] = "other-model"
+            try:
+                assert app_module.answer_version() != changed.get_json()["version"], "model change"
+            finally:
+                os.environ.pop("GEMINI_MODEL")
+            print("✅ ANSWER_CACHE_EPOCH / model change → new version, cached answers are discarded")
+    finally:
+        app_module.orchestrator, idempotency._store, rate_limit._limiter, epoch = saved
+        if epoch is None:
+            os.environ.pop("ANSWER_CACHE_EPOCH", None)
+        else:
+            os.environ["ANSWER_CACHE_EPOCH"] = epoch
+    return True
+
+
+def main():
+    print("Answer Version Test")
+    print("=" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [test_version_endpoint(tmp)]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All answer version tests passed!")
+        return 0
+    print("⚠️ Some answer version tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Static Asset Test Script
+
+Verifies the production asset mode:
+- index.html references content-hashed files through url_for
+- hashed files are served precompressed by Accept-Encoding with immutable
+  caching, ETags and 304 revalidation
+- the manifest is rebuilt when a source asset changes
+- development mode keeps plain filenames and template auto-reload
+
+Usage:
+    python test_assets.py
+"""
+
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import assets
+from assets import ASSETS, load_manifest
+
+HERE = Path(__file__).parent
+
+
+def test_production_serving():
+    print("=== Production Mode ===")
+    os.environ.pop("FLASK_DEBUG", None)
+    os.environ.pop("FLASK_ENV", None)
+    import app as app_module
+
+    flask_app = app_module.app
+    assert flask_app.config["TEMPLATES_AUTO_RELOAD"] is False
+    with flask_app.test_client() as client:
+        html = client.get("/").get_data(as_text=True)
+        js_url = re.search(r'src="(/static/dist/app\.[0-9a-f]{10}\.js)"', html).group(1)
+        css_url = re.search(r'href="(/static/dist/styles\.[0-9a-f]{10}\.css)"', html).group(1)
+        print(f"✅ index.html → {js_url}, {css_url}")
+
+        source = (HERE / "static" / "app.js").read_bytes()
+        zipped = client.get(js_url, headers={"Accept-Encoding": "gzip, deflate"})
+        assert zipped.status_code == 200 and zipped.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(zipped.data) == source
+        assert zipped.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+        assert zipped.headers["Vary"] == "Accept-Encoding"
+        assert zipped.headers["Content-Type"].startswith("text/javascript")
+        assert len(zipped.data) < len(source) / 2
+        print(f"✅ gzip variant: {len(zipped.data)} of {len(source)} bytes, immutable for a year")
+
+        plain = client.get(js_url, headers={"Accept-Encoding": "identity"})
+        assert plain.data == source and "Content-Encoding" not in plain.headers
+        assert plain.headers["ETag"] != zipped.headers["ETag"]
+        revalidated = client.get(js_url, headers={"Accept-Encoding": "gzip", "If-None-Match": zipped.headers["ETag"]})
+        assert revalidated.status_code == 304 and not revalidated.data
+        if assets.brotli is not None:
+            br = client.get(css_url, headers={"Accept-Encoding": "gzip, br"})
+            assert br.headers["Content-Encoding"] == "br"
+            print("✅ brotli variant preferred when accepted")
+        else:
+            print("ℹ️ brotli not installed: gzip variants only")
+        print("✅ per-encoding ETags with 304 revalidation; identity fallback")
+
+        assert client.get("/static/app.js").status_code == 200, "unhashed files are still served"
+    return True
+
+
+def test_rebuild_on_change():
+    print("\n=== Manifest Freshness ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ASSETS:
+            shutil.copy(HERE / "static" / name, os.path.join(tmp, name))
+        first = load_manifest(tmp)
+        assert load_manifest(tmp) == first, "unchanged sources reuse the manifest"
+        with open(os.path.join(tmp, "app.js"), "a", encoding="utf-8") as f:
+            f.write("\n// changed\n")
+        second = load_manifest(tmp)
+        assert second["app.js"]["path"] != first["app.js"]["path"]
+        assert second["styles.css"]["path"] == first["styles.css"]["path"]
+        assert os.path.exists(os.path.join(tmp, first["app.js"]["path"])), "old hashes kept for cached HTML"
+    print(f"✅ changed app.js → new fingerprint {second['app.js']['path']}, styles.css untouched")
+    return True
+
+
+def test_development_mode():
+    print("\n=== Development Mode ===")
+    env = dict(os.environ, FLASK_DEBUG="1")
+    script = (
+        "import app\n"
+        "html = app.app.test_client().get('/').get_data(as_text=True)\n"
+        "print(app.app.config['TEMPLATES_AUTO_RELOAD'], '/static/app.js' in html, '/static/dist/' in html)\n"
+    )
+    out = subprocess.run([sys.executable, "-c", script], cwd=str(HERE), env=env,
+                         capture_output=True, text=True, timeout=120)
+    assert out.stdout.strip().splitlines()[-1] == "True True False", out.stdout
+    print("✅ plain filenames and template auto-reload under FLASK_DEBUG=1")
+    return True
+
+
+def main():
+    print("Static Asset Test")
+    print("=" * 50)
+    results = [test_production_serving(), test_rebuild_on_change(), test_development_mode()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All static asset tests passed!")
+        return 0
+    print("⚠️ Some static asset tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
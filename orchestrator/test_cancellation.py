@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cancellation Test Script
+
+Verifies end-to-end cancellation without API keys:
+- cancelling a tracked request cancels the awaiting upstream call
+  (the coroutine sees CancelledError) and records the stage it was in
+- a fan-out request cancels every concurrent agent call at once
+- /api/ask returns 499 when cancelled via /api/requests/<id>/cancel,
+  and the counters show up on /status
+- a cancel that reaches another worker process is handed to the owning
+  worker through the shared SQLite table
+- the tokens-saved estimate leaves out output that was already streamed
+
+Usage:
+    python test_cancellation.py
+"""
+
+import asyncio
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import CancelledError
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_router import Orchestrator, CLASSIFIER_SYSTEM, MULTI_CLASSIFIER_SYSTEM
+from background import get_background_loop
+from cancellation import (
+    CancellationRegistry, SharedCancellations, approx_tokens, get_cancellations, mark_stage, note_output,
+)
+
+
+class SlowOrchestrator(Orchestrator):
+    """Answers hang until cancelled; records which calls were interrupted."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.cancelled = []
+        self.completed = 0
+
+    async def _chat(self, system, user, tools=None):
+        if system == CLASSIFIER_SYSTEM:
+            return '{"label": "coder"}'
+        if system == MULTI_CLASSIFIER_SYSTEM:
+            return '{"labels": ["coder", "analyst", "travel"]}'
+        return await self._upstream("answer")
+
+    async def _chat_stream(self, system, user, tools=None):
+        yield await self._upstream("stream")
+
+    async def _upstream(self, name):
+        self.started.set()
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            self.cancelled.append(name)
+            raise
+        self.completed += 1
+        return "done"
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_cancel_single():
+    print("=== Cancel Single Request ===")
+    registry = CancellationRegistry()
+    orch = SlowOrchestrator()
+    future = registry.track("req-1", orch.ask_async("Pythonのコード"), get_background_loop())
+    assert orch.started.wait(2)
+
+    assert registry.cancel("req-1", reason="client")
+    try:
+        future.result(timeout=2)
+        raise AssertionError("request was not cancelled")
+    except CancelledError:
+        pass
+    assert wait_until(lambda: orch.cancelled == ["answer"]), orch.cancelled
+    assert orch.completed == 0
+    assert not registry.cancel("req-1"), "finished requests cannot be cancelled twice"
+
+    stats = registry.stats()
+    assert stats["in_flight"] == 0
+    assert stats["cancelled_by_reason"] == {"client": 1}
+    assert stats["cancelled_by_stage"] == {"answer": 1}
+    assert stats["estimated_tokens_saved"] > 0
+    print(f"✅ upstream call interrupted during answer, stats: {stats}")
+    return True
+
+
+def test_cancel_fan_out():
+    print("\n=== Cancel Fan-out ===")
+    registry = CancellationRegistry()
+    orch = SlowOrchestrator()
+    registry.track("req-2", orch.ask_multi_async("x"), get_background_loop(), kind="ask_multi")
+    assert wait_until(lambda: orch.started.is_set())
+    time.sleep(0.05)
+
+    # 別のクライアント・別の種類の同じ request_id は置き換えない
+    other = registry.track("req-2", asyncio.sleep(0, result="other"), get_background_loop(), owner="ip:10.0.0.9")
+    discussion = registry.track("req-2", asyncio.sleep(0, result="run"), get_background_loop(), kind="discussion")
+    assert other.result(timeout=2) == "other" and discussion.result(timeout=2) == "run"
+    assert not orch.cancelled and not registry.cancel("req-2", owner="ip:10.0.0.9")
+
+    # 同じクライアントの同じ request_id での再送信は前の実行を置き換える
+    replacement = registry.track("req-2", asyncio.sleep(0, result="retry"), get_background_loop(), kind="ask_multi")
+    assert replacement.result(timeout=2) == "retry"
+    assert wait_until(lambda: len(orch.cancelled) == 3), orch.cancelled
+    assert registry.stats()["cancelled_by_reason"] == {"superseded": 1}
+    print(f"✅ all {len(orch.cancelled)} concurrent agent calls cancelled on resubmit")
+    return True
+
+
+def test_cancel_endpoint():
+    print("\n=== /api/ask Cancellation ===")
+    import app as app_module
+
+    orch = SlowOrchestrator()
+    saved = app_module.orchestrator
+    app_module.orchestrator = orch
+    responses = {}
+    try:
+        def call():
+            client = app_module.app.test_client()
+            responses["ask"] = client.post("/api/ask", json={"prompt": "x", "request_id": "web-1"})
+
+        worker = threading.Thread(target=call)
+        worker.start()
+        assert orch.started.wait(2)
+        other = app_module.app.test_client()
+        stranger = other.post("/api/requests/web-1/cancel", environ_base={"REMOTE_ADDR": "10.0.0.9"})
+        assert stranger.get_json()["cancelled"] is False, "another client cannot cancel the request"
+        cancel = other.post("/api/requests/web-1/cancel")
+        assert cancel.get_json() == {"request_id": "web-1", "cancelled": True}
+        assert other.post("/api/requests/unknown/cancel").get_json()["cancelled"] is False
+        worker.join(5)
+        status = other.get("/status").get_json()
+    finally:
+        app_module.orchestrator = saved
+
+    assert responses["ask"].status_code == 499, responses["ask"].status_code
+    assert responses["ask"].get_json()["error"] == "cancelled"
+    assert status["cancellation"]["cancelled_by_reason"].get("client", 0) >= 1
+    assert get_cancellations().stats()["in_flight"] == 0
+    print(f"✅ 499 returned, /status reports {status['cancellation']['cancelled_total']} cancellation(s)")
+    return True
+
+
+def test_cancel_across_workers():
+    print("\n=== Cancel Across Workers ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = str(Path(tmp) / "cancel.sqlite3")
+        owner = CancellationRegistry(SharedCancellations(db, worker="w1", poll_interval=0.02, wait=2))
+        other = CancellationRegistry(SharedCancellations(db, worker="w2", poll_interval=0.02, wait=0.3))
+        orch = SlowOrchestrator()
+        future = owner.track("req-3", orch.ask_async("Pythonのコード"), get_background_loop(), owner="ip:10.0.0.1")
+        assert orch.started.wait(2)
+
+        # 別のクライアント・未知の ID は、どのワーカーにも無いのですぐ False
+        started = time.time()
+        assert not other.cancel("req-3", owner="ip:10.0.0.9")
+        assert not other.cancel("unknown", owner="ip:10.0.0.1")
+        assert time.time() - started < 0.3, "no waiting when no worker runs the request"
+
+        # 同じクライアントの要求は、実行中のワーカー（w1）のポーラーが取り消して結果を返す
+        assert other.cancel("req-3", reason="client", owner="ip:10.0.0.1")
+        try:
+            future.result(timeout=2)
+            raise AssertionError("request was not cancelled")
+        except CancelledError:
+            pass
+        assert wait_until(lambda: orch.cancelled == ["answer"]), orch.cancelled
+        assert owner.stats()["cancelled_by_reason"] == {"client": 1}
+        assert wait_until(lambda: not owner.shared.pending()), "the request row is answered"
+        assert not other.cancel("req-3", owner="ip:10.0.0.1"), "finished requests are unpublished"
+    print("✅ a cancel sent to another worker reaches the worker running the request")
+    return True
+
+
+def test_tokens_saved_estimate():
+    print("\n=== Tokens-saved Estimate ===")
+    registry = CancellationRegistry()
+    registry.record_answer_tokens(400)
+    release = threading.Event()
+
+    async def streaming(produced):
+        mark_stage("answer", answers=2)
+        note_output("a" * produced * 4)
+        while not release.is_set():
+            await asyncio.sleep(0.01)
+
+    early = registry.track("early", streaming(0), get_background_loop())
+    late = registry.track("late", streaming(700), get_background_loop())
+    time.sleep(0.1)
+    assert registry.cancel("early") and registry.cancel("late")
+    release.set()
+    assert early.cancelled() and late.cancelled()
+    # 2 件 × 400 のうち、早い中断は 800、既に 700 トークン生成済みなら残りの 100 だけ
+    assert registry.stats()["estimated_tokens_saved"] == 800 + 100, registry.stats()
+    print("✅ late cancels only credit the output that was not generated yet")
+    return True
+
+
+def test_approx_tokens():
+    print("\n=== Token Estimate ===")
+    assert approx_tokens("") == 0
+    assert approx_tokens("a" * 400) == 100
+    assert approx_tokens("あ" * 150) == 100
+    print("✅ token estimate for ASCII and Japanese text")
+    return True
+
+
+def main():
+    print("Cancellation Test")
+    print("=" * 50)
+    results = [
+        test_cancel_single(),
+        test_cancel_fan_out(),
+        test_cancel_endpoint(),
+        test_cancel_across_workers(),
+        test_tokens_saved_estimate(),
+        test_approx_tokens(),
+    ]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All cancellation tests passed!")
+        return 0
+    print("⚠️ Some cancellation tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+LLM Cassette Test Script
+
+Verifies record/replay of upstream LLM traffic without API keys:
+- record mode saves single-shot and streamed interactions (chunks, timing,
+  usage) to a gzip cassette
+- replay mode drives the real Orchestrator offline with identical answers,
+  either at full speed or with the recorded latency profile
+- unrecorded requests fail loudly; the Flask app runs the real
+  Orchestrator (not MockOrchestrator) from a cassette with no API key
+- recorders append one interaction at a time, so several workers can share
+  a cassette; max_tokens is not part of the request key
+
+Usage:
+    python test_cassette.py
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_core.models import CreateResult, RequestUsage, SystemMessage, UserMessage
+
+from autogen_router import Orchestrator, CLASSIFIER_SYSTEM
+from cassette import CassetteClient, CassetteMissError, request_key
+from checkpoint import CheckpointStore
+
+
+class SlowUpstream:
+    """Stands in for the live API: 0.2s per call, streamed chunks 0.1s apart."""
+
+    async def create(self, messages, **kwargs):
+        await asyncio.sleep(0.2)
+        label = "coder" if messages[0].content == CLASSIFIER_SYSTEM else "none"
+        return CreateResult(content=json.dumps({"label": label}), usage=RequestUsage(50, 5),
+                            finish_reason="stop", cached=False)
+
+    async def create_stream(self, messages, **kwargs):
+        for word in ("def ", "hello", "():"):
+            await asyncio.sleep(0.1)
+            yield word
+        yield CreateResult(content="def hello():", usage=RequestUsage(30, 9), finish_reason="stop", cached=False)
+
+    async def close(self):
+        pass
+
+
+def make_orchestrator(client, tmp):
+    orch = Orchestrator.__new__(Orchestrator)
+    orch.client = client
+    orch.checkpoints = CheckpointStore(os.path.join(tmp, "checkpoints"))
+    return orch
+
+
+async def run_session(orch):
+    single = await orch.ask_async("hello 関数を書いて")
+    chunks = [c async for c in orch._chat_stream("system", "hello 関数を書いて")]
+    return single, chunks
+
+
+def test_record_and_replay():
+    print("=== Record / Replay ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cassettes", "session.json.gz")
+        recorder = CassetteClient(path, "record", inner=SlowUpstream())
+        start = time.perf_counter()
+        live = asyncio.run(run_session(make_orchestrator(recorder, tmp)))
+        live_seconds = time.perf_counter() - start
+        assert recorder.recorded == 3 and os.path.getsize(path) < 2048
+        print(f"✅ recorded {recorder.recorded} interactions ({os.path.getsize(path)} bytes, live {live_seconds:.2f}s)")
+
+        fast = CassetteClient(path, "replay", speed=0)
+        start = time.perf_counter()
+        replayed = asyncio.run(run_session(make_orchestrator(fast, tmp)))
+        fast_seconds = time.perf_counter() - start
+        assert replayed[0]["response"] == live[0]["response"]
+        assert replayed[0]["usage"] == live[0]["usage"]
+        assert replayed[1] == live[1] == ["def ", "hello", "():"]
+        assert fast_seconds < 0.1, fast_seconds
+        print(f"✅ full-speed replay: identical answers and usage in {fast_seconds * 1000:.1f}ms")
+
+        realtime = CassetteClient(path, "replay", speed=1)
+        orch = make_orchestrator(realtime, tmp)
+
+        async def chunk_offsets():
+            start = time.perf_counter()
+            return [time.perf_counter() - start async for _ in orch._chat_stream("system", "hello 関数を書いて")]
+
+        offsets = asyncio.run(chunk_offsets())
+        assert 0.08 < offsets[0] < 0.18 and 0.27 < offsets[-1] < 0.45, offsets
+        print(f"✅ realtime replay reproduces chunk timing: {[round(o, 2) for o in offsets]}")
+
+        try:
+            asyncio.run(orch._chat("system", "記録していない質問"))
+            raise AssertionError("unrecorded request was answered")
+        except CassetteMissError:
+            pass
+        assert realtime.stats()["cassette"]["misses"] == 1
+        print("✅ unrecorded request raises CassetteMissError")
+    return True
+
+
+def test_shared_cassette():
+    print("\n=== Append / Shared Cassette / Key ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "shared.json.gz")
+        # gunicorn の 2 ワーカー相当: 同じファイルに別々のレコーダーが交互に記録する
+        first = CassetteClient(path, "record", inner=SlowUpstream())
+        second = CassetteClient(path, "record", inner=SlowUpstream())
+
+        async def record_both():
+            await asyncio.gather(
+                first.create([SystemMessage(content="a"), UserMessage(content="one", source="user")]),
+                second.create([SystemMessage(content="a"), UserMessage(content="two", source="user")]),
+            )
+            await first.create([SystemMessage(content="a"), UserMessage(content="three", source="user")])
+
+        asyncio.run(record_both())
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 4 and json.loads(lines[0]) == {"version": 2}, lines
+        assert len(CassetteClient(path, "replay").interactions) == 3
+        print("✅ interactions from two recorders are appended to one cassette (none overwritten)")
+
+        legacy = os.path.join(tmp, "legacy.json.gz")
+        with gzip.open(legacy, "wt", encoding="utf-8") as f:
+            json.dump({"version": 1, "interactions": json.loads("[" + ",".join(lines[1:]) + "]")}, f)
+        assert len(CassetteClient(legacy, "replay").interactions) == 3
+        print("✅ version 1 cassettes still load")
+
+    messages = [UserMessage(content="x", source="user")]
+    assert request_key("create", messages, {"extra_create_args": {"max_tokens": 128}}) == \
+        request_key("create", messages, {"extra_create_args": {"max_tokens": 4096}}) == \
+        request_key("create", messages, {})
+    assert request_key("create", messages, {"extra_create_args": {"temperature": 0}}) != request_key("create", messages, {})
+    print("✅ max_tokens is left out of the request key")
+    return True
+
+
+def test_app_offline():
+    print("\n=== App Replay Without API Key ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "app.json.gz")
+        recorder = CassetteClient(path, "record", inner=SlowUpstream())
+        live = asyncio.run(make_orchestrator(recorder, tmp).ask_async("hello 関数を書いて"))
+
+        env = {k: v for k, v in os.environ.items() if k not in ("GEMINI_API_KEY", "GOOGLE_API_KEY", "GEMINI_API_KEYS")}
+        env.update(LLM_CASSETTE_MODE="replay", LLM_CASSETTE_PATH=path, GEMINI_API_KEY="",
+                   RATE_LIMIT_DB=os.path.join(tmp, "rl.sqlite3"), USAGE_DB=os.path.join(tmp, "usage.sqlite3"),
+                   JOB_DB=os.path.join(tmp, "jobs.sqlite3"), CHECKPOINT_DIR=os.path.join(tmp, "checkpoints"))
+        script = (
+            "import json, app\n"
+            "c = app.app.test_client()\n"
+            "r = c.post('/api/ask', json={'prompt': 'hello 関数を書いて'}).get_json()\n"
+            "print(json.dumps({'available': app.AUTOGEN_AVAILABLE, 'response': r['response'],"
+            " 'cassette': c.get('/status').get_json()['upstream']['cassette']}))\n"
+        )
+        out = subprocess.run([sys.executable, "-c", script], cwd=str(Path(__file__).parent), env=env,
+                             capture_output=True, text=True, timeout=120)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert result["available"] is True, out.stdout
+    assert result["response"] == live["response"]
+    assert result["cassette"]["hits"] == 2 and result["cassette"]["mode"] == "replay"
+    print("✅ real Orchestrator served from the cassette (no MockOrchestrator, no key)")
+    return True
+
+
+def main():
+    print("LLM Cassette Test")
+    print("=" * 50)
+    results = [test_record_and_replay(), test_shared_cassette(), test_app_offline()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All cassette tests passed!")
+        return 0
+    print("⚠️ Some cassette tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoint / Resume Test Script
+
+Verifies that an interrupted group-chat discussion resumes from the last
+completed message instead of replaying every turn, and that the
+orchestrator's classify -> answer flow skips classification on retry.
+Runs fully offline (ReplayChatCompletionClient, no API keys needed).
+
+Usage:
+    python test_checkpoint_resume.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_ext.models.replay import ReplayChatCompletionClient
+
+from checkpoint import CheckpointStore, validate_run_id
+
+
+class FlakyReplayClient(ReplayChatCompletionClient):
+    """Replay client that fails on the N-th call (simulates a 429 / timeout)."""
+
+    def __init__(self, chat_completions, fail_at):
+        super().__init__(chat_completions)
+        self.calls = 0
+        self.fail_at = fail_at
+
+    async def create(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise RuntimeError("429 Too Many Requests")
+        return await super().create(*args, **kwargs)
+
+
+def test_checkpoint_store():
+    """Atomic save / load / delete round-trip"""
+    print("=== Checkpoint Store ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CheckpointStore(tmp)
+        store.save("run-1", "ask", {"selected": "travel"}, prompt="京都")
+        payload = store.load("run-1", kind="ask")
+        assert payload["state"] == {"selected": "travel"}
+        assert payload["meta"]["prompt"] == "京都"
+        assert store.load("run-1", kind="discussion") is None
+        assert store.list_runs() == ["run-1"]
+        # no temp files left behind
+        assert [p.name for p in Path(tmp).iterdir()] == ["run-1.json"]
+        store.delete("run-1")
+        assert store.load("run-1") is None
+        try:
+            store.save("../escape", "ask", {})
+            raise AssertionError("path traversal run_id should be rejected")
+        except ValueError:
+            pass
+    assert validate_run_id(" run-1 ") == "run-1" and validate_run_id("") is None
+    for bad in ("../escape", "a b", "x" * 129):
+        try:
+            validate_run_id(bad)
+            raise AssertionError(f"{bad!r} should be rejected")
+        except ValueError:
+            pass
+    print("✅ save / load / delete / run_id validation")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CheckpointStore(tmp, ttl=60)
+        store.save("old-ask", "ask", {"selected": "travel"})
+        store.save("old-discussion", "discussion", {"message_count": 2})
+        store.save("fresh", "ask", {"selected": "travel"})
+        stale = time.time() - 120
+        os.utime(Path(tmp) / "old-discussion.json", (stale, stale))
+        assert store.purge_expired() == 1 and store.list_runs() == ["fresh", "old-ask"]
+        # 中身の updated_at が古ければ、掃除の前でも再開には使わない
+        payload = json.loads((Path(tmp) / "old-ask.json").read_text(encoding="utf-8"))
+        payload["updated_at"] = stale
+        (Path(tmp) / "old-ask.json").write_text(json.dumps(payload), encoding="utf-8")
+        assert store.load("old-ask", kind="ask") is None and store.list_runs() == ["fresh"]
+    print("✅ ask and discussion checkpoints expire after CHECKPOINT_TTL")
+    return True
+
+
+def test_discussion_resume():
+    """Discussion interrupted at the 3rd model call resumes from message 3"""
+    from discussion import run_discussion
+
+    print("\n=== Discussion Resume ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CheckpointStore(tmp)
+        flaky = FlakyReplayClient(["経済: 論点1", "気候: 論点2", "unused"], fail_at=3)
+
+        async def first_run():
+            try:
+                await run_discussion(task="議題", run_id="d1", store=store, model_client=flaky,
+                                     on_message=lambda m, c: None)
+            except RuntimeError as e:
+                return str(e)
+            return None
+
+        error = asyncio.run(first_run())
+        assert error and "429 Too Many Requests" in error, error
+        saved = store.load("d1", kind="discussion")
+        assert saved is not None, "checkpoint should survive the failure"
+        print(f"✅ failed run left checkpoint after {saved['state']['message_count']} messages")
+
+        resumed_client = ReplayChatCompletionClient(["経済: 【結論】料金施策×代替手段"])
+        result = asyncio.run(run_discussion(run_id="d1", store=store, model_client=resumed_client,
+                                            on_message=lambda m, c: None))
+        assert result["resumed"] is True
+        assert [m["source"] for m in result["messages"]] == ["economist"]
+        assert "【結論】" in result["messages"][-1]["content"]
+        assert store.load("d1") is None, "checkpoint should be removed on success"
+        print("✅ resumed run paid for 1 new turn only and finished with 【結論】")
+    return True
+
+
+def test_orchestrator_resume():
+    """Second ask_async with the same run_id reuses the checkpointed label"""
+    from autogen_router import Orchestrator
+
+    print("\n=== Orchestrator Resume ===")
+
+    class TestOrchestrator(Orchestrator):
+        def __init__(self, store):
+            self.checkpoints = store
+            self.classify_calls = 0
+            self.fail_answer = True
+
+        async def classify_async(self, prompt):
+            self.classify_calls += 1
+            return "travel"
+
+        async def _chat(self, system, user, tools=None):
+            if self.fail_answer:
+                raise RuntimeError("timeout")
+            return "半日観光プラン"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        orch = TestOrchestrator(CheckpointStore(tmp))
+        first = asyncio.run(orch.ask_async("京都の観光プラン", run_id="a1"))
+        assert first["selected"] == "travel" and first["response"].startswith("Sorry") and first["degraded"]
+        orch.fail_answer = False
+        second = asyncio.run(orch.ask_async("京都の観光プラン", run_id="a1"))
+        assert second["response"].startswith("半日観光プラン") and "degraded" not in second
+        assert orch.classify_calls == 1, "classification should not be repeated"
+        assert orch.checkpoints.load("a1") is None
+    print("✅ retry skipped classification and cleared the checkpoint")
+    print("✅ the canned error reply is flagged degraded (never stored or versioned)")
+
+    import app as app_module
+    with app_module.app.test_client() as client:
+        for path, body in (("/api/ask", {"prompt": "京都"}), ("/api/jobs", {"prompt": "京都"})):
+            resp = client.post(path, json={**body, "run_id": "../escape"})
+            assert resp.status_code == 400 and "run_id" in resp.get_json()["error"], (path, resp.status_code)
+    print("✅ an invalid run_id is rejected with 400 before any work starts")
+    return True
+
+
+def main():
+    print("Checkpoint / Resume Test")
+    print("=" * 50)
+    results = [
+        test_checkpoint_store(),
+        test_discussion_resume(),
+        test_orchestrator_resume(),
+    ]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All checkpoint tests passed!")
+        return 0
+    print("⚠️ Some checkpoint tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Circuit Breaker Test Script
+
+Verifies upstream failure isolation without API keys:
+- the breaker opens on a high error rate or slow calls, rejects calls
+  immediately while open, and closes again after a successful half-open probe
+- each upstream call is bounded by the timeout
+- long answers are not slow calls: streams are judged on the first chunk,
+  create() on the time left after its output tokens
+- while open, the orchestrator routes with the keyword classifier and
+  answers with a fast degraded response (no upstream call)
+- breaker state is reported on /status
+
+Usage:
+    python test_circuit_breaker.py
+"""
+
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import circuit_breaker
+from circuit_breaker import BreakerClient, CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+
+
+async def failing():
+    raise ConnectionError("upstream down")
+
+
+async def succeeding(delay=0.0):
+    await asyncio.sleep(delay)
+    return "ok"
+
+
+def make_breaker(**kwargs):
+    options = dict(window_seconds=60, min_calls=3, error_rate=0.5, slow_call_seconds=5,
+                   slow_call_rate=0.8, open_seconds=0.2, half_open_probes=1, timeout=0.2)
+    options.update(kwargs)
+    return CircuitBreaker("test", **options)
+
+
+def test_open_and_recover():
+    print("=== Open / Half-open / Close ===")
+    breaker = make_breaker()
+
+    async def scenario():
+        for _ in range(3):
+            try:
+                await breaker.call(failing())
+            except ConnectionError:
+                pass
+        assert breaker.state == OPEN, breaker.state
+
+        start = time.perf_counter()
+        try:
+            await breaker.call(succeeding(1.0))
+            raise AssertionError("call passed an open circuit")
+        except CircuitOpenError as e:
+            assert e.retry_in > 0
+        assert time.perf_counter() - start < 0.05, "open circuit must reject immediately"
+
+        await asyncio.sleep(0.25)
+        assert breaker.state == HALF_OPEN
+        try:
+            await breaker.call(failing())
+        except ConnectionError:
+            pass
+        assert breaker.state == OPEN, "failed probe re-opens the circuit"
+
+        await asyncio.sleep(0.25)
+        assert await breaker.call(succeeding()) == "ok"
+        assert breaker.state == CLOSED
+
+    asyncio.run(scenario())
+    stats = breaker.stats()
+    assert stats["opened_total"] == 2 and stats["rejected_total"] == 1
+    print(f"✅ opened, rejected fast, recovered via probe: {stats['state']}")
+    return True
+
+
+def test_timeout_and_slow_calls():
+    print("\n=== Timeout / Slow Calls ===")
+    breaker = make_breaker(timeout=0.1)
+
+    async def timed_out():
+        start = time.perf_counter()
+        try:
+            await breaker.call(succeeding(5))
+            raise AssertionError("timeout not applied")
+        except asyncio.TimeoutError:
+            pass
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(timed_out())
+    assert elapsed < 0.5 and breaker.stats()["error_rate"] == 1.0
+    print(f"✅ hung upstream call bounded at {elapsed:.2f}s")
+
+    slow = make_breaker(slow_call_seconds=0.05, slow_call_rate=0.6, timeout=1)
+
+    async def slow_calls():
+        for _ in range(3):
+            await slow.call(succeeding(0.06))
+
+    asyncio.run(slow_calls())
+    assert slow.state == OPEN, "slow (but successful) calls should open the circuit"
+    print("✅ latency window opens the circuit on slow calls")
+    return True
+
+
+def test_long_answers_are_not_slow():
+    print("\n=== Slow Calls vs Long Answers ===")
+
+    async def answer(delay, tokens):
+        await asyncio.sleep(delay)
+        return SimpleNamespace(content="x", usage=SimpleNamespace(completion_tokens=tokens))
+
+    options = dict(slow_call_seconds=0.05, slow_call_rate=0.6, slow_seconds_per_token=0.01, timeout=0.1)
+    long_answers = make_breaker(**options)
+    slow_start = make_breaker(**options)
+
+    async def creates():
+        for _ in range(3):
+            # 0.12 秒かかっても 20 トークン分（0.2 秒）の生成時間内、max_tokens の分だけタイムアウトも延びる
+            await long_answers.call(answer(0.12, 20), max_tokens=20)
+            await slow_start.call(answer(0.06, 0))
+
+    asyncio.run(creates())
+    assert long_answers.state == CLOSED and long_answers.stats()["error_rate"] == 0.0
+    assert slow_start.state == OPEN
+    print("✅ create(): judged per output token, timeout extended by max_tokens")
+
+    class StreamingClient:
+        def __init__(self, first_delay):
+            self.first_delay = first_delay
+
+        async def create_stream(self, messages, **kwargs):
+            await asyncio.sleep(self.first_delay)
+            for _ in range(4):
+                yield "chunk"
+                await asyncio.sleep(0.03)
+
+    async def stream(client):
+        return [chunk async for chunk in client.create_stream([])]
+
+    quick = make_breaker(**options)
+    late = make_breaker(**options)
+    for _ in range(3):
+        asyncio.run(stream(BreakerClient(StreamingClient(0), quick)))
+        asyncio.run(stream(BreakerClient(StreamingClient(0.06), late)))
+    assert quick.state == CLOSED, "a long stream that starts quickly is not slow"
+    assert late.state == OPEN
+    print("✅ streams: judged on time to the first chunk")
+    return True
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, messages, **kwargs):
+        self.calls += 1
+        raise ConnectionError("503 Service Unavailable")
+
+
+def test_degraded_mode():
+    from autogen_router import Orchestrator
+    from checkpoint import CheckpointStore
+
+    print("\n=== Degraded Routing / Answering ===")
+    saved = circuit_breaker._breakers.get("llm")
+    circuit_breaker._breakers["llm"] = make_breaker(open_seconds=30)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            orch = Orchestrator.__new__(Orchestrator)
+            orch.client = BreakerClient(FakeClient())
+            orch.checkpoints = CheckpointStore(tmp)
+
+            # 失敗が続いてブレーカーが open になるまで
+            for _ in range(2):
+                asyncio.run(orch.ask_async("今日の天気は？"))
+            assert circuit_breaker.get_breaker().state == OPEN
+            calls = orch.client.calls
+
+            start = time.perf_counter()
+            result = asyncio.run(orch.ask_async("今日の旅行プランの予算とホテルを教えて"))
+            elapsed = time.perf_counter() - start
+            assert orch.client.calls == calls, "no upstream call while open"
+            assert result["selected"] == "travel", result
+            assert result.get("degraded") is True and "簡易モード" in result["response"]
+            assert elapsed < 0.1
+
+            multi = asyncio.run(orch.ask_multi_async("Pythonで旅行の支出データを分析するツール", synthesize=True))
+            assert len(multi["selected_agents"]) >= 2
+            assert all("簡易モード" in r for r in multi["responses"].values())
+            assert orch.client.calls == calls
+        print(f"✅ keyword routing → {result['selected']}, degraded answer in {elapsed * 1000:.1f}ms")
+
+        import app as app_module
+        with app_module.app.test_client() as client:
+            status = client.get("/status").get_json()
+        assert status["circuit_breaker"]["state"] == OPEN
+        print(f"✅ /status reports circuit state: {status['circuit_breaker']['state']}")
+    finally:
+        if saved is not None:
+            circuit_breaker._breakers["llm"] = saved
+        else:
+            circuit_breaker._breakers.pop("llm", None)
+    return True
+
+
+def main():
+    print("Circuit Breaker Test")
+    print("=" * 50)
+    results = [test_open_and_recover(), test_timeout_and_slow_calls(), test_long_answers_are_not_slow(),
+               test_degraded_mode()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All circuit breaker tests passed!")
+        return 0
+    print("⚠️ Some circuit breaker tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Discussion Streaming Test Script
+
+Verifies the live discussion pipeline without API keys:
+- Broadcaster keeps per-subscriber queues bounded (slow clients drop the
+  oldest events instead of stalling the publisher) and replays history
+- DiscussionManager runs a group chat in the background loop
+- /api/discussions/<id>/events streams each finalized message as SSE
+- runs and their checkpoints belong to the client that started them
+
+Usage:
+    python test_discussion_stream.py
+"""
+
+import json
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_ext.models.replay import ReplayChatCompletionClient
+
+from broadcaster import Broadcaster
+from checkpoint import CheckpointStore, checkpoint_key
+
+
+def test_broadcaster():
+    print("=== Broadcaster ===")
+    b = Broadcaster(queue_size=3)
+    fast = b.subscribe()
+    slow = b.subscribe()
+    for i in range(5):
+        b.publish({"type": "message", "n": i})
+        fast_event = fast.get(timeout=1)
+        assert fast_event["n"] == i
+    # slow subscriber never read: only the newest 3 remain, publisher never blocked
+    assert [slow.get(timeout=1)["n"] for _ in range(3)] == [2, 3, 4]
+    assert slow.dropped == 2
+    late = b.subscribe()
+    assert late.get(timeout=1)["n"] == 2, "late subscriber gets recent history"
+    b.close()
+    assert fast.get(timeout=1) is None, "close() ends every stream"
+    print("✅ bounded queues, drop-oldest, history replay, close")
+    return True
+
+
+def test_sse_endpoint():
+    print("\n=== SSE Endpoint ===")
+    import app as app_module
+    from discussion import DiscussionManager
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = DiscussionManager(
+            model_client_factory=lambda: ReplayChatCompletionClient(
+                ["経済: 混雑課金が有効", "気候: 【結論】混雑課金×公共交通強化"]
+            ),
+            store=CheckpointStore(tmp),
+        )
+        app_module._discussions = manager
+        run = manager.start(task="議題: 渋滞対策", client_id="ip:127.0.0.1")
+
+        with app_module.app.test_client() as client:
+            resp = client.get(f"/api/discussions/{run.run_id}/events")
+            assert resp.status_code == 200
+            assert resp.mimetype == "text/event-stream"
+            body = resp.get_data(as_text=True)
+
+        events = []
+        for block in body.strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in block.split("\n") if not line.startswith(":"))
+            events.append((lines["event"], json.loads(lines["data"])))
+
+        kinds = [kind for kind, _ in events]
+        assert kinds[0] == "start" and kinds[-1] == "done", kinds
+        speakers = [ev["source"] for kind, ev in events if kind == "message"]
+        assert speakers == ["user", "economist", "climatologist"], speakers
+        assert "【結論】" in events[-2][1]["content"]
+        assert events[-2][1]["usage"] is not None
+
+        deadline = time.time() + 5
+        while run.status == "running" and time.time() < deadline:
+            time.sleep(0.05)
+        assert manager.get(run.run_id, "ip:127.0.0.1") is run and run.status == "done"
+        with app_module.app.test_client() as client:
+            assert client.get("/api/discussions/unknown/events").status_code == 404
+        app_module._discussions = None
+    print("✅ start → user → economist → climatologist → done streamed as SSE")
+    return True
+
+
+def test_discussion_owner():
+    print("\n=== Discussion Ownership ===")
+    import app as app_module
+    from discussion import DiscussionManager
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CheckpointStore(tmp)
+        manager = DiscussionManager(
+            model_client_factory=lambda: ReplayChatCompletionClient(
+                ["経済: 混雑課金が有効", "気候: 【結論】混雑課金×公共交通強化"]
+            ),
+            store=store,
+        )
+        app_module._discussions = manager
+        # 別のクライアントが同じ run_id で中断した議論のチェックポイント
+        other_key = checkpoint_key("shared", "ip:10.0.0.9")
+        store.save(other_key, "discussion", {"team": {}, "message_count": 5}, task="他人の議題")
+        assert checkpoint_key("shared", "ip:127.0.0.1") != other_key
+
+        manager.start(task="議題: 渋滞対策", run_id="shared", client_id="ip:127.0.0.1")
+        stranger = {"REMOTE_ADDR": "10.0.0.9"}
+        with app_module.app.test_client() as client:
+            assert client.get("/api/discussions/shared", environ_base=stranger).status_code == 404
+            assert client.get("/api/discussions/shared/events", environ_base=stranger).status_code == 404
+            assert client.post("/api/discussions/shared/cancel", environ_base=stranger).get_json()["cancelled"] is False
+            body = client.get("/api/discussions/shared/events").get_data(as_text=True)
+            assert client.get("/api/discussions/shared").get_json()["status"] == "done"
+        app_module._discussions = None
+
+        done = [json.loads(line[len("data: "):]) for line in body.splitlines()
+                if line.startswith("data: ") and '"done"' in line]
+        assert done and done[-1]["resumed"] is False, "another client's checkpoint must not be resumed"
+        assert "他人の議題" not in body
+        assert store.load(other_key, kind="discussion") is not None, "the other client's checkpoint is untouched"
+        assert manager.get("shared") is None and manager.get("shared", "ip:10.0.0.9") is None
+    print("✅ only the starting client can read, stream or cancel a run; checkpoints are per client")
+    return True
+
+
+def main():
+    print("Discussion Streaming Test")
+    print("=" * 50)
+    results = [test_broadcaster(), test_sse_endpoint(), test_discussion_owner()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All discussion streaming tests passed!")
+        return 0
+    print("⚠️ Some discussion streaming tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
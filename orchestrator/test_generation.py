@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Generation Limit Test Script
+
+Verifies per-call max_tokens and automatic continuation without API keys:
+- the classifier gets a small limit with thinking turned off
+  (reasoning_effort), and replies cut off at that limit are counted;
+  answers use the agent's configured
+  max_tokens until enough answers were seen, then p95 × headroom of the
+  observed lengths for that agent and prompt type
+- answers cut off at max_tokens (finish_reason "length") are continued
+  and concatenated, both for single-shot and streamed answers
+
+Usage:
+    python test_generation.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_core.models import AssistantMessage, CreateResult, RequestUsage
+
+import generation
+from autogen_router import Orchestrator, CLASSIFIER_SYSTEM, MULTI_CLASSIFIER_SYSTEM
+from checkpoint import CheckpointStore
+from generation import CONTINUE_PROMPT, GenerationLimits, prompt_type
+
+ANSWER_WORDS = 700
+
+
+class TruncatingClient:
+    """Writes a 700-word answer, cut at max_tokens words per call (1 word = 1 token)."""
+
+    def __init__(self):
+        self.limits = []
+        self.efforts = []
+        self.classify_finish = "stop"
+
+    def _turn(self, messages, kwargs):
+        max_tokens = kwargs.get("extra_create_args", {}).get("max_tokens")
+        self.limits.append((messages[0].content, max_tokens))
+        self.efforts.append(kwargs.get("extra_create_args", {}).get("reasoning_effort"))
+        if messages[0].content == CLASSIFIER_SYSTEM:
+            return CreateResult(content='{"label": "coder"}', usage=RequestUsage(10, 6),
+                                finish_reason=self.classify_finish, cached=False)
+        if messages[0].content == MULTI_CLASSIFIER_SYSTEM:
+            return CreateResult(content='{"labels": ["coder"]}', usage=RequestUsage(10, 8), finish_reason="stop", cached=False)
+        if len(messages) > 2:
+            assert messages[-1].content == CONTINUE_PROMPT
+        written = sum(len(m.content.split()) for m in messages if isinstance(m, AssistantMessage))
+        words = [f"w{i}" for i in range(written, ANSWER_WORDS)][:max_tokens]
+        finish = "length" if written + len(words) < ANSWER_WORDS else "stop"
+        return CreateResult(content=" ".join(words) + " ", usage=RequestUsage(20, len(words)),
+                            finish_reason=finish, cached=False)
+
+    async def create(self, messages, **kwargs):
+        return self._turn(messages, kwargs)
+
+    async def create_stream(self, messages, **kwargs):
+        result = self._turn(messages, kwargs)
+        for word in result.content.split():
+            yield word + " "
+        yield result
+
+    async def close(self):
+        pass
+
+
+def make_orchestrator(tmp):
+    orch = Orchestrator.__new__(Orchestrator)
+    orch.client = TruncatingClient()
+    orch.checkpoints = CheckpointStore(os.path.join(tmp, "checkpoints"))
+    return orch
+
+
+def test_adaptive_limits():
+    print("=== Adaptive Limits ===")
+    limits = GenerationLimits()
+    limits.min_samples = 20
+    assert limits.limit("classify", "none", "x") == generation.CLASSIFY_MAX_TOKENS
+    assert limits.limit("answer", "coder", "短い質問") == 3072, "configured in agents.json"
+    assert limits.limit("answer", "none", "短い質問") == generation.ANSWER_MAX_TOKENS
+    assert limits.limit("other", "none", "x") is None
+
+    for i in range(19):
+        limits.observe("travel", "京都の観光", 300 + i)
+    assert limits.limit("answer", "travel", "奈良の観光") == 1536, "not enough samples yet"
+    limits.observe("travel", "京都の観光", 400)
+    adaptive = limits.limit("answer", "travel", "奈良の観光")
+    assert adaptive == int(318 * 1.25), adaptive
+    assert limits.limit("answer", "travel", "x" * 2000) == 1536, "long prompts are tracked separately"
+    print(f"✅ travel/short: 1536 → {adaptive} after 20 answers (p95 318 × 1.25)")
+
+    for _ in range(20):
+        limits.observe("analyst", "平均は？", 20)
+        limits.observe("coder", "バグ", 9000)
+    assert limits.limit("answer", "analyst", "中央値は？") == limits.floor
+    assert limits.limit("answer", "coder", "直して") == 3072, "never above the configured limit"
+    assert prompt_type("```py\nx\n```") == "code"
+    print(f"✅ clamped to [{limits.floor}, configured]; stats: {limits.stats()['answers']['travel/short']}")
+    return True
+
+
+def short_history():
+    """Fresh limits that have only seen a short coder answer (limit drops to the floor)."""
+    limits = generation._limits = GenerationLimits()
+    limits.min_samples = 1
+    limits.observe("coder", "Pythonでソートを書いて", 100)
+    return limits
+
+
+def test_continuation(tmp):
+    print("\n=== Continuation ===")
+    orch = make_orchestrator(tmp)
+    result = asyncio.run(orch.ask_async("Pythonでソートを書いて"))
+    words = result["response"].split("\n\n---")[0].split()
+    assert words == [f"w{i}" for i in range(ANSWER_WORDS)], words[-3:]
+    calls = orch.client.limits
+    assert calls[0] == (CLASSIFIER_SYSTEM, generation.CLASSIFY_MAX_TOKENS)
+    assert [limit for _, limit in calls[1:]] == [3072], "700 words fit the coder limit in one call"
+    assert orch.client.efforts == ["none", None], "thinking is off for the classifier only"
+    print(f"✅ classifier max_tokens={calls[0][1]} (reasoning_effort=none), coder answer in 1 call")
+
+    limits = short_history()
+    orch.client.limits.clear()
+    result = asyncio.run(orch.ask_async("Pythonでソートを書いて"))
+    words = result["response"].split("\n\n---")[0].split()
+    assert words == [f"w{i}" for i in range(ANSWER_WORDS)], "continued answer is complete"
+    answer_calls = [limit for system, limit in orch.client.limits if system != CLASSIFIER_SYSTEM]
+    assert answer_calls == [256, 256, 256], answer_calls
+    stats = limits.stats()
+    assert stats["truncated_answers"] == 1 and stats["continuations"] == 2
+    assert stats["answers"]["coder/short"]["samples"] == 2
+    print(f"✅ limit {answer_calls[0]} learned from history; 2 continuations completed all {ANSWER_WORDS} words")
+
+    limits = short_history()
+    events = []
+    multi = asyncio.run(orch.ask_multi_async("Pythonでソートを書いて", on_event=events.append))
+    streamed = "".join(e["delta"] for e in events if e["type"] == "partial").split()
+    assert streamed == [f"w{i}" for i in range(ANSWER_WORDS)], streamed[-3:]
+    assert multi["responses"]["coder"].split("\n\n---")[0].split() == streamed
+    assert limits.stats()["continuations"] == 2
+    print("✅ streamed answers continue seamlessly")
+
+    limits = short_history()
+    orch.client.classify_finish = "length"
+    asyncio.run(orch.ask_async("Pythonでソートを書いて"))
+    assert limits.stats()["truncated_classifications"] == 1 and limits.stats()["truncated_answers"] == 1
+    print("✅ classifier replies cut off at max_tokens are counted")
+    return True
+
+
+def main():
+    print("Generation Limit Test")
+    print("=" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [test_adaptive_limits(), test_continuation(tmp)]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All generation limit tests passed!")
+        return 0
+    print("⚠️ Some generation limit tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Idempotency Test Script
+
+Verifies Idempotency-Key handling without API keys:
+- concurrent retries with the same key run the work once and all get the
+  same result; later retries get the stored result (until the TTL)
+- a different body under the same key is rejected; failures and degraded
+  (circuit-open fallback) answers are not stored
+- across workers (two stores on one SQLite file): a retry waits for the
+  other worker's execution, gives up with a conflict after the wait limit,
+  and takes over once a crashed worker's lease has expired
+- /api/ask and /api/jobs: a retry storm makes one upstream answer / one job
+
+Usage:
+    python test_idempotency.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import idempotency
+import rate_limit
+from idempotency import IdempotencyConflict, IdempotencyMismatch, IdempotencyStore, fingerprint
+from jobs import JobQueue, JobStore
+from rate_limit import RateLimiter
+
+
+def counting(seconds=0.2, status=200):
+    runs = []
+
+    def execute():
+        runs.append(threading.get_ident())
+        time.sleep(seconds)
+        return status, {"answer": len(runs)}
+    return execute, runs
+
+
+def test_single_worker(tmp):
+    print("=== Retries in One Worker ===")
+    store = IdempotencyStore(os.path.join(tmp, "one.sqlite3"), ttl=60)
+    execute, runs = counting()
+    body_hash = fingerprint({"prompt": "京都の観光", "request_id": "a"})
+    assert fingerprint({"prompt": "京都の観光", "request_id": "b"}) == body_hash, "request_id may change"
+
+    with ThreadPoolExecutor(5) as pool:
+        outcomes = list(pool.map(lambda _: store.run("k1", body_hash, execute), range(5)))
+    assert len(runs) == 1, f"executed {len(runs)} times"
+    assert all(body == {"answer": 1} for _, body, _ in outcomes)
+    assert sorted(replayed for _, _, replayed in outcomes) == [False, True, True, True, True]
+    assert store.run("k1", body_hash, execute) == (200, {"answer": 1}, True)
+    print(f"✅ 5 concurrent retries → 1 execution; stats {store.stats()}")
+
+    try:
+        store.run("k1", fingerprint({"prompt": "別の質問"}), execute)
+        raise AssertionError("mismatched body accepted")
+    except IdempotencyMismatch:
+        pass
+
+    failing, failed_runs = counting(0.0, status=500)
+    assert store.run("k2", body_hash, failing)[0] == 500
+    assert store.run("k2", body_hash, failing)[2] is False and len(failed_runs) == 2, "failures are retried"
+    print("✅ different body → mismatch; failed results are not stored")
+
+    degraded_runs = []
+
+    def degraded():
+        degraded_runs.append(1)
+        return 200, {"response": "ただいま混み合っています", "degraded": True}
+
+    assert store.run("k3", body_hash, degraded)[:2] == (200, {"response": "ただいま混み合っています", "degraded": True})
+    assert store.run("k3", body_hash, degraded)[2] is False and len(degraded_runs) == 2
+    assert store.run("k3", body_hash, execute)[:3] == (200, {"answer": 2}, False), "recovered answer is stored"
+    assert store.run("k3", body_hash, execute)[2] is True
+    print("✅ degraded 200s are not stored; the retry after recovery gets a real answer")
+    return True
+
+
+def test_across_workers(tmp):
+    print("\n=== Retries Across Workers ===")
+    path = os.path.join(tmp, "shared.sqlite3")
+    worker_a = IdempotencyStore(path, ttl=60)
+    worker_b = IdempotencyStore(path, ttl=60, wait=5)
+    execute, runs = counting(0.5)
+    body_hash = fingerprint({"prompt": "x"})
+
+    first = threading.Thread(target=worker_a.run, args=("k", body_hash, execute))
+    first.start()
+    time.sleep(0.1)
+    start = time.perf_counter()
+    status, body, replayed = worker_b.run("k", body_hash, execute)
+    first.join()
+    assert (status, body, replayed) == (200, {"answer": 1}, True) and len(runs) == 1
+    print(f"✅ worker B waited {time.perf_counter() - start:.2f}s for worker A's result instead of re-running")
+
+    impatient = IdempotencyStore(path, ttl=60, wait=0.2)
+    slow = threading.Thread(target=worker_a.run, args=("slow", body_hash, counting(1.0)[0]))
+    slow.start()
+    time.sleep(0.1)
+    try:
+        impatient.run("slow", body_hash, execute)
+        raise AssertionError("expected a conflict")
+    except IdempotencyConflict as e:
+        assert e.retry_after >= 1
+    slow.join()
+    print("✅ still running past IDEMPOTENCY_WAIT → 409 conflict")
+
+    crashed = IdempotencyStore(path, lease=0.2)
+    crashed._claim("orphan", body_hash)  # 実行を始めたまま落ちたワーカー
+    takeover, takeover_runs = counting(0.0)
+    assert worker_b.run("orphan", body_hash, takeover)[2] is False and len(takeover_runs) == 1
+    print("✅ a crashed worker's claim expires after its lease and the retry executes")
+    return True
+
+
+class CountingOrchestrator:
+    def __init__(self):
+        self.calls = 0
+
+    async def ask_async(self, prompt, run_id=None):
+        self.calls += 1
+        await asyncio.sleep(0.3)
+        return {"selected": "travel", "response": f"answer {self.calls}", "usage": {}}
+
+
+def test_endpoints(tmp):
+    print("\n=== /api/ask and /api/jobs ===")
+    import app as app_module
+
+    saved = (app_module.orchestrator, app_module._jobs, idempotency._store, rate_limit._limiter)
+    orch = CountingOrchestrator()
+    app_module.orchestrator = orch
+    app_module._jobs = JobQueue(JobStore(os.path.join(tmp, "jobs.sqlite3")), app_module.run_ask_job,
+                                workers=1, poll_interval=0.05)
+    idempotency._store = IdempotencyStore(os.path.join(tmp, "idem.sqlite3"))
+    rate_limit._limiter = RateLimiter(os.path.join(tmp, "rl.sqlite3"), requests_per_minute=600, request_burst=3)
+    try:
+        def post(request_id, headers):
+            with app_module.app.test_client() as client:
+                return client.post("/api/ask", json={"prompt": "京都の観光", "request_id": request_id},
+                                   headers=headers)
+
+        key = {"Idempotency-Key": "retry-1"}
+        with ThreadPoolExecutor(6) as pool:
+            responses = list(pool.map(lambda i: post(f"r{i}", key), range(6)))
+        assert [r.status_code for r in responses] == [200] * 6
+        assert orch.calls == 1 and {r.get_json()["response"] for r in responses} == {"answer 1"}
+        assert sum(r.headers.get("Idempotent-Replayed") == "true" for r in responses) == 5
+        assert rate_limit._limiter.stats()["allowed"] == 1, "retries do not consume the rate limit"
+        print("✅ 6 concurrent POST /api/ask with one key → 1 upstream answer, 5 replayed")
+
+        assert post("r9", key).headers["Idempotent-Replayed"] == "true" and orch.calls == 1
+        with app_module.app.test_client() as client:
+            other = client.post("/api/ask", json={"prompt": "大阪"}, headers=key)
+            assert other.status_code == 422, other.status_code
+            assert client.post("/api/ask", json={"prompt": "京都の観光"}).status_code == 200
+            assert orch.calls == 2, "requests without a key are never deduplicated"
+
+            jobs = [client.post("/api/jobs", json={"prompt": "長い質問"}, headers={"Idempotency-Key": "job-1"})
+                    for _ in range(3)]
+            assert all(j.status_code == 202 for j in jobs)
+            assert len({j.get_json()["id"] for j in jobs}) == 1 and jobs[2].headers["Location"].endswith(
+                jobs[0].get_json()["id"])
+            assert client.get("/status").get_json()["idempotency"]["replayed"] >= 3
+            client.get(f"/api/jobs/{jobs[0].get_json()['id']}/events").get_data()  # 完了まで待つ
+            assert orch.calls == 3, "one job ran"
+        print(f"✅ retried job submissions return the first job ({jobs[0].get_json()['id']}); other body → 422")
+    finally:
+        app_module._jobs.stop()
+        app_module.orchestrator, app_module._jobs, idempotency._store, rate_limit._limiter = saved
+    return True
+
+
+def main():
+    print("Idempotency Test")
+    print("=" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [test_single_worker(tmp), test_across_workers(tmp), test_endpoints(tmp)]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All idempotency tests passed!")
+        return 0
+    print("⚠️ Some idempotency tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
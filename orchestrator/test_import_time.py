@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Import Time Test Script
+
+Guards worker startup cost (gunicorn --reload and worker recycling import
+app.py again each time):
+- `import app` in a fresh interpreter stays under IMPORT_TIME_BUDGET
+  seconds (default 0.6) and does not load autogen / openai
+- credentials are probed from the environment without building clients
+- the real Orchestrator is built on first use, and preload_modules()
+  loads the heavy modules (gunicorn master with preload_app)
+
+Usage:
+    python test_import_time.py
+    IMPORT_TIME_BUDGET=0.4 python test_import_time.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+HERE = str(Path(__file__).parent)
+BUDGET = float(os.environ.get("IMPORT_TIME_BUDGET", "0.6"))
+HEAVY = ("autogen_core", "autogen_ext", "autogen_agentchat", "openai")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+heavy = [m for m in %r if m in sys.modules]
+after = {}
+if "--use" in sys.argv:
+    app.app.test_client().get("/status")
+    after = {"loaded": app.orchestrator.loaded, "type": type(app.orchestrator.get()).__name__,
+             "heavy": [m for m in %r if m in sys.modules]}
+print(json.dumps({"seconds": elapsed, "heavy": heavy, "available": app.AUTOGEN_AVAILABLE, **after}))
+""" % (HEAVY, HEAVY)
+
+
+def probe(env_overrides, *args):
+    env = {k: v for k, v in os.environ.items()
+           if k not in ("GEMINI_API_KEY", "GOOGLE_API_KEY", "GEMINI_API_KEYS", "UPSTREAM_ENDPOINTS", "LLM_CASSETTE_MODE")}
+    env.update(env_overrides)
+    out = subprocess.run([sys.executable, "-c", PROBE, *args], cwd=HERE, env=env,
+                         capture_output=True, text=True, timeout=120)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_import_budget():
+    print("=== Import Time Budget ===")
+    for label, env in (("with API key", {"GEMINI_API_KEY": "dummy"}), ("without API key", {})):
+        runs = [probe(env) for _ in range(3)]
+        best = min(r["seconds"] for r in runs)
+        assert all(not r["heavy"] for r in runs), f"heavy modules imported by app: {runs[0]['heavy']}"
+        assert best < BUDGET, f"import app took {best:.3f}s {label} (budget {BUDGET}s)"
+        print(f"✅ import app {label}: {best * 1000:.0f}ms (budget {BUDGET * 1000:.0f}ms), no autogen/openai loaded")
+    return True
+
+
+def test_lazy_orchestrator():
+    print("\n=== Lazy Orchestrator / Credential Probe ===")
+    from startup import credentials_configured, preload_modules
+
+    saved = {k: os.environ.pop(k) for k in ("GEMINI_API_KEY", "GOOGLE_API_KEY", "GEMINI_API_KEYS",
+                                            "UPSTREAM_ENDPOINTS", "LLM_CASSETTE_MODE") if k in os.environ}
+    try:
+        assert not credentials_configured()
+        os.environ["GEMINI_API_KEYS"] = "a,b"
+        assert credentials_configured()
+        del os.environ["GEMINI_API_KEYS"]
+        os.environ["LLM_CASSETTE_MODE"] = "replay"
+        assert credentials_configured()
+        del os.environ["LLM_CASSETTE_MODE"]
+    finally:
+        os.environ.update(saved)
+    print("✅ credentials probed from the environment (keys, key lists, replay cassettes)")
+
+    used = probe({"GEMINI_API_KEY": "dummy"}, "--use")
+    assert used["available"] and used["loaded"] and used["type"] == "Orchestrator", used
+    assert "autogen_ext" in used["heavy"]
+    mock = probe({}, "--use")
+    assert not mock["available"] and mock["type"] == "MockOrchestrator" and not mock["heavy"], mock
+    print("✅ real Orchestrator built on first request; mock mode never loads autogen")
+
+    preload_modules()
+    assert all(name in sys.modules for name in ("autogen_router", "discussion", "autogen_ext"))
+    print("✅ preload_modules() loads the heavy modules for a preloading master")
+    return True
+
+
+def main():
+    print("Import Time Test")
+    print("=" * 50)
+    results = [test_import_budget(), test_lazy_orchestrator()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All import time tests passed!")
+        return 0
+    print("⚠️ Some import time tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
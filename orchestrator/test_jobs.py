@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Job Queue Test Script
+
+Verifies the asynchronous job API without API keys:
+- the SQLite queue hands out jobs by priority, re-runs jobs whose lease
+  expired and drops results after the TTL
+- background workers run jobs concurrently, renew the lease of long jobs,
+  hand running jobs back on stop and post webhooks
+- webhooks to private / loopback / link-local addresses are rejected
+  unless the host is listed in JOB_WEBHOOK_ALLOWED_HOSTS
+- POST /api/jobs returns 202 immediately; results are available by
+  polling and as SSE completion events
+
+Usage:
+    python test_jobs.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from background import BackgroundLoop
+from jobs import JobQueue, JobStore, validate_webhook
+
+
+def test_store():
+    print("=== Priority / Lease / TTL ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        store = JobStore(os.path.join(tmp, "jobs.sqlite3"), ttl=60, lease_seconds=60)
+        low = store.enqueue({"n": 1})
+        high = store.enqueue({"n": 2}, priority=5)
+        low2 = store.enqueue({"n": 3})
+        order = [store.claim()["id"] for _ in range(3)]
+        assert order == [high["id"], low["id"], low2["id"]], order
+        assert store.claim() is None
+        print("✅ higher priority first, then oldest first")
+
+        store.lease_seconds = 0
+        again = store.claim()
+        assert again is not None and store.get(again["id"])["attempts"] == 2
+        print("✅ job with an expired lease is picked up again")
+
+        store.lease_seconds = 0.3
+        time.sleep(0.35)
+        assert store.renew(again["id"])
+        renewed = store.claim()
+        assert renewed is not None and renewed["id"] != again["id"], "renewed lease must not be re-claimed"
+        print("✅ renewed lease keeps the job with its worker")
+        store.lease_seconds = 60
+
+        store.ttl = 0
+        store.finish(high["id"], "done", {"response": "x"})
+        assert store.get(high["id"]) is None and store.purge_expired() == 1
+        print("✅ finished results expire after the TTL")
+    return True
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    received = []
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        WebhookHandler.received.append(json.loads(self.rfile.read(length)))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_workers_and_webhook():
+    print("\n=== Workers / Webhook ===")
+    server = HTTPServer(("127.0.0.1", 0), WebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webhook = f"http://127.0.0.1:{server.server_port}/hook"
+    saved_allowed = os.environ.get("JOB_WEBHOOK_ALLOWED_HOSTS")
+    os.environ["JOB_WEBHOOK_ALLOWED_HOSTS"] = "127.0.0.1"  # テスト用のローカル受け口だけ明示的に許可
+
+    async def runner(payload):
+        await asyncio.sleep(0.2)
+        if payload.get("fail"):
+            raise RuntimeError("upstream failed")
+        return {"echo": payload["n"]}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = JobQueue(JobStore(os.path.join(tmp, "jobs.sqlite3")), runner,
+                         workers=4, poll_interval=0.05, loop=BackgroundLoop("test-jobs"))
+        start = time.perf_counter()
+        ids = [queue.submit({"n": i})["id"] for i in range(8)]
+        failing = queue.submit({"n": 99, "fail": True}, webhook=webhook)["id"]
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            jobs = [queue.store.get(i) for i in ids + [failing]]
+            if all(j["status"] in ("done", "error") for j in jobs):
+                break
+            time.sleep(0.02)
+        elapsed = time.perf_counter() - start
+        assert [j["result"]["echo"] for j in jobs[:-1]] == list(range(8))
+        assert jobs[-1]["status"] == "error" and jobs[-1]["error"] == "upstream failed"
+        # 4 workers x 0.2s: 9 jobs ≈ 0.6s（逐次なら 1.8s）
+        assert elapsed < 1.2, f"jobs took {elapsed:.2f}s"
+        print(f"✅ 9 jobs on 4 workers finished in {elapsed:.2f}s")
+
+        deadline = time.time() + 3
+        while not WebhookHandler.received and time.time() < deadline:
+            time.sleep(0.02)
+        assert WebhookHandler.received == [{"id": failing, "status": "error", "error": "upstream failed"}]
+        print("✅ webhook received the completion")
+
+        queue.store.enqueue({"n": 100})  # 別プロセスが積んだジョブ相当（通知なし）
+        queued = queue.store.enqueue({"n": 101}, priority=-10)
+        assert queue.cancel(queued["id"]) or queue.store.get(queued["id"])["status"] == "done"
+        queue.stop()
+    server.shutdown()
+    if saved_allowed is None:
+        os.environ.pop("JOB_WEBHOOK_ALLOWED_HOSTS")
+    else:
+        os.environ["JOB_WEBHOOK_ALLOWED_HOSTS"] = saved_allowed
+
+    saved_allowed = os.environ.pop("JOB_WEBHOOK_ALLOWED_HOSTS", None)
+    try:
+        for url in ("file:///etc/passwd", webhook, "http://169.254.169.254/latest/meta-data/",
+                    "http://10.0.0.5/hook", "http://[::1]:8080/hook", "http://localhost/hook"):
+            try:
+                validate_webhook(url)
+                raise AssertionError(f"webhook {url} accepted")
+            except ValueError:
+                pass
+    finally:
+        if saved_allowed is not None:
+            os.environ["JOB_WEBHOOK_ALLOWED_HOSTS"] = saved_allowed
+    print("✅ non-http and internal webhook targets are rejected")
+    return True
+
+
+def test_lease_and_stop():
+    print("\n=== Heartbeat / Cancel / Stop ===")
+    calls = []
+
+    async def runner(payload):
+        calls.append(payload["n"])
+        await asyncio.sleep(payload["sleep"])
+        return {"echo": payload["n"]}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "jobs.sqlite3")
+        queue = JobQueue(JobStore(path, lease_seconds=0.2), runner,
+                         workers=2, poll_interval=0.05, loop=BackgroundLoop("test-jobs-lease"))
+        long_job = queue.submit({"n": 1, "sleep": 0.8})["id"]
+        deadline = time.time() + 3
+        while queue.store.get(long_job)["status"] != "done" and time.time() < deadline:
+            time.sleep(0.02)
+        job = queue.store.get(long_job)
+        assert job["status"] == "done" and job["attempts"] == 1 and calls == [1], (job, calls)
+        print("✅ a job longer than the lease runs once (lease renewed while running)")
+
+        cancelled = queue.submit({"n": 2, "sleep": 5})["id"]
+        while queue.store.get(cancelled)["status"] != "running":
+            time.sleep(0.02)
+        time.sleep(0.05)
+        assert queue.cancel(cancelled)
+        after = queue.submit({"n": 3, "sleep": 0})["id"]
+        deadline = time.time() + 3
+        while queue.store.get(after)["status"] != "done" and time.time() < deadline:
+            time.sleep(0.02)
+        assert queue.store.get(cancelled)["status"] == "cancelled"
+        assert queue.store.get(after)["status"] == "done", "workers survive a cancelled job"
+        print("✅ cancelling a running job records it and keeps the worker alive")
+
+        interrupted = queue.submit({"n": 4, "sleep": 5})["id"]
+        while queue.store.get(interrupted)["status"] != "running":
+            time.sleep(0.02)
+        time.sleep(0.05)
+        tasks = list(queue._tasks)
+        queue.stop()
+        deadline = time.time() + 2
+        while not all(t.done() for t in tasks) and time.time() < deadline:
+            time.sleep(0.02)
+        assert all(t.cancelled() for t in tasks), "stop() cancellation must propagate out of the workers"
+        assert queue.store.get(interrupted)["status"] == "queued"
+        print("✅ stop() hands the running job back to the queue and ends the workers")
+    return True
+
+
+def test_job_endpoints():
+    print("\n=== /api/jobs ===")
+    import app as app_module
+
+    class SlowOrchestrator:
+        async def ask_async(self, prompt, run_id=None):
+            await asyncio.sleep(0.5)
+            return {"selected": "coder", "response": f"answer to {prompt}"}
+
+    saved_orch, saved_jobs = app_module.orchestrator, app_module._jobs
+    with tempfile.TemporaryDirectory() as tmp:
+        app_module.orchestrator = SlowOrchestrator()
+        app_module._jobs = JobQueue(JobStore(os.path.join(tmp, "jobs.sqlite3")), app_module.run_ask_job,
+                                    workers=2, poll_interval=0.05)
+        try:
+            with app_module.app.test_client() as client:
+                start = time.perf_counter()
+                resp = client.post("/api/jobs", json={"prompt": "長いコードを書いて", "priority": 3})
+                submit_ms = (time.perf_counter() - start) * 1000
+                assert resp.status_code == 202, resp.status_code
+                job = resp.get_json()
+                assert job["status"] == "queued" and resp.headers["Location"] == f"/api/jobs/{job['id']}"
+
+                stream = client.get(f"/api/jobs/{job['id']}/events").get_data(as_text=True)
+                kinds = [line[7:] for line in stream.splitlines() if line.startswith("event: ")]
+                assert kinds[-1] == "done" and "running" in kinds, kinds
+
+                polled = client.get(f"/api/jobs/{job['id']}").get_json()
+                assert polled["status"] == "done"
+                assert polled["result"]["response"] == "answer to 長いコードを書いて"
+                assert client.get("/api/jobs/unknown").status_code == 404
+                assert client.post("/api/jobs", json={"prompt": "x", "webhook": "ftp://x"}).status_code == 400
+                assert client.get("/status").get_json()["jobs"]["completed"] == 1
+        finally:
+            app_module._jobs.stop()
+            app_module.orchestrator, app_module._jobs = saved_orch, saved_jobs
+    assert submit_ms < 200, f"submit took {submit_ms:.0f}ms"
+    print(f"✅ 202 in {submit_ms:.1f}ms (answer takes 500ms); events: {kinds}")
+    return True
+
+
+def main():
+    print("Job Queue Test")
+    print("=" * 50)
+    results = [test_store(), test_workers_and_webhook(), test_lease_and_stop(), test_job_endpoints()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All job queue tests passed!")
+        return 0
+    print("⚠️ Some job queue tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Multi-Agent Fan-out Test Script
+
+Verifies multi-label routing without API keys:
+- classify_multi_async parses {"labels": [...]} and falls back to keywords
+- ask_multi_async runs the selected agents concurrently (wall time is
+  roughly the slowest agent, not the sum), streams partial answers and
+  optionally merges them with a synthesis call
+- /api/ask/multi streams the events as SSE
+
+Usage:
+    python test_multi_agent.py
+"""
+
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_router import Orchestrator, MULTI_CLASSIFIER_SYSTEM, SYNTHESIS_SYSTEM
+
+AGENT_DELAY = 0.3
+
+
+class TestOrchestrator(Orchestrator):
+    def __init__(self, classifier_reply):
+        self.classifier_reply = classifier_reply
+        self.synthesis_calls = 0
+
+    async def _chat(self, system, user, tools=None):
+        if system == MULTI_CLASSIFIER_SYSTEM:
+            return self.classifier_reply
+        if system == SYNTHESIS_SYSTEM:
+            self.synthesis_calls += 1
+            return "統合回答"
+        raise AssertionError("unexpected _chat call")
+
+    async def _chat_stream(self, system, user, tools=None):
+        for word in ("部分", "回答"):
+            await asyncio.sleep(AGENT_DELAY / 2)
+            yield word
+
+
+def test_classify_multi():
+    print("=== Multi-label Classification ===")
+    cases = [
+        ('{"labels": ["coder", "analyst", "travel"]}', "x", ["coder", "analyst", "travel"]),
+        ('```json\n{"labels": ["travel", "travel", "chef"]}\n```', "x", ["travel"]),
+        ('{"labels": []}', "x", []),
+        ("???", "Pythonで旅行の支出データを分析するツール", ["coder", "analyst", "travel"]),
+        ("???", "今日の天気は？", []),
+    ]
+    ok = True
+    for reply, prompt, expected in cases:
+        actual = asyncio.run(TestOrchestrator(reply).classify_multi_async(prompt))
+        if sorted(actual) == sorted(expected):
+            print(f"✅ {reply[:30]!r} → {actual}")
+        else:
+            print(f"❌ {reply[:30]!r} → expected {expected}, got {actual}")
+            ok = False
+    return ok
+
+
+def test_concurrent_fan_out():
+    print("\n=== Concurrent Fan-out ===")
+    orch = TestOrchestrator('{"labels": ["coder", "analyst", "travel"]}')
+    events = []
+    start = time.perf_counter()
+    result = asyncio.run(orch.ask_multi_async("x", synthesize=True, on_event=events.append))
+    elapsed = time.perf_counter() - start
+
+    assert result["selected_agents"] == ["coder", "analyst", "travel"]
+    assert set(result["responses"]) == {"coder", "analyst", "travel"}
+    assert result["responses"]["travel"].startswith("部分回答")
+    assert result["response"] == "統合回答" and orch.synthesis_calls == 1
+    kinds = [e["type"] for e in events]
+    assert kinds[0] == "selected" and kinds[-1] == "synthesis"
+    assert kinds.count("partial") == 6 and kinds.count("answer") == 3
+    # 3 agents x 0.3s each: concurrent ≈ 0.3s, sequential would be ≈ 0.9s
+    assert elapsed < AGENT_DELAY * 2, f"fan-out took {elapsed:.2f}s"
+    print(f"✅ 3 agents answered in {elapsed:.2f}s (slowest agent: {AGENT_DELAY:.2f}s)")
+
+    single = asyncio.run(TestOrchestrator('{"labels": []}').ask_multi_async("x", synthesize=True))
+    assert single["selected"] == "none" and list(single["responses"]) == ["none"]
+    print("✅ general question falls back to the general agent without synthesis")
+    return True
+
+
+def test_multi_endpoint():
+    print("\n=== /api/ask/multi ===")
+    import app as app_module
+
+    with app_module.app.test_client() as client:
+        resp = client.post("/api/ask/multi", json={"prompt": "Pythonで旅行データを分析", "synthesize": True})
+        assert resp.status_code == 200 and resp.mimetype == "text/event-stream"
+        events = []
+        for block in resp.get_data(as_text=True).strip().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.split("\n") if not line.startswith(":"))
+            events.append((fields["event"], json.loads(fields["data"])))
+        assert events[0][0] == "selected" and events[-1][0] == "done"
+        assert len(events[0][1]["agents"]) >= 2, events[0]
+        assert client.post("/api/ask/multi", json={}).status_code == 400
+    print(f"✅ streamed {len(events)} events for {events[0][1]['agents']}")
+    return True
+
+
+def main():
+    print("Multi-Agent Fan-out Test")
+    print("=" * 50)
+    results = [test_classify_multi(), test_concurrent_fan_out(), test_multi_endpoint()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All multi-agent tests passed!")
+        return 0
+    print("⚠️ Some multi-agent tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Profiling Test Script
+
+Verifies the on-demand sampling profiler without API keys:
+- nothing is sampled at the default rate; /admin/profile raises the rate
+  for a limited time and is protected by ADMIN_TOKEN
+- samples of /api/ask include the web thread, CPU work running on the
+  asyncio loop and time the task spends awaiting the upstream
+- per-endpoint downloads in collapsed-stack and speedscope formats
+- the rate override and resets reach every worker, and summaries /
+  downloads merge the stacks every worker flushed to PROFILE_DIR
+
+Usage:
+    python test_profiling.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_core.models import CreateResult, RequestUsage
+
+import profiling
+from autogen_router import Orchestrator
+from checkpoint import CheckpointStore
+from profiling import SamplingProfiler
+
+
+def burn_cpu(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SlowClient:
+    """Upstream wait (0.3s) followed by local CPU work (0.2s)."""
+
+    async def create(self, messages, **kwargs):
+        await asyncio.sleep(0.3)
+        burn_cpu(0.2)
+        return CreateResult(content='{"label": "none"}', usage=RequestUsage(10, 5), finish_reason="stop", cached=False)
+
+    async def close(self):
+        pass
+
+
+def test_admin_and_sampling():
+    print("=== Sampling / Admin Protection ===")
+    import app as app_module
+
+    orch = Orchestrator.__new__(Orchestrator)
+    orch.client = SlowClient()
+    saved_profiler, saved_orch = profiling._profiler, app_module.orchestrator
+    saved_token = os.environ.pop("ADMIN_TOKEN", None)
+    with tempfile.TemporaryDirectory() as tmp:
+        profiling._profiler = SamplingProfiler(sample_rate=0, interval=0.005, directory=os.path.join(tmp, "profiles"))
+        orch.checkpoints = CheckpointStore(os.path.join(tmp, "checkpoints"))
+        app_module.orchestrator = orch
+        try:
+            with app_module.app.test_client() as client:
+                assert client.get("/admin/profile").status_code == 404, "disabled without ADMIN_TOKEN"
+                os.environ["ADMIN_TOKEN"] = "s3cret"
+                auth = {"Authorization": "Bearer s3cret"}
+                assert client.get("/admin/profile").status_code == 401
+                assert client.get("/admin/profile", headers={"X-Admin-Token": "wrong"}).status_code == 401
+
+                client.post("/api/ask", json={"prompt": "今日の天気は？"})
+                assert profiling._profiler.samples == 0
+                print("✅ default rate samples nothing; admin routes need the token")
+
+                enabled = client.post("/admin/profile", json={"rate": 1.0, "seconds": 30}, headers=auth).get_json()
+                assert enabled["sample_rate"] == 1.0
+                client.post("/api/ask", json={"prompt": "今日の天気は？"})
+                summary = client.get("/admin/profile", headers=auth).get_json()
+                assert summary["endpoints"]["api_ask"]["requests"] == 1
+                collapsed = client.get("/admin/profile/api_ask", headers=auth)
+                speedscope = client.get("/admin/profile/api_ask?format=speedscope", headers=auth)
+                assert client.get("/admin/profile/nope", headers=auth).status_code == 404
+                assert client.delete("/admin/profile", headers=auth).get_json()["samples"] == 0
+        finally:
+            profiling._profiler, app_module.orchestrator = saved_profiler, saved_orch
+            os.environ.pop("ADMIN_TOKEN", None)
+            if saved_token is not None:
+                os.environ["ADMIN_TOKEN"] = saved_token
+
+    print(f"✅ profiled 1 request: {summary['endpoints']['api_ask']['samples']} samples")
+    assert "attachment" in collapsed.headers["Content-Disposition"]
+    lines = collapsed.get_data(as_text=True).splitlines()
+    weights = {}
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        weights[stack] = int(count)
+    total = sum(weights.values())
+    waiting = sum(n for stack, n in weights.items() if "[await" in stack)
+    cpu = sum(n for stack, n in weights.items() if "burn_cpu (test_profiling.py" in stack)
+    assert all("api_ask (app.py" in stack for stack in weights), lines[:3]
+    # 待ち 0.3s・CPU 0.2s（分類と回答で 2 回）。CPU 中は GIL の切り替え間隔でしか採取できないため少なめに出る
+    assert waiting > total * 0.3 and cpu > total * 0.1, (waiting, cpu, total)
+    print(f"✅ upstream wait {waiting / total:.0%} and loop CPU {cpu / total:.0%} of samples, under api_ask")
+
+    doc = speedscope.get_json()
+    profile = doc["profiles"][0]
+    assert profile["type"] == "sampled" and len(profile["samples"]) == len(profile["weights"])
+    assert all(i < len(doc["shared"]["frames"]) for sample in profile["samples"] for i in sample)
+    assert "speedscope.json" in speedscope.headers["Content-Disposition"]
+    print(f"✅ speedscope export: {len(doc['shared']['frames'])} frames, {profile['endValue']}s sampled")
+    return True
+
+
+def test_shared_across_workers():
+    print("\n=== Shared Across Workers ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        # 同じ PROFILE_DIR を使う 2 つのプロファイラ = gunicorn の 2 ワーカー
+        first = SamplingProfiler(sample_rate=0, directory=tmp, worker="w1")
+        second = SamplingProfiler(sample_rate=0, directory=tmp, worker="w2")
+        saved_refresh = profiling.CONTROL_REFRESH
+        profiling.CONTROL_REFRESH = 0
+        try:
+            first.enable(0.5, 60)
+            assert second.current_rate() == 0.5, "the override reaches the other worker"
+
+            first.requests["api_ask"] += 1
+            first._add("api_ask", ["api_ask (app.py:1)", "classify (autogen_router.py:1)"])
+            second.requests["api_ask"] += 2
+            for _ in range(3):
+                second._add("api_ask", ["api_ask (app.py:1)", "[await]"])
+            second._add("api_jobs", ["api_jobs (app.py:2)"])
+            second.flush()
+
+            summary = first.summary()
+            assert summary["workers"] == 2 and summary["samples"] == 5, summary
+            assert summary["endpoints"]["api_ask"] == {"requests": 3, "samples": 4}
+            assert first.endpoints() == ["api_ask", "api_jobs"]
+            collapsed = first.collapsed("api_ask")
+            assert "api_ask (app.py:1);[await] 3" in collapsed and "classify (autogen_router.py:1) 1" in collapsed
+            print("✅ summary and collapsed stacks merge every worker's samples")
+
+            first.reset()
+            assert first.summary()["samples"] == 0
+            assert second.summary()["samples"] == 0, "the reset clears the other worker too"
+            second.flush()
+            assert first.summary()["samples"] == 0
+        finally:
+            profiling.CONTROL_REFRESH = saved_refresh
+    print("✅ enable / reset apply to every worker")
+    return True
+
+
+def main():
+    print("Profiling Test")
+    print("=" * 50)
+    results = [test_admin_and_sampling(), test_shared_across_workers()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All profiling tests passed!")
+        return 0
+    print("⚠️ Some profiling tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
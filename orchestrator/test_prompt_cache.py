@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Prompt Cache Test Script
+
+Verifies prompt-prefix caching without API keys:
+- system prompts are sent byte-identical on every call (normalized, with a
+  version hash per purpose/agent; content changes are counted)
+- cached-token counts reported by the upstream are recorded per call,
+  lower the estimated cost and reach the SQLite store and /metrics
+- explicit context caching (local stub provider): long prefixes are
+  registered in the background, later calls send the cache name instead of
+  the system prompt, short prefixes and tool calls are left alone, and a
+  rejected cache falls back to resending the prompt (streamed calls too,
+  if no chunk was yielded yet)
+- the Gemini provider sends the expected cachedContents request
+
+Usage:
+    python test_prompt_cache.py
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_core.logging import LLMCallEvent
+from autogen_core.models import CreateResult, RequestUsage, SystemMessage, UserMessage
+
+import usage as usage_module
+from autogen_router import Orchestrator, CLASSIFIER_SYSTEM
+from checkpoint import CheckpointStore
+from prompt_cache import (
+    ContextCachedClient, GeminiContextCacheProvider, LocalContextCacheProvider, PromptCache,
+    get_prompt_cache, normalize_prefix,
+)
+from usage import UsageLedger, cost_usd, start_request, usage_scope
+
+LONG_SYSTEM = "あなたは旅行の専門家です。\n" + "旅程・交通・宿泊の注意点を丁寧に説明してください。\n" * 40
+
+
+class UpstreamStub:
+    """Reports prompt_tokens_details.cached_tokens like the real API (via autogen's call event)."""
+
+    def __init__(self, cached_tokens=0, reject_cache=False):
+        self.cached_tokens = cached_tokens
+        self.reject_cache = reject_cache
+        self.calls = []
+
+    async def create(self, messages, stream=False, **kwargs):
+        self.calls.append((list(messages), dict(kwargs)))
+        extra_body = kwargs.get("extra_create_args", {}).get("extra_body")
+        if extra_body and self.reject_cache:
+            error = RuntimeError("CachedContent not found")
+            error.status_code = 404
+            raise error
+        if messages[0].content == CLASSIFIER_SYSTEM if isinstance(messages[0], SystemMessage) else False:
+            content = '{"label": "travel"}'
+        else:
+            content = "回答です。"
+        if not stream:
+            # autogen は生のレスポンスをイベントとしてログに出す（ストリーミングでは出さない）
+            response = {"usage": {"prompt_tokens": 1000, "completion_tokens": 10,
+                                  "prompt_tokens_details": {"cached_tokens": self.cached_tokens}}}
+            logging.getLogger("autogen_core.events").info(
+                LLMCallEvent(messages=[], response=response, prompt_tokens=1000, completion_tokens=10))
+        return CreateResult(content=content, usage=RequestUsage(1000, 10), finish_reason="stop", cached=False)
+
+    async def create_stream(self, messages, **kwargs):
+        result = await self.create(messages, stream=True, **kwargs)
+        yield result.content
+        yield result
+
+    async def close(self):
+        pass
+
+
+def make_orchestrator(tmp, client):
+    orch = Orchestrator.__new__(Orchestrator)
+    orch.client = client
+    orch.checkpoints = CheckpointStore(os.path.join(tmp, "checkpoints"))
+    return orch
+
+
+def test_stable_prefixes(tmp):
+    print("=== Stable Prefixes ===")
+    cache = PromptCache()
+    a = cache.prefix("指示文  \r\n続き\t\n")
+    b = cache.prefix("指示文\n続き")
+    assert a.text == b.text == normalize_prefix("指示文\n続き") and a.version == b.version
+    cache.stable("v1", "answer/coder")
+    cache.stable("v1", "answer/coder")
+    cache.stable("v2", "answer/coder")
+    coder = cache.stats()["prefixes"]["answer/coder"]
+    assert coder["calls"] == 3 and coder["changes"] == 1
+    print(f"✅ normalized prefixes share a version ({a.version}); content changes are counted")
+
+    stub = UpstreamStub()
+    orch = make_orchestrator(tmp, stub)
+    for prompt in ("京都の観光", "大阪のグルメ"):
+        asyncio.run(orch.ask_async(prompt))
+    systems = [m[0].content.encode("utf-8") for m, _ in stub.calls if m[0].content != CLASSIFIER_SYSTEM]
+    assert len(systems) == 2 and systems[0] == systems[1]
+    prefixes = get_prompt_cache().stats()["prefixes"]
+    assert any(name.startswith("answer/") for name in prefixes), prefixes
+    print(f"✅ answer system prompts byte-identical across requests; tracked: {sorted(prefixes)}")
+    return True
+
+
+def test_cached_token_accounting(tmp):
+    print("\n=== Cached Token Accounting ===")
+    saved = usage_module._ledger
+    usage_module._ledger = UsageLedger(path=os.path.join(tmp, "usage.sqlite3"), flush_interval=3600)
+    try:
+        orch = make_orchestrator(tmp, UpstreamStub(cached_tokens=800))
+        result = asyncio.run(orch.ask_async("京都の観光"))
+        calls = result["usage"]["calls"]
+        assert all(c["cached_tokens"] == 800 for c in calls), calls
+        assert result["usage"]["cached_tokens"] == 800 * len(calls)
+        full = cost_usd(1000 * len(calls), 10 * len(calls))
+        assert result["usage"]["cost_usd"] < full * 0.5
+        print(f"✅ cached tokens per call: {[c['cached_tokens'] for c in calls]}; "
+              f"cost ${result['usage']['cost_usd']:.6f} vs ${full:.6f} uncached")
+
+        async def streamed():
+            request = start_request()
+            async for _ in orch._chat_stream("system", "question"):
+                pass
+            return request.calls
+        assert asyncio.run(streamed())[0]["cached_tokens"] == 0, "autogen drops the count when streaming"
+
+        ledger = usage_module._ledger
+        assert ledger.flush() > 0
+        rows = ledger.summary(group_by="purpose")
+        assert sum(r["cached_tokens"] for r in rows) == 800 * len(calls)
+        assert "llm_cached_prompt_tokens_total" in ledger.metrics_text()
+        stats = get_prompt_cache().stats()
+        assert stats["cached_tokens"] == 800 * len(calls) and stats["prompt_tokens"] == 1000 * (len(calls) + 1)
+        print(f"✅ stored per purpose and on /metrics (cached share {stats['cached_share']})")
+
+        # cached_tokens 列のない既存ストアにも書き出せる
+        old = os.path.join(tmp, "old.sqlite3")
+        conn = sqlite3.connect(old)
+        conn.execute("CREATE TABLE usage (bucket REAL NOT NULL, agent TEXT NOT NULL, client TEXT NOT NULL, "
+                      "purpose TEXT NOT NULL, calls INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, "
+                      "completion_tokens INTEGER NOT NULL, PRIMARY KEY (bucket, agent, client, purpose))")
+        conn.commit()
+        conn.close()
+        migrated = UsageLedger(path=old, flush_interval=3600)
+        migrated.record(100, 5, 60)
+        assert migrated.flush() == 1 and migrated.summary()[0]["cached_tokens"] == 60
+        print("✅ existing usage stores gain the cached_tokens column")
+    finally:
+        usage_module._ledger = saved
+    return True
+
+
+def test_explicit_cache(tmp):
+    print("\n=== Explicit Context Cache ===")
+    stub = UpstreamStub()
+    provider = LocalContextCacheProvider(delay=0.01)
+    client = ContextCachedClient(stub, provider, min_tokens=200, ttl=600)
+    orch = make_orchestrator(tmp, client)
+    long_system = get_prompt_cache().stable(LONG_SYSTEM, "answer/travel")
+
+    async def run():
+        request = start_request()
+        with usage_scope("answer", "travel"):
+            await orch._chat(long_system, "京都の観光")
+            await asyncio.sleep(0.05)
+            await orch._chat(long_system, "奈良の観光")
+            await orch._chat("短い指示", "こんにちは")
+            await orch._chat(long_system, "東京から京都", orch._agent_tools("travel"))
+            async for _ in orch._chat_stream(long_system, "大阪の観光"):
+                pass
+        return [c["cached_tokens"] for c in request.calls]
+
+    cached = asyncio.run(run())
+    (m1, k1), (m2, k2), (m3, k3), (m4, k4), (m5, k5) = stub.calls[:5]
+    assert isinstance(m1[0], SystemMessage) and "extra_body" not in k1.get("extra_create_args", {})
+    assert provider.created and provider.created[0][1] == get_prompt_cache().prefix(long_system).version
+    name = provider.created[0][0]
+    assert isinstance(m2[0], UserMessage), "system prompt replaced by the cache"
+    assert k2["extra_create_args"]["extra_body"] == {"extra_body": {"google": {"cached_content": name}}}
+    assert k2["extra_create_args"]["max_tokens"], "other create args are kept"
+    prefix_tokens = get_prompt_cache().prefix(long_system).tokens
+    assert cached == [0, 0, 0, 0, prefix_tokens], "reported counts win; streamed cache hits count the prefix"
+    assert isinstance(m3[0], SystemMessage) and len(provider.created) == 1, "short prefixes are not cached"
+    assert isinstance(m4[0], SystemMessage) and k4.get("tools"), "tool calls keep the system prompt"
+    assert isinstance(m5[0], UserMessage), "streamed calls use the cache too"
+    print(f"✅ first call sent the prompt and registered {name}; later calls send only the cache name")
+
+    stub.reject_cache = True
+    stub.calls.clear()
+    answer = asyncio.run(orch._chat(long_system, "広島の観光"))
+    assert answer == "回答です。" and len(stub.calls) == 2 and isinstance(stub.calls[1][0][0], SystemMessage)
+    assert not client._handles and get_prompt_cache().counters["invalidations"] >= 1
+    print("✅ a rejected cache is dropped and the call is resent with the system prompt")
+
+    async def stream(prompt):
+        return [chunk async for chunk in orch._chat_stream(long_system, prompt)]
+
+    async def register():
+        await orch._chat(long_system, "準備")
+        await asyncio.sleep(0.05)
+
+    stub.reject_cache = False
+    asyncio.run(register())
+    assert client._handles, "cache registered again"
+    stub.reject_cache = True
+    stub.calls.clear()
+    chunks = asyncio.run(stream("福岡の観光"))
+    assert "".join(chunks) == "回答です。", chunks
+    assert len(stub.calls) == 2 and isinstance(stub.calls[0][0][0], UserMessage)
+    assert isinstance(stub.calls[1][0][0], SystemMessage), "streamed retry resends the system prompt"
+    assert not client._handles
+    print("✅ a streamed call rejected before its first chunk is resent with the system prompt")
+    return True
+
+
+def test_gemini_provider():
+    print("\n=== Gemini cachedContents ===")
+    seen = {}
+
+    def post(url, body):
+        seen["url"], seen["body"] = url, body
+        return {"name": "cachedContents/abc123", "usageMetadata": {"totalTokenCount": 1500}}
+
+    provider = GeminiContextCacheProvider(
+        "test-key", "https://generativelanguage.googleapis.com/v1beta/openai/", "gemini-2.5-flash")
+    provider._post = post
+    prefix = PromptCache().prefix(LONG_SYSTEM, "answer/travel")
+    handle = asyncio.run(provider.create(prefix, 3600))
+    assert seen["url"] == "https://generativelanguage.googleapis.com/v1beta/cachedContents"
+    assert seen["body"]["model"] == "models/gemini-2.5-flash"
+    assert seen["body"]["systemInstruction"]["parts"][0]["text"] == prefix.text and seen["body"]["ttl"] == "3600s"
+    assert handle.name == "cachedContents/abc123" and handle.tokens == 1500
+    print(f"✅ POST {seen['url']} → {handle.name} ({handle.tokens} tokens)")
+    return True
+
+
+def main():
+    print("Prompt Cache Test")
+    print("=" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [test_stable_prefixes(tmp), test_cached_token_accounting(tmp), test_explicit_cache(tmp),
+                   test_gemini_provider()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All prompt cache tests passed!")
+        return 0
+    print("⚠️ Some prompt cache tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
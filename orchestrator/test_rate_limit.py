@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Rate Limit Test Script
+
+Verifies per-client token-bucket limiting without API keys:
+- request-count and token-cost buckets, refill and Retry-After
+- settling the token estimate against actual usage
+- the buckets are shared across processes (gunicorn workers)
+- /api/ask returns 429 + Retry-After per client, and /metrics exposes
+  the limiter counters
+- only API keys listed in RATE_LIMIT_API_KEYS get their own budget
+
+Usage:
+    python test_rate_limit.py
+"""
+
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import rate_limit
+from rate_limit import RateLimiter
+
+
+def test_buckets():
+    print("=== Request / Token Buckets ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        limiter = RateLimiter(os.path.join(tmp, "rl.sqlite3"), requests_per_minute=60, request_burst=3,
+                              tokens_per_minute=600, token_burst=100)
+        assert all(limiter.acquire("a").allowed for _ in range(3))
+        denied = limiter.acquire("a")
+        assert not denied.allowed and denied.reason == "requests"
+        assert 0.9 < denied.retry_after <= 1.0 and denied.headers()["Retry-After"] == "1"
+        assert limiter.acquire("b").allowed, "buckets are per client"
+        print(f"✅ 4th request denied (retry after {denied.retry_after:.2f}s), other clients unaffected")
+
+        assert limiter.acquire("c", tokens=80).allowed
+        denied = limiter.acquire("c", tokens=50)
+        assert not denied.allowed and denied.reason == "tokens"
+        assert 2.5 < denied.retry_after <= 3.0, denied.retry_after
+        limiter.settle("c", -40)  # 実際は見積もりより 40 トークン少なかった
+        assert limiter.acquire("c", tokens=50).allowed
+        print("✅ token bucket limits by estimated cost and refunds on settle")
+
+        stats = limiter.stats()
+        assert stats["allowed"] == 6 and stats["limited"] == {"requests": 1, "tokens": 1}
+    return True
+
+
+def _worker(path, attempts):
+    limiter = RateLimiter(path, requests_per_minute=0.001, request_burst=20)
+    return sum(1 for _ in range(attempts) if limiter.acquire("shared").allowed)
+
+
+def test_shared_across_processes():
+    print("\n=== Shared Across Workers ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "rl.sqlite3")
+        RateLimiter(path)  # スキーマ作成
+        with ProcessPoolExecutor(max_workers=4) as pool:
+            allowed = sum(pool.map(_worker, [path] * 4, [15] * 4))
+    assert allowed == 20, allowed
+    print(f"✅ 4 processes x 15 attempts → exactly {allowed} admitted (burst 20)")
+    return True
+
+
+def test_endpoint():
+    print("\n=== /api/ask 429 + /metrics ===")
+    import app as app_module
+
+    saved = rate_limit._limiter
+    with tempfile.TemporaryDirectory() as tmp:
+        rate_limit._limiter = RateLimiter(os.path.join(tmp, "rl.sqlite3"), requests_per_minute=6, request_burst=2)
+        os.environ["RATE_LIMIT_API_KEYS"] = "team-a, team-b"
+        try:
+            with app_module.app.test_client() as client:
+                codes = [client.post("/api/ask", json={"prompt": "こんにちは"}).status_code for _ in range(2)]
+                limited = client.post("/api/ask", json={"prompt": "こんにちは"})
+                other = client.post("/api/ask", json={"prompt": "こんにちは"}, headers={"X-API-Key": "team-b"})
+                forged = client.post("/api/ask", json={"prompt": "こんにちは"}, headers={"X-API-Key": "made-up"})
+                multi = client.post("/api/ask/multi", json={"prompt": "x"})
+                metrics = client.get("/metrics").get_data(as_text=True)
+        finally:
+            rate_limit._limiter = saved
+            os.environ.pop("RATE_LIMIT_API_KEYS", None)
+
+    assert codes == [200, 200], codes
+    assert limited.status_code == 429 and limited.get_json()["reason"] == "requests"
+    assert 1 <= int(limited.headers["Retry-After"]) <= 10
+    assert other.status_code == 200, "a different client keeps its own budget"
+    assert forged.status_code == 429, "an unlisted key falls back to the client address"
+    assert multi.status_code == 429
+    assert 'ratelimit_limited_total{reason="requests"} 3' in metrics, metrics
+    assert "ratelimit_allowed_total 3" in metrics
+    print(f"✅ 429 with Retry-After: {limited.headers['Retry-After']}s; metrics exported")
+    return True
+
+
+def main():
+    print("Rate Limit Test")
+    print("=" * 50)
+    results = [test_buckets(), test_shared_across_processes(), test_endpoint()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All rate limit tests passed!")
+        return 0
+    print("⚠️ Some rate limit tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
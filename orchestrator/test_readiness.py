@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Readiness Test Script
+
+Verifies worker warmup and /readyz without API keys:
+- warmup steps run once in the background; /readyz is 503 until every
+  required step is done, and failures of optional steps are only reported
+- failed required steps are retried with backoff, and re-run from /readyz
+  once the warmup thread has given up
+- upstream warmup opens each pool member's connection concurrently
+- end to end against a local OpenAI-compatible server: the connection
+  opened during warmup is the one the first real request reuses
+
+Usage:
+    python test_readiness.py
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from readiness import Readiness
+from upstream_pool import UpstreamMember, UpstreamPool
+
+
+def test_steps():
+    print("=== Warmup Steps ===")
+    gate = threading.Event()
+    readiness = Readiness()
+    readiness.add_step("index", lambda: gate.wait(5) and {"agents": 3})
+    readiness.add_step("upstream", lambda: 1 / 0, required=False)
+    assert readiness.start() and not readiness.start(), "runs only once"
+    time.sleep(0.05)
+    assert not readiness.ready and readiness.status()["steps"]["index"]["status"] == "running"
+    gate.set()
+    assert readiness.wait(5)
+    status = readiness.status()
+    assert status["ready"], status
+    assert status["steps"]["index"]["detail"] == {"agents": 3}
+    assert status["steps"]["upstream"]["status"] == "failed" and "division" in status["steps"]["upstream"]["error"]
+    print("✅ not ready while a required step runs; optional failures are reported only")
+
+    def load_broken_registry():
+        raise ValueError("bad agents.json")
+
+    broken = Readiness(retries=1, backoff=0.01)
+    broken.add_step("registry", load_broken_registry)
+    broken.start()
+    broken.wait(5)
+    assert not broken.ready and broken.status()["steps"]["registry"]["attempts"] == 2
+    print("✅ a failed required step keeps the worker out of rotation")
+    return True
+
+
+def test_retries():
+    print("\n=== Retrying Failed Steps ===")
+    calls = {"db": 0, "upstream": 0}
+
+    def open_db():
+        calls["db"] += 1
+        if calls["db"] < 3:
+            raise OSError("database is locked")
+        return "ok"
+
+    def connect_upstream():
+        calls["upstream"] += 1
+        raise ConnectionError("refused")
+
+    readiness = Readiness(retries=3, backoff=0.02)
+    readiness.add_step("stores", open_db)
+    readiness.add_step("upstream", connect_upstream, required=False)
+    readiness.start()
+    assert readiness.wait(5) and readiness.ready, readiness.status()
+    step = readiness.status()["steps"]["stores"]
+    assert step["attempts"] == 3 and step["status"] == "ok" and "error" not in step, step
+    assert calls["upstream"] == 1, "optional steps are not retried"
+    print("✅ a transient failure of a required step recovers after backing off")
+
+    state = {"broken": True}
+
+    def load_registry():
+        if state["broken"]:
+            raise ValueError("agents.json is being deployed")
+        return {"agents": 3}
+
+    readiness = Readiness(retries=1, backoff=0.05)
+    readiness.add_step("orchestrator", lambda: "ready")
+    readiness.add_step("registry", load_registry)
+    readiness.start()
+    readiness.wait(5)
+    assert not readiness.ready
+    assert not readiness.start(), "re-runs wait for the backoff interval"
+    state["broken"] = False
+    time.sleep(0.06)
+    assert readiness.start(), "/readyz re-runs the failed step"
+    assert readiness.wait(5) and readiness.ready, readiness.status()
+    steps = readiness.status()["steps"]
+    assert steps["registry"]["attempts"] == 3 and steps["orchestrator"]["attempts"] == 1, steps
+    assert not readiness.start(), "nothing left to re-run"
+    print("✅ /readyz re-runs only the failed required steps once the thread has given up")
+    return True
+
+
+def test_pool_warmup():
+    print("\n=== Upstream Pool Warmup ===")
+    pool = UpstreamPool([UpstreamMember(name, name) for name in ("fast", "slow", "down")])
+
+    async def connect(client):
+        if client == "down":
+            raise ConnectionError("refused")
+        await asyncio.sleep(0.3 if client == "slow" else 0.05)
+
+    start = time.perf_counter()
+    result = asyncio.run(pool.warmup(connect, timeout=1.0))
+    elapsed = time.perf_counter() - start
+    assert result["fast"]["ok"] and result["slow"]["ok"] and not result["down"]["ok"], result
+    assert elapsed < 0.5, f"members should warm concurrently ({elapsed:.2f}s)"
+    timed_out = asyncio.run(pool.warmup(connect, timeout=0.1))
+    assert not timed_out["slow"]["ok"]
+    print(f"✅ members warmed concurrently in {elapsed:.2f}s; failures and timeouts reported per member")
+    return True
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible endpoint that logs which client port sent each request."""
+    protocol_version = "HTTP/1.1"
+    seen = []
+
+    def _reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        FakeOpenAI.seen.append((self.path, self.client_address[1], self.headers.get("Authorization")))
+        self._reply({"object": "list", "data": [{"id": "m", "object": "model", "created": 0, "owned_by": "t"}]})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        FakeOpenAI.seen.append((self.path, self.client_address[1], self.headers.get("Authorization")))
+        self._reply({
+            "id": "c", "object": "chat.completion", "created": 0, "model": "m",
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "ウォームアップ済みの接続で回答しました。"}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+        })
+
+    def log_message(self, *args):
+        pass
+
+
+def test_readyz_end_to_end():
+    print("\n=== /readyz + Connection Reuse ===")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {k: v for k, v in os.environ.items() if k not in ("GEMINI_API_KEYS", "UPSTREAM_ENDPOINTS", "LLM_CASSETTE_MODE")}
+        env.update(GEMINI_API_KEY="test-key", GEMINI_OPENAI_BASE_URL=f"http://127.0.0.1:{server.server_port}/v1/",
+                   RATE_LIMIT_DB=os.path.join(tmp, "rl.sqlite3"), USAGE_DB=os.path.join(tmp, "usage.sqlite3"),
+                   JOB_DB=os.path.join(tmp, "jobs.sqlite3"), CHECKPOINT_DIR=os.path.join(tmp, "checkpoints"))
+        script = (
+            "import json, time, app\n"
+            "c = app.app.test_client()\n"
+            "first = c.get('/readyz')\n"
+            "while c.get('/readyz').status_code != 200: time.sleep(0.02)\n"
+            "status = c.get('/readyz').get_json()\n"
+            "answer = c.post('/api/ask', json={'prompt': 'コードを書いて'}).get_json()\n"
+            "print(json.dumps({'first': first.status_code, 'retry': first.headers.get('Retry-After'),"
+            " 'status': status, 'answer': answer['response']}))\n"
+        )
+        out = subprocess.run([sys.executable, "-c", script], cwd=str(Path(__file__).parent), env=env,
+                             capture_output=True, text=True, timeout=120)
+    server.shutdown()
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert result["first"] == 503 and result["retry"] == "1", result
+    steps = result["status"]["steps"]
+    assert all(steps[name]["status"] == "ok" for name in ("registry", "orchestrator", "upstream", "stores")), steps
+    assert steps["upstream"]["detail"]["default"]["ok"]
+    assert "ウォームアップ済み" in result["answer"]
+
+    paths = [path for path, _, _ in FakeOpenAI.seen]
+    ports = {port for _, port, _ in FakeOpenAI.seen}
+    assert paths[0] == "/v1/models" and "/v1/chat/completions" in paths, paths
+    assert all(auth == "Bearer test-key" for _, _, auth in FakeOpenAI.seen)
+    assert len(ports) == 1, f"expected one reused connection, saw ports {ports}"
+    print(f"✅ /readyz 503 → 200 after {result['status']['seconds']}s; "
+          f"{len(paths)} upstream requests over 1 connection opened during warmup")
+    return True
+
+
+def main():
+    print("Readiness Test")
+    print("=" * 50)
+    results = [test_steps(), test_retries(), test_pool_warmup(), test_readyz_end_to_end()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All readiness tests passed!")
+        return 0
+    print("⚠️ Some readiness tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
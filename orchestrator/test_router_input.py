@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Routing Input Test Script
+
+Verifies the routing input reducer without API keys:
+- prompts within the token budget reach the classifiers unchanged
+- long pastes are reduced to head + tail + prose lines + code fence
+  languages within the budget, and the savings are reported
+- reduction time and classifier input size stay flat as the paste grows
+  (the answer is still generated from the full prompt)
+
+Usage:
+    python test_router_input.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_core.models import CreateResult, RequestUsage
+
+from autogen_router import Orchestrator, CLASSIFIER_SYSTEM
+from checkpoint import CheckpointStore
+from router_input import get_routing_input_stats, looks_like_prose, reduce_routing_input
+
+INSTRUCTION = "次のエラーログを見て、原因を調べてください。"
+CLOSING = "このバグを直すPythonコードを書いて"
+
+
+def paste(log_lines):
+    log = "\n".join(
+        f"2024-05-01 12:00:{i % 60:02d} ERROR worker-{i} failed: connection reset by peer (retry {i})"
+        for i in range(log_lines)
+    )
+    code = "```python\n" + "\n".join(f"    x{i} = compute({i})" for i in range(200)) + "\n```\n```json\n{}\n```"
+    return f"{INSTRUCTION}\n{log}\n本番環境は Kubernetes 上で動いています。\n{code}\n{CLOSING}"
+
+
+def test_short_prompts():
+    print("=== Short Prompts ===")
+    for prompt in ("Pythonでソートを書いて", "京都の観光プランを作って。" * 20, "word " * 300):
+        routing = reduce_routing_input(prompt, budget=400)
+        assert not routing.reduced and routing.text is prompt and routing.saved_tokens == 0
+    print("✅ prompts within the budget are passed through unchanged")
+    return True
+
+
+def test_long_paste():
+    print("\n=== Long Paste ===")
+    prompt = paste(5000)
+    routing = reduce_routing_input(prompt, budget=400)
+    assert routing.reduced
+    assert routing.text.startswith(INSTRUCTION) and routing.text.endswith(CLOSING)
+    assert "本番環境は Kubernetes 上で動いています。" in routing.text, "prose in the middle is kept"
+    assert routing.languages == ["python", "json"]
+    assert "コード: python, json" in routing.text
+    assert routing.tokens <= 420, routing.tokens
+    assert routing.original_tokens > 100000 and routing.saved_tokens > 100000
+    assert "worker-2500" not in routing.text
+    print(f"✅ ~{routing.original_tokens} → ~{routing.tokens} tokens, kept head/tail/prose, "
+          f"languages {routing.languages}, {routing.skipped_lines} lines omitted")
+
+    assert looks_like_prose("この関数が遅い理由を教えてください")
+    assert looks_like_prose("Why does this request time out after a deploy?")
+    assert not looks_like_prose("2024-05-01 12:00:00 ERROR failed")
+    assert not looks_like_prose("    return self.cache[key]")
+    assert not looks_like_prose('  File "app.py", line 12, in <module>')
+    assert not looks_like_prose("}")
+    print("✅ log, stack trace and code lines are not mistaken for instructions")
+    return True
+
+
+def test_flat_latency():
+    print("\n=== Flat Routing Cost ===")
+    small, huge = paste(2000), paste(400000)
+    timings = []
+    for prompt in (small, huge):
+        start = time.perf_counter()
+        routing = reduce_routing_input(prompt)
+        timings.append((time.perf_counter() - start, routing))
+    (small_time, small_routing), (huge_time, huge_routing) = timings
+    assert abs(small_routing.tokens - huge_routing.tokens) < 40
+    assert huge_time < 0.25, f"{len(huge) / 1e6:.0f}MB paste took {huge_time:.3f}s"
+    print(f"✅ {len(small) // 1000}KB: {small_time * 1000:.1f}ms / ~{small_routing.tokens} tokens, "
+          f"{len(huge) / 1e6:.0f}MB: {huge_time * 1000:.1f}ms / ~{huge_routing.tokens} tokens")
+    return True
+
+
+class RecordingClient:
+    def __init__(self):
+        self.seen = []
+
+    async def create(self, messages, **kwargs):
+        self.seen.append((messages[0].content, messages[-1].content))
+        if messages[0].content == CLASSIFIER_SYSTEM:
+            return CreateResult(content='{"label": "coder"}', usage=RequestUsage(10, 5), finish_reason="stop", cached=False)
+        return CreateResult(content="修正版です。", usage=RequestUsage(10, 5), finish_reason="stop", cached=False)
+
+    async def close(self):
+        pass
+
+
+def test_orchestrator(tmp):
+    print("\n=== Orchestrator ===")
+    orch = Orchestrator.__new__(Orchestrator)
+    orch.client = RecordingClient()
+    orch.checkpoints = CheckpointStore(os.path.join(tmp, "checkpoints"))
+    before = get_routing_input_stats().stats()
+    sizes = []
+    for lines in (2000, 100000):
+        orch.client.seen.clear()
+        prompt = paste(lines)
+        with_ranking = asyncio.run(orch.classify_async(prompt))
+        classifier_inputs = [user for system, user in orch.client.seen if system == CLASSIFIER_SYSTEM]
+        sizes.append(len(classifier_inputs[0]) if classifier_inputs else 0)
+        assert with_ranking == "coder", with_ranking
+    assert max(sizes) < 2000 and abs(sizes[0] - sizes[1]) < 200, sizes
+
+    orch.client.seen.clear()
+    prompt = paste(2000)
+    result = asyncio.run(orch.ask_async(prompt))
+    answer_inputs = [user for system, user in orch.client.seen if system != CLASSIFIER_SYSTEM]
+    assert answer_inputs == [prompt], "answers are generated from the full prompt"
+    assert result["selected"] == "coder"
+
+    after = get_routing_input_stats().stats()
+    assert after["reduced"] - before["reduced"] == 3
+    assert after["saved_tokens"] - before["saved_tokens"] > 100000
+    print(f"✅ classifier input {sizes[0]} vs {sizes[1]} chars for 2k vs 100k log lines; "
+          f"saved ~{after['saved_tokens']} tokens")
+    return True
+
+
+def main():
+    print("Routing Input Test")
+    print("=" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [test_short_prompts(), test_long_paste(), test_flat_latency(), test_orchestrator(tmp)]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All routing input tests passed!")
+        return 0
+    print("⚠️ Some routing input tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
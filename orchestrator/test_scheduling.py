@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Request Class Scheduling Test Script
+
+Verifies the interactive / bulk / background lanes without API keys:
+- free upstream slots are shared by weight (stride scheduling), FIFO within a class
+- reserved slots: a batch filling every other slot cannot delay an interactive call
+- cancelled waiters leave the queue and granted slots are always returned,
+  also when waiters live on different event loops (threads)
+- under batch load the interactive p95 stays near one upstream call, while a
+  single FIFO queue makes it wait behind the batch
+- the circuit breaker times only the upstream call, not the wait for a slot
+- a client's interactive requests beyond SCHED_INTERACTIVE_PER_CLIENT run as bulk
+- the X-Request-Class header picks the class; jobs run as background; per-class
+  SLO metrics appear on /status and /metrics
+
+Usage:
+    python test_scheduling.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+import idempotency
+import rate_limit
+import scheduling
+from idempotency import IdempotencyStore
+from jobs import JobQueue, JobStore
+from circuit_breaker import CLOSED, BreakerClient, CircuitBreaker
+from rate_limit import RateLimiter
+from scheduling import BACKGROUND, BULK, INTERACTIVE, FairScheduler, ScheduledClient, classified
+
+NO_RESERVATION = {INTERACTIVE: 0, BULK: 0, BACKGROUND: 0}
+
+
+def test_weighted_share():
+    print("=== Weighted Fair Share ===")
+    scheduler = FairScheduler(max_concurrency=1, weights={INTERACTIVE: 6, BULK: 3, BACKGROUND: 1},
+                              reserved=NO_RESERVATION)
+
+    async def run():
+        order = []
+
+        async def call(request_class, index):
+            await scheduler.acquire(request_class)
+            order.append((request_class, index))
+            await asyncio.sleep(0)
+            scheduler.release(request_class)
+
+        await scheduler.acquire(BULK)  # 唯一の枠を埋めておく
+        tasks = [asyncio.create_task(call(BULK, i)) for i in range(12)]
+        tasks += [asyncio.create_task(call(BACKGROUND, i)) for i in range(12)]
+        await asyncio.sleep(0.01)
+        scheduler.release(BULK)
+        await asyncio.gather(*tasks)
+        return order
+
+    order = asyncio.run(run())
+    first = [cls for cls, _ in order[:8]]
+    assert first.count(BULK) == 6 and first.count(BACKGROUND) == 2, first
+    assert [i for cls, i in order if cls == BULK] == list(range(12)), "FIFO within a class"
+    stats = scheduler.stats()
+    assert stats["in_flight"] == 0 and stats["classes"][BACKGROUND]["calls"] == 12
+    print(f"✅ weights bulk 3 : background 1 → first 8 slots {first.count(BULK)} : {first.count(BACKGROUND)}")
+    return True
+
+
+def test_reserved_slots():
+    print("\n=== Reserved Slots ===")
+    scheduler = FairScheduler(max_concurrency=4, reserved={INTERACTIVE: 1, BULK: 0, BACKGROUND: 0})
+    peak_bulk = []
+
+    async def call(request_class, seconds):
+        await scheduler.acquire(request_class)
+        peak_bulk.append(scheduler.lanes[BULK].in_flight)
+        await asyncio.sleep(seconds)
+        scheduler.release(request_class)
+
+    async def run():
+        batch = [asyncio.create_task(call(BULK, 0.2)) for _ in range(10)]
+        await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        await call(INTERACTIVE, 0.0)
+        waited = time.perf_counter() - start
+        await asyncio.gather(*batch)
+        return waited
+
+    waited = asyncio.run(run())
+    assert waited < 0.05, f"interactive waited {waited:.3f}s behind the batch"
+    assert max(peak_bulk) == 3, "bulk never takes the interactive reservation"
+    print(f"✅ 10 bulk calls hold 3 of 4 slots; interactive started after {waited * 1000:.1f}ms")
+
+    try:
+        FairScheduler(max_concurrency=2, reserved={INTERACTIVE: 2, BULK: 1, BACKGROUND: 0})
+        raise AssertionError("reservations above the limit accepted")
+    except ValueError:
+        pass
+    return True
+
+
+def test_cancellation_and_loops():
+    print("\n=== Cancellation / Event Loops ===")
+    scheduler = FairScheduler(max_concurrency=1, reserved=NO_RESERVATION)
+
+    async def cancelled_waiter():
+        await scheduler.acquire(BULK)
+        waiter = asyncio.create_task(scheduler.acquire(INTERACTIVE))
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()["classes"][INTERACTIVE]["queued"] == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release(BULK)
+
+    asyncio.run(cancelled_waiter())
+    stats = scheduler.stats()
+    assert stats["in_flight"] == 0 and stats["classes"][INTERACTIVE]["queued"] == 0
+    print("✅ a cancelled waiter leaves the queue without taking a slot")
+
+    # 別スレッドのイベントループで持っている枠が解放されると、このループの待ちが起きる
+    held = threading.Event()
+
+    def other_thread():
+        async def hold():
+            await scheduler.acquire(BULK)
+            held.set()
+            await asyncio.sleep(0.2)
+            scheduler.release(BULK)
+        asyncio.run(hold())
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    held.wait()
+
+    async def acquire_here():
+        start = time.perf_counter()
+        await scheduler.acquire(INTERACTIVE)
+        scheduler.release(INTERACTIVE)
+        return time.perf_counter() - start
+
+    waited = asyncio.run(acquire_here())
+    thread.join()
+    assert 0.1 < waited < 1.0 and scheduler.stats()["in_flight"] == 0, waited
+    print(f"✅ slot handed across event loops after {waited * 1000:.0f}ms")
+    return True
+
+
+class SlowUpstream:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.model_info = {"function_calling": True}
+
+    async def create(self, messages, **kwargs):
+        await asyncio.sleep(self.seconds)
+        return "answer"
+
+    async def create_stream(self, messages, **kwargs):
+        await asyncio.sleep(self.seconds)
+        yield "ans"
+        yield "answer"
+
+    async def close(self):
+        pass
+
+
+def interactive_p95(scheduler, interactive_class):
+    """Interactive p95 (seconds) while 40 bulk requests compete for 4 slots."""
+    client = ScheduledClient(SlowUpstream(0.1), scheduler)
+
+    async def ask():
+        return await client.create([])
+
+    async def run():
+        batch = [asyncio.create_task(classified(ask(), BULK)) for _ in range(40)]
+        await asyncio.sleep(0.02)
+        for _ in range(10):
+            await classified(ask(), interactive_class)
+            await asyncio.sleep(0.03)
+        await asyncio.gather(*batch)
+
+    saved = scheduling._scheduler
+    scheduling._scheduler = scheduler
+    try:
+        asyncio.run(run())
+    finally:
+        scheduling._scheduler = saved
+    return scheduler.stats()["classes"][interactive_class]["latency_ms"]["p95"] / 1000
+
+
+def test_interactive_under_load():
+    print("\n=== Interactive p95 Under Batch Load ===")
+    lanes = FairScheduler(max_concurrency=4, reserved={INTERACTIVE: 1, BULK: 0, BACKGROUND: 0},
+                          slo_ms={INTERACTIVE: 300, BULK: 60000, BACKGROUND: 60000})
+    scheduled = interactive_p95(lanes, INTERACTIVE)
+    fifo = interactive_p95(FairScheduler(max_concurrency=4, reserved=NO_RESERVATION), BULK)
+    assert scheduled < 0.2, f"interactive p95 {scheduled:.3f}s"
+    assert fifo > 0.4, f"a single queue should make interactive wait ({fifo:.3f}s)"
+    stats = lanes.stats()["classes"]
+    assert stats[INTERACTIVE]["slo_attainment"] == 1.0 and stats[INTERACTIVE]["requests"] == 10
+    assert stats[BULK]["requests"] == 40
+    print(f"✅ interactive p95 {scheduled * 1000:.0f}ms with lanes vs {fifo * 1000:.0f}ms in one FIFO queue "
+          f"(bulk p95 {stats[BULK]['latency_ms']['p95']:.0f}ms)")
+
+    scheduler = FairScheduler(max_concurrency=1, reserved=NO_RESERVATION)
+    client = ScheduledClient(SlowUpstream(0.05), scheduler)
+    assert client.model_info["function_calling"], "other attributes pass through"
+
+    async def stream():
+        chunks = []
+        async for chunk in client.create_stream([]):
+            chunks.append((chunk, scheduler.stats()["in_flight"]))
+        return chunks, scheduler.stats()["in_flight"]
+
+    chunks, after = asyncio.run(stream())
+    assert [n for _, n in chunks] == [1, 1] and after == 0
+    print("✅ streamed calls hold their slot until the stream ends")
+    return True
+
+
+def test_breaker_inside_slot():
+    print("\n=== Breaker Times the Upstream Call Only ===")
+    scheduler = FairScheduler(max_concurrency=1, reserved=NO_RESERVATION)
+    breaker = CircuitBreaker("sched-test", min_calls=5, slow_call_seconds=0.2, timeout=0.3)
+    client = ScheduledClient(BreakerClient(SlowUpstream(0.1), breaker), scheduler)
+
+    async def run():
+        return await asyncio.gather(*(client.create([]) for _ in range(10)), return_exceptions=True)
+
+    start = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    assert results == ["answer"] * 10, results
+    assert breaker.state == CLOSED and breaker.stats()["slow_call_rate"] == 0.0
+    print(f"✅ 10 queued calls through 1 slot in {elapsed:.1f}s: no timeouts, circuit {breaker.state}")
+    return True
+
+
+def test_interactive_cap():
+    print("\n=== Per-Client Interactive Cap ===")
+    scheduler = FairScheduler(interactive_per_client=2)
+    with scheduler.admit(INTERACTIVE, "ip:1") as a, scheduler.admit(INTERACTIVE, "ip:1") as b, \
+            scheduler.admit(INTERACTIVE, "ip:1") as c, scheduler.admit(INTERACTIVE, "ip:2") as d:
+        assert (a, b, c, d) == (INTERACTIVE, INTERACTIVE, BULK, INTERACTIVE)
+    with scheduler.admit(INTERACTIVE, "ip:1") as again:
+        assert again == INTERACTIVE, "finished requests free the client's interactive share"
+    assert scheduler.stats()["demoted_interactive"] == 1
+    assert "sched_demoted_interactive_total 1" in scheduler.metrics_text()
+    print("✅ 3rd concurrent interactive request from one client runs as bulk; other clients unaffected")
+    return True
+
+
+class CountingOrchestrator:
+    async def ask_async(self, prompt, run_id=None):
+        await asyncio.sleep(0.01)
+        return {"selected": "travel", "response": "answer", "usage": {}}
+
+
+def test_endpoints(tmp):
+    print("\n=== X-Request-Class / Metrics ===")
+    import app as app_module
+
+    saved = (app_module.orchestrator, app_module._jobs, idempotency._store, rate_limit._limiter,
+             scheduling._scheduler)
+    app_module.orchestrator = CountingOrchestrator()
+    app_module._jobs = JobQueue(JobStore(os.path.join(tmp, "jobs.sqlite3")), app_module.run_ask_job,
+                                workers=1, poll_interval=0.05)
+    idempotency._store = IdempotencyStore(os.path.join(tmp, "idem.sqlite3"))
+    rate_limit._limiter = RateLimiter(os.path.join(tmp, "rl.sqlite3"))
+    scheduling._scheduler = FairScheduler()
+    try:
+        with app_module.app.test_client() as client:
+            ui = {"X-Request-Class": "interactive"}
+            assert client.post("/api/ask", json={"prompt": "京都"}, headers=ui).status_code == 200
+            assert client.post("/api/ask", json={"prompt": "大阪"}).status_code == 200
+            bad = client.post("/api/ask", json={"prompt": "x"}, headers={"X-Request-Class": "urgent"})
+            assert bad.status_code == 400, bad.status_code
+            job = client.post("/api/jobs", json={"prompt": "長い質問"}).get_json()
+            client.get(f"/api/jobs/{job['id']}/events").get_data()
+
+            classes = client.get("/status").get_json()["scheduling"]["classes"]
+            assert [classes[c]["requests"] for c in (INTERACTIVE, BULK, BACKGROUND)] == [1, 1, 1], classes
+            metrics = client.get("/metrics").get_data(as_text=True)
+            assert 'sched_requests_total{class="interactive"} 1' in metrics
+            assert 'sched_slo_violations_total{class="background"} 0' in metrics
+            assert 'sched_request_latency_seconds{class="bulk",quantile="0.95"}' in metrics
+        print(f"✅ UI → interactive, no header → bulk, job → background; "
+              f"interactive p95 {classes[INTERACTIVE]['latency_ms']['p95']}ms on /status and /metrics")
+    finally:
+        app_module._jobs.stop()
+        (app_module.orchestrator, app_module._jobs, idempotency._store, rate_limit._limiter,
+         scheduling._scheduler) = saved
+    return True
+
+
+def main():
+    print("Request Class Scheduling Test")
+    print("=" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [test_weighted_share(), test_reserved_slots(), test_cancellation_and_loops(),
+                   test_interactive_under_load(), test_breaker_inside_slot(), test_interactive_cap(),
+                   test_endpoints(tmp)]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All scheduling tests passed!")
+        return 0
+    print("⚠️ Some scheduling tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Shadow Routing Test Script
+
+Verifies shadow evaluation of candidate routers without API keys:
+- sampled requests queue the candidates without waiting for them; slow
+  candidates never add to the classification latency
+- evaluations beyond SHADOW_MAX_CONCURRENCY are dropped, not queued
+- agreement with the primary label, coverage, latency and confusions are
+  aggregated per router (and per primary routing source)
+- Orchestrator.classify_async feeds the default candidates
+  (keyword / embedding / cache) and /admin/shadow reports them
+- the aggregates and the /admin/shadow override are shared by every
+  worker process through SQLite
+
+Usage:
+    python test_shadow.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_core.models import CreateResult, RequestUsage
+
+import shadow
+from autogen_router import Orchestrator
+from checkpoint import CheckpointStore
+from shadow import ShadowEvaluator, ShadowStore, register_default_routers
+
+
+def slow_router(label, seconds):
+    def route(prompt):
+        time.sleep(seconds)
+        return label
+    return route
+
+
+def make_store(tmp, name):
+    return ShadowStore(os.path.join(tmp, f"{name}.sqlite3"))
+
+
+def test_off_path_and_cap(tmp):
+    print("=== Off the Response Path ===")
+    evaluator = ShadowEvaluator(sample_rate=1.0, max_concurrency=1, store=make_store(tmp, "cap"))
+    evaluator.register("slow", slow_router("coder", 0.3))
+    assert not ShadowEvaluator(sample_rate=0, store=make_store(tmp, "off")).observe("x", "coder", 0.1), \
+        "disabled by default"
+
+    start = time.perf_counter()
+    queued = [evaluator.observe(f"質問{i}", "coder", 0.5) for i in range(3)]
+    elapsed = time.perf_counter() - start
+    assert elapsed < 0.05, f"observe must not wait for candidates ({elapsed:.3f}s)"
+    assert queued == [True, False, False], queued
+    assert evaluator.wait_idle()
+    report = evaluator.report()
+    assert report["sampled"] == 1 and report["dropped"] == 2
+    assert report["routers"]["slow"]["latency_ms"]["p50"] >= 300
+    print(f"✅ 3 observes in {elapsed * 1000:.1f}ms; 1 evaluated, 2 dropped at the concurrency cap")
+
+    evaluator.enable(0.0, 60)
+    assert not evaluator.observe("x", "coder", 0.1)
+    print("✅ /admin/shadow can override the sample rate temporarily")
+    return True
+
+
+def test_aggregation(tmp):
+    print("\n=== Agreement Report ===")
+    evaluator = ShadowEvaluator(sample_rate=1.0, max_concurrency=4, store=make_store(tmp, "aggregation"))
+    evaluator.register("fixed", lambda prompt: "coder")
+    evaluator.register("unsure", lambda prompt: None)
+    evaluator.register("broken", lambda prompt: 1 / 0)
+
+    async def local_model(prompt):
+        await asyncio.sleep(0.01)
+        return "travel" if "旅行" in prompt else "coder"
+    evaluator.register("local_model", local_model)
+
+    for prompt, label, source in [("バグを直して", "coder", "embedding"), ("旅行プラン", "travel", "llm"),
+                                  ("関数を書いて", "coder", "llm"), ("京都旅行", "travel", "llm")]:
+        evaluator.observe(prompt, label, 0.8, source)
+        evaluator.wait_idle()
+    routers = evaluator.report()["routers"]
+    assert routers["fixed"]["agreement"] == 0.5 and routers["fixed"]["confusions"] == {"travel->coder": 2}
+    assert routers["fixed"]["by_primary_source"]["llm"] == {"runs": 3, "agreement": 0.333}
+    assert routers["unsure"]["coverage"] == 0 and routers["unsure"]["agreement"] is None
+    assert routers["broken"]["errors"] == 4
+    assert routers["local_model"]["agreement"] == 1.0, "coroutine routers are supported"
+    assert evaluator.report()["recent_disagreements"][0]["label"] == "coder"
+    print(f"✅ fixed {routers['fixed']['agreement']}, local_model {routers['local_model']['agreement']}, "
+          f"unsure coverage {routers['unsure']['coverage']}, broken errors {routers['broken']['errors']}")
+    return True
+
+
+def test_shared_across_workers(tmp):
+    print("\n=== Shared Across Workers ===")
+    path = os.path.join(tmp, "shared.sqlite3")
+    # 同じ SQLite を指す 2 つの評価器 = gunicorn の 2 ワーカー
+    first = ShadowEvaluator(sample_rate=0, max_concurrency=2, store=ShadowStore(path))
+    second = ShadowEvaluator(sample_rate=0, max_concurrency=2, store=ShadowStore(path))
+    for evaluator in (first, second):
+        evaluator.register("fixed", lambda prompt: "coder")
+
+    saved_refresh = shadow.OVERRIDE_REFRESH
+    shadow.OVERRIDE_REFRESH = 0
+    try:
+        first.enable(1.0, 60)
+        assert second.current_rate() == 1.0, "the override reaches the other worker"
+        assert first.observe("バグを直して", "coder", 0.1) and second.observe("旅行プラン", "travel", 0.2)
+        assert first.wait_idle() and second.wait_idle()
+        for report in (first.report(), second.report()):
+            assert report["sampled"] == 2 and report["routers"]["fixed"]["agreement"] == 0.5, report
+        second.reset()
+        assert first.report()["sampled"] == 0
+        second.enable(0.0, 60)
+        assert first.current_rate() == 0.0
+    finally:
+        shadow.OVERRIDE_REFRESH = saved_refresh
+    print("✅ both workers report the same totals; enable / reset apply to every worker")
+    return True
+
+
+class ClassifierClient:
+    async def create(self, messages, **kwargs):
+        await asyncio.sleep(0.05)
+        return CreateResult(content='{"label": "coder"}', usage=RequestUsage(10, 5), finish_reason="stop", cached=False)
+
+    async def close(self):
+        pass
+
+
+def test_orchestrator_and_admin(tmp):
+    print("\n=== Orchestrator / Admin ===")
+    import app as app_module
+
+    evaluator = ShadowEvaluator(sample_rate=1.0, max_concurrency=2, store=make_store(tmp, "admin"))
+    register_default_routers(evaluator)
+    evaluator.register("local_model", slow_router("coder", 0.5))
+    saved = shadow._shadow
+    saved_token = os.environ.pop("ADMIN_TOKEN", None)
+    shadow._shadow = evaluator
+    try:
+        orch = Orchestrator.__new__(Orchestrator)
+        orch.client = ClassifierClient()
+        orch.checkpoints = CheckpointStore(os.path.join(tmp, "checkpoints"))
+        prompt = "この関数のバグを直して、リファクタリングしてください"
+        start = time.perf_counter()
+        label = asyncio.run(orch.classify_async(prompt))
+        elapsed = time.perf_counter() - start
+        assert elapsed < 0.4, f"classification waited for the 0.5s shadow router ({elapsed:.2f}s)"
+        assert evaluator.wait_idle()
+        asyncio.run(orch.classify_async(prompt))
+        assert evaluator.wait_idle()
+
+        report = evaluator.report()
+        assert report["sampled"] == 2
+        assert set(report["routers"]) == {"keyword", "embedding", "cache", "local_model"}
+        assert report["routers"]["cache"]["answered"] == 1 and report["routers"]["cache"]["agree"] == 1
+        assert report["routers"]["keyword"]["runs"] == 2
+        print(f"✅ primary {label} in {elapsed * 1000:.0f}ms; shadow report: "
+              f"{ {name: r['agreement'] for name, r in report['routers'].items()} }")
+
+        with app_module.app.test_client() as client:
+            assert client.get("/admin/shadow").status_code == 404, "disabled without ADMIN_TOKEN"
+            os.environ["ADMIN_TOKEN"] = "s3cret"
+            auth = {"Authorization": "Bearer s3cret"}
+            assert client.get("/admin/shadow").status_code == 401
+            assert client.get("/admin/shadow", headers=auth).get_json()["sampled"] == 2
+            enabled = client.post("/admin/shadow", json={"rate": 0.25, "seconds": 60}, headers=auth).get_json()
+            assert enabled["sample_rate"] == 0.25
+            assert client.delete("/admin/shadow", headers=auth).get_json()["sampled"] == 0
+        print("✅ /admin/shadow reports, enables and resets (ADMIN_TOKEN protected)")
+    finally:
+        shadow._shadow = saved
+        os.environ.pop("ADMIN_TOKEN", None)
+        if saved_token is not None:
+            os.environ["ADMIN_TOKEN"] = saved_token
+    return True
+
+
+def main():
+    print("Shadow Routing Test")
+    print("=" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [
+            test_off_path_and_cap(tmp),
+            test_aggregation(tmp),
+            test_shared_across_workers(tmp),
+            test_orchestrator_and_admin(tmp),
+        ]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All shadow routing tests passed!")
+        return 0
+    print("⚠️ Some shadow routing tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Local Speaker Selection Test Script
+
+Verifies the in-process next-speaker choice for discussions without API keys:
+- the expert whose domain terms (from its system_message) appear in the new
+  messages speaks next; experts with nothing in their domain are skipped
+- when nobody has new points the discussion ends (NoNewPointsTermination)
+  instead of paying for another turn, so it takes fewer upstream calls
+  than round-robin
+- selection never calls the model: upstream calls == expert messages
+- the mode is kept in the checkpoint and reused on resume
+
+Usage:
+    python test_speaker_selection.py
+"""
+
+import asyncio
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_agentchat.messages import TextMessage
+from autogen_core.models import CreateResult, RequestUsage, SystemMessage
+from autogen_ext.models.replay import ReplayChatCompletionClient
+
+from checkpoint import CheckpointStore
+from discussion import EXPERT_SYSTEM_MESSAGES, DiscussionManager, run_discussion
+from speaker_selection import LocalSpeakerSelector, NoNewPointsTermination, normalize_speaker_selection
+
+TASK = "議題: 渋滞対策の税制と費用便益を検討"
+ECONOMIST_NO_CLIMATE = "経済: 混雑課金は費用便益分析で純便益が大きく、税収は公共交通へ回せる"
+ECONOMIST_ASKS_CLIMATE = "経済: 料金施策の効果を示すには交通起源の排出量の推計と温室効果ガスの評価が要る"
+
+
+class ExpertScriptClient(ReplayChatCompletionClient):
+    """Answers each expert (recognized by its system message) from its own script."""
+
+    def __init__(self, scripts, fail_at=None):
+        super().__init__(["unused"])
+        self.scripts = {name: list(lines) for name, lines in scripts.items()}
+        self.calls = []
+        self.fail_at = fail_at
+
+    async def create(self, messages, **kwargs):
+        system = messages[0].content if isinstance(messages[0], SystemMessage) else ""
+        speaker = next((name for name, text in EXPERT_SYSTEM_MESSAGES.items() if text == system), None)
+        assert speaker is not None, "unexpected model call (speaker selection?)"
+        self.calls.append(speaker)
+        if len(self.calls) == self.fail_at:
+            raise RuntimeError("429 Too Many Requests")
+        return CreateResult(content=self.scripts[speaker].pop(0), usage=RequestUsage(100, 20),
+                            finish_reason="stop", cached=False)
+
+
+def test_selection_rules():
+    print("=== Selection Rules ===")
+    experts = dict(EXPERT_SYSTEM_MESSAGES)
+    experts["planner"] = "あなたは都市計画の専門家です。土地利用、用途地域、駐車場配置、歩行者空間の設計に詳しい。"
+    selector = LocalSpeakerSelector(experts, min_terms=2)
+    assert selector.select([("user", TASK)]) == "economist", "the task's domain opens"
+    assert not selector.converged([("user", TASK)])
+
+    after_economist = [("user", TASK), ("economist", ECONOMIST_NO_CLIMATE)]
+    assert selector.converged(after_economist), "nobody else has new points"
+    assert selector.select([("user", TASK), ("economist", ECONOMIST_ASKS_CLIMATE)]) == "climatologist"
+    assert selector.select([("user", TASK), ("economist", "経済: 駐車場配置と用途地域の見直しも要る")]) == "planner"
+    print("✅ domain terms pick the next speaker; no new points → converged")
+
+    async def check_termination():
+        termination = NoNewPointsTermination(selector)
+        selector.history = [("user", TASK)]
+        asks = TextMessage(source="economist", content=ECONOMIST_ASKS_CLIMATE)
+        assert await termination([asks]) is None
+        stop = await termination([TextMessage(source="economist", content=ECONOMIST_NO_CLIMATE)])
+        assert stop is not None and termination.terminated
+        await termination.reset()
+        assert not termination.terminated
+
+    asyncio.run(check_termination())
+    print("✅ NoNewPointsTermination stops the run instead of repeating the last speaker")
+
+    assert normalize_speaker_selection("") == "round_robin" and normalize_speaker_selection("LOCAL") == "local"
+    try:
+        normalize_speaker_selection("llm")
+        raise AssertionError("unknown mode accepted")
+    except ValueError:
+        pass
+    return True
+
+
+def discuss(mode, store=None, scripts=None):
+    client = ExpertScriptClient(scripts or {
+        "economist": [ECONOMIST_NO_CLIMATE, "経済: 【結論】混雑課金×公共交通強化（費用便益で妥当）"],
+        "climatologist": ["気候: 排出面でも賛成です", "気候: 【結論】混雑課金×公共交通強化"],
+    })
+    with tempfile.TemporaryDirectory() as tmp:
+        result = asyncio.run(run_discussion(task=TASK, store=store or CheckpointStore(tmp), model_client=client,
+                                            on_message=lambda m, c: None, speaker_selection=mode))
+    return result, client.calls
+
+
+def test_fewer_turns():
+    print("\n=== Fewer Turns Than Round-Robin ===")
+    robin, robin_calls = discuss("round_robin")
+    local, local_calls = discuss("local")
+    assert "【結論】" in robin["messages"][-1]["content"]
+    assert robin_calls == ["economist", "climatologist", "economist"]
+    assert local_calls == ["economist"] and local["speaker_selection"] == "local"
+    assert local["stop_reason"] == "No expert has new points to add", local["stop_reason"]
+    experts = [m for m in local["messages"] if m["source"] != "user"]
+    assert len(experts) == len(local_calls), "no model calls spent on choosing speakers"
+    print(f"✅ round-robin {len(robin_calls)} upstream calls, local selection {len(local_calls)} "
+          f"(ended: {local['stop_reason']})")
+
+    relevant, calls = discuss("local", scripts={
+        "economist": [ECONOMIST_ASKS_CLIMATE, "経済: 【結論】混雑課金×排出規制"],
+        "climatologist": ["気候: 交通起源の排出は推計で約15%減、【結論】混雑課金×排出規制"],
+    })
+    assert calls == ["economist", "climatologist"], calls
+    assert "【結論】" in relevant["messages"][-1]["content"]
+    print("✅ an expert whose domain comes up still gets the turn (and concludes)")
+    return True
+
+
+def test_resume_keeps_mode():
+    print("\n=== Checkpoint / Resume ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CheckpointStore(tmp)
+        flaky = ExpertScriptClient({"economist": [ECONOMIST_ASKS_CLIMATE], "climatologist": ["unused"]}, fail_at=2)
+
+        async def first_run():
+            try:
+                await run_discussion(task=TASK, run_id="d1", store=store, model_client=flaky,
+                                     on_message=lambda m, c: None, speaker_selection="local")
+            except RuntimeError:
+                return True
+            return False
+
+        assert asyncio.run(first_run())
+        assert store.load("d1")["meta"]["speaker_selection"] == "local"
+        resumed = ExpertScriptClient({"economist": [], "climatologist": ["気候: 排出推計を踏まえ【結論】混雑課金×排出規制"]})
+        result = asyncio.run(run_discussion(run_id="d1", store=store, model_client=resumed,
+                                            on_message=lambda m, c: None))
+        assert result["resumed"] and result["speaker_selection"] == "local"
+        assert resumed.calls == ["climatologist"], "the resumed selector continues the same order"
+        print("✅ resumed without a mode argument, kept local selection and paid for 1 new turn")
+
+    try:
+        DiscussionManager().start(task=TASK, speaker_selection="llm")
+        raise AssertionError("unknown mode accepted")
+    except ValueError:
+        pass
+    print("✅ unknown speaker_selection is rejected before starting")
+    return True
+
+
+def main():
+    print("Local Speaker Selection Test")
+    print("=" * 50)
+    results = [test_selection_rules(), test_fewer_turns(), test_resume_keeps_mode()]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All speaker selection tests passed!")
+        return 0
+    print("⚠️ Some speaker selection tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
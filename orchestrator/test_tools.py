@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tool Calling Test Script
+
+Verifies the agent tool loop without API keys:
+- every tool call of one model turn runs concurrently (turn cost is the
+  slowest tool, not the sum) with per-tool timeouts clamped to the
+  request's remaining time budget
+- deterministic tool results are memoized in a TTL cache and duplicate
+  calls within a turn run once
+- Orchestrator: a model turn requesting tools gets the results back and the
+  next turn answers in text; streamed answers do the same; once the round
+  limit or budget is reached the model is told not to call tools again
+- tool-calling turns are recorded and replayed by the LLM cassette
+
+Usage:
+    python test_tools.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_core import FunctionCall
+from autogen_core.models import CreateResult, FunctionExecutionResultMessage, RequestUsage
+
+import tools as tools_module
+from autogen_router import Orchestrator, CLASSIFIER_SYSTEM, MULTI_CLASSIFIER_SYSTEM
+from cassette import CassetteClient
+from checkpoint import CheckpointStore
+from tools import ToolRegistry, get_tools, register_default_tools, start_budget
+
+EMPTY = {"type": "object", "properties": {}}
+
+
+def make_registry():
+    registry = ToolRegistry()
+    runs = {"fares": 0, "weather": 0}
+
+    @registry.register("fares", "fares", EMPTY, cache_ttl=60)
+    async def fares(city: str = "京都"):
+        runs["fares"] += 1
+        await asyncio.sleep(0.2)
+        return {"city": city, "fare": 13970}
+
+    @registry.register("weather", "weather", EMPTY)
+    async def weather():
+        runs["weather"] += 1
+        await asyncio.sleep(0.2)
+        return "晴れ"
+
+    @registry.register("hotels", "hotels", EMPTY, timeout=0.1)
+    async def hotels():
+        await asyncio.sleep(1)
+
+    return registry, runs
+
+
+def call(name, call_id, **arguments):
+    return FunctionCall(id=call_id, name=name, arguments=json.dumps(arguments, ensure_ascii=False))
+
+
+def test_concurrent_calls():
+    print("=== Concurrent Tool Calls ===")
+    registry, runs = make_registry()
+
+    async def turn():
+        start_budget(30)
+        begin = time.perf_counter()
+        results = await registry.run_calls([
+            call("fares", "1", city="京都"), call("weather", "2"), call("hotels", "3"),
+            call("fares", "4", city="京都"), call("missing", "5"),
+        ])
+        return results, time.perf_counter() - begin
+
+    results, elapsed = asyncio.run(turn())
+    assert [r.call_id for r in results] == ["1", "2", "3", "4", "5"]
+    assert json.loads(results[0].content)["fare"] == 13970 and results[1].content == "晴れ"
+    assert results[2].is_error and "timed out" in results[2].content
+    assert results[3].content == results[0].content and runs["fares"] == 1, "duplicate call runs once"
+    assert results[4].is_error and "unknown tool" in results[4].content
+    assert elapsed < 0.35, f"turn should cost the slowest tool, took {elapsed:.2f}s"
+    print(f"✅ 5 calls in {elapsed:.2f}s (3 × 0.2s tools + 1s tool timed out at 0.1s)")
+
+    async def tight_budget():
+        start_budget(0.1)
+        begin = time.perf_counter()
+        result = (await registry.run_calls([call("weather", "6")]))[0]
+        return result, time.perf_counter() - begin
+
+    result, elapsed = asyncio.run(tight_budget())
+    assert result.is_error and elapsed < 0.15, (result, elapsed)
+    assert registry.stats()["tools"]["hotels"]["timeouts"] == 1
+    print(f"✅ tool timeout clamped to the remaining request budget ({elapsed:.2f}s)")
+    return True
+
+
+def test_cache():
+    print("\n=== Result Cache ===")
+    registry, runs = make_registry()
+
+    async def twice(name, **arguments):
+        start_budget(30)
+        first = await registry.run_calls([call(name, "a", **arguments)])
+        begin = time.perf_counter()
+        second = await registry.run_calls([call(name, "b", **arguments)])
+        return first[0], second[0], time.perf_counter() - begin
+
+    first, second, elapsed = asyncio.run(twice("fares", city="大阪"))
+    assert first.content == second.content and runs["fares"] == 1 and elapsed < 0.05
+    asyncio.run(twice("fares", city="奈良"))
+    assert runs["fares"] == 2, "different arguments are a different entry"
+    asyncio.run(twice("weather"))
+    assert runs["weather"] == 2, "non-deterministic tools are never cached"
+    stats = registry.stats()
+    assert stats["tools"]["fares"]["cache_hits"] == 2 and stats["cache"]["size"] == 2
+    print(f"✅ deterministic results cached ({stats['cache']}); non-deterministic tools rerun")
+
+    registry.cache.put("fares:x", "old", ttl=0.05)
+    time.sleep(0.06)
+    assert registry.cache.get("fares:x") is None
+    print("✅ entries expire after their TTL")
+    return True
+
+
+def test_default_tools():
+    print("\n=== Offline Stand-ins ===")
+    registry = ToolRegistry()
+    register_default_tools(registry)
+
+    async def run():
+        start_budget(30)
+        return await registry.run_calls([
+            call("route_info", "1", origin="東京駅", destination="kyoto"),
+            call("calculate", "2", expression="(13970 * 2 + 9000) / 3"),
+            call("calculate", "3", expression="__import__('os')"),
+            call("current_datetime", "4"),
+            call("calculate", "5", expression="(((9**64)**64)**64)**64"),
+            call("calculate", "6", expression="3**64 * 3**64"),
+        ])
+
+    start = time.perf_counter()
+    route, total, unsafe, now, huge, large = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    route = json.loads(route.content)
+    assert route["destination"] == "京都" and 300 < route["distance_km"] < 500 and route["fare_jpy"] > 0, route
+    assert json.loads(total.content)["result"] == 12313.333333333334
+    assert unsafe.is_error and not now.is_error
+    assert huge.is_error and "too large" in huge.content and elapsed < 1.0, (huge.content, elapsed)
+    assert json.loads(large.content)["result"] == 3 ** 128
+    print("✅ nested powers are refused before computing (result size capped)")
+    print(f"✅ route_info 東京→京都: {route['distance_km']}km {route['duration_min']}分 ¥{route['fare_jpy']}")
+    return True
+
+
+class ToolCallingClient:
+    """Asks for route_info + calculate on the first turn, answers from the results on the next."""
+
+    def __init__(self):
+        self.requests = []
+
+    def _turn(self, messages, kwargs):
+        self.requests.append((list(messages), dict(kwargs)))
+        if messages[0].content == CLASSIFIER_SYSTEM:
+            return CreateResult(content='{"label": "travel"}', usage=RequestUsage(10, 2),
+                                finish_reason="stop", cached=False)
+        if messages[0].content == MULTI_CLASSIFIER_SYSTEM:
+            return CreateResult(content='{"labels": ["travel"]}', usage=RequestUsage(10, 2),
+                                finish_reason="stop", cached=False)
+        results = {r.name: r.content for m in messages if isinstance(m, FunctionExecutionResultMessage)
+                   for r in m.content}
+        # IGNORE_TOOL_CHOICE: tool_choice "none" を無視して呼び続けるモデル
+        may_call = kwargs.get("tools") and (kwargs.get("tool_choice") != "none" or os.environ.get("IGNORE_TOOL_CHOICE"))
+        if may_call and not results:
+            calls = [call("route_info", "r", origin="東京", destination="京都"),
+                     call("calculate", "c", expression="2 * 3")]
+            return CreateResult(content=calls, usage=RequestUsage(20, 8), finish_reason="function_calls", cached=False)
+        if may_call and os.environ.get("GREEDY_TOOLS"):
+            # ツール結果を受け取った後も追加で呼び続けるモデル
+            return CreateResult(content=[call("calculate", f"g{len(self.requests)}", expression="1 + 1")],
+                                usage=RequestUsage(5, 5), finish_reason="function_calls", cached=False)
+        if "route_info" not in results:
+            return CreateResult(content="ツールなしの回答です。", usage=RequestUsage(30, 12),
+                                finish_reason="stop", cached=False)
+        fare = json.loads(results["route_info"])["fare_jpy"]
+        return CreateResult(content=f"新幹線で片道約{fare}円です。", usage=RequestUsage(30, 12),
+                            finish_reason="stop", cached=False)
+
+    async def create(self, messages, **kwargs):
+        return self._turn(messages, kwargs)
+
+    async def create_stream(self, messages, **kwargs):
+        result = self._turn(messages, kwargs)
+        if isinstance(result.content, str):
+            yield result.content
+        yield result
+
+    async def close(self):
+        pass
+
+
+def make_orchestrator(tmp):
+    orch = Orchestrator.__new__(Orchestrator)
+    orch.client = ToolCallingClient()
+    orch.checkpoints = CheckpointStore(os.path.join(tmp, "checkpoints"))
+    return orch
+
+
+def test_orchestrator_loop(tmp):
+    print("\n=== Orchestrator Tool Loop ===")
+    get_tools().cache.clear()
+    orch = make_orchestrator(tmp)
+    result = asyncio.run(orch.ask_async("東京から京都まで新幹線でいくら？"))
+    assert result["selected"] == "travel" and "新幹線で片道約" in result["response"], result
+    answer_turns = [(m, k) for m, k in orch.client.requests if m[0].content != CLASSIFIER_SYSTEM]
+    assert len(answer_turns) == 2
+    offered = [t["name"] for t in answer_turns[0][1]["tools"]]
+    assert offered == ["route_info", "calculate", "current_datetime"], offered
+    assert [c["purpose"] for c in result["usage"]["calls"]] == ["classify", "answer", "answer"]
+    print(f"✅ travel agent called route_info + calculate, then answered: {result['response'].splitlines()[0]}")
+
+    streamed = []
+    multi = asyncio.run(orch.ask_multi_async("東京から京都", on_event=streamed.append))
+    assert "新幹線で片道約" in multi["responses"]["travel"]
+    assert any(e["type"] == "partial" for e in streamed)
+    print("✅ streamed answers run the same tool loop")
+
+    os.environ["GREEDY_TOOLS"] = "1"
+    try:
+        orch.client.requests.clear()
+        asyncio.run(orch.ask_async("東京から京都まで新幹線でいくら？"))
+        turns = [k for m, k in orch.client.requests if m[0].content != CLASSIFIER_SYSTEM]
+        assert len(turns) == tools_module.TOOL_MAX_ROUNDS + 1 and turns[-1]["tool_choice"] == "none", turns
+        print(f"✅ tool rounds capped at {tools_module.TOOL_MAX_ROUNDS}; last turn forced to answer")
+
+        os.environ["IGNORE_TOOL_CHOICE"] = "1"
+        for run in (orch.ask_async, orch.ask_multi_async):
+            orch.client.requests.clear()
+            asyncio.run(asyncio.wait_for(run("東京から京都まで新幹線でいくら？"), timeout=10))
+            turns = [k for m, k in orch.client.requests if m[0].content not in (CLASSIFIER_SYSTEM, MULTI_CLASSIFIER_SYSTEM)]
+            assert len(turns) == tools_module.TOOL_MAX_ROUNDS + 1, turns
+        os.environ.pop("IGNORE_TOOL_CHOICE")
+        print("✅ calls made after tools were withdrawn are dropped (create and stream)")
+
+        orch.client.requests.clear()
+        stops = get_tools().budget_stops
+
+        async def nearly_out_of_time():
+            start_budget(30)
+            return await orch._chat("system", "東京から京都", orch._agent_tools("travel"))
+
+        saved_min = tools_module.TOOL_MIN_REMAINING
+        tools_module.TOOL_MIN_REMAINING = 31
+        try:
+            asyncio.run(nearly_out_of_time())
+        finally:
+            tools_module.TOOL_MIN_REMAINING = saved_min
+        assert [k.get("tool_choice") for _, k in orch.client.requests] == ["none"]
+        assert get_tools().budget_stops == stops + 1
+        print("✅ no tools offered when the request budget is nearly spent")
+    finally:
+        os.environ.pop("GREEDY_TOOLS", None)
+        os.environ.pop("IGNORE_TOOL_CHOICE", None)
+
+    orch.client.requests.clear()
+    asyncio.run(orch._chat("system", "こんにちは"))
+    assert orch.client.requests[0][1] == {}, "agents without tools send no tool options"
+    print("✅ agents without tools are unchanged")
+    return True
+
+
+def test_cassette_replay(tmp):
+    print("\n=== Cassette Replay ===")
+    path = os.path.join(tmp, "tools.json.gz")
+    recorder = make_orchestrator(tmp)
+    recorder.client = CassetteClient(path, "record", inner=ToolCallingClient())
+    recorded = asyncio.run(recorder.ask_async("東京から京都まで新幹線でいくら？"))
+
+    player = make_orchestrator(tmp)
+    player.client = CassetteClient(path, "replay")
+    replayed = asyncio.run(player.ask_async("東京から京都まで新幹線でいくら？"))
+    assert replayed["response"] == recorded["response"], replayed
+    assert player.client.stats()["cassette"]["misses"] == 0
+    print(f"✅ {recorder.client.recorded} turns (incl. the tool call) replayed offline")
+    return True
+
+
+def main():
+    print("Tool Calling Test")
+    print("=" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [test_concurrent_calls(), test_cache(), test_default_tools(), test_orchestrator_loop(tmp),
+                   test_cassette_replay(tmp)]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All tool calling tests passed!")
+        return 0
+    print("⚠️ Some tool calling tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Upstream Pool Test Script
+
+Verifies multi-key / multi-endpoint load balancing without API keys:
+- peak-EWMA selection sends most traffic to the faster member
+- a 429 with Retry-After moves the request to another member immediately
+  and keeps the limited member out of rotation until the cooldown ends
+- members that keep failing are ejected
+- with per-key concurrency limits, throughput scales with the number of keys
+- UPSTREAM_ENDPOINTS / GEMINI_API_KEYS configuration
+- group-chat discussions run through the same pool / breaker / scheduler chain
+
+Usage:
+    python test_upstream_pool.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from upstream_pool import (
+    LEAST_OUTSTANDING, PEAK_EWMA, PoolExhaustedError, UpstreamMember, UpstreamPool,
+)
+
+
+class RateLimitError(Exception):
+    """Shaped like openai.RateLimitError (status_code + response.headers)."""
+
+    def __init__(self, retry_after=None):
+        super().__init__("Error code: 429 - Too Many Requests")
+        self.status_code = 429
+        self.response = type("Resp", (), {"status_code": 429, "headers": {"retry-after": retry_after} if retry_after else {}})()
+
+
+class FakeClient:
+    def __init__(self, latency=0.01, max_concurrent=None, fail=False, retry_after=None):
+        self.latency = latency
+        self.max_concurrent = max_concurrent
+        self.fail = fail
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.calls = 0
+
+    async def create(self, messages, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("503 Service Unavailable")
+        if self.retry_after is not None:
+            raise RateLimitError(self.retry_after)
+        if self.max_concurrent is not None and self.in_flight >= self.max_concurrent:
+            raise RateLimitError("0.2")
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        return "ok"
+
+    async def create_stream(self, messages, **kwargs):
+        yield await self.create(messages)
+
+    async def close(self):
+        pass
+
+
+def pool_of(*clients, **kwargs):
+    return UpstreamPool([UpstreamMember(f"m{i}", c) for i, c in enumerate(clients)], **kwargs)
+
+
+def test_latency_aware_selection():
+    print("=== Peak-EWMA Selection ===")
+    slow, fast = FakeClient(latency=0.05), FakeClient(latency=0.005)
+    pool = pool_of(slow, fast, strategy=PEAK_EWMA)
+
+    async def run():
+        for _ in range(20):
+            await pool.create(messages=[])
+
+    asyncio.run(run())
+    assert fast.calls >= 15, (slow.calls, fast.calls)
+    print(f"✅ fast member served {fast.calls}/20 sequential requests")
+    return True
+
+
+def test_rate_limit_failover():
+    print("\n=== 429 / Retry-After ===")
+    limited, healthy = FakeClient(retry_after="2"), FakeClient()
+    pool = pool_of(limited, healthy, strategy=PEAK_EWMA)
+    pool.members[1].ewma = 0.5  # 未計測の m0 が最初に選ばれる
+
+    async def run():
+        for _ in range(6):
+            assert await pool.create(messages=[]) == "ok"
+        chunks = [c async for c in pool.create_stream(messages=[])]
+        assert chunks == ["ok"]
+
+    asyncio.run(run())
+    stats = {m["name"]: m for m in pool.stats()["members"]}
+    assert limited.calls == 1, "rate-limited member must sit out its Retry-After"
+    assert stats["m0"]["rate_limited"] == 1 and 1.0 < stats["m0"]["cooldown_in"] <= 2.0
+    print(f"✅ 429 retried on another member; cooldown {stats['m0']['cooldown_in']}s")
+
+    only = pool_of(FakeClient(retry_after="5"))
+    try:
+        asyncio.run(only.create(messages=[]))
+    except RateLimitError:
+        pass
+    try:
+        asyncio.run(only.create(messages=[]))
+        raise AssertionError("exhausted pool should raise")
+    except PoolExhaustedError as e:
+        assert 4 < e.retry_in <= 5
+    print("✅ all members limited → PoolExhaustedError with retry_in")
+    return True
+
+
+def test_ejection():
+    print("\n=== Ejection ===")
+    broken, healthy = FakeClient(fail=True), FakeClient()
+    pool = pool_of(broken, healthy, eject_after=2, eject_seconds=60)
+
+    async def run():
+        ok = 0
+        for _ in range(10):
+            try:
+                await pool.create(messages=[])
+                ok += 1
+            except ConnectionError:
+                pass
+        return ok
+
+    ok = asyncio.run(run())
+    assert broken.calls == 2, broken.calls
+    assert pool.stats()["available"] == 1 and ok == 8
+    print(f"✅ failing member ejected after {broken.calls} errors; {ok}/10 succeeded")
+    return True
+
+
+def test_throughput_scales_with_keys():
+    print("\n=== Throughput vs. Keys ===")
+
+    def run(n_keys):
+        clients = [FakeClient(latency=0.05, max_concurrent=1) for _ in range(n_keys)]
+        pool = pool_of(*clients, strategy=LEAST_OUTSTANDING)
+
+        async def burst():
+            results = await asyncio.gather(
+                *(pool.create(messages=[]) for _ in range(3)), return_exceptions=True
+            )
+            return sum(1 for r in results if r == "ok")
+
+        return asyncio.run(burst())
+
+    single, triple = run(1), run(3)
+    assert single == 1 and triple == 3, (single, triple)
+    print(f"✅ 3 concurrent requests: 1 key → {single} ok, 3 keys → {triple} ok")
+    return True
+
+
+def test_from_env():
+    print("\n=== Configuration ===")
+    created = []
+
+    def factory(api_key=None, base_url=None, model=None):
+        created.append((api_key, base_url, model))
+        return FakeClient()
+
+    saved = {k: os.environ.get(k) for k in ("UPSTREAM_ENDPOINTS", "GEMINI_API_KEYS", "LOCAL_KEY")}
+    try:
+        os.environ["LOCAL_KEY"] = "secret"
+        os.environ["UPSTREAM_ENDPOINTS"] = json.dumps([
+            {"name": "gemini"},
+            {"name": "local", "base_url": "http://localhost:11434/v1", "model": "llama3", "api_key_env": "LOCAL_KEY"},
+        ])
+        pool = UpstreamPool.from_env(factory)
+        assert [m.name for m in pool.members] == ["gemini", "local"]
+        assert created[1] == ("secret", "http://localhost:11434/v1", "llama3")
+
+        del os.environ["UPSTREAM_ENDPOINTS"]
+        os.environ["GEMINI_API_KEYS"] = "key-aaaa1111, key-bbbb2222"
+        pool = UpstreamPool.from_env(factory)
+        assert [m.name for m in pool.members] == ["key-…1111", "key-…2222"]
+        assert "key-aaaa1111" not in json.dumps(pool.stats(), ensure_ascii=False)
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    print("✅ UPSTREAM_ENDPOINTS and GEMINI_API_KEYS parsed (keys not exposed)")
+    return True
+
+
+def test_discussion_through_pool():
+    print("\n=== Discussions Use the Pool ===")
+    from autogen_ext.models.replay import ReplayChatCompletionClient
+
+    from checkpoint import CheckpointStore
+    from circuit_breaker import BreakerClient, CircuitBreaker
+    from discussion import run_discussion
+    from scheduling import ScheduledClient
+
+    class LimitedReplay(ReplayChatCompletionClient):
+        async def create(self, *args, **kwargs):
+            raise RateLimitError("30")
+
+    limited = LimitedReplay(["unused"])
+    healthy = ReplayChatCompletionClient(["経済: 混雑課金を提案", "気候: 【結論】混雑課金×公共交通強化"])
+    pool = pool_of(limited, healthy)
+    pool.members[1].ewma = 0.5  # 未計測の m0（429 を返す）が最初に選ばれる
+    client = ScheduledClient(BreakerClient(pool, CircuitBreaker("pool-test")))
+    with tempfile.TemporaryDirectory() as tmp:
+        result = asyncio.run(run_discussion(task="議題", store=CheckpointStore(tmp), model_client=client,
+                                            on_message=lambda m, c: None))
+    assert "【結論】" in result["messages"][-1]["content"]
+    stats = {m["name"]: m for m in pool.stats()["members"]}
+    assert stats["m0"]["rate_limited"] == 1 and stats["m0"]["cooldown_in"] > 20
+    assert stats["m1"]["requests"] == 2
+    print(f"✅ the discussion's first turn failed over after a 429; {stats['m0']['name']} cooling down")
+    return True
+
+
+def main():
+    print("Upstream Pool Test")
+    print("=" * 50)
+    results = [
+        test_latency_aware_selection(),
+        test_rate_limit_failover(),
+        test_ejection(),
+        test_throughput_scales_with_keys(),
+        test_from_env(),
+        test_discussion_through_pool(),
+    ]
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All upstream pool tests passed!")
+        return 0
+    print("⚠️ Some upstream pool tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
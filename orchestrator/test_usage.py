@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Token Usage Test Script
+
+Verifies token accounting without API keys (the fake client returns real
+autogen CreateResult objects):
+- _chat returns CreateResult.content (no metadata leaking into the answer)
+  and records RequestUsage for the classifier and answer calls
+- streamed answers record the usage chunk, attributed per agent even when
+  agents run concurrently
+- usage is aggregated per agent / client / purpose, flushed to SQLite and
+  exposed on /api/ask, /api/usage (admin only) and /metrics
+- record() never writes SQLite on the caller's thread (flushes run in the background)
+
+Usage:
+    python test_usage.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from autogen_core.models import CreateResult, RequestUsage
+
+import usage as usage_module
+from autogen_router import Orchestrator, CLASSIFIER_SYSTEM, MULTI_CLASSIFIER_SYSTEM
+from checkpoint import CheckpointStore
+from usage import UsageLedger, attributed
+
+
+class FakeClient:
+    async def create(self, messages, **kwargs):
+        system = messages[0].content
+        if system == CLASSIFIER_SYSTEM:
+            return CreateResult(content='{"label": "none"}', usage=RequestUsage(50, 5),
+                                finish_reason="stop", cached=False)
+        if system == MULTI_CLASSIFIER_SYSTEM:
+            return CreateResult(content='{"labels": ["coder", "travel"]}', usage=RequestUsage(60, 10),
+                                finish_reason="stop", cached=False)
+        return CreateResult(content="一般的な回答です。", usage=RequestUsage(40, 200),
+                            finish_reason="stop", cached=False)
+
+    async def create_stream(self, messages, **kwargs):
+        assert kwargs.get("include_usage") is True
+        for word in ("部分", "回答"):
+            await asyncio.sleep(0.01)
+            yield word
+        yield CreateResult(content="部分回答", usage=RequestUsage(30, 60), finish_reason="stop", cached=False)
+
+    async def close(self):
+        pass
+
+
+def make_orchestrator(tmp):
+    orch = Orchestrator.__new__(Orchestrator)
+    orch.client = FakeClient()
+    orch.checkpoints = CheckpointStore(os.path.join(tmp, "checkpoints"))
+    return orch
+
+
+def test_request_usage(tmp):
+    print("=== Per-request Usage ===")
+    orch = make_orchestrator(tmp)
+    result = asyncio.run(attributed(orch.ask_async("今日の天気は？"), "ip:10.0.0.1"))
+    assert result["response"] == "一般的な回答です。", result["response"]
+    usage = result["usage"]
+    assert [(c["purpose"], c["agent"]) for c in usage["calls"]] == [("classify", "none"), ("answer", "none")]
+    assert usage["prompt_tokens"] == 90 and usage["completion_tokens"] == 205
+    assert usage["cost_usd"] > 0
+    print(f"✅ classify + answer: {usage['total_tokens']} tokens (${usage['cost_usd']})")
+
+    multi = asyncio.run(attributed(orch.ask_multi_async("x"), "key:team-b"))
+    calls = sorted((c["purpose"], c["agent"], c["completion_tokens"]) for c in multi["usage"]["calls"])
+    assert calls == [("answer", "coder", 60), ("answer", "travel", 60), ("classify", "none", 10)], calls
+    print("✅ concurrent streamed answers attributed to their own agents")
+    return True
+
+
+def test_ledger_and_endpoints(tmp):
+    print("\n=== Aggregation / Store / Endpoints ===")
+    ledger = usage_module._ledger
+    stats = {(agent, purpose): counts for (agent, purpose), counts in ledger.totals.items()}
+    assert stats[("coder", "answer")] == [1, 30, 60]
+    assert ledger.flush() > 0
+    by_client = {row["client"]: row for row in ledger.summary(group_by="client")}
+    assert by_client["ip:10.0.0.1"]["prompt_tokens"] == 90
+    assert by_client["key:team-b"]["completion_tokens"] == 130
+    print(f"✅ flushed to SQLite; per-client totals: { {k: v['calls'] for k, v in by_client.items()} }")
+
+    eager = UsageLedger(os.path.join(tmp, "eager.sqlite3"), flush_interval=0)
+    connect = eager._connect
+
+    def slow_connect():
+        time.sleep(0.3)
+        return connect()
+
+    eager._connect = slow_connect
+    start = time.perf_counter()
+    for _ in range(5):
+        eager.record(10, 20)
+    elapsed = time.perf_counter() - start
+    assert elapsed < 0.1, f"record() waited {elapsed:.2f}s for SQLite"
+    deadline = time.time() + 3
+    while (eager._flushing or eager._pending) and time.time() < deadline:
+        time.sleep(0.02)
+    assert eager.summary()[0]["calls"] == 5
+    print(f"✅ record() returns in {elapsed * 1000:.1f}ms; the flush runs off the caller's thread")
+
+    import app as app_module
+    saved = app_module.orchestrator
+    app_module.orchestrator = make_orchestrator(tmp)
+    try:
+        with app_module.app.test_client() as client:
+            data = client.post("/api/ask", json={"prompt": "今日の天気は？"}).get_json()
+            assert data["usage"]["total_tokens"] == 295
+            saved_token = os.environ.pop("ADMIN_TOKEN", None)
+            try:
+                assert client.get("/api/usage?group_by=client").status_code == 404, "disabled without ADMIN_TOKEN"
+                os.environ["ADMIN_TOKEN"] = "s3cret"
+                assert client.get("/api/usage?group_by=client").status_code == 401
+                admin = {"Authorization": "Bearer s3cret"}
+                rows = client.get("/api/usage?group_by=client", headers=admin).get_json()["usage"]
+                assert any(r["client"] == "ip:127.0.0.1" and r["calls"] == 2 for r in rows), rows
+                assert client.get("/api/usage?group_by=nope", headers=admin).status_code == 400
+            finally:
+                os.environ.pop("ADMIN_TOKEN", None)
+                if saved_token is not None:
+                    os.environ["ADMIN_TOKEN"] = saved_token
+            metrics = client.get("/metrics").get_data(as_text=True)
+    finally:
+        app_module.orchestrator = saved
+    assert 'llm_completion_tokens_total{agent="none",purpose="answer"} 400' in metrics, metrics
+    assert "llm_cost_usd_total" in metrics
+    print("✅ /api/ask returns usage; /api/usage (admin token) and /metrics report totals")
+    return True
+
+
+def main():
+    print("Token Usage Test")
+    print("=" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = usage_module._ledger
+        usage_module._ledger = UsageLedger(os.path.join(tmp, "usage.sqlite3"), flush_interval=3600)
+        try:
+            results = [test_request_usage(tmp), test_ledger_and_endpoints(tmp)]
+        finally:
+            usage_module._ledger = saved
+    print("\n" + "=" * 50)
+    if all(results):
+        print("🎉 All token usage tests passed!")
+        return 0
+    print("⚠️ Some token usage tests failed.")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+エージェントが使うツール（function calling）の登録と実行。
+
+- ツールは async 関数として登録し、agents.json の "tools" に名前を書いたエージェントだけに提示する
+- 1 ターンでモデルが要求したツール呼び出しはすべて並行に実行する
+  （複数ツールのターンの所要時間は合計ではなく最も遅い 1 件ぶん）
+- ツールごとにタイムアウトを設け、さらにリクエスト全体の時間予算（REQUEST_TIME_BUDGET）の
+  残りで頭打ちにする。予算が残り少なければ、それ以上ツールを提示せずに回答させる
+- 決定的なツール（同じ引数なら同じ結果）は TTL キャッシュに結果を保持し、同じターン内の
+  重複呼び出しは 1 回にまとめる
+- 既定のツールはオフラインで動くローカルの代替実装（運賃・所要時間の概算、計算、現在時刻）。
+  実サービスに接続するツールも同じ register() で差し替えられる
+
+設定:
+- REQUEST_TIME_BUDGET: 1 リクエストの時間予算（秒、既定 60）
+- TOOL_TIMEOUT: ツール 1 回のタイムアウト既定値（秒、既定 5）
+- TOOL_MAX_ROUNDS: 1 回答あたりのツール呼び出しターン数の上限（既定 3）
+- TOOL_MIN_REMAINING: これより予算が少なければツールを提示しない（秒、既定 5）
+- TOOL_CACHE_SIZE: キャッシュの最大件数（既定 1024）
+"""
+
+import os
+import ast
+import json
+import math
+import time
+import asyncio
+import datetime
+import operator
+import threading
+import contextvars
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from autogen_core import FunctionCall
+from autogen_core.models import FunctionExecutionResult
+
+REQUEST_TIME_BUDGET = float(os.environ.get("REQUEST_TIME_BUDGET", "60"))
+TOOL_TIMEOUT = float(os.environ.get("TOOL_TIMEOUT", "5"))
+TOOL_MAX_ROUNDS = int(os.environ.get("TOOL_MAX_ROUNDS", "3"))
+TOOL_MIN_REMAINING = float(os.environ.get("TOOL_MIN_REMAINING", "5"))
+
+
+# ---- request time budget ----
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+def start_budget(seconds: Optional[float] = None) -> float:
+    """Start the current request's time budget; returns the monotonic deadline."""
+    deadline = time.monotonic() + (REQUEST_TIME_BUDGET if seconds is None else seconds)
+    _deadline.set(deadline)
+    return deadline
+
+
+def budget_remaining() -> float:
+    """Seconds left in the current request's budget (the full budget outside a request)."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return REQUEST_TIME_BUDGET
+    return max(0.0, deadline - time.monotonic())
+
+
+# ---- result cache ----
+class TTLCache:
+    """Small LRU cache whose entries expire after a per-entry TTL."""
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size if max_size is not None else int(os.environ.get("TOOL_CACHE_SIZE", "1024"))
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value: str, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+# ---- tools ----
+class Tool:
+    def __init__(self, name: str, description: str, parameters: Dict[str, Any],
+                 fn: Callable[..., Awaitable[Any]], timeout: Optional[float] = None, cache_ttl: float = 0.0):
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.fn = fn
+        self.timeout = timeout if timeout is not None else TOOL_TIMEOUT
+        # 0 = 非決定的（毎回実行）
+        self.cache_ttl = cache_ttl
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+
+    def schema(self) -> Dict[str, Any]:
+        """autogen ToolSchema (passed to client.create(tools=...))."""
+        return {"name": self.name, "description": self.description, "parameters": self.parameters}
+
+    def stats(self) -> Dict[str, Any]:
+        executed = self.calls - self.cache_hits
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "avg_ms": round(self.total_seconds / executed * 1000, 1) if executed else 0.0,
+        }
+
+
+def cache_key(name: str, arguments: Dict[str, Any]) -> str:
+    return f"{name}:{json.dumps(arguments, ensure_ascii=False, sort_keys=True)}"
+
+
+def _result_text(value: Any) -> str:
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+
+class ToolRegistry:
+    def __init__(self):
+        self._tools: Dict[str, Tool] = {}
+        self.cache = TTLCache()
+        self.rounds = 0
+        self.budget_stops = 0
+
+    def register(self, name: str, description: str, parameters: Dict[str, Any],
+                 timeout: Optional[float] = None, cache_ttl: float = 0.0):
+        """Decorator registering an async function as a tool (replaces a tool of the same name)."""
+        def decorator(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            self._tools[name] = Tool(name, description, parameters, fn, timeout, cache_ttl)
+            return fn
+        return decorator
+
+    def get(self, name: str) -> Optional[Tool]:
+        return self._tools.get(name)
+
+    def resolve(self, names: Optional[Sequence[str]]) -> List[Tool]:
+        """Registered tools among names (unknown names in agents.json are ignored)."""
+        return [self._tools[n] for n in names or [] if n in self._tools]
+
+    def offer(self, tools: List[Tool], round_index: int) -> bool:
+        """Whether this model turn may still call tools (round limit and remaining budget)."""
+        if not tools or round_index >= TOOL_MAX_ROUNDS:
+            return False
+        if budget_remaining() < TOOL_MIN_REMAINING:
+            self.budget_stops += 1
+            return False
+        return True
+
+    async def _execute(self, tool: Tool, arguments: Dict[str, Any]) -> str:
+        tool.calls += 1
+        key = cache_key(tool.name, arguments)
+        if tool.cache_ttl > 0:
+            cached = self.cache.get(key)
+            if cached is not None:
+                tool.cache_hits += 1
+                return cached
+        # ツールの待ち時間もリクエストの時間予算から差し引く
+        timeout = min(tool.timeout, budget_remaining())
+        start = time.monotonic()
+        try:
+            value = await asyncio.wait_for(tool.fn(**arguments), timeout)
+        except asyncio.TimeoutError:
+            tool.timeouts += 1
+            raise
+        except Exception:
+            tool.errors += 1
+            raise
+        finally:
+            tool.total_seconds += time.monotonic() - start
+        text = _result_text(value)
+        if tool.cache_ttl > 0:
+            self.cache.put(key, text, tool.cache_ttl)
+        return text
+
+    async def _result(self, call: FunctionCall, shared: Dict[str, "asyncio.Task[str]"]) -> FunctionExecutionResult:
+        tool = self._tools.get(call.name)
+        try:
+            if tool is None:
+                raise KeyError(f"unknown tool: {call.name}")
+            arguments = json.loads(call.arguments or "{}")
+            if not isinstance(arguments, dict):
+                raise ValueError("arguments must be a JSON object")
+            key = cache_key(call.name, arguments)
+            # 同じターン内の同一呼び出しは 1 回だけ実行
+            if key not in shared:
+                shared[key] = asyncio.ensure_future(self._execute(tool, arguments))
+            content = await asyncio.shield(shared[key])
+            return FunctionExecutionResult(content=content, name=call.name, call_id=call.id, is_error=False)
+        except asyncio.TimeoutError:
+            content = f"error: {call.name} timed out"
+        except Exception as e:
+            content = f"error: {e}"
+        return FunctionExecutionResult(content=content, name=call.name, call_id=call.id, is_error=True)
+
+    async def run_calls(self, calls: Sequence[FunctionCall]) -> List[FunctionExecutionResult]:
+        """Run every tool call of one model turn concurrently (results in call order)."""
+        self.rounds += 1
+        shared: Dict[str, "asyncio.Task[str]"] = {}
+        try:
+            return list(await asyncio.gather(*(self._result(call, shared) for call in calls)))
+        finally:
+            for task in shared.values():
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rounds": self.rounds,
+            "budget_stops": self.budget_stops,
+            "cache": self.cache.stats(),
+            "tools": {name: tool.stats() for name, tool in self._tools.items()},
+        }
+
+
+def tool_calls(result: Any) -> List[FunctionCall]:
+    """Function calls requested by a model turn (empty for a text answer)."""
+    content = getattr(result, "content", None)
+    if isinstance(content, list):
+        return [c for c in content if isinstance(c, FunctionCall)]
+    return []
+
+
+# ---- offline stand-ins ----
+# 主要都市の座標（運賃・所要時間の概算用）
+CITIES: Dict[str, Tuple[float, float]] = {
+    "東京": (35.681, 139.767), "横浜": (35.466, 139.622), "名古屋": (35.171, 136.882),
+    "京都": (34.985, 135.758), "大阪": (34.702, 135.496), "神戸": (34.680, 135.180),
+    "奈良": (34.685, 135.805), "金沢": (36.578, 136.648), "広島": (34.398, 132.475),
+    "福岡": (33.590, 130.421), "仙台": (38.260, 140.882), "札幌": (43.069, 141.351),
+}
+CITY_ALIASES = {
+    "tokyo": "東京", "yokohama": "横浜", "nagoya": "名古屋", "kyoto": "京都", "osaka": "大阪",
+    "kobe": "神戸", "nara": "奈良", "kanazawa": "金沢", "hiroshima": "広島", "fukuoka": "福岡",
+    "博多": "福岡", "sendai": "仙台", "sapporo": "札幌",
+}
+# 移動手段ごとの (平均速度 km/h, 円/km, 乗り換え・待ち時間 分)
+TRAVEL_MODES = {
+    "train": (180.0, 25.0, 20),
+    "bus": (60.0, 12.0, 15),
+    "car": (70.0, 20.0, 0),
+    "plane": (500.0, 30.0, 90),
+}
+
+
+def _city(name: str) -> Tuple[str, Tuple[float, float]]:
+    key = name.strip().removesuffix("駅").removesuffix("市")
+    key = CITY_ALIASES.get(key.lower(), key)
+    if key not in CITIES:
+        raise ValueError(f"unknown city: {name} (known: {', '.join(CITIES)})")
+    return key, CITIES[key]
+
+
+def _distance_km(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (*a, *b))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    # 直線距離 × 1.25 で経路距離を近似
+    return 2 * 6371.0 * math.asin(math.sqrt(h)) * 1.25
+
+
+_ARITHMETIC = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod, ast.Pow: operator.pow,
+    ast.USub: operator.neg, ast.UAdd: operator.pos,
+}
+
+
+# 整数の結果の上限（約 1200 桁）。((9**64)**64)**64 のような入れ子のべき乗で
+# 共有のイベントループが止まらないよう、べき乗は計算前に、その他の演算は計算後に確かめる
+MAX_RESULT_BITS = 4096
+
+
+def _checked(value: float) -> float:
+    if isinstance(value, int) and value.bit_length() > MAX_RESULT_BITS:
+        raise ValueError("result too large")
+    return value
+
+
+def _evaluate(node: ast.AST) -> float:
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return _checked(node.value)
+    if isinstance(node, ast.BinOp) and type(node.op) in _ARITHMETIC:
+        right = _evaluate(node.right)
+        if isinstance(node.op, ast.Pow) and abs(right) > 64:
+            raise ValueError("exponent too large")
+        left = _evaluate(node.left)
+        if (isinstance(node.op, ast.Pow) and isinstance(left, int) and isinstance(right, int)
+                and right > 0 and (abs(left).bit_length() - 1) * right > MAX_RESULT_BITS):
+            raise ValueError("result too large")
+        try:
+            return _checked(_ARITHMETIC[type(node.op)](left, right))
+        except OverflowError:
+            raise ValueError("result too large")
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _ARITHMETIC:
+        return _ARITHMETIC[type(node.op)](_evaluate(node.operand))
+    raise ValueError("only numbers and + - * / // % ** are allowed")
+
+
+def register_default_tools(registry: "ToolRegistry") -> None:
+    @registry.register(
+        "route_info",
+        "主要都市間の移動距離・所要時間・片道運賃（円）の概算を返す",
+        {
+            "type": "object",
+            "properties": {
+                "origin": {"type": "string", "description": "出発地の都市名（例: 東京）"},
+                "destination": {"type": "string", "description": "目的地の都市名（例: 京都）"},
+                "mode": {"type": "string", "enum": list(TRAVEL_MODES), "description": "移動手段"},
+            },
+            "required": ["origin", "destination"],
+        },
+        cache_ttl=3600,
+    )
+    async def route_info(origin: str, destination: str, mode: str = "train") -> Dict[str, Any]:
+        if mode not in TRAVEL_MODES:
+            raise ValueError(f"unknown mode: {mode}")
+        (src, a), (dst, b) = _city(origin), _city(destination)
+        km = _distance_km(a, b)
+        speed, yen_per_km, overhead = TRAVEL_MODES[mode]
+        return {
+            "origin": src, "destination": dst, "mode": mode,
+            "distance_km": round(km), "duration_min": round(km / speed * 60 + overhead),
+            "fare_jpy": int(round(km * yen_per_km, -1)), "source": "local estimate",
+        }
+
+    @registry.register(
+        "calculate",
+        "四則演算・べき乗の数式を正確に計算する",
+        {
+            "type": "object",
+            "properties": {"expression": {"type": "string", "description": "例: (1200 * 3 + 450) / 4"}},
+            "required": ["expression"],
+        },
+        cache_ttl=3600,
+    )
+    async def calculate(expression: str) -> Dict[str, Any]:
+        return {"expression": expression, "result": _evaluate(ast.parse(expression, mode="eval"))}
+
+    @registry.register(
+        "current_datetime",
+        "現在の日時（日本時間）と曜日を返す",
+        {"type": "object", "properties": {}},
+    )
+    async def current_datetime() -> Dict[str, Any]:
+        now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9)))
+        return {"datetime": now.isoformat(timespec="minutes"), "weekday": "月火水木金土日"[now.weekday()]}
+
+
+_registry: Optional[ToolRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_tools() -> ToolRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ToolRegistry()
+            register_default_tools(_registry)
+        return _registry
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+複数の API キー / エンドポイントを 1 つのモデルクライアントとして束ねる上流プール。
+
+- メンバー（キー × base_url × model）ごとに独立したクライアントを持ち、
+  呼び出しごとに peak-EWMA レイテンシ × 同時実行数（または最小同時実行数）で選択
+- 429 を受けたメンバーは Retry-After の間だけ選択対象から外し、別メンバーで即再試行
+- 連続失敗したメンバーは一定時間イジェクト（繰り返すたびに倍、上限あり）
+- Orchestrator からは create / create_stream / close を持つ通常のクライアントに見える
+  （サーキットブレーカーはプール全体の成否を見る）
+
+設定（上から優先）:
+- UPSTREAM_ENDPOINTS: JSON 配列
+  [{"name": "gemini-a", "api_key_env": "GEMINI_KEY_A"},
+   {"name": "local", "base_url": "http://localhost:11434/v1", "model": "llama3", "api_key": "x"}]
+- GEMINI_API_KEYS: カンマ区切りのキー（base_url / model は共通）
+- 従来どおり GEMINI_API_KEY（1 メンバー）
+"""
+
+import os
+import json
+import math
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence
+
+PEAK_EWMA = "peak_ewma"
+LEAST_OUTSTANDING = "least_outstanding"
+
+
+class PoolExhaustedError(RuntimeError):
+    """Every member is rate-limited or ejected."""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"no upstream member available (retry in {retry_in:.0f}s)")
+        self.retry_in = retry_in
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429 or "429" in str(error).split("\n", 1)[0]
+
+
+def retry_after_seconds(error: BaseException, default: float) -> float:
+    """Retry-After from the error's HTTP response (seconds or HTTP date)."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class UpstreamMember:
+    def __init__(self, name: str, client: Any, decay_seconds: float = 10.0):
+        self.name = name
+        self.client = client
+        self.decay_seconds = decay_seconds
+        self.outstanding = 0
+        self.ewma: Optional[float] = None  # peak-EWMA latency (seconds)
+        self._ewma_at = 0.0
+        self.cooldown_until = 0.0  # 429 / Retry-After
+        self.ejected_until = 0.0
+        self.ejections = 0
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.rate_limited = 0
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until and now >= self.ejected_until
+
+    def observe_latency(self, latency: float, now: float) -> None:
+        if self.ewma is None or latency > self.ewma:
+            # peak: 遅くなったら即座に反映し、速くなったら時間減衰でゆっくり戻す
+            self.ewma = latency
+        else:
+            w = math.exp(-(now - self._ewma_at) / self.decay_seconds)
+            self.ewma = self.ewma * w + latency * (1.0 - w)
+        self._ewma_at = now
+
+    def cost(self, strategy: str) -> float:
+        if strategy == LEAST_OUTSTANDING:
+            return float(self.outstanding)
+        # 未計測のメンバーは最優先で試す
+        return (self.ewma or 0.0) * (self.outstanding + 1)
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "available": self.available(now),
+            "outstanding": self.outstanding,
+            "ewma_latency": round(self.ewma, 3) if self.ewma is not None else None,
+            "cooldown_in": round(max(0.0, self.cooldown_until - now), 1),
+            "ejected_in": round(max(0.0, self.ejected_until - now), 1),
+            "requests": self.requests,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+        }
+
+
+class UpstreamPool:
+    def __init__(
+        self,
+        members: Sequence[UpstreamMember],
+        strategy: Optional[str] = None,
+        eject_after: Optional[int] = None,
+        eject_seconds: Optional[float] = None,
+        max_eject_seconds: float = 300.0,
+        default_retry_after: Optional[float] = None,
+    ):
+        if not members:
+            raise ValueError("upstream pool needs at least one member")
+        env = os.environ.get
+        self.members: List[UpstreamMember] = list(members)
+        self.strategy = strategy or env("UPSTREAM_STRATEGY", PEAK_EWMA)
+        if self.strategy not in (PEAK_EWMA, LEAST_OUTSTANDING):
+            raise ValueError(f"unknown UPSTREAM_STRATEGY: {self.strategy}")
+        self.eject_after = eject_after if eject_after is not None else int(env("UPSTREAM_EJECT_AFTER", "3"))
+        self.eject_seconds = eject_seconds if eject_seconds is not None else float(env("UPSTREAM_EJECT_SECONDS", "30"))
+        self.max_eject_seconds = max_eject_seconds
+        self.default_retry_after = (
+            default_retry_after if default_retry_after is not None else float(env("UPSTREAM_RETRY_AFTER", "10"))
+        )
+        self._lock = threading.Lock()
+
+    # ---- construction ----
+    @classmethod
+    def from_env(cls, client_factory: Callable[..., Any]) -> "UpstreamPool":
+        """
+        Build members from UPSTREAM_ENDPOINTS / GEMINI_API_KEYS.
+        client_factory(api_key=, base_url=, model=) creates one model client
+        (None means the factory's own default).
+        """
+        decay = float(os.environ.get("UPSTREAM_EWMA_DECAY", "10"))
+        members: List[UpstreamMember] = []
+        endpoints = os.environ.get("UPSTREAM_ENDPOINTS", "").strip()
+        keys = [k.strip() for k in os.environ.get("GEMINI_API_KEYS", "").split(",") if k.strip()]
+        if endpoints:
+            for i, ep in enumerate(json.loads(endpoints)):
+                api_key = ep.get("api_key") or (os.environ.get(ep["api_key_env"]) if ep.get("api_key_env") else None)
+                client = client_factory(api_key=api_key, base_url=ep.get("base_url"), model=ep.get("model"))
+                members.append(UpstreamMember(ep.get("name") or f"endpoint-{i}", client, decay))
+        elif keys:
+            for key in keys:
+                # キーそのものは出さず末尾だけで識別
+                members.append(UpstreamMember(f"key-…{key[-4:]}", client_factory(api_key=key), decay))
+        else:
+            members.append(UpstreamMember("default", client_factory(), decay))
+        return cls(members)
+
+    # ---- selection / bookkeeping ----
+    def _select(self, exclude: Sequence[UpstreamMember] = ()) -> UpstreamMember:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [m for m in self.members if m.available(now) and m not in exclude]
+            if not candidates:
+                waits = [max(m.cooldown_until, m.ejected_until) - now for m in self.members]
+                raise PoolExhaustedError(max(0.0, min(waits)))
+            best = min(m.cost(self.strategy) for m in candidates)
+            member = random.choice([m for m in candidates if m.cost(self.strategy) == best])
+            member.outstanding += 1
+            member.requests += 1
+            return member
+
+    def _success(self, member: UpstreamMember, latency: float) -> None:
+        with self._lock:
+            member.outstanding -= 1
+            member.consecutive_failures = 0
+            member.ejections = 0
+            member.observe_latency(latency, time.monotonic())
+
+    def _failure(self, member: UpstreamMember, error: Optional[BaseException], latency: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            member.outstanding -= 1
+            if error is None:
+                return  # キャンセルはメンバーの健全性とは無関係
+            member.failures += 1
+            if is_rate_limited(error):
+                member.rate_limited += 1
+                member.cooldown_until = now + retry_after_seconds(error, self.default_retry_after)
+                print(f"Upstream {member.name} rate limited for {member.cooldown_until - now:.0f}s")
+                return
+            member.observe_latency(latency, now)
+            member.consecutive_failures += 1
+            if member.consecutive_failures >= self.eject_after:
+                duration = min(self.max_eject_seconds, self.eject_seconds * (2 ** member.ejections))
+                member.ejections += 1
+                member.consecutive_failures = 0
+                member.ejected_until = now + duration
+                print(f"Upstream {member.name} ejected for {duration:.0f}s: {error}")
+
+    # ---- model client interface ----
+    @property
+    def model_info(self) -> Any:
+        """Capabilities of the members' model (agents check them; every member serves the same family)."""
+        return self.members[0].client.model_info
+
+    async def create(self, messages, **kwargs) -> Any:
+        tried: List[UpstreamMember] = []
+        while True:
+            member = self._select(tried)
+            tried.append(member)
+            start = time.monotonic()
+            try:
+                result = await member.client.create(messages=messages, **kwargs)
+            except asyncio.CancelledError:
+                self._failure(member, None, 0.0)
+                raise
+            except Exception as e:
+                self._failure(member, e, time.monotonic() - start)
+                # 429 は別メンバーで即再試行（全員試したら諦める）
+                if is_rate_limited(e) and len(tried) < len(self.members):
+                    continue
+                raise
+            self._success(member, time.monotonic() - start)
+            return result
+
+    async def create_stream(self, messages, **kwargs) -> AsyncIterator[Any]:
+        tried: List[UpstreamMember] = []
+        while True:
+            member = self._select(tried)
+            tried.append(member)
+            start = time.monotonic()
+            first_chunk: Optional[float] = None
+            try:
+                async for chunk in member.client.create_stream(messages=messages, **kwargs):
+                    if first_chunk is None:
+                        first_chunk = time.monotonic() - start
+                    yield chunk
+            except Exception as e:
+                self._failure(member, e, time.monotonic() - start)
+                # まだ何も返していなければ 429 は別メンバーで再試行できる
+                if first_chunk is None and is_rate_limited(e) and len(tried) < len(self.members):
+                    continue
+                raise
+            except BaseException:
+                self._failure(member, None, 0.0)
+                raise
+            # ストリームは最初のチャンクまでの時間で比較する
+            self._success(member, first_chunk if first_chunk is not None else time.monotonic() - start)
+            return
+
+    async def warmup(self, connect: Callable[[Any], Awaitable[Any]], timeout: float = 10.0) -> Dict[str, Any]:
+        """
+        Open every member's connection ahead of the first request (DNS, TLS, HTTP/2).
+        connect(client) makes one cheap call; failures are reported, not raised.
+        """
+        async def warm(member: UpstreamMember):
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(connect(member.client), timeout)
+                return member.name, {"ok": True, "seconds": round(time.monotonic() - start, 3)}
+            except Exception as e:
+                return member.name, {"ok": False, "error": str(e)[:200] or type(e).__name__}
+
+        return dict(await asyncio.gather(*(warm(m) for m in self.members)))
+
+    async def close(self) -> None:
+        for member in self.members:
+            try:
+                await member.client.close()
+            except Exception:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "strategy": self.strategy,
+                "members": [m.stats(now) for m in self.members],
+                "available": sum(1 for m in self.members if m.available(now)),
+            }
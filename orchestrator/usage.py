@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+LLM 呼び出しごとのトークン使用量とコストの集計。
+
+- _chat / _chat_stream が上流の RequestUsage（prompt / completion tokens）を記録
+- 「どの用途（classify / answer / synthesis …）で、どのエージェントが、どのクライアントのために」
+  使ったかは contextvars で呼び出し元から引き継ぐ（asyncio.gather の並行タスクにも伝播）
+- リクエスト単位の内訳は /api/ask のレスポンス（usage）に、
+  エージェント/用途別の累計は /metrics に出す
+- メモリ上で「時間バケット × エージェント × クライアント × 用途」ごとに集計し、
+  USAGE_FLUSH_INTERVAL 秒ごとに SQLite（data/usage.sqlite3）へ加算で書き出す
+  （書き出しは別スレッドで行い、record() を呼ぶイベントループは SQLite を待たない）
+- /api/usage は ADMIN_TOKEN で保護（クライアント別の集計には IP が含まれるため）
+- 上流のプロンプトキャッシュに乗った入力トークン（cached_tokens、prompt_cache.py）は
+  内数として記録し、割引単価（USAGE_PRICE_CACHED_INPUT_PER_MTOK）でコストを計算
+"""
+
+import os
+import time
+import atexit
+import sqlite3
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Awaitable, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "usage.sqlite3")
+
+# 100 万トークンあたりの単価（USD）。既定値は gemini-2.5-flash の公開価格
+PRICE_INPUT_PER_MTOK = float(os.environ.get("USAGE_PRICE_INPUT_PER_MTOK", "0.30"))
+PRICE_OUTPUT_PER_MTOK = float(os.environ.get("USAGE_PRICE_OUTPUT_PER_MTOK", "2.50"))
+PRICE_CACHED_INPUT_PER_MTOK = float(os.environ.get("USAGE_PRICE_CACHED_INPUT_PER_MTOK", "0.03"))
+
+
+def cost_usd(prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+    """cached_tokens are part of prompt_tokens (billed at the cached-input price)."""
+    cached = min(cached_tokens, prompt_tokens)
+    return ((prompt_tokens - cached) * PRICE_INPUT_PER_MTOK + cached * PRICE_CACHED_INPUT_PER_MTOK
+            + completion_tokens * PRICE_OUTPUT_PER_MTOK) / 1_000_000
+
+
+class RequestUsage:
+    """Usage of every upstream call made while serving one request."""
+
+    def __init__(self):
+        self.calls: List[Dict[str, Any]] = []
+
+    def add(self, purpose: str, agent: str, prompt_tokens: int, completion_tokens: int,
+            cached_tokens: int = 0) -> None:
+        self.calls.append({
+            "purpose": purpose,
+            "agent": agent,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+        })
+
+    @property
+    def prompt_tokens(self) -> int:
+        return sum(c["prompt_tokens"] for c in self.calls)
+
+    @property
+    def completion_tokens(self) -> int:
+        return sum(c["completion_tokens"] for c in self.calls)
+
+    @property
+    def cached_tokens(self) -> int:
+        return sum(c["cached_tokens"] for c in self.calls)
+
+    def completion_tokens_for(self, purpose: str) -> int:
+        return sum(c["completion_tokens"] for c in self.calls if c["purpose"] == purpose)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "cost_usd": round(cost_usd(self.prompt_tokens, self.completion_tokens, self.cached_tokens), 6),
+            "calls": list(self.calls),
+        }
+
+
+_client: contextvars.ContextVar[str] = contextvars.ContextVar("usage_client", default="-")
+_scope: contextvars.ContextVar[Tuple[str, str]] = contextvars.ContextVar("usage_scope", default=("other", "none"))
+_request: contextvars.ContextVar[Optional[RequestUsage]] = contextvars.ContextVar("usage_request", default=None)
+
+
+@contextmanager
+def usage_scope(purpose: str, agent: str = "none") -> Iterator[None]:
+    """Attribute upstream calls made inside the block to (purpose, agent)."""
+    token = _scope.set((purpose, agent))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def current_scope() -> Tuple[str, str]:
+    """(purpose, agent) that upstream calls are currently attributed to."""
+    return _scope.get()
+
+
+def start_request() -> RequestUsage:
+    """Begin collecting per-request usage in the current context."""
+    usage = RequestUsage()
+    _request.set(usage)
+    return usage
+
+
+async def attributed(coro: Awaitable[Any], client_id: str) -> Any:
+    """Run coro with usage attributed to client_id (context does not cross threads by itself)."""
+    _client.set(client_id)
+    return await coro
+
+
+class UsageLedger:
+    def __init__(self, path: Optional[str] = None, bucket_seconds: Optional[float] = None,
+                 flush_interval: Optional[float] = None):
+        env = os.environ.get
+        self.path = path or env("USAGE_DB", DEFAULT_DB_PATH)
+        self.bucket_seconds = bucket_seconds if bucket_seconds is not None else float(env("USAGE_BUCKET_SECONDS", "300"))
+        self.flush_interval = flush_interval if flush_interval is not None else float(env("USAGE_FLUSH_INTERVAL", "30"))
+        self._lock = threading.Lock()
+        # (bucket, agent, client, purpose) -> [calls, prompt, completion, cached]  未書き出し分
+        self._pending: Dict[Tuple[float, str, str, str], List[int]] = {}
+        # プロセス起動からの累計（/metrics 用）: (agent, purpose) -> [calls, prompt, completion]
+        self.totals: Dict[Tuple[str, str], List[int]] = {}
+        # 同じくキャッシュに乗った入力トークン（prompt の内数）
+        self.cached_totals: Dict[Tuple[str, str], int] = {}
+        self._last_flush = time.monotonic()
+        self._flushing = False
+        self._schema_ready = False
+
+    def record(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> None:
+        purpose, agent = _scope.get()
+        client = _client.get()
+        request = _request.get()
+        if request is not None:
+            request.add(purpose, agent, prompt_tokens, completion_tokens, cached_tokens)
+        bucket = time.time() // self.bucket_seconds * self.bucket_seconds
+        with self._lock:
+            row = self._pending.setdefault((bucket, agent, client, purpose), [0, 0, 0, 0])
+            total = self.totals.setdefault((agent, purpose), [0, 0, 0])
+            for counts in (row, total):
+                counts[0] += 1
+                counts[1] += prompt_tokens
+                counts[2] += completion_tokens
+            row[3] += cached_tokens
+            self.cached_totals[(agent, purpose)] = self.cached_totals.get((agent, purpose), 0) + cached_tokens
+            due = not self._flushing and time.monotonic() - self._last_flush >= self.flush_interval
+            if due:
+                self._flushing = True
+        if due:
+            threading.Thread(target=self._background_flush, name="usage-flush", daemon=True).start()
+
+    def _background_flush(self) -> None:
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._flushing = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if not self._schema_ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        if not self._schema_ready:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "bucket REAL NOT NULL, agent TEXT NOT NULL, client TEXT NOT NULL, purpose TEXT NOT NULL, "
+                "calls INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, "
+                "cached_tokens INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (bucket, agent, client, purpose))"
+            )
+            # cached_tokens 追加前に作られたストア
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(usage)")}
+            if "cached_tokens" not in columns:
+                conn.execute("ALTER TABLE usage ADD COLUMN cached_tokens INTEGER NOT NULL DEFAULT 0")
+            self._schema_ready = True
+        return conn
+
+    def flush(self) -> int:
+        """Add pending aggregates to the SQLite store (safe to call from any worker)."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO usage (bucket, agent, client, purpose, calls, prompt_tokens, "
+                        "completion_tokens, cached_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(bucket, agent, client, purpose) DO UPDATE SET "
+                        "calls = calls + excluded.calls, "
+                        "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                        "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                        "cached_tokens = cached_tokens + excluded.cached_tokens",
+                        [(*key, *counts) for key, counts in pending.items()],
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            # 書き出しに失敗したら次回に持ち越す
+            print(f"Usage flush failed: {e}")
+            with self._lock:
+                for key, counts in pending.items():
+                    row = self._pending.setdefault(key, [0, 0, 0, 0])
+                    for i, value in enumerate(counts):
+                        row[i] += value
+            return 0
+        return len(pending)
+
+    def summary(self, since: float = 0.0, group_by: str = "agent") -> List[Dict[str, Any]]:
+        """Stored usage since `since` (epoch seconds) grouped by agent / client / purpose."""
+        if group_by not in ("agent", "client", "purpose"):
+            raise ValueError("group_by must be agent, client or purpose")
+        self.flush()
+        if not os.path.exists(self.path):
+            return []
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT {group_by}, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens) "
+                f"FROM usage "
+                f"WHERE bucket >= ? GROUP BY {group_by} ORDER BY SUM(prompt_tokens + completion_tokens) DESC",
+                (since // self.bucket_seconds * self.bucket_seconds,),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [
+            {
+                group_by: key,
+                "calls": calls,
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "cached_tokens": cached,
+                "cost_usd": round(cost_usd(prompt, completion, cached), 6),
+            }
+            for key, calls, prompt, completion, cached in rows
+        ]
+
+    def cached_summary(self) -> Tuple[int, int]:
+        """(prompt tokens, cached prompt tokens) sent by this process so far."""
+        with self._lock:
+            return sum(c[1] for c in self.totals.values()), sum(self.cached_totals.values())
+
+    def metrics_text(self) -> str:
+        """Prometheus exposition of this process's totals per agent and purpose."""
+        with self._lock:
+            totals = {key: list(v) + [self.cached_totals.get(key, 0)] for key, v in self.totals.items()}
+        if not totals:
+            return ""
+        lines = []
+        for name, index, help_text in (
+            ("llm_calls_total", 0, "Upstream LLM calls."),
+            ("llm_prompt_tokens_total", 1, "Prompt tokens sent upstream."),
+            ("llm_completion_tokens_total", 2, "Completion tokens generated upstream."),
+            ("llm_cached_prompt_tokens_total", 3, "Prompt tokens served from the upstream prompt cache."),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (agent, purpose), counts in sorted(totals.items()):
+                lines.append(f'{name}{{agent="{agent}",purpose="{purpose}"}} {counts[index]}')
+        cost = sum(cost_usd(c[1], c[2], c[3]) for c in totals.values())
+        lines += [
+            "# HELP llm_cost_usd_total Estimated upstream cost in USD.",
+            "# TYPE llm_cost_usd_total counter",
+            f"llm_cost_usd_total {cost:.6f}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+_ledger: Optional[UsageLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger() -> UsageLedger:
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger()
+            atexit.register(_ledger.flush)
+        return _ledger
+
+
+def record_usage(usage: Any, cached_tokens: int = 0) -> None:
+    """Record an autogen RequestUsage (or anything with prompt/completion_tokens)."""
+    if usage is None:
+        return
+    prompt = int(getattr(usage, "prompt_tokens", 0) or 0)
+    completion = int(getattr(usage, "completion_tokens", 0) or 0)
+    if prompt or completion:
+        get_usage_ledger().record(prompt, completion, min(cached_tokens, prompt) if prompt else cached_tokens)